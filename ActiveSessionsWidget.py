@@ -9,17 +9,22 @@ from tkinter import *
 from tkinter import ttk
 from PIL import ImageTk, Image
 
+import KeepTreeviewView
+import VirtualTreeview
+
 class ActiveSessionsWidget(object):
     """
     A class that handles the active-sessions GUI widget.
     The "View" in the MVC pattern.
     """
 
-    def __init__(self, parent):
+    def __init__(self, parent, virtual=False):
         """
         Constructs the GUI widget.
 
         :param parent: A Tk widget that acts as the parent to this widget.
+        :param virtual: If True, only the rows in view are created as Tk items
+                        (see VirtualTreeview).
         """
         # Determine where the source code is to be found
         # :NOTE: Refer to documentation of sys.path for why this works.
@@ -56,6 +61,8 @@ class ActiveSessionsWidget(object):
 
         # Create the TreeView component that will display the list of active sessions.
         self.active_sessions_tv = ttk.Treeview(self.active_sessions_frame)
+        if virtual:
+            self.active_sessions_tv = VirtualTreeview.VirtualTreeview(self.active_sessions_tv)
         self.active_sessions_tv.grid(column=0, columnspan=4, row=0, padx=4, pady=4, sticky=(N, S, E, W))
         self.active_sessions_tv["selectmode"] = "browse"
         self.active_sessions_tv["columns"] = ("Username", "Display #", "Display Name", "PID")
@@ -70,6 +77,15 @@ class ActiveSessionsWidget(object):
         self.active_sessions_tv.column(column="PID", anchor="e", minwidth=50, stretch=False, width=50)
         self.active_sessions_tv.heading(column="PID", text="PID")
 
+        # Configure the tags used by the child items that hold the less
+        # commonly used information, and create the child items only when
+        # an item is opened.
+        self.active_sessions_tv.tag_configure('geo_childitem', image=self.geometry_icon)
+        self.active_sessions_tv.tag_bind('geo_childitem', sequence="<<TreeviewSelect>>", callback=self.adjust_selection_to_parent)
+        self.active_sessions_tv.tag_configure('fmt_childitem', image=self.pixelformat_icon)
+        self.active_sessions_tv.tag_bind('fmt_childitem', sequence="<<TreeviewSelect>>", callback=self.adjust_selection_to_parent)
+        self.active_sessions_tv.bind(sequence="<<TreeviewOpen>>", func=self.handle_treeviewopen)
+
         # Add the refresh active-sessions button
         self.refresh_button_icon = Image.open(self.SRC_DIR+"/icons/squid-ink/Controls & Navigation/png_32/Refresh.png")
         self.refresh_button_icon = self.refresh_button_icon.resize((24, 24), Image.BICUBIC)
@@ -120,7 +136,11 @@ class ActiveSessionsWidget(object):
 
         # Treeview widgets don't give you a way to iterate over their items. You
         # must store references to the items, yourself. Which is stupid...but, oh well...
-        self.items_in_tv = []
+        # :NOTE: The rows are keyed by the PID of the session (as a string), which
+        #        maps to a (Treeview item, row values, detail values) tuple.
+        #        row_order holds the key of each row in display order.
+        self.items_in_tv = {}
+        self.row_order = []
 
         # Create H and V scroll bars to allow changing the view point of the listbox.
         self.log_vscroll = ttk.Scrollbar(self.active_sessions_frame, orient='vertical', command=self.active_sessions_tv.yview)
@@ -139,6 +159,11 @@ class ActiveSessionsWidget(object):
         self.server_ip_address = None
         self.server_port = None
 
+        # The version tag the server gave the entries in the Treeview, so that
+        # it can be asked for them again only if they have changed. None if
+        # the server didn't give one.
+        self.sessions_version = None
+
         # A list of method references to call when the refresh button is clicked.
         self.refresh_button_clicked_handlers = []
 
@@ -160,9 +185,11 @@ class ActiveSessionsWidget(object):
         Clears the TreeView of all items.
         """
         self.log.debug("Clearing TreeView")
-        for item in self.items_in_tv:
+        for item, values, details in self.items_in_tv.values():
             self.active_sessions_tv.delete(item)
         self.items_in_tv.clear()
+        self.row_order.clear()
+        self.sessions_version = None
 
 
     def insert(self, idx, username, display_number, display_name, pid, geometry, pixelformat):
@@ -185,36 +212,150 @@ class ActiveSessionsWidget(object):
                                                                          display_name,
                                                                          index))
         # Insert the commonly used information as a child of the root
+        values = (username, display_number, display_name, pid)
         new_item = self.active_sessions_tv.insert('',
                                                   index=index,
                                                   text='',
                                                   image=self.session_icon,
-                                                  values=(username, display_number, display_name, pid))
-        self.items_in_tv.append(new_item)
+                                                  values=values)
+        self.items_in_tv[str(pid)] = (new_item, values, (geometry, pixelformat))
+        self.row_order.insert(len(self.row_order) if idx == -1 else idx, str(pid))
 
-        # Insert the less commonly used information as a child of the item
+        # The less commonly used information goes in children of the item
         # inserted above so that it is not shown by default (the user will have
-        # to click the node to open it).
+        # to click the node to open it). Until then, a placeholder child stands
+        # in for them so that the node can be opened.
         self.active_sessions_tv.insert(new_item,
+                                       index='end',
+                                       text='')
+
+        return new_item
+
+
+    def upsert(self, idx, username, display_number, display_name, pid, geometry, pixelformat):
+        """
+        Adds a row for the session at the index, or updates its existing row
+        and moves it to the index. Nothing is done if the row is unchanged.
+
+        :param idx: The position the row should have among the top-level rows.
+        :param username:
+        :param display_number:
+        :param display_name:
+        :param pid: The PID of the session. This is the row key.
+        :param geometry:
+        :param pixelformat:
+        """
+        key = str(pid)
+        if key not in self.items_in_tv:
+            self.insert(idx, username, display_number, display_name, pid, geometry, pixelformat)
+            return
+
+        item, old_values, old_details = self.items_in_tv[key]
+        values = (username, display_number, display_name, pid)
+        details = (geometry, pixelformat)
+        if old_values != values:
+            self.log.debug("Updating item: {0}:{1}:{2}".format(username, display_number, display_name))
+            self.active_sessions_tv.item(item, values=values)
+        if old_details != details:
+            # :NOTE: If the item hasn't been opened, it only holds the
+            #        placeholder and there is nothing to update.
+            children = self.active_sessions_tv.get_children(item)
+            if len(children) == 2:
+                geo_child, fmt_child = children
+                self.active_sessions_tv.item(geo_child, values=(geometry))
+                self.active_sessions_tv.item(fmt_child, values=(pixelformat))
+        self.items_in_tv[key] = (item, values, details)
+
+        if self.row_order[idx] != key:
+            self.row_order.remove(key)
+            self.row_order.insert(idx, key)
+            self.active_sessions_tv.move(item, '', idx)
+
+
+    def remove(self, pid):
+        """
+        Removes the row for the session, if there is one.
+
+        :param pid: The PID of the session.
+        """
+        key = str(pid)
+        if key not in self.items_in_tv:
+            return
+        item, values, details = self.items_in_tv.pop(key)
+        self.log.debug("Removing item: {0}:{1}:{2}".format(*values))
+        self.row_order.remove(key)
+        self.active_sessions_tv.delete(item)
+
+
+    def reconcile(self, sessions):
+        """
+        Brings the rows in line with a complete list of sessions, inserting,
+        moving, updating or deleting only the rows that differ. The selection
+        and scroll position are kept.
+
+        :param sessions: A list of session dictionaries, as returned by the
+                         session-server, in the order they should be shown.
+        """
+        with KeepTreeviewView.KeepTreeviewView(self.active_sessions_tv):
+            wanted = set(str(session["pid"]) for session in sessions)
+            for key in [key for key in self.items_in_tv if key not in wanted]:
+                self.remove(key)
+            for idx, session in enumerate(sessions):
+                self.upsert(idx, **session)
+
+
+    def apply_event(self, event, session):
+        """
+        Updates the rows for a session that started or ended.
+
+        :param event: session_started, session_exited or session_killed.
+        :param session: The session dictionary, as returned by the session-server.
+        """
+        key = str(session["pid"])
+        if event == "session_started":
+            # New sessions go at the end, as they would in a full listing.
+            if key in self.row_order:
+                self.upsert(self.row_order.index(key), **session)
+            else:
+                self.upsert(len(self.row_order), **session)
+        else:
+            self.remove(key)
+
+
+    def handle_treeviewopen(self, e):
+        """
+        Replaces the placeholder child of the item being opened with the
+        child items holding the less commonly used information.
+
+        :param e: A TK event object
+        """
+        item = self.active_sessions_tv.focus()
+        if item == "" or self.active_sessions_tv.parent(item) != "":
+            return
+        children = self.active_sessions_tv.get_children(item)
+        if len(children) != 1:
+            # Already opened before.
+            return
+        key = str(self.active_sessions_tv.item(item)["values"][3])
+        geometry, pixelformat = self.items_in_tv[key][2]
+        self.active_sessions_tv.delete(*children)
+        self.active_sessions_tv.insert(item,
                                        index='end',
                                        text='',
                                        values=(geometry),
                                        tags='geo_childitem')
-        self.active_sessions_tv.insert(new_item,
+        self.active_sessions_tv.insert(item,
                                        index='end',
                                        text='',
                                        values=(pixelformat),
                                        tags='fmt_childitem')
 
-        self.active_sessions_tv.tag_configure('geo_childitem', image=self.geometry_icon)
-        self.active_sessions_tv.tag_bind('geo_childitem', sequence="<<TreeviewSelect>>", callback=self.adjust_selection_to_parent)
-        self.active_sessions_tv.tag_configure('fmt_childitem', image=self.pixelformat_icon)
-        self.active_sessions_tv.tag_bind('fmt_childitem', sequence="<<TreeviewSelect>>", callback=self.adjust_selection_to_parent)
-
 
     def adjust_selection_to_parent(self, e):
-        selected_item = e.widget.selection()
-        parent = e.widget.parent(selected_item)
+        selected_item = self.active_sessions_tv.selection()
+        if not selected_item:
+            return
+        parent = self.active_sessions_tv.parent(selected_item[0])
         if parent != "":
             # Select the parent item instead of it's child
             self.active_sessions_tv.selection_set(parent)
@@ -232,21 +373,12 @@ class ActiveSessionsWidget(object):
         self.log.debug("Retrieving list of display numbers in use...")
         # A list to return to the caller
         display_list = []
-        # Get the column names (note that Tk returns this as item 4
-        # in a weird 5-tuple structure)
-        cols = self.active_sessions_tv.configure("columns")[4]
-        # Determine which column index is holds the display number
-        display_number_idx = None
-        for idx, col in enumerate(cols):
-            if col.lower() == "display #":
-                display_number_idx = idx
-                break
         # Iterate over all the items in the TreeView
-        for item in self.items_in_tv:
-            # Get the value of each column of the item
-            item_vals = self.active_sessions_tv.item(item)["values"]
+        # :NOTE: The row values are kept alongside the items, so there is
+        #        no need to ask Tk for them.
+        for item, item_vals, details in self.items_in_tv.values():
             # Extract the display number and add it to the list of display numbers
-            display_list.append(item_vals[display_number_idx])
+            display_list.append(int(item_vals[1]))
         return display_list
 
 
@@ -292,6 +424,23 @@ class ActiveSessionsWidget(object):
         self.server_port = port
 
 
+    def set_sessions_version(self, version):
+        """
+        Records the version tag the server gave the entries in the Treeview.
+        :param version: The version tag, or None if the server didn't give one.
+        """
+        self.sessions_version = version
+
+
+    def get_sessions_version(self):
+        """
+        Retrieves the version tag the server gave the entries in the Treeview.
+
+        :return: The version tag, or None if there isn't one.
+        """
+        return self.sessions_version
+
+
     def get_server_info(self):
         """
         Retrieves the server information associated with the entries in
@@ -0,0 +1,338 @@
+import asyncio
+import concurrent.futures
+import logging
+
+import MortProtocol
+
+
+class AsyncSessionService(object):
+    """
+    A class that serves session-server requests from a single asyncio event
+    loop, as an alternative to a thread per connection.
+
+    Connections are accepted, read and written without blocking. The work
+    of carrying out a request (which forks ps, spawns VNC servers, etc.)
+    blocks, so it is handed to a bounded pool of worker threads. At most
+    max_connections connections are served at once; connections beyond that
+    are answered with a busy error and closed.
+
+    A request whose msg_type has a subscription handler turns its connection
+    over to messages pushed to the client, until the client closes it. A
+    subscribed connection is counted against max_subscriptions rather than
+    max_connections, and is sent a heartbeat message whenever it has had
+    nothing else for heartbeat_interval seconds.
+    """
+
+    def __init__(self, sock, handle_request, idle_timeout=30.0, max_connections=64, max_workers=4,
+                 subscription_handlers=None, max_subscriptions=16, heartbeat_interval=10.0, async_handlers=None):
+        """
+        Class constructor.
+
+        :param sock: The listening socket to accept connections on.
+        :param handle_request: A callable taking the request fields and the client's
+                               (ip address, port) tuple, and returning the response
+                               fields or None. Run on the worker threads. Framed
+                               requests it doesn't answer, or fails to carry out,
+                               are answered with an error response.
+        :param idle_timeout: Number of seconds a framed connection is kept open
+                             waiting for the next request.
+        :param max_connections: The most connections served at once.
+        :param max_workers: The number of worker threads carrying out requests.
+        :param subscription_handlers: A dictionary of the callables that subscribe a
+                                      client to pushed messages, by msg_type. Each
+                                      takes the request fields, the client's (ip
+                                      address, port) tuple and a thread-safe push
+                                      callable, and returns a (resp, cancel) tuple.
+                                      Run on the worker threads.
+        :param max_subscriptions: The most subscribed connections served at once.
+        :param heartbeat_interval: Number of seconds a subscribed connection may go
+                                   without a message before it is sent a heartbeat.
+        :param async_handlers: A dictionary of the coroutine functions that carry out
+                               requests on the event loop instead of handle_request,
+                               by msg_type. Each takes the same arguments as
+                               handle_request and returns the same. Used for requests
+                               that wait (e.g. for a start to finish), which would
+                               otherwise hold a worker thread. They must not block.
+        """
+        # Configure logging
+        self.log = logging.getLogger("AsyncSessionService")
+        self.log.debug("Starting up...")
+
+        self.sock = sock
+        self.handle_request = handle_request
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.subscription_handlers = subscription_handlers or {}
+        self.max_subscriptions = max_subscriptions
+        self.heartbeat_interval = heartbeat_interval
+        self.async_handlers = async_handlers or {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                              thread_name_prefix="session_worker")
+
+        # The number of connections being served, not counting the subscribed
+        # connections, and the number of subscribed connections.
+        self.connection_count = 0
+        self.subscription_count = 0
+
+
+    def run(self):
+        """
+        Serves connections until the process exits.
+        """
+        asyncio.run(self.serve())
+
+
+    async def serve(self):
+        """
+        Accepts connections on the listening socket and serves them.
+        """
+        server = await asyncio.start_server(self.handle_connection, sock=self.sock)
+        self.log.info("Starting service loop")
+        async with server:
+            await server.serve_forever()
+
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serves the requests a client sends on a connection until the client
+        closes it or stops sending them.
+
+        :param reader: The asyncio.StreamReader of the connection.
+        :param writer: The asyncio.StreamWriter of the connection.
+        """
+        remote_addr = writer.get_extra_info("peername")
+        if self.connection_count >= self.max_connections:
+            self.log.warning("Refusing connection from {0}:{1}."
+                             " Already serving {2} connections.".format(remote_addr[0],
+                                                                        remote_addr[1],
+                                                                        self.connection_count))
+            await self.refuse_connection(reader, writer)
+            return
+
+        self.connection_count += 1
+        self.log.info("Accepted connection from: {}".format(remote_addr))
+        try:
+            await self.serve_requests(reader, writer, remote_addr)
+        except (OSError, asyncio.TimeoutError) as ex:
+            msg = ("Could not exchange messages with client."
+                   " IP Address: {0}"
+                   " Port: {1}"
+                   " Error Msg: {2}".format(remote_addr[0],
+                                            remote_addr[1],
+                                            ex))
+            self.log.critical(msg)
+        except MortProtocol.ProtocolError as ex:
+            msg = ("Invalid message from {0}:{1}."
+                   " {2}."
+                   " Discarding".format(remote_addr[0],
+                                        remote_addr[1],
+                                        ex))
+            self.log.warning(msg)
+        finally:
+            self.connection_count -= 1
+            writer.close()
+
+
+    async def refuse_connection(self, reader, writer):
+        """
+        Answers the first request on a connection with a busy error, in the
+        protocol it was sent with, and closes the connection. Clients can
+        then tell a busy server from one that doesn't understand them.
+
+        :param reader: The asyncio.StreamReader of the connection.
+        :param writer: The asyncio.StreamWriter of the connection.
+        """
+        resp = MortProtocol.error_response(MortProtocol.BUSY)
+        try:
+            # :NOTE: Clients send their request as soon as they connect, so
+            #        a refused connection isn't held open for long.
+            data = await asyncio.wait_for(reader.read(16384), 1)
+            if not data:
+                return
+            if MortProtocol.is_framed(data):
+                messages = MortProtocol.FrameDecoder().feed(data)
+                version = messages[0][0] if messages else MortProtocol.PROTOCOL_VERSION
+                if messages and "request_id" in messages[0][1]:
+                    resp["request_id"] = messages[0][1]["request_id"]
+            else:
+                version = 0
+            writer.write(MortProtocol.encode_response(resp, version))
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError, MortProtocol.ProtocolError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def serve_requests(self, reader, writer, remote_addr):
+        """
+        Reads the request messages a client sends on a connection and answers
+        them in turn.
+
+        :param reader: The asyncio.StreamReader of the connection.
+        :param writer: The asyncio.StreamWriter of the connection.
+        :param remote_addr: The (ip address, port) tuple of the client.
+        """
+        decoder = MortProtocol.FrameDecoder()
+
+        data = await asyncio.wait_for(reader.read(16384), 5)
+        if not data:
+            return
+
+        if not MortProtocol.is_framed(data):
+            # :NOTE: Legacy clients send the whole (small) request in one go and
+            #        read the response until the connection is closed, so they
+            #        only get one request per connection.
+            msg_fields = MortProtocol.decode_legacy(data)
+            resp = await self.carry_out(msg_fields, remote_addr)
+            if resp is not None:
+                writer.write(MortProtocol.encode_response(resp, 0))
+                await writer.drain()
+            return
+
+        while True:
+            for version, msg_fields in decoder.feed(data):
+                handle_subscription = self.subscription_handlers.get(msg_fields.get("msg_type"))
+                if handle_subscription is not None:
+                    await self.serve_subscription(handle_subscription, reader, writer, remote_addr, msg_fields, version)
+                    return
+                # :NOTE: A framed client waits for a response to each request,
+                #        so every request gets one.
+                resp = await self.carry_out(msg_fields, remote_addr)
+                if resp is None:
+                    resp = MortProtocol.error_response("no response")
+                if "request_id" in msg_fields:
+                    resp["request_id"] = msg_fields["request_id"]
+                writer.write(MortProtocol.encode_response(resp, version))
+                await writer.drain()
+
+            # Wait for the rest of the frame, or the next request.
+            try:
+                data = await asyncio.wait_for(reader.read(max(decoder.pending() or 0, 16384)), self.idle_timeout)
+            except asyncio.TimeoutError:
+                if decoder.buffer:
+                    raise
+                self.log.debug("Connection from {} idle for {} seconds.".format(remote_addr, self.idle_timeout))
+                return
+            if not data:
+                if decoder.buffer:
+                    raise MortProtocol.ProtocolError("Connection closed part way through a request")
+                return
+
+
+    async def carry_out(self, msg_fields, remote_addr):
+        """
+        Carries out a request on a worker thread, or on the event loop if it
+        has an async handler.
+
+        :param msg_fields: A dictionary of the request message fields.
+        :param remote_addr: The (ip address, port) tuple of the client.
+        :return: A dictionary of the response fields, or None if there is no
+                 response. A request that fails gets an error response.
+        """
+        loop = asyncio.get_running_loop()
+        handle_async = self.async_handlers.get(msg_fields.get("msg_type"))
+        try:
+            if handle_async is not None:
+                return await handle_async(msg_fields, remote_addr)
+            return await loop.run_in_executor(self.executor, self.handle_request, msg_fields, remote_addr)
+        except Exception:
+            self.log.exception("Could not carry out a request from {0}:{1}".format(remote_addr[0], remote_addr[1]))
+            return MortProtocol.error_response("internal error")
+
+
+    async def serve_subscription(self, handle_subscription, reader, writer, remote_addr, msg_fields, version):
+        """
+        Subscribes a client to pushed messages and sends them to it until it
+        closes the connection.
+
+        :param handle_subscription: The subscription handler for the request.
+        :param reader: The asyncio.StreamReader of the connection.
+        :param writer: The asyncio.StreamWriter of the connection.
+        :param remote_addr: The (ip address, port) tuple of the client.
+        :param msg_fields: A dictionary of the request message fields.
+        :param version: The protocol version the client spoke.
+        """
+        if self.subscription_count >= self.max_subscriptions:
+            self.log.warning("Refusing subscription from {0}:{1}."
+                             " Already serving {2} subscriptions.".format(remote_addr[0],
+                                                                          remote_addr[1],
+                                                                          self.subscription_count))
+            resp = MortProtocol.error_response(MortProtocol.BUSY)
+            if "request_id" in msg_fields:
+                resp["request_id"] = msg_fields["request_id"]
+            writer.write(MortProtocol.encode_response(resp, version))
+            await writer.drain()
+            return
+
+        # :NOTE: A subscriber holds its connection for as long as it likes, so
+        #        it is counted against max_subscriptions instead, and can't
+        #        starve the clients sending requests of connections.
+        self.connection_count -= 1
+        self.subscription_count += 1
+        try:
+            await self.push_messages(handle_subscription, reader, writer, remote_addr, msg_fields, version)
+        finally:
+            self.subscription_count -= 1
+            self.connection_count += 1
+
+
+    async def push_messages(self, handle_subscription, reader, writer, remote_addr, msg_fields, version):
+        """
+        Subscribes a client to pushed messages and sends them to it, or a
+        heartbeat if there are none for heartbeat_interval seconds, until it
+        closes the connection.
+
+        :param handle_subscription: As for serve_subscription().
+        :param reader: As for serve_subscription().
+        :param writer: As for serve_subscription().
+        :param remote_addr: As for serve_subscription().
+        :param msg_fields: As for serve_subscription().
+        :param version: As for serve_subscription().
+        """
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue()
+
+        def push(fields):
+            loop.call_soon_threadsafe(messages.put_nowait, fields)
+
+        resp, cancel = await loop.run_in_executor(self.executor, handle_subscription, msg_fields, remote_addr, push)
+        closed = loop.create_task(self.wait_for_eof(reader))
+        message = None
+        try:
+            if "request_id" in msg_fields:
+                resp["request_id"] = msg_fields["request_id"]
+            writer.write(MortProtocol.encode_response(resp, version))
+            await writer.drain()
+            while True:
+                if message is None:
+                    message = loop.create_task(messages.get())
+                done, pending = await asyncio.wait({message, closed}, timeout=self.heartbeat_interval,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if closed in done:
+                    self.log.debug("Subscriber {} closed the connection.".format(remote_addr))
+                    return
+                if message in done:
+                    fields = message.result()
+                    message = None
+                else:
+                    fields = {"msg_type": MortProtocol.HEARTBEAT}
+                writer.write(MortProtocol.encode_response(fields, version))
+                # :NOTE: A subscriber that stops reading is dropped, rather
+                #        than the messages for it piling up.
+                await asyncio.wait_for(writer.drain(), self.idle_timeout)
+        finally:
+            cancel()
+            closed.cancel()
+            if message is not None:
+                message.cancel()
+
+
+    async def wait_for_eof(self, reader):
+        """
+        Reads and discards what a client sends until it closes the connection.
+
+        :param reader: The asyncio.StreamReader of the connection.
+        """
+        while await reader.read(16384):
+            pass
@@ -4,14 +4,24 @@ import sys
 import os
 import os.path
 import pwd
+import signal
 import subprocess
 import multiprocessing
 import logging
 import time
+import tempfile
+
+import VNCServerSpawner
 
 class CreateNewVNCServer(multiprocessing.Process):
 
     def __init__(self, name, username, display_number, display_name, geometry, pixelformat):
+        """
+        Class constructor.
+
+        What vncserver writes to stderr is sent back down a pipe once it
+        exits, for read_stderr(). The process exits with vncserver's exit code.
+        """
         super().__init__(name=name)
 
         log = logging.getLogger("CreateNewVNCServer")
@@ -22,6 +32,45 @@ class CreateNewVNCServer(multiprocessing.Process):
         self.display_name = display_name
         self.geometry = geometry
         self.pixelformat = pixelformat
+        self.result_reader, self.result_conn = multiprocessing.Pipe(duplex=False)
+
+
+    def start(self):
+        """
+        Starts the process, keeping only the receiving end of the pipe.
+        """
+        try:
+            super().start()
+        finally:
+            self.result_conn.close()
+
+
+    def read_stderr(self):
+        """
+        Reads what vncserver wrote to stderr, if it has been sent yet, and
+        closes the pipe.
+
+        :return: The text, or None.
+        """
+        try:
+            if self.result_reader.poll(1.0):
+                return self.result_reader.recv()
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.result_reader.close()
+        return None
+
+
+    def kill_process_group(self):
+        """
+        Kills this process, vncserver and the Xvnc it started, if they are
+        still running.
+        """
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
 
 
     def run(self):
@@ -31,6 +80,12 @@ class CreateNewVNCServer(multiprocessing.Process):
         # Get a new logger to use
         log = logging.getLogger("CreateNewVNCServer")
         log.info("Creating a VNC server for {}".format(self.username))
+        self.result_reader.close()
+
+        # Move to a session of our own, so the process group holds this
+        # process, vncserver and the Xvnc it starts, and nothing of the
+        # session-server, and kill_process_group() can kill them all.
+        os.setsid()
 
         # Get the current environment and modify it to represent the new user
         new_env = os.environ.copy()
@@ -47,34 +102,23 @@ class CreateNewVNCServer(multiprocessing.Process):
         os.chdir(pwd.getpwnam(self.username).pw_dir)
 
         # Build up the args to use in the call to vncserver
-        args = []
-        args.append("vncserver")
-        args.append(":{}".format(self.display_number))
-
-        if self.display_name is None or self.display_name == "":
-            # Use default display name created by vncserver
-            pass
-        else:
-            args.append("-name")
-            args.append(self.display_name)
-
-        if self.geometry is None or self.geometry == "":
-            # Use default geometry selected by vncserver
-            pass
-        else:
-            args.append("-geometry")
-            args.append(self.geometry)
-
-        if self.pixelformat is None or self.pixelformat == "":
-            # Use default pixelformat based on depth
-            pass
-        else:
-            args.append("-pixelformat")
-            args.append(self.pixelformat)
-
-
-        # Kick off the VNC server
-        subprocess.Popen(args, env=new_env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        args = VNCServerSpawner.vncserver_args(self.display_number,
+                                               self.display_name,
+                                               self.geometry,
+                                               self.pixelformat)
+
+        # Kick off the VNC server and wait for it to start Xvnc.
+        # :NOTE: stderr goes to a file rather than a pipe, as Xvnc inherits it
+        #        and keeps it open long after vncserver has exited.
+        with tempfile.TemporaryFile() as stderr_file:
+            try:
+                returncode = subprocess.call(args, env=new_env, stdout=subprocess.DEVNULL, stderr=stderr_file)
+            except OSError as ex:
+                stderr_file.write(str(ex).encode('utf8'))
+                returncode = 127
+            stderr_file.seek(0)
+            self.result_conn.send(stderr_file.read(65536).decode('utf8', 'replace'))
+        sys.exit(returncode)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,221 @@
+import os
+import re
+import threading
+import itertools
+import time
+import logging
+
+
+# The highest display number there can be, as Xvnc listens on TCP port
+# 5900 + display number.
+MAX_DISPLAY = 65535 - 5900
+
+
+class DisplayAllocator(object):
+    """
+    A class that decides which X display number each new session gets, so
+    that concurrent starts never pick the same one.
+
+    The displays in use are kept as a bitmap (an int with bit n set if
+    display n is in use), built from the Xvnc inventory, the X lock files
+    (/tmp/.X<n>-lock) and sockets (/tmp/.X11-unix/X<n>), the starts in
+    progress and the leases handed out. The lowest clear bit is the next
+    free display.
+
+    A client can lease the next free display for lease_time seconds (e.g.
+    while its user fills in a form), and then claim it when it starts the
+    session. Claiming a display reserves it for the start under the same
+    lock it was chosen under.
+    """
+
+    def __init__(self, session_inventory, reserved_displays, first_display=1, last_display=999,
+                 lease_time=60.0, tmp_dir="/tmp"):
+        """
+        Class constructor.
+
+        :param session_inventory: The SessionInventory of this host.
+        :param reserved_displays: A callable returning the set of display numbers
+                                  (strings) with starts in progress.
+        :param first_display: The lowest display number handed out.
+        :param last_display: The highest display number handed out.
+        :param lease_time: Number of seconds a leased display is held for.
+        :param tmp_dir: The directory X servers keep their lock files and
+                        socket directory in.
+        """
+        # Configure logging
+        self.log = logging.getLogger("DisplayAllocator")
+        self.log.debug("Starting up...")
+
+        self.session_inventory = session_inventory
+        self.reserved_displays = reserved_displays
+        self.first_display = first_display
+        self.last_display = last_display
+        self.lease_time = lease_time
+        self.tmp_dir = tmp_dir
+
+        # The leases handed out, by lease ID, as (display number, expiry time)
+        # tuples, and the lock that arbitrates access to them and serialises
+        # the choice of displays.
+        self.leases = {}
+        self.lock = threading.Lock()
+
+        # Unique lease IDs. The random prefix keeps a restarted server from
+        # reusing the IDs it handed out before.
+        self.lease_id_prefix = os.urandom(4).hex()
+        self.lease_ids = itertools.count()
+
+
+    def lease(self):
+        """
+        Holds the lowest free display for lease_time seconds.
+
+        :return: A (lease_id, display_number) tuple, with the display number as
+                 a string, or None if every display is in use.
+        """
+        with self.lock:
+            display_number = self.lowest_free(self.used_displays())
+            if display_number is None:
+                return None
+            lease_id = "{0}-{1}".format(self.lease_id_prefix, next(self.lease_ids))
+            self.leases[lease_id] = (display_number, time.monotonic() + self.lease_time)
+        self.log.debug("Leased display {0} as {1}".format(display_number, lease_id))
+        return lease_id, str(display_number)
+
+
+    def release(self, lease_id):
+        """
+        Gives up a lease before it expires.
+
+        :param lease_id: The ID of the lease.
+        """
+        with self.lock:
+            self.leases.pop(lease_id, None)
+
+
+    def claim(self, reserve, display_number=None, lease_id=None):
+        """
+        Picks a display for a new session and reserves it, all under the lock.
+
+        The display is, in order of preference: the one asked for, the one
+        leased, or the lowest free one. The lease, if any, is used up either
+        way.
+
+        :param reserve: A callable taking the display number, as a string, and
+                        returning the reservation, or None if it couldn't be made.
+        :param display_number: The display asked for, if any, as a string.
+        :param lease_id: The ID of the lease held for the start, if any.
+        :return: What reserve returned, or None if the display asked for is in
+                 use or there is no free display.
+        """
+        with self.lock:
+            lease = self.leases.pop(lease_id, None) if lease_id is not None else None
+            if lease is not None and lease[1] < time.monotonic():
+                lease = None
+            used = self.used_displays(include_files=display_number is None)
+
+            if display_number is not None:
+                # :NOTE: Leftover lock files and sockets don't count against a
+                #        display that is asked for by number; the caller cleans
+                #        them up.
+                try:
+                    chosen = int(display_number)
+                except ValueError:
+                    return None
+                if chosen < 0 or chosen > MAX_DISPLAY or used >> chosen & 1:
+                    return None
+            elif lease is not None:
+                chosen = lease[0]
+            else:
+                chosen = self.lowest_free(used)
+                if chosen is None:
+                    return None
+            return reserve(str(chosen))
+
+
+    def free_count(self):
+        """
+        Counts the displays between first_display and last_display that are
+        free. Used to report the capacity of the host, so the session list
+        may be up to max_staleness seconds old.
+
+        :return: The number of free displays.
+        """
+        with self.lock:
+            used = self.used_displays(max_age=None)
+        mask = (1 << (self.last_display + 1)) - (1 << self.first_display)
+        return bin(mask & ~used).count("1")
+
+
+    def used_displays(self, include_files=True, max_age=0):
+        """
+        Builds the bitmap of the displays in use. The lock must be held.
+        Expired leases are dropped along the way.
+
+        :param include_files: Whether displays with X lock files or sockets count
+                              as in use.
+        :param max_age: The oldest the session list may be, in seconds, or None
+                        for the inventory's max_staleness.
+        :return: An int with bit n set if display n is in use.
+        """
+        used = 0
+        now = time.monotonic()
+        for lease_id, (display_number, expires_at) in list(self.leases.items()):
+            if expires_at < now:
+                del self.leases[lease_id]
+            else:
+                used |= 1 << display_number
+
+        # :NOTE: A fresh list is used by default, as a stale one could miss a
+        #        session that was started moments ago.
+        display_numbers = [session["display_number"] for session in self.session_inventory.get(max_age=max_age)]
+        display_numbers += self.reserved_displays()
+        if include_files:
+            display_numbers += self.display_files()
+        for display_number in display_numbers:
+            try:
+                display_number = int(display_number)
+            except ValueError:
+                continue
+            if 0 <= display_number <= MAX_DISPLAY:
+                used |= 1 << display_number
+        return used
+
+
+    def lowest_free(self, used):
+        """
+        Finds the lowest display between first_display and last_display that
+        isn't in use.
+
+        :param used: The bitmap of the displays in use.
+        :return: The display number, or None if they are all in use.
+        """
+        mask = (1 << (self.last_display + 1)) - (1 << self.first_display)
+        free = mask & ~used
+        if not free:
+            return None
+        # The lowest set bit of free.
+        return (free & -free).bit_length() - 1
+
+
+    def display_files(self):
+        """
+        Lists the displays that have X lock files or sockets.
+
+        :return: A list of display numbers, as strings.
+        """
+        display_numbers = []
+        try:
+            for name in os.listdir(self.tmp_dir):
+                match = re.fullmatch(r"\.X(\d+)-lock", name)
+                if match is not None:
+                    display_numbers.append(match.group(1))
+        except OSError:
+            pass
+        try:
+            for name in os.listdir(os.path.join(self.tmp_dir, ".X11-unix")):
+                match = re.fullmatch(r"X(\d+)", name)
+                if match is not None:
+                    display_numbers.append(match.group(1))
+        except OSError:
+            pass
+        return display_numbers
@@ -0,0 +1,52 @@
+import os
+
+
+def load_per_cpu():
+    """
+    :return: The 1 minute load average divided by the number of CPUs.
+    """
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+def mem_available(meminfo_path="/proc/meminfo"):
+    """
+    Reads how much memory is available for new processes without swapping.
+
+    :param meminfo_path: The path of the meminfo file.
+    :return: The number of MiB available, or None if it can't be read.
+    """
+    try:
+        with open(meminfo_path, "rb") as f:
+            for line in f:
+                if line.startswith(b"MemAvailable:"):
+                    # The value is in kiB.
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def health_fields(session_count, free_displays, inventory_version, meminfo_path="/proc/meminfo"):
+    """
+    Gathers the health and capacity of this host as announce message fields.
+    Everything comes from /proc or the caller, so it is cheap to call once
+    per announce.
+
+    :param session_count: The number of Xvnc sessions running.
+    :param free_displays: The number of displays free for new sessions.
+    :param inventory_version: The version tag of the session inventory.
+    :param meminfo_path: The path of the meminfo file.
+    :return: A dictionary with the keys load_avg (the 1, 5 and 15 minute load
+             averages, comma separated), cpu_count, mem_available (MiB, if it
+             can be read), session_count, free_displays and inventory_version,
+             all as strings.
+    """
+    fields = {"load_avg": ",".join("{:.2f}".format(load) for load in os.getloadavg()),
+              "cpu_count": str(os.cpu_count() or 1),
+              "session_count": str(session_count),
+              "free_displays": str(free_displays),
+              "inventory_version": str(inventory_version)}
+    free_memory = mem_available(meminfo_path)
+    if free_memory is not None:
+        fields["mem_available"] = str(free_memory)
+    return fields
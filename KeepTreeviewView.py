@@ -0,0 +1,27 @@
+class KeepTreeviewView(object):
+    """
+    A context manager that notes the top-level row at the top of a Treeview's
+    view on entry and scrolls back to it on exit, so that rows added or
+    removed above it don't make the view jump.
+    """
+
+    def __init__(self, tv):
+        """
+        Class constructor.
+
+        :param tv: The ttk.Treeview whose view should be kept.
+        """
+        self.tv = tv
+        self.anchor = None
+
+    def __enter__(self):
+        children = self.tv.get_children('')
+        first = self.tv.yview()[0]
+        if children and first > 0:
+            self.anchor = children[min(int(round(first * len(children))), len(children) - 1)]
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.anchor is not None and self.tv.exists(self.anchor):
+            self.tv.yview_moveto(self.tv.index(self.anchor) / len(self.tv.get_children('')))
+        return False
@@ -1,8 +1,12 @@
+import sys
+import os.path
 import threading
 import socket
 import datetime
+import time
 import logging
 import select
+import configparser
 
 import SessionServerInfo
 
@@ -10,24 +14,40 @@ class LauncherAnnounceTask(threading.Thread):
     """
     A class that runs as a thread and handles receiving the server-announce
     messages that arrive
+
+    Each time the announce socket becomes readable, every datagram waiting
+    on it is read out and the whole batch is applied to the known_servers
+    list under a single acquisition of its lock.
     """
 
-    def __init__(self, known_servers, known_servers_cv):
+    def __init__(self, known_servers, known_servers_cv, port=42124):
         """
         Class constructor
 
-        :param known_servers: A Python list of SessionSeverInfo objects.
+        :param known_servers: A SessionServerList of SessionSeverInfo objects.
         :param known_servers_cv: A threading.Condition object used to arbitrate access to the known_servers
                                  list and to notify other threads that the known_servers list was updated.
+        :param port: The UDP port to watch for announce messages on.
         """
         # Give a name to this thread and make it a daemon so it
         # doesn't prevent the caller from exiting.
         super().__init__(name="announce_thread", daemon=True)
 
+        # Determine where the source code is to be found
+        # :NOTE: Refer to documentation of sys.path for why this works.
+        self.SRC_DIR = os.path.abspath(sys.path[0])
+
         # Configure logging
         self.log = logging.getLogger("LauncherAnnounceTask")
         self.log.debug("Starting up...")
 
+        # Load config information from the config file
+        # :NOTE: A receive_buffer_size of 0 leaves the OS default in place.
+        cfg = configparser.ConfigParser()
+        cfg.read(self.SRC_DIR+"/launcher.ini")
+        self.receive_buffer_size = cfg.getint("ANNOUNCE_TASK", "receive_buffer_size", fallback=0)
+        self.max_batch_size = cfg.getint("ANNOUNCE_TASK", "max_batch_size", fallback=1024)
+
         # Store up the instance data passed in for use later
         self.known_servers = known_servers
         self.known_servers_cv = known_servers_cv
@@ -37,10 +57,23 @@ class LauncherAnnounceTask(threading.Thread):
         self.announce_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.announce_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
 
+        # Size the receive buffer so that an announce storm can queue up in
+        # the kernel while a batch is being applied.
+        if self.receive_buffer_size > 0:
+            try:
+                self.announce_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size)
+            except OSError as ex:
+                msg = ("Unable to set announce socket receive buffer size."
+                       " Error No: {0}"
+                       " Error Msg: {1}".format(ex.errno, ex.strerror))
+                self.log.warning(msg)
+        self.log.debug("Announce socket receive buffer size: {}".format(self.announce_sock.getsockopt(socket.SOL_SOCKET,
+                                                                                                       socket.SO_RCVBUF)))
+
         # Setup the announce socket to watch for server announce messages.
         try:
             #self.announce_sock.bind(('<broadcast>', 42124))
-            self.announce_sock.bind(('0.0.0.0', 42124))
+            self.announce_sock.bind(('0.0.0.0', port))
         except OSError as ex:
             msg = ("Unable to create broadcast socket."
                    " Error No: {0}"
@@ -48,6 +81,10 @@ class LauncherAnnounceTask(threading.Thread):
             self.log.critical(msg)
             raise
 
+        # The socket is drained with non-blocking reads after select()
+        # reports it is readable.
+        self.announce_sock.setblocking(False)
+
 
     def run(self):
         """
@@ -56,83 +93,158 @@ class LauncherAnnounceTask(threading.Thread):
         that displays the known session-servers on the GUI.
         """
         while True:
-            # Wait for data to arrive on the announce_sock objectx
-            self.announce_sock.settimeout(None)
+            # Wait for data to arrive on the announce_sock object
+            # :NOTE: Since the announce_sock is the ONLY item in the call to select below,
+            #        if select returns, we know it's because the announce_sock
+            #        had data to read.
             robj, wobj, xobj = select.select([self.announce_sock], [], [])
 
-            # Read the packet from the socket.
-            # :NOTE: Since the announce_sock is the ONLY item in the call to select above,
-            #        if we get to this point, we know it's because the announce_sock
-            #        had data to read.
+            # Read out every message waiting on the socket.
+            batch = self.drain_socket()
+            if not batch:
+                continue
+
+            # Parse the messages. Only the latest announce from each
+            # session-server in the batch needs to be applied.
+            announces = {}
+            for msg, remote_addr in batch:
+                msg_fields = self.parse_announce(msg, remote_addr)
+                if msg_fields is not None:
+                    announces[msg_fields["ip_address"]] = msg_fields
+
+            self.apply_announces(announces.values())
+
+
+    def drain_socket(self):
+        """
+        Reads messages from the announce socket until it would block, or
+        max_batch_size messages have been read.
+
+        :return: A list of (msg, remote_addr) tuples.
+        """
+        batch = []
+        while len(batch) < self.max_batch_size:
             try:
-                self.announce_sock.settimeout(5)
                 msg, remote_addr = self.announce_sock.recvfrom(4096)
-                msg = msg.decode('utf8')
+            except BlockingIOError:
+                # EAGAIN; the socket is empty.
+                break
             except OSError as ex:
                 msg = ("Unable to read message from socket."
                        " Error No: {0}"
                        " Error Msg: {1}".format(ex.errno, ex.strerror))
                 self.log.critical(msg)
-                continue
+                break
+            batch.append((msg, remote_addr))
+        self.log.debug("Read {} announce messages".format(len(batch)))
+        return batch
 
-            # Break the message down into its key/value pairs
-            msg_lines = msg.splitlines()
-            msg_fields = {}
-            for msg_line in msg_lines:
-                msg_field = msg_line.split(':')
-                msg_fields[msg_field[0]] = msg_field[1]
 
-            # Check for the correct message type. If this isn't a server-announce
-            # message then discard it and move on.
-            # :WARN: Must obtain the lock on the known_server variable before
-            #        interacting with it.
-            if "msg_type" in msg_fields.keys():
-                if msg_fields["msg_type"] == "session_server_announce":
-                    with self.known_servers_cv:
-                        known_servers_list_updated = False
-                        for known_server in self.known_servers:
-                            if known_server.ip_address == msg_fields["ip_address"]:
-                                # We've seen this server before. Update its information in
-                                # case it has changed
-                                if known_server.hostname != msg_fields["hostname"]:
-                                    known_server.hostname = msg_fields["hostname"]
-                                    known_servers_list_updated = True
-
-                                if known_server.port != int(msg_fields["port"]):
-                                    known_server.port = int(msg_fields["port"])
-                                    known_servers_list_updated = True
-
-                                known_server.last_seen = datetime.datetime.now()
-                                break
-                        else:
-                            # Server is new so add it to the known_servers list.
-                            new_server = SessionServerInfo.SessionServerInfo(msg_fields["hostname"],
-                                                                             msg_fields["ip_address"],
-                                                                             int(msg_fields["port"]),
-                                                                             datetime.datetime.now())
-                            self.known_servers.append(new_server)
-                            self.log.info("Added host: {0} ({1}:{2})".format(new_server.hostname,
-                                                                             new_server.ip_address,
-                                                                             new_server.port))
-                            known_servers_list_updated = True
-
-                        # If changes were made to the known_servers list, notify watchers.
-                        if known_servers_list_updated:
-                            self.known_servers_cv.notify_all()
+    def parse_announce(self, msg, remote_addr):
+        """
+        Breaks a session-server announce message down into its key/value pairs.
 
-                else:
-                    # Discard message; not a "session_server_announce" message
+        :param msg: The bytes of the message.
+        :param remote_addr: The (ip address, port) tuple the message came from.
+        :return: A dictionary of the message fields, or None if the message should be discarded.
+        """
+        try:
+            msg = msg.decode('utf8')
+        except UnicodeDecodeError:
+            self.log.warning("Undecodable session server announce message from {0}:{1}."
+                             " Discarding".format(remote_addr[0],
+                                                  remote_addr[1]))
+            return None
+
+        # Break the message down into its key/value pairs
+        msg_lines = msg.splitlines()
+        msg_fields = {}
+        for msg_line in msg_lines:
+            msg_field = msg_line.split(':', 1)
+            if len(msg_field) == 2:
+                msg_fields[msg_field[0]] = msg_field[1]
+
+        # Check for the correct message type. If this isn't a server-announce
+        # message then discard it and move on.
+        if "msg_type" in msg_fields.keys():
+            if msg_fields["msg_type"] == "session_server_announce":
+                try:
+                    if "hostname" not in msg_fields or "ip_address" not in msg_fields:
+                        raise KeyError
+                    msg_fields["port"] = int(msg_fields["port"])
+                except (KeyError, ValueError):
+                    # Discard message; a field is missing or malformed.
                     msg = ("Invalid session server announce message from {0}:{1}."
-                           " Invalid msg_type value."
+                           " Missing or invalid hostname, ip_address or port field."
                            " Discarding".format(remote_addr[0],
                                                 remote_addr[1]))
                     self.log.warning(msg)
+                    return None
+                # The health fields are optional, as older session-servers
+                # don't send them.
+                msg_fields["health"] = SessionServerInfo.ServerHealth.from_fields(msg_fields)
+                return msg_fields
+
             else:
-                # Discard message; no msg_type field found.
+                # Discard message; not a "session_server_announce" message
                 msg = ("Invalid session server announce message from {0}:{1}."
-                       " Missing msg_type field."
+                       " Invalid msg_type value."
                        " Discarding".format(remote_addr[0],
                                             remote_addr[1]))
                 self.log.warning(msg)
+        else:
+            # Discard message; no msg_type field found.
+            msg = ("Invalid session server announce message from {0}:{1}."
+                   " Missing msg_type field."
+                   " Discarding".format(remote_addr[0],
+                                        remote_addr[1]))
+            self.log.warning(msg)
+        return None
 
 
+    def apply_announces(self, announces):
+        """
+        Applies a batch of parsed announce messages to the known_servers list
+        and notifies watchers once if anything about the list changed.
+
+        :param announces: An iterable of announce message field dictionaries.
+        """
+        # Take the time once for the whole batch.
+        now = time.monotonic()
+        wall_now = datetime.datetime.now()
+
+        # :WARN: Must obtain the lock on the known_server variable before
+        #        interacting with it.
+        with self.known_servers_cv:
+            known_servers_list_updated = False
+            for msg_fields in announces:
+                known_server = self.known_servers.get_by_ip(msg_fields["ip_address"])
+                if known_server is not None:
+                    # We've seen this server before. Update its information in
+                    # case it has changed
+                    # :NOTE: The hostname is the sort key of the list so let the
+                    #        list move the server to its new spot.
+                    if self.known_servers.update(known_server,
+                                                 hostname=msg_fields["hostname"],
+                                                 port=msg_fields["port"],
+                                                 health=msg_fields["health"]):
+                        known_servers_list_updated = True
+
+                    known_server.heard(now, wall_now)
+                else:
+                    # Server is new so add it to the known_servers list.
+                    new_server = SessionServerInfo.SessionServerInfo(msg_fields["hostname"],
+                                                                     msg_fields["ip_address"],
+                                                                     msg_fields["port"],
+                                                                     wall_now,
+                                                                     now)
+                    new_server.health = msg_fields["health"]
+                    self.known_servers.append(new_server)
+                    self.log.info("Added host: {0} ({1}:{2})".format(new_server.hostname,
+                                                                     new_server.ip_address,
+                                                                     new_server.port))
+                    known_servers_list_updated = True
+
+            # If changes were made to the known_servers list, notify watchers.
+            if known_servers_list_updated:
+                self.known_servers_cv.notify_all()
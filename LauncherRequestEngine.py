@@ -0,0 +1,781 @@
+import threading
+import asyncio
+import itertools
+import json
+import logging
+
+import MortProtocol
+
+
+# The requests that do no harm if a server carries them out twice, so may be
+# sent again if the connection they were sent on turns out to be closed.
+IDEMPOTENT_MSG_TYPES = frozenset(["ping",
+                                  "get_active_sessions",
+                                  "get_start_job",
+                                  "release_display"])
+
+
+def is_idempotent(fields):
+    """
+    Returns True if a request does no harm if carried out twice. A batch is
+    if all of its operations are.
+
+    :param fields: A dictionary of the request message fields.
+    """
+    if fields.get("msg_type") == "batch":
+        try:
+            return all(is_idempotent(operation) for operation in json.loads(fields["operations"]))
+        except (KeyError, ValueError, TypeError, AttributeError):
+            return False
+    return fields.get("msg_type") in IDEMPOTENT_MSG_TYPES
+
+
+class LauncherRequestEngine(object):
+    """
+    A class that sends requests to session-servers from an asyncio event
+    loop running on a background thread, so that the thread submitting a
+    request (e.g. the Tk main loop) never blocks on the network.
+
+    submit() returns a concurrent.futures.Future that resolves to the
+    fields of the server's response, or raises asyncio.TimeoutError, OSError
+    (MortProtocol.ServerBusyError if the server turned the connection away,
+    MortProtocol.ConnectionClosedError if it closed the connection before
+    answering) or MortProtocol.ProtocolError if the exchange failed.
+    Requests may be cancelled through their future, and a request submitted
+    with a key cancels any request with the same key that is still in
+    flight (e.g. an older refresh of the same widget).
+
+    The first time a server is talked to, it is pinged with a framed
+    message to find out which protocol it speaks. A request is never sent
+    a second time in another protocol, as it may already have been carried
+    out. The protocol is found out again after a failed exchange, in case
+    the server has since been upgraded or downgraded.
+
+    Connections to servers that speak the framed protocol are kept open
+    after a request and pooled per server, so back-to-back requests to the
+    same server skip the connection setup. Only idempotent requests are
+    sent on pooled connections, as one may turn out to have been closed
+    with no way to tell whether the server carried out the request. Idle connections are dropped
+    after pool_idle_timeout, and pinged every health_check_interval so that
+    dead ones are found before a request is sent on them.
+
+    subscribe() opens a connection of its own on which the server pushes
+    messages (e.g. session events) until either side closes it. Servers
+    send heartbeats on a quiet subscription, so one that sends nothing for
+    subscription_timeout is taken to be dead.
+    """
+
+    def __init__(self, ui_dispatcher=None, default_timeout=5.0, max_response_size=MortProtocol.MAX_FRAME_SIZE,
+                 pool_size=2, pool_idle_timeout=20.0, health_check_interval=10.0, subscription_timeout=30.0):
+        """
+        Class constructor.
+
+        :param ui_dispatcher: If given, the UIDispatcher that completion callbacks
+                              are posted to. Otherwise callbacks run on the
+                              engine's thread.
+        :param default_timeout: Number of seconds a request may take, from connecting
+                                to receiving the whole response, if no timeout is
+                                given when it is submitted.
+        :param max_response_size: The most bytes read back for a response.
+        :param pool_size: The most idle connections kept open to each server.
+        :param pool_idle_timeout: Number of seconds an unused connection is kept open.
+                                  Should be less than the server's idle timeout.
+        :param health_check_interval: Number of seconds between pings of the idle
+                                      connections.
+        :param subscription_timeout: Number of seconds a subscription may go without
+                                     a message (heartbeats included) before it fails.
+                                     Should be more than the server's heartbeat interval.
+        """
+        # Configure logging
+        self.log = logging.getLogger("LauncherRequestEngine")
+        self.log.debug("Starting up...")
+
+        self.ui_dispatcher = ui_dispatcher
+        self.default_timeout = default_timeout
+        self.max_response_size = max_response_size
+        self.subscription_timeout = subscription_timeout
+
+        # The protocol version spoken by each session-server, by (ip address,
+        # port), once it has been found out by protocol_version(). Only used
+        # from the event loop's thread.
+        self.protocol_versions = {}
+
+        # The idle connections to each session-server, by (ip address, port),
+        # as lists of (reader, writer, idle_since) tuples, the most recently
+        # used last. Only used from the event loop's thread.
+        self.pool_size = pool_size
+        self.pool_idle_timeout = pool_idle_timeout
+        self.health_check_interval = health_check_interval
+        self.idle_connections = {}
+
+        # A smoothed estimate of the round trip time to each session-server, in
+        # seconds, by (ip address, port), from probes and health check pings.
+        # Only written from the event loop's thread.
+        self.rtts = {}
+
+        # Unique IDs for the requests sent on pooled connections.
+        self.request_ids = itertools.count()
+
+        # The event loop the requests run on and the thread that runs it.
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.run_loop,
+                                            name="request_engine_thread",
+                                            daemon=True)
+
+        # The futures of keyed requests still in flight, and the lock that
+        # arbitrates access to them from different threads.
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+
+    def start(self):
+        """
+        Starts the thread running the event loop.
+        """
+        self.loop_thread.start()
+
+
+    def stop(self):
+        """
+        Cancels the requests in flight and stops the event loop.
+        """
+        with self.pending_lock:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+
+        # Let every other request unwind before closing the loop.
+        for connections in self.idle_connections.values():
+            for reader, writer, idle_since in connections:
+                writer.close()
+        self.idle_connections.clear()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(asyncio.wait(tasks))
+        self.loop.close()
+
+
+    def run_loop(self):
+        """
+        Runs the event loop until stop() is called. Runs as a seperate thread.
+        """
+        asyncio.set_event_loop(self.loop)
+        if self.health_check_interval > 0:
+            self.loop.create_task(self.health_check_task())
+        self.loop.run_forever()
+
+
+    def submit(self, ip_address, port, fields, callback=None, timeout=None, key=None):
+        """
+        Sends a request to a session-server without waiting for the response.
+        Safe to call from any thread.
+
+        :param ip_address: The IP address of the session-server.
+        :param port: The TCP port of the session-server.
+        :param fields: A dictionary of the request message fields.
+        :param callback: If given, called with the future once the request is done,
+                         failed or was cancelled.
+        :param timeout: Number of seconds the request may take. Defaults to default_timeout.
+        :param key: If given, any request submitted with the same key that is still
+                    in flight is cancelled.
+        :return: A concurrent.futures.Future for a dictionary of the response fields.
+        """
+        return self.schedule(self.request(ip_address, port, fields, timeout), callback, key)
+
+
+    def submit_pipelined(self, ip_address, port, requests, callback=None, timeout=None, key=None):
+        """
+        Sends several requests to a session-server on one connection without
+        waiting for each response in between. Safe to call from any thread.
+
+        :param ip_address: The IP address of the session-server.
+        :param port: The TCP port of the session-server.
+        :param requests: A list of dictionaries of request message fields.
+        :param callback: As for submit().
+        :param timeout: Number of seconds all of the requests may take. Defaults to
+                        default_timeout.
+        :param key: As for submit().
+        :return: A concurrent.futures.Future for a list of dictionaries of the
+                 response fields, in the same order as the requests.
+        """
+        return self.schedule(self.request_pipelined(ip_address, port, requests, timeout), callback, key)
+
+
+    def submit_batch(self, ip_address, port, operations, callback=None, timeout=None, key=None):
+        """
+        Sends a batch of operations to a session-server in one message. The
+        server carries them out in order. Safe to call from any thread.
+
+        :param ip_address: The IP address of the session-server.
+        :param port: The TCP port of the session-server.
+        :param operations: A list of dictionaries of request message fields.
+        :param callback: As for submit().
+        :param timeout: Number of seconds the batch may take. Defaults to default_timeout.
+        :param key: As for submit().
+        :return: A concurrent.futures.Future for a list of dictionaries of the
+                 response fields, in the same order as the operations. The entry
+                 for an operation the server didn't answer is None.
+        """
+        return self.schedule(self.request_batch(ip_address, port, operations, timeout), callback, key)
+
+
+    def subscribe(self, ip_address, port, fields, on_message, callback=None, key=None):
+        """
+        Sends a subscription request to a session-server and passes on each
+        message the server sends back, until the connection is closed. Safe
+        to call from any thread.
+
+        :param ip_address: The IP address of the session-server.
+        :param port: The TCP port of the session-server.
+        :param fields: A dictionary of the subscription request message fields.
+        :param on_message: Called with a dictionary of the fields of each message
+                           the server sends, the response to the request first.
+                           Heartbeats aren't passed on. Posted to the ui_dispatcher
+                           like callbacks.
+        :param callback: If given, called with the future once the subscription has
+                         ended, failed or was cancelled.
+        :param key: As for submit(). Cancelling the subscription closes its connection.
+        :return: A concurrent.futures.Future for the number of messages received.
+        """
+        return self.schedule(self.request_subscription(ip_address, port, fields, on_message), callback, key)
+
+
+    def probe(self, ip_address, port, callback=None, timeout=None):
+        """
+        Pings a session-server to measure the round trip time to it. Safe to
+        call from any thread.
+
+        :param ip_address: The IP address of the session-server.
+        :param port: The TCP port of the session-server.
+        :param callback: As for submit().
+        :param timeout: Number of seconds the ping may take. Defaults to default_timeout.
+        :return: A concurrent.futures.Future for the round trip time, in seconds.
+        """
+        return self.schedule(self.request_probe(ip_address, port, timeout), callback, None)
+
+
+    def schedule(self, coro, callback, key):
+        """
+        Runs a request coroutine on the event loop.
+
+        :param coro: The coroutine.
+        :param callback: As for submit().
+        :param key: As for submit().
+        :return: A concurrent.futures.Future for the coroutine's result.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+        if key is not None:
+            with self.pending_lock:
+                superseded = self.pending.get(key)
+                self.pending[key] = future
+            if superseded is not None:
+                self.log.debug("Cancelling superseded request: {}".format(key))
+                superseded.cancel()
+            future.add_done_callback(lambda f: self.forget(key, f))
+
+        if callback is not None:
+            if self.ui_dispatcher is None:
+                future.add_done_callback(callback)
+            else:
+                future.add_done_callback(lambda f: self.ui_dispatcher.post(callback, f))
+        return future
+
+
+    def forget(self, key, future):
+        """
+        Drops a finished keyed request from the requests in flight.
+
+        :param key: The key the request was submitted with.
+        :param future: The future of the request.
+        """
+        with self.pending_lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+
+
+    async def request(self, ip_address, port, fields, timeout):
+        """
+        Sends a request to a session-server and waits for the response.
+
+        :param ip_address: The IP address of the session-server.
+        :param port: The TCP port of the session-server.
+        :param fields: A dictionary of the request message fields.
+        :param timeout: Number of seconds the request may take, or None for default_timeout.
+        :return: A dictionary of the response fields.
+        """
+        responses = await self.request_pipelined(ip_address, port, [fields], timeout)
+        return responses[0]
+
+
+    async def request_probe(self, ip_address, port, timeout):
+        """
+        Pings a session-server and times the answer.
+
+        :param ip_address: The IP address of the session-server.
+        :param port: The TCP port of the session-server.
+        :param timeout: Number of seconds the ping may take, or None for default_timeout.
+        :return: The round trip time, in seconds.
+        """
+        started_at = self.loop.time()
+        resp = await self.request(ip_address, port, {"msg_type": "ping"}, timeout)
+        if resp.get("msg_type") != "pong":
+            raise MortProtocol.ProtocolError("Unexpected answer to ping: {}".format(resp.get("msg_type")))
+        rtt = self.loop.time() - started_at
+        self.record_rtt((ip_address, port), rtt)
+        return rtt
+
+
+    def record_rtt(self, server, rtt):
+        """
+        Folds a round trip time into the estimate for a session-server, using
+        an exponentially weighted moving average.
+
+        :param server: The (ip address, port) of the session-server.
+        :param rtt: The round trip time, in seconds.
+        """
+        if server in self.rtts:
+            self.rtts[server] += (rtt - self.rtts[server]) / 4
+        else:
+            self.rtts[server] = rtt
+
+
+    async def request_pipelined(self, ip_address, port, requests, timeout):
+        """
+        Sends several requests to a session-server and waits for the responses.
+
+        :param ip_address: The IP address of the session-server.
+        :param port: The TCP port of the session-server.
+        :param requests: A list of dictionaries of request message fields.
+        :param timeout: Number of seconds the requests may take, or None for default_timeout.
+        :return: A list of dictionaries of the response fields.
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+        return await asyncio.wait_for(self.exchange(ip_address, port, requests), timeout)
+
+
+    async def request_batch(self, ip_address, port, operations, timeout):
+        """
+        Sends a batch of operations to a session-server and waits for the
+        results.
+
+        :param ip_address: The IP address of the session-server.
+        :param port: The TCP port of the session-server.
+        :param operations: A list of dictionaries of request message fields.
+        :param timeout: Number of seconds the batch may take, or None for default_timeout.
+        :return: A list of dictionaries of the response fields, or None for
+                 operations that weren't answered.
+        """
+        # :NOTE: Servers that predate the framed protocol don't know the batch
+        #        message either, so they are sent the operations one by one.
+        if await self.protocol_version(ip_address, port, timeout) == 0:
+            return await self.request_pipelined(ip_address, port, operations, timeout)
+
+        resp_fields = await self.request(ip_address,
+                                         port,
+                                         {"msg_type": "batch",
+                                          "operations": json.dumps(operations)},
+                                         timeout)
+
+        try:
+            if resp_fields["msg_type"] != "batch_response":
+                raise ValueError
+            results = json.loads(resp_fields["results"])
+            if not isinstance(results, list) or len(results) != len(operations):
+                raise ValueError
+        except (KeyError, ValueError):
+            raise MortProtocol.ProtocolError("Invalid batch response")
+        return results
+
+
+    async def request_subscription(self, ip_address, port, fields, on_message):
+        """
+        Sends a subscription request to a session-server and passes on the
+        messages it sends back until the connection is closed.
+
+        :param ip_address: The IP address of the session-server.
+        :param port: The TCP port of the session-server.
+        :param fields: A dictionary of the subscription request message fields.
+        :param on_message: As for subscribe().
+        :return: The number of messages received.
+        """
+        try:
+            return await self.follow_subscription(ip_address, port, fields, on_message)
+        except (OSError, MortProtocol.ProtocolError) as ex:
+            self.forget_protocol((ip_address, port), ex)
+            raise
+
+
+    async def follow_subscription(self, ip_address, port, fields, on_message):
+        """
+        Subscribes to a session-server and passes on the messages it sends,
+        for request_subscription().
+
+        :param ip_address: The IP address of the session-server.
+        :param port: The TCP port of the session-server.
+        :param fields: A dictionary of the subscription request message fields.
+        :param on_message: As for subscribe().
+        :return: The number of messages received.
+        """
+        # :NOTE: Servers that predate the framed protocol can't push messages.
+        if await self.protocol_version(ip_address, port) == 0:
+            raise MortProtocol.ProtocolError("Server doesn't support subscriptions")
+
+        self.log.debug("Subscribing to server {0}:{1}...".format(ip_address, port))
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip_address, port), self.default_timeout)
+        count = 0
+        try:
+            writer.write(MortProtocol.encode_frame(fields))
+            await writer.drain()
+
+            decoder = MortProtocol.FrameDecoder(self.max_response_size)
+            while True:
+                data = await asyncio.wait_for(reader.read(decoder.pending() or 16384), self.subscription_timeout)
+                if not data:
+                    if decoder.buffer:
+                        raise MortProtocol.ProtocolError("Connection closed part way through a message")
+                    self.log.debug("Subscription to {0}:{1} closed by server.".format(ip_address, port))
+                    return count
+                if count == 0 and not decoder.buffer and not MortProtocol.is_framed(data):
+                    raise MortProtocol.ProtocolError("Server doesn't support subscriptions")
+                for version, msg_fields in decoder.feed(data):
+                    if count == 0 and MortProtocol.is_busy(msg_fields):
+                        raise MortProtocol.ServerBusyError()
+                    if msg_fields.get("msg_type") == MortProtocol.HEARTBEAT:
+                        continue
+                    count += 1
+                    if self.ui_dispatcher is None:
+                        on_message(msg_fields)
+                    else:
+                        self.ui_dispatcher.post(on_message, msg_fields)
+        finally:
+            writer.close()
+
+
+    async def exchange(self, ip_address, port, requests):
+        """
+        Sends requests to a session-server in the protocol it speaks and
+        reads back the responses. Legacy messages are sent one per connection.
+
+        :param ip_address: The IP address of the session-server.
+        :param port: The TCP port of the session-server.
+        :param requests: A list of dictionaries of request message fields.
+        :return: A list of dictionaries of the response fields.
+        """
+        try:
+            if await self.protocol_version(ip_address, port) > 0:
+                return await self.exchange_framed(ip_address, port, requests)
+            responses = []
+            for fields in requests:
+                responses.append(await self.exchange_legacy(ip_address, port, fields))
+            return responses
+        except (OSError, MortProtocol.ProtocolError) as ex:
+            self.forget_protocol((ip_address, port), ex)
+            raise
+
+
+    def forget_protocol(self, server, ex):
+        """
+        Forgets the protocol version of a session-server after a failed
+        exchange, so it is found out again next time, unless the server
+        just turned the connection away for being busy.
+
+        :param server: The (ip address, port) of the session-server.
+        :param ex: The exception the exchange failed with.
+        """
+        if not isinstance(ex, MortProtocol.ServerBusyError):
+            self.protocol_versions.pop(server, None)
+
+
+    async def protocol_version(self, ip_address, port, timeout=None):
+        """
+        Returns the protocol version a session-server speaks, finding it out
+        with a framed ping the first time the server is talked to.
+
+        A server that answers the ping speaks the framed protocol, and the
+        connection is kept for the requests that follow. A server that closes
+        the connection without answering, or answers in the legacy protocol,
+        predates it. Any other failure (e.g. a reset connection or a busy
+        server) is raised, and the version is found out next time.
+
+        :param ip_address: The IP address of the session-server.
+        :param port: The TCP port of the session-server.
+        :param timeout: Number of seconds finding out may take, or None for default_timeout.
+        :return: The protocol version, 0 for a legacy server.
+        """
+        server = (ip_address, port)
+        if server not in self.protocol_versions:
+            if timeout is None:
+                timeout = self.default_timeout
+            await asyncio.wait_for(self.detect_protocol(server), timeout)
+        return self.protocol_versions[server]
+
+
+    async def detect_protocol(self, server):
+        """
+        Pings a session-server with a framed message on a new connection,
+        and records the protocol version it answers in. See protocol_version().
+
+        :param server: The (ip address, port) of the session-server.
+        """
+        self.log.debug("Finding out the protocol spoken by {0}:{1}...".format(server[0], server[1]))
+        started_at = self.loop.time()
+        reader, writer = await asyncio.open_connection(server[0], server[1])
+        try:
+            writer.write(MortProtocol.encode_frame({"msg_type": "ping"}))
+            await writer.drain()
+            data = await reader.read(MortProtocol.HEADER.size)
+            if not data or not MortProtocol.is_framed(data):
+                # :NOTE: Legacy servers close the connection without answering
+                #        a message they can't make sense of.
+                self.log.info("Server {0}:{1} doesn't speak the framed protocol."
+                              " Using legacy messages.".format(server[0], server[1]))
+                self.protocol_versions[server] = 0
+                writer.close()
+                return
+
+            decoder = MortProtocol.FrameDecoder(self.max_response_size)
+            messages = decoder.feed(data)
+            while not messages:
+                messages = decoder.feed(await self.read_exactly(reader, decoder.pending() or
+                                                                MortProtocol.HEADER.size - len(decoder.buffer)))
+        except BaseException:
+            writer.close()
+            raise
+
+        version, resp_fields = messages[0]
+        self.protocol_versions[server] = version
+        if MortProtocol.is_busy(resp_fields):
+            writer.close()
+            raise MortProtocol.ServerBusyError()
+        self.record_rtt(server, self.loop.time() - started_at)
+        self.checkin(server, reader, writer)
+
+
+    async def exchange_framed(self, ip_address, port, requests):
+        """
+        Exchanges framed messages with a session-server, reusing an idle
+        connection to it if there is one and the requests are idempotent.
+
+        :param ip_address: The IP address of the session-server.
+        :param port: The TCP port of the session-server.
+        :param requests: A list of dictionaries of request message fields.
+        :return: A list of dictionaries of the response fields.
+        """
+        server = (ip_address, port)
+        # :NOTE: A pooled connection may have been closed by the server at
+        #        any point, e.g. while it was idle or after a failure part way
+        #        through the last exchange. If it turns out to be closed, there
+        #        is no telling whether the server carried out the requests, so
+        #        only requests that can safely be sent again are sent on one.
+        #        Anything else gets a new connection and is never resent.
+        if all(is_idempotent(fields) for fields in requests):
+            connection = self.checkout(server)
+            if connection is not None:
+                try:
+                    return await self.send_framed(server, connection[0], connection[1], requests)
+                except ConnectionError as ex:
+                    if isinstance(ex, MortProtocol.ServerBusyError):
+                        raise
+                    self.log.debug("Pooled connection to {0}:{1} was closed. Reconnecting...".format(ip_address, port))
+
+        self.log.debug("Connecting to server {0}:{1}...".format(ip_address, port))
+        reader, writer = await asyncio.open_connection(ip_address, port)
+        return await self.send_framed(server, reader, writer, requests)
+
+
+    async def send_framed(self, server, reader, writer, requests):
+        """
+        Sends framed requests on a connection, all at once, and reads back
+        the responses. Each request is given a request_id, which the server
+        copies into its response. The connection is returned to the pool
+        afterwards, or closed if the exchange failed.
+
+        :param server: The (ip address, port) of the session-server.
+        :param reader: The asyncio.StreamReader of the connection.
+        :param writer: The asyncio.StreamWriter of the connection.
+        :param requests: A list of dictionaries of request message fields.
+        :return: A list of dictionaries of the response fields.
+        """
+        request_ids = []
+        responses = {}
+        try:
+            for fields in requests:
+                request_id = str(next(self.request_ids))
+                request_ids.append(request_id)
+                writer.write(MortProtocol.encode_frame(dict(fields, request_id=request_id)))
+            await writer.drain()
+
+            data = await reader.read(MortProtocol.HEADER.size)
+            if not data:
+                raise MortProtocol.ConnectionClosedError()
+            if not MortProtocol.is_framed(data):
+                # The server answered in the legacy protocol, which only
+                # allows one request per connection.
+                self.protocol_versions[server] = 0
+                resp_fields = MortProtocol.decode_legacy(data + await self.read_to_eof(reader, len(data)))
+                writer.close()
+                if len(requests) != 1:
+                    raise MortProtocol.ProtocolError("Server doesn't support pipelined requests")
+                return [resp_fields]
+
+            decoder = MortProtocol.FrameDecoder(self.max_response_size)
+            while True:
+                for version, resp_fields in decoder.feed(data):
+                    if MortProtocol.is_busy(resp_fields):
+                        raise MortProtocol.ServerBusyError()
+                    request_id = resp_fields.pop("request_id", None)
+                    if request_id not in request_ids:
+                        raise MortProtocol.ProtocolError("Response to an unknown request: {}".format(request_id))
+                    responses[request_id] = resp_fields
+                if len(responses) == len(request_ids):
+                    break
+                # :NOTE: Once a header is in, the rest of its frame is read
+                #        in one go rather than in small chunks.
+                data = await self.read_exactly(reader, decoder.pending() or
+                                               MortProtocol.HEADER.size - len(decoder.buffer))
+        except BaseException:
+            # :NOTE: This includes cancellation, which leaves the connection
+            #        part way through an exchange.
+            writer.close()
+            raise
+
+        self.protocol_versions[server] = version
+        self.checkin(server, reader, writer)
+        return [responses[request_id] for request_id in request_ids]
+
+
+    def checkout(self, server):
+        """
+        Takes the most recently used healthy idle connection to a server out
+        of the pool, closing any that have expired or been closed.
+
+        :param server: The (ip address, port) of the session-server.
+        :return: A (reader, writer, idle_since) tuple, or None if there isn't one.
+        """
+        connections = self.idle_connections.get(server)
+        now = self.loop.time()
+        while connections:
+            reader, writer, idle_since = connections.pop()
+            if (writer.is_closing() or
+                reader.at_eof() or
+                now - idle_since > self.pool_idle_timeout):
+                writer.close()
+                continue
+            return reader, writer, idle_since
+        return None
+
+
+    def checkin(self, server, reader, writer, idle_since=None):
+        """
+        Puts a connection back in the pool, or closes it if the pool for the
+        server is full.
+
+        :param server: The (ip address, port) of the session-server.
+        :param reader: The asyncio.StreamReader of the connection.
+        :param writer: The asyncio.StreamWriter of the connection.
+        :param idle_since: The loop time the connection was last used for a
+                           request. Defaults to now.
+        """
+        if idle_since is None:
+            idle_since = self.loop.time()
+        connections = self.idle_connections.setdefault(server, [])
+        if len(connections) >= self.pool_size:
+            writer.close()
+            return
+        connections.append((reader, writer, idle_since))
+
+
+    async def health_check_task(self):
+        """
+        Periodically pings the idle connections, closing those that have
+        expired or don't answer. Runs on the event loop until it is stopped.
+        """
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            for server in list(self.idle_connections):
+                connections = self.idle_connections.pop(server)
+                for reader, writer, idle_since in connections:
+                    if (writer.is_closing() or
+                        reader.at_eof() or
+                        self.loop.time() - idle_since > self.pool_idle_timeout):
+                        writer.close()
+                        continue
+                    started_at = self.loop.time()
+                    try:
+                        await asyncio.wait_for(self.send_framed(server, reader, writer, [{"msg_type": "ping"}]),
+                                               self.default_timeout)
+                    except (asyncio.TimeoutError, OSError, MortProtocol.ProtocolError):
+                        self.log.debug("Dropping unhealthy connection to {0}:{1}".format(server[0], server[1]))
+                        continue
+                    self.record_rtt(server, self.loop.time() - started_at)
+                    # :NOTE: send_framed() put the connection back as if it had
+                    #        just been used. A ping doesn't count as use, so
+                    #        restore the time it went idle.
+                    connections = self.idle_connections.get(server, [])
+                    for i, connection in enumerate(connections):
+                        if connection[1] is writer:
+                            connections[i] = (reader, writer, idle_since)
+
+
+    async def exchange_legacy(self, ip_address, port, fields):
+        """
+        Exchanges legacy "key:value\\n" messages with a session-server.
+
+        :param ip_address: The IP address of the session-server.
+        :param port: The TCP port of the session-server.
+        :param fields: A dictionary of the request message fields.
+        :return: A dictionary of the response fields.
+        """
+        self.log.debug("Connecting to server {0}:{1}...".format(ip_address, port))
+        reader, writer = await asyncio.open_connection(ip_address, port)
+        try:
+            writer.write(MortProtocol.encode_legacy(fields))
+            await writer.drain()
+
+            # :NOTE: The server closes the connection once it has sent the
+            #        response, so read until EOF.
+            resp = await self.read_to_eof(reader, 0)
+        finally:
+            writer.close()
+        self.log.debug("Received {0} bytes from {1}:{2}".format(len(resp), ip_address, port))
+        return MortProtocol.decode_legacy(resp)
+
+
+    async def read_exactly(self, reader, size):
+        """
+        Reads a number of bytes from a stream.
+
+        :param reader: The asyncio.StreamReader to read from.
+        :param size: The number of bytes to read.
+        :return: The bytes read.
+        :raises MortProtocol.ConnectionClosedError: If the stream ends first.
+        """
+        try:
+            return await reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            raise MortProtocol.ConnectionClosedError() from None
+
+
+    async def read_to_eof(self, reader, already_read):
+        """
+        Reads from a stream until EOF.
+
+        :param reader: The asyncio.StreamReader to read from.
+        :param already_read: The number of bytes of the response already read.
+        :return: The bytes read.
+        """
+        resp = bytearray()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            resp += data
+            if already_read + len(resp) > self.max_response_size:
+                raise MortProtocol.ProtocolError("Response is too large")
+        return bytes(resp)
@@ -7,19 +7,31 @@ from tkinter import *
 from tkinter import ttk
 from PIL import ImageTk, Image
 
+import LogRecordBuffer
+
 class LogBoxWidget(object):
     """
     A class that handles the log box GUI widget.
     The "View" in the MVC pattern.
+
+    Records taken off the log queue wait in a bounded ring buffer until the
+    Tk main loop shows them in batches. If records arrive faster than they
+    can be shown, the oldest waiting records are dropped and counted. The
+    Text widget keeps at most max_lines lines, trimming the oldest.
     """
 
-    def __init__(self, parent, log_queue):
+    def __init__(self, parent, log_queue, ui_dispatcher, max_lines=5000, batch_size=200, max_pending=10000):
         """
         Constructs the GUI widget.
 
         :param parent: A Tk widget that acts as the parent to this widget.
         :param queue: A queue.Queue that the widget will watch for logging.LogRecord
                       items to display in the log box.
+        :param ui_dispatcher: A UIDispatcher used to hand records to the Tk main loop.
+        :param max_lines: The most lines the log box keeps before trimming the oldest.
+        :param batch_size: The most records shown per UI tick.
+        :param max_pending: The most records that can wait to be shown before the
+                            oldest are dropped.
         """
         # Determine where the source code is to be found
         # :NOTE: Refer to documentation of sys.path for why this works.
@@ -35,6 +47,16 @@ class LogBoxWidget(object):
         # Hold a reference to the queue to watch for log items to display.
         self.log_queue = log_queue
 
+        # Hold a reference to the dispatcher used to update the Text widget
+        # from the Tk main loop.
+        self.ui_dispatcher = ui_dispatcher
+
+        # The limits on the log box and the ring buffer of records waiting to
+        # be shown.
+        self.max_lines = max_lines
+        self.batch_size = batch_size
+        self.pending_records = LogRecordBuffer.LogRecordBuffer(max_pending)
+
         # Create a dictionary of icons to use for the various message types.
         self.msg_icons = {}
 
@@ -69,6 +91,7 @@ class LogBoxWidget(object):
         self.logbox_pane.columnconfigure(1, weight=0)
         self.logbox_pane.rowconfigure(0, weight=1)
         self.logbox_pane.rowconfigure(1, weight=0)
+        self.logbox_pane.rowconfigure(2, weight=0)
         self.parent.add(self.logbox_pane, weight=1)
 
         # Create the Text component that will display the log messages.
@@ -86,6 +109,10 @@ class LogBoxWidget(object):
         self.log_hscroll.grid(column=0, row=1, sticky=(E, W))
         self.logbox.configure(xscrollcommand=self.log_hscroll.set)
 
+        # Create a label to show how many records were dropped.
+        self.dropped_label = ttk.Label(self.logbox_pane, text="")
+        self.dropped_label.grid(column=0, row=2, padx=4, sticky=(E, W))
+
         # Kick off a thread that will watch the queue and update the Text widget
         # with the info in the LogRecords from the queue.
         self.logbox_update_task = threading.Thread(target=self.update_task,
@@ -107,12 +134,44 @@ class LogBoxWidget(object):
 
         # Watch the queue for messages that should be displayed in
         # the logbox widget.
+        # :NOTE: Tk is not thread-safe so the records are handed to the
+        #        main loop to display. Whatever is waiting on the queue is
+        #        moved at once, and the post is keyed so that records
+        #        arriving before the main loop gets to it share one batch.
         while True:
-            item = self.log_queue.get()
+            self.pending_records.fill_from(self.log_queue, self.batch_size)
+            self.ui_dispatcher.post(self.show_records, key="LogBoxWidget.show_records")
+
+
+    def show_records(self):
+        """
+        Displays up to batch_size waiting LogRecords in the log box. Must be
+        run on the Tk main loop.
+        """
+        # Only follow the end of the log if the user hasn't scrolled away from it.
+        pinned_to_bottom = self.logbox.yview()[1] >= 1.0
+
+        for item in self.pending_records.take(self.batch_size):
             self.logbox.image_create('end',
                                      image=self.msg_icons[item.levelname],
                                      align='center',
                                      padx=1,
                                      pady=1)
             self.logbox.insert('end', ":{0.levelname:10}: {0.name} - {0.msg}\n".format(item))
-            self.logbox.see('end')
\ No newline at end of file
+
+        # Trim the oldest lines so the log box doesn't grow without bound.
+        # :NOTE: Each record ends with a newline, so the last line of the Text
+        #        widget (the one 'end-1c' is on) is always empty, hence the - 1.
+        line_count = int(self.logbox.index('end-1c').split('.')[0]) - 1
+        if line_count > self.max_lines:
+            self.logbox.delete('1.0', '{}.0'.format(line_count - self.max_lines + 1))
+
+        if pinned_to_bottom:
+            self.logbox.see('end')
+
+        if self.pending_records.dropped:
+            self.dropped_label.configure(text="Dropped records: {}".format(self.pending_records.dropped))
+
+        # Leave the rest of the records for the next tick.
+        if self.pending_records:
+            self.ui_dispatcher.post(self.show_records, key="LogBoxWidget.show_records")
@@ -0,0 +1,75 @@
+import collections
+import queue
+
+
+class LogRecordBuffer(object):
+    """
+    A class that holds the LogRecords waiting to be shown in the log box, in
+    a bounded ring buffer. If records arrive faster than they are taken, the
+    oldest waiting records are dropped and counted.
+
+    One thread fills the buffer and another takes from it.
+    """
+
+    def __init__(self, max_pending=10000):
+        """
+        Class constructor.
+
+        :param max_pending: The most records that can wait before the oldest are dropped.
+        """
+        # :NOTE: deque's append() and popleft() are thread-safe, and a full deque
+        #        drops its oldest item when a new one is appended.
+        self.records = collections.deque(maxlen=max_pending)
+        self.dropped = 0
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def put(self, record):
+        """
+        Adds a record, dropping the oldest waiting record if the buffer is full.
+
+        :param record: The logging.LogRecord.
+        """
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append(record)
+
+
+    def fill_from(self, log_queue, count):
+        """
+        Moves records from a queue into the buffer. Blocks until there is a
+        record, then takes whatever else is already waiting, up to count
+        records in all.
+
+        :param log_queue: The queue.Queue of LogRecords.
+        :param count: The most records to move.
+        :return: The number of records moved.
+        """
+        self.put(log_queue.get())
+        moved = 1
+        while moved < count:
+            try:
+                self.put(log_queue.get_nowait())
+            except queue.Empty:
+                break
+            moved += 1
+        return moved
+
+
+    def take(self, count):
+        """
+        Takes the oldest waiting records.
+
+        :param count: The most records to take.
+        :return: A list of up to count LogRecords, oldest first.
+        """
+        records = []
+        while len(records) < count:
+            try:
+                records.append(self.records.popleft())
+            except IndexError:
+                break
+        return records
@@ -0,0 +1,230 @@
+import struct
+import json
+import errno
+
+
+# A framed message starts with a header giving the protocol version, the
+# length of the message type and the length of the payload, followed by
+# the message type and then the payload. The payload is the rest of the
+# message's fields encoded as a JSON object.
+#
+#   +-------+---------+-------------+----------------+----------+---------+
+#   | magic | version | type length | payload length | msg_type | payload |
+#   |  4 B  |   1 B   |     1 B     |      4 B       |          |         |
+#   +-------+---------+-------------+----------------+----------+---------+
+#
+# :NOTE: The magic starts with a NUL byte, which never starts a legacy
+#        "key:value\n" message, so the first byte received tells the two
+#        apart.
+MAGIC = b"\x00MRT"
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!4sBBI")
+
+# The largest frame accepted by default, header included.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# The reason given in the error response of a server that turns a connection
+# away because it is already serving as many as it can.
+BUSY = "busy"
+
+# The msg_type of the message a server sends on a subscribed connection that
+# has had nothing else to send for a while, so that the client can tell a
+# quiet subscription from a dead one.
+HEARTBEAT = "heartbeat"
+
+
+class ProtocolError(Exception):
+    """
+    Raised when a message can't be encoded or decoded.
+    """
+    pass
+
+
+class ServerBusyError(ConnectionError):
+    """
+    Raised when a server turns a connection away because it is busy.
+    """
+
+    def __init__(self):
+        super().__init__(errno.EBUSY, "Server is busy")
+
+
+class ConnectionClosedError(ConnectionError):
+    """
+    Raised when a server closes the connection before the whole response
+    has arrived.
+    """
+
+    def __init__(self):
+        super().__init__(errno.ECONNRESET, "Connection closed before the whole response arrived")
+
+
+def error_response(error):
+    """
+    Builds the response to a request that can't be carried out.
+
+    :param error: The reason, e.g. BUSY.
+    :return: A dictionary of the response fields.
+    """
+    return {"msg_type": "error",
+            "error": error}
+
+
+def is_busy(fields):
+    """
+    Returns True if a response is the one a busy server turns a connection away with.
+
+    :param fields: A dictionary of the response fields.
+    """
+    return fields.get("msg_type") == "error" and fields.get("error") == BUSY
+
+
+def is_framed(data):
+    """
+    Returns True if the data is the start of a framed message, or False if
+    it is the start of a legacy "key:value\\n" message.
+
+    :param data: The first bytes received. Must not be empty.
+    """
+    return data[:1] == MAGIC[:1]
+
+
+def encode_frame(fields, version=PROTOCOL_VERSION):
+    """
+    Encodes a message as a frame.
+
+    :param fields: A dictionary of the message fields. Must have a msg_type.
+    :param version: The protocol version to put in the header.
+    :return: The bytes of the frame.
+    """
+    try:
+        msg_type = fields["msg_type"].encode('utf8')
+    except KeyError:
+        raise ProtocolError("Message has no msg_type field")
+    if len(msg_type) > 255:
+        raise ProtocolError("msg_type is too long")
+    payload = json.dumps({key: value for key, value in fields.items() if key != "msg_type"}).encode('utf8')
+    return HEADER.pack(MAGIC, version, len(msg_type), len(payload)) + msg_type + payload
+
+
+def encode_legacy(fields):
+    """
+    Encodes a message as "key:value\\n" lines, the msg_type first.
+
+    :param fields: A dictionary of the message fields. Must have a msg_type.
+    :return: The bytes of the message.
+    """
+    if "msg_type" not in fields:
+        raise ProtocolError("Message has no msg_type field")
+    lines = ["msg_type:{}\n".format(fields["msg_type"])]
+    for key, value in fields.items():
+        if key != "msg_type":
+            lines.append("{0}:{1}\n".format(key, value))
+    return "".join(lines).encode('utf8')
+
+
+def encode_response(fields, version):
+    """
+    Encodes a response in the protocol the request was sent with.
+
+    :param fields: A dictionary of the response fields. Must have a msg_type.
+    :param version: The protocol version of the request, 0 for a legacy request.
+    :return: The bytes of the response.
+    """
+    if version == 0:
+        return encode_legacy(fields)
+    return encode_frame(fields, min(version, PROTOCOL_VERSION))
+
+
+def decode_legacy(data):
+    """
+    Breaks a legacy "key:value\\n" message down into its key/value pairs.
+    Lines without a ':' are ignored.
+
+    :param data: The bytes of the message.
+    :return: A dictionary of the message fields.
+    """
+    try:
+        msg = data.decode('utf8')
+    except UnicodeDecodeError:
+        raise ProtocolError("Undecodable message")
+    msg_fields = {}
+    for msg_line in msg.splitlines():
+        msg_field = msg_line.split(':', 1)
+        if len(msg_field) == 2:
+            msg_fields[msg_field[0]] = msg_field[1]
+    return msg_fields
+
+
+class FrameDecoder(object):
+    """
+    Reassembles frames from a stream of bytes that may split or join them
+    arbitrarily.
+
+    Only the bytes of the frame being received are buffered, and a frame
+    whose header claims more than max_frame_size bytes is refused before any
+    of its payload is buffered.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        """
+        Class constructor.
+
+        :param max_frame_size: The largest frame accepted, header included.
+        """
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+        # The header of the frame being received, or None if it hasn't all
+        # arrived yet.
+        self.header = None
+
+
+    def feed(self, data):
+        """
+        Adds received bytes and returns the messages they complete.
+
+        :param data: The bytes received.
+        :return: A list of (version, fields) tuples, one per complete frame.
+        """
+        self.buffer += data
+        messages = []
+        while True:
+            if self.header is None:
+                if len(self.buffer) < HEADER.size:
+                    break
+                magic, version, type_length, payload_length = HEADER.unpack_from(self.buffer)
+                if magic != MAGIC:
+                    raise ProtocolError("Bad frame magic")
+                if HEADER.size + type_length + payload_length > self.max_frame_size:
+                    raise ProtocolError("Frame of {} bytes is too large".format(HEADER.size + type_length + payload_length))
+                self.header = (version, type_length, payload_length)
+
+            version, type_length, payload_length = self.header
+            frame_size = HEADER.size + type_length + payload_length
+            if len(self.buffer) < frame_size:
+                break
+
+            msg_type = bytes(self.buffer[HEADER.size:HEADER.size + type_length])
+            payload = bytes(self.buffer[HEADER.size + type_length:frame_size])
+            del self.buffer[:frame_size]
+            self.header = None
+
+            try:
+                fields = json.loads(payload.decode('utf8'))
+                fields["msg_type"] = msg_type.decode('utf8')
+            except (UnicodeDecodeError, ValueError, TypeError):
+                raise ProtocolError("Undecodable frame")
+            messages.append((version, fields))
+        return messages
+
+
+    def pending(self):
+        """
+        Returns the number of bytes still needed to complete the frame being
+        received, or None if its header hasn't arrived yet.
+        """
+        if self.header is None:
+            return None
+        version, type_length, payload_length = self.header
+        return HEADER.size + type_length + payload_length - len(self.buffer)
@@ -0,0 +1,136 @@
+import os
+import threading
+import select
+import time
+import logging
+
+
+class ProcessReaper(object):
+    """
+    A class that waits for child processes on a dedicated thread, so each
+    one is reaped as soon as it exits rather than lingering as a zombie.
+
+    Each watched process gets a pidfd, which becomes readable when the
+    process exits. Where pidfds aren't available, the processes are polled
+    every poll_interval seconds instead.
+    """
+
+    def __init__(self, poll_interval=0.5):
+        """
+        Class constructor.
+
+        :param poll_interval: Number of seconds between polls of processes that
+                              can't be given a pidfd.
+        """
+        # Configure logging
+        self.log = logging.getLogger("ProcessReaper")
+        self.log.debug("Starting up...")
+
+        self.poll_interval = poll_interval
+
+        # The processes being watched, as (popen, callback) tuples, by pidfd
+        # for those with one and in a list for those without, and the lock
+        # that arbitrates access to them from different threads.
+        self.by_pidfd = {}
+        self.polled = []
+        self.lock = threading.Lock()
+
+        # Wakes the reaper up when a process is added.
+        self.wakeup_read_fd, self.wakeup_write_fd = os.pipe()
+        os.set_blocking(self.wakeup_read_fd, False)
+        os.set_blocking(self.wakeup_write_fd, False)
+
+        self.reaper_task = threading.Thread(target=self.reap,
+                                            name="process_reaper_thread",
+                                            daemon=True)
+
+
+    def start(self):
+        """
+        Starts the reaper thread.
+        """
+        self.reaper_task.start()
+
+
+    def watch(self, popen, callback=None):
+        """
+        Reaps a child process once it exits. Safe to call from any thread.
+
+        :param popen: The subprocess.Popen of the process.
+        :param callback: If given, called with the exit code of the process once
+                         it has been reaped. Called on the reaper thread.
+        """
+        try:
+            pidfd = os.pidfd_open(popen.pid)
+        except (AttributeError, OSError):
+            pidfd = None
+        with self.lock:
+            if pidfd is None:
+                self.polled.append((popen, callback))
+            else:
+                self.by_pidfd[pidfd] = (popen, callback)
+        try:
+            os.write(self.wakeup_write_fd, b"\0")
+        except BlockingIOError:
+            # The reaper already has a wake up waiting.
+            pass
+
+
+    def reap(self):
+        """
+        Waits for the watched processes to exit and reaps them. Runs as a
+        seperate thread.
+        """
+        while True:
+            try:
+                self.reap_once()
+            except Exception:
+                # :NOTE: An error mustn't stop the reaper, or every process
+                #        started from then on would be left a zombie.
+                self.log.exception("Process reaper failed")
+                time.sleep(self.poll_interval)
+
+
+    def reap_once(self):
+        """
+        Waits for a watched process to exit, a process to be added, or the
+        next poll, and reaps the processes that have exited.
+        """
+        # :NOTE: poll() is used rather than select(), which can't wait on fds
+        #        numbered 1024 or above, and there is a pidfd per process.
+        poller = select.poll()
+        with self.lock:
+            poller.register(self.wakeup_read_fd, select.POLLIN)
+            for pidfd in self.by_pidfd:
+                poller.register(pidfd, select.POLLIN)
+            timeout = self.poll_interval * 1000 if self.polled else None
+        events = poller.poll(timeout)
+
+        exited = []
+        with self.lock:
+            for fd, event in events:
+                if fd == self.wakeup_read_fd:
+                    try:
+                        while os.read(fd, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    exited.append(self.by_pidfd.pop(fd))
+                    os.close(fd)
+            still_running = []
+            for popen, callback in self.polled:
+                if popen.poll() is None:
+                    still_running.append((popen, callback))
+                else:
+                    exited.append((popen, callback))
+            self.polled = still_running
+
+        for popen, callback in exited:
+            returncode = popen.wait()
+            self.log.debug("Reaped process {0} with exit code {1}".format(popen.pid, returncode))
+            if callback is not None:
+                try:
+                    callback(returncode)
+                except Exception:
+                    self.log.exception("Process exit callback failed")
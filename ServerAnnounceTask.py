@@ -15,13 +15,15 @@ class ServerAnnounceTask(threading.Thread):
     messages at repetitive intervals.
     """
 
-    def __init__(self, announce_hostname, announce_ip_address, announce_port):
+    def __init__(self, announce_hostname, announce_ip_address, announce_port, health=None):
         """
         Class constructor
 
         :param announce_hostname: The string hostname of the session server to announce.
         :param announce_ip_address: The string IP address of the session server to announce.
         :param announce_port: The integer port the session-server is listening on.
+        :param health: If given, a callable returning a dictionary of the health and
+                       capacity fields to add to each announce message.
         """
         # Give a name to this thread and make it a daemon so it
         # doesn't prevent the caller from exiting.
@@ -46,6 +48,7 @@ class ServerAnnounceTask(threading.Thread):
         self.ip_address = announce_ip_address
         self.hostname = announce_hostname
         self.port = announce_port
+        self.health = health
         self.msg = ("msg_type:session_server_announce\n"
                     "hostname:{0}\n"
                     "ip_address:{1}\n"
@@ -73,10 +76,14 @@ class ServerAnnounceTask(threading.Thread):
         Then pauses a set amount of time before sending another message.
         """
         while True:
+            # Build the message once per announce, so the health fields are
+            # gathered once for all the hosts it is sent to.
+            msg_bytes = self.build_msg().encode('utf8')
+
             # Send an announce message via broadcast if configured to
             if self.use_broadcast_announce:
                 try:
-                    self.sock.sendto(self.msg.encode('utf8'), ("<broadcast>", 42124))
+                    self.sock.sendto(msg_bytes, ("<broadcast>", 42124))
                 except OSError as ex:
                     msg = ("Unable to send broadcast announce message."
                            " Error No: {0}"
@@ -87,7 +94,7 @@ class ServerAnnounceTask(threading.Thread):
             if self.use_unicast_announce:
                 for address in self.unicast_announce_hosts:
                     try:
-                        self.sock.sendto(self.msg.encode('utf8'), (address, 42124))
+                        self.sock.sendto(msg_bytes, (address, 42124))
                     except OSError as ex:
                         msg = ("Unable to send unicast announce message."
                                " IP Address: {0}"
@@ -103,6 +110,23 @@ class ServerAnnounceTask(threading.Thread):
             time.sleep(10)
 
 
+    def build_msg(self):
+        """
+        Builds an announce message, with the current health fields if there
+        are any.
+
+        :return: The message string.
+        """
+        if self.health is None:
+            return self.msg
+        try:
+            health_fields = self.health()
+        except Exception:
+            self.log.exception("Unable to gather the health fields for the announce message.")
+            return self.msg
+        return self.msg + "".join("{0}:{1}\n".format(key, value) for key, value in health_fields.items())
+
+
 if __name__ == "__main__":
     # For testing purposes, each time this thread is started as the
     # main program, kick off a server with a random information
@@ -0,0 +1,157 @@
+import collections
+
+
+# A session-server that a new session could be placed on. health is the
+# SessionServerInfo.ServerHealth it last announced, or None, and rtt the
+# measured round trip time to it in seconds, or None.
+Candidate = collections.namedtuple("Candidate",
+                                   ["hostname",
+                                    "ip_address",
+                                    "port",
+                                    "health",
+                                    "rtt"])
+
+
+# A candidate with its score (lower is better) and the description of each
+# term that went into the score.
+Placement = collections.namedtuple("Placement",
+                                   ["score",
+                                    "candidate",
+                                    "reasons"])
+
+
+def load_term(candidate):
+    """
+    :return: The load per CPU as the cost, with its description, or None if unknown.
+    """
+    if candidate.health is None:
+        return None
+    load = candidate.health.load_per_cpu
+    return load, "load {:.2f}/CPU".format(load)
+
+
+def memory_term(candidate):
+    """
+    :return: A cost of 1 with 1 GiB of memory available, falling as more is
+             available, with its description, or None if unknown.
+    """
+    if candidate.health is None or candidate.health.mem_available is None:
+        return None
+    mem_available = candidate.health.mem_available
+    return 1024 / max(mem_available, 1), "{} MiB free".format(mem_available)
+
+
+def sessions_term(candidate):
+    """
+    :return: A cost of 0.1 per session running, with its description, or None if unknown.
+    """
+    if candidate.health is None:
+        return None
+    return candidate.health.session_count / 10, "{} sessions".format(candidate.health.session_count)
+
+
+def rtt_term(candidate):
+    """
+    :return: A cost of 1 per 100 ms of round trip time, with its description,
+             or None if unknown.
+    """
+    if candidate.rtt is None:
+        return None
+    return candidate.rtt / 0.1, "rtt {:.0f} ms".format(candidate.rtt * 1000)
+
+
+# The terms a score is made of, by name. Each takes a Candidate and returns a
+# (cost, description) tuple, where a cost of about 1 is "busy", or None if the
+# term can't be worked out for the candidate.
+DEFAULT_TERMS = {"load": load_term,
+                 "memory": memory_term,
+                 "sessions": sessions_term,
+                 "rtt": rtt_term}
+
+DEFAULT_WEIGHTS = {"load": 1.0,
+                   "memory": 1.0,
+                   "sessions": 0.5,
+                   "rtt": 1.0}
+
+
+class ServerPlacement(object):
+    """
+    A class that ranks session-servers for placing a new session on, from
+    the health they announce and the round trip time to them.
+
+    Each candidate's score is the weighted sum of the costs of the terms
+    (lower is better). A term that can't be worked out for a candidate (e.g.
+    it is an older server that doesn't announce its health) costs
+    unknown_cost. Servers that announce they have no free displays are left
+    out.
+
+    Both the terms and their weights can be swapped out, e.g. to weight by
+    the weights in launcher.ini, or to add a term of one's own.
+    """
+
+    def __init__(self, weights=None, terms=None, unknown_cost=1.0):
+        """
+        Class constructor.
+
+        :param weights: A dictionary of the weight of each term, by name. Terms
+                        without a weight get a weight of 0. Defaults to DEFAULT_WEIGHTS.
+        :param terms: A dictionary of the term functions, by name. Defaults to
+                      DEFAULT_TERMS.
+        :param unknown_cost: The cost of a term that can't be worked out.
+        """
+        self.weights = dict(DEFAULT_WEIGHTS if weights is None else weights)
+        self.terms = dict(DEFAULT_TERMS if terms is None else terms)
+        self.unknown_cost = unknown_cost
+
+
+    def score(self, candidate):
+        """
+        Scores a candidate.
+
+        :param candidate: The Candidate.
+        :return: A Placement, or None if the candidate has no free displays.
+        """
+        if candidate.health is not None and candidate.health.free_displays <= 0:
+            return None
+        score = 0.0
+        reasons = []
+        for name, term in self.terms.items():
+            weight = self.weights.get(name, 0.0)
+            if not weight:
+                continue
+            result = term(candidate)
+            if result is None:
+                cost, description = self.unknown_cost, "{} unknown".format(name)
+            else:
+                cost, description = result
+            score += weight * cost
+            reasons.append(description)
+        return Placement(score, candidate, reasons)
+
+
+    def rank(self, candidates):
+        """
+        Ranks candidates, best first.
+
+        :param candidates: An iterable of Candidates.
+        :return: A list of Placements, lowest score first. Ties are broken by
+                 hostname.
+        """
+        placements = [placement for placement in map(self.score, candidates) if placement is not None]
+        placements.sort(key=lambda placement: (placement.score, placement.candidate.hostname or ""))
+        return placements
+
+
+    @staticmethod
+    def explain(placement):
+        """
+        Describes why a server was placed where it was.
+
+        :param placement: A Placement.
+        :return: A string such as "a.b.c (192.168.7.220): score 0.92 - load
+                 0.25/CPU, 4096 MiB free, 3 sessions, rtt 12 ms".
+        """
+        return "{0} ({1}): score {2:.2f} - {3}".format(placement.candidate.hostname,
+                                                        placement.candidate.ip_address,
+                                                        placement.score,
+                                                        ", ".join(placement.reasons))
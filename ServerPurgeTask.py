@@ -1,7 +1,9 @@
+import sys
+import os.path
 import threading
 import time
-import datetime
 import logging
+import configparser
 
 
 class ServerPurgeTask(threading.Thread):
@@ -9,13 +11,18 @@ class ServerPurgeTask(threading.Thread):
     A class that runs as a thread to clean out session-servers from the
     list of known session-servers if an announce message hasn't been
     received within a specific time interval from a session-server.
+
+    Each session-server is given a time-to-live (TTL) derived from the
+    interval it has been observed announcing at. The thread sleeps until
+    the next session-server is due to expire and only looks at the
+    session-servers that are due, rather than scanning the whole list.
     """
 
     def __init__(self, known_servers, known_servers_cv):
         """
         Class constructor
 
-        :param known_servers: A Python list of SessionSeverInfo objects.
+        :param known_servers: A SessionServerList of SessionSeverInfo objects.
         :param known_servers_cv: A threading.Condition object used to arbitrate access to the known_servers
                                  list and to notify other threads that the known_servers list was updated.
         """
@@ -23,42 +30,75 @@ class ServerPurgeTask(threading.Thread):
         # doesn't prevent the caller from exiting.
         super().__init__(name="purge_thread", daemon=True)
 
+        # Determine where the source code is to be found
+        # :NOTE: Refer to documentation of sys.path for why this works.
+        self.SRC_DIR = os.path.abspath(sys.path[0])
+
         # Configure logging
         self.log = logging.getLogger("ServerPurgeTask")
         self.log.debug("Starting up...")
 
+        # Load config information from the config file
+        # :NOTE: A session-server's TTL is ttl_multiplier times its observed
+        #        announce interval, limited to the range min_ttl to max_ttl.
+        #        default_ttl is used until the announce interval is known.
+        cfg = configparser.ConfigParser()
+        cfg.read(self.SRC_DIR+"/launcher.ini")
+        self.default_ttl = cfg.getfloat("PURGE_TASK", "default_ttl", fallback=30.0)
+        self.ttl_multiplier = cfg.getfloat("PURGE_TASK", "ttl_multiplier", fallback=3.0)
+        self.min_ttl = cfg.getfloat("PURGE_TASK", "min_ttl", fallback=15.0)
+        self.max_ttl = cfg.getfloat("PURGE_TASK", "max_ttl", fallback=120.0)
+
         # Store the references to the known_servers list and it's associated
         # lock for use later.
         self.known_servers = known_servers
         self.known_servers_cv = known_servers_cv
 
 
+    def ttl(self, server):
+        """
+        Returns the number of seconds a session-server may go without
+        announcing before it is purged.
+
+        :param server: A SessionServerInfo object.
+        """
+        if server.announce_interval is None:
+            return self.default_ttl
+        ttl = server.announce_interval * self.ttl_multiplier
+        return min(max(ttl, self.min_ttl), self.max_ttl)
+
+
     def run(self):
         """
-        Handles iterating over the known_servers list and purging session-servers
-        that haven't been seen within a specific time interval.
+        Handles purging session-servers from the known_servers list that
+        haven't been seen within their TTL.
         :return:
         """
-        while True:
-            # Grab the lock before doing anything with the list since the list
-            # is shared between threads.
-            with self.known_servers_cv:
-                known_servers_list_updated = False
-                for server in self.known_servers[:]:
-                    # If we haven't seen an announce message from the server in
-                    # the last 30 seconds, remove it from the list.
-                    delta = datetime.datetime.now() - server.last_seen
-                    if delta.seconds > 30:
-                        self.known_servers.remove(server)
-                        self.log.warn("Removed host: {0} ({1}:{2}) last seen: {3}".format(server.hostname,
-                                                                                          server.ip_address,
-                                                                                          server.port,
-                                                                                          server.last_seen))
-                        known_servers_list_updated = True
+        # Grab the lock before doing anything with the list since the list
+        # is shared between threads.
+        # :NOTE: wait() releases the lock while the thread sleeps and
+        #        re-aquires it before returning.
+        with self.known_servers_cv:
+            while True:
+                # :NOTE: The monotonic clock is used so that changes to the
+                #        wall-clock (e.g. NTP) don't purge servers early or late.
+                now = time.monotonic()
+                expired = self.known_servers.pop_expired(now, self.ttl)
+                for server in expired:
+                    self.log.warning("Removed host: {0} ({1}:{2}) last seen: {3}".format(server.hostname,
+                                                                                         server.ip_address,
+                                                                                         server.port,
+                                                                                         server.last_seen))
 
                 # If changes were made to the known_servers list, notify watchers.
-                if known_servers_list_updated:
+                if expired:
                     self.known_servers_cv.notify_all()
 
-            # Chill for a bit before checking again...
-            time.sleep(10)
+                # Sleep until the next session-server is due to expire. Other
+                # threads notify the condition when servers are added, which
+                # wakes this thread up to look at the new deadlines.
+                next_deadline = self.known_servers.next_deadline()
+                if next_deadline is None:
+                    self.known_servers_cv.wait()
+                else:
+                    self.known_servers_cv.wait(max(next_deadline - time.monotonic(), 0))
@@ -0,0 +1,437 @@
+import os
+import threading
+import select
+import time
+import logging
+import ctypes
+import ctypes.util
+
+
+# inotify event masks (see inotify(7)).
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+
+
+class SessionInventory(object):
+    """
+    A class that keeps the list of Xvnc sessions running on this host in
+    memory, so that requests for it don't each scan the process table.
+
+    The list is rescanned when it is older than max_staleness, or when it
+    has been invalidated. It is invalidated by calling invalidate() (e.g.
+    after spawning or killing a session), and, once start() has been called,
+    by a watcher thread when:
+      - an X display socket is created or removed in /tmp/.X11-unix
+        (noticed with inotify), or
+      - one of the Xvnc processes in the list exits (noticed with a pidfd).
+    The watcher also rescans an invalidated list straight away, and any
+    list older than refresh_interval, so that reads rarely have to wait.
+
+    Only one scan runs at a time. Reads that need a scan while one is in
+    progress (e.g. many launchers refreshing at once) wait for it and share
+    its result. How often that happens is kept in counters; see stats().
+
+    Listeners added with subscribe() are told of each session that starts,
+    exits or is killed, as rescans find them.
+    """
+
+    def __init__(self, scan, max_staleness=10.0, refresh_interval=5.0, x11_socket_dir="/tmp/.X11-unix"):
+        """
+        Class constructor.
+
+        :param scan: A callable returning the list of session dictionaries.
+        :param max_staleness: Number of seconds a list may be served for before
+                              it is rescanned.
+        :param refresh_interval: Number of seconds between rescans by the watcher.
+        :param x11_socket_dir: The directory X servers create their sockets in.
+        """
+        # Configure logging
+        self.log = logging.getLogger("SessionInventory")
+        self.log.debug("Starting up...")
+
+        self.scan = scan
+        self.max_staleness = max_staleness
+        self.refresh_interval = refresh_interval
+        self.x11_socket_dir = x11_socket_dir
+
+        # Number of seconds the watcher pauses for after it fails.
+        self.retry_interval = 1.0
+
+        # The latest list of sessions, the monotonic time the scan that found
+        # it started at (None if it has been invalidated), and the condition
+        # that arbitrates access to them from different threads.
+        self.sessions = []
+        self.scanned_at = None
+        self.invalidated_at = None
+        self.condition = threading.Condition()
+
+        # A tag that changes whenever the list does, so that clients can ask
+        # for the list only if it has changed since they last saw it.
+        # :NOTE: The random part keeps a restarted server from reusing the
+        #        tags it handed out before.
+        self.version_prefix = os.urandom(4).hex()
+        self.version_count = 0
+        self.version = "{0}-{1}".format(self.version_prefix, self.version_count)
+
+        # The callables told of each session that starts or ends, and the PIDs
+        # of the sessions killed but not yet seen to have ended.
+        self.listeners = []
+        self.killed_pids = set()
+
+        # Whether a scan is in progress, and when it started.
+        # :NOTE: Only one scan runs at a time. Readers that need a scan while
+        #        one is in progress wait for it and share its result, rather
+        #        than each scanning the process table.
+        self.scanning = False
+        self.scan_started_at = None
+
+        # Counts of the reads served from memory, the reads that scanned, and
+        # the reads that waited for another read's scan.
+        self.hits = 0
+        self.scans = 0
+        self.coalesced = 0
+
+        # Wakes the watcher up when the list is invalidated.
+        self.wakeup_read_fd, self.wakeup_write_fd = os.pipe()
+        os.set_blocking(self.wakeup_read_fd, False)
+        os.set_blocking(self.wakeup_write_fd, False)
+
+        # The pidfds of the Xvnc processes in the list, by PID, and the PIDs
+        # that have been seen to exit (which may linger as zombies).
+        self.pidfds = {}
+        self.exited_pids = set()
+
+        # The inotify instance and whether the socket directory is watched.
+        self.inotify_fd = None
+        self.x11_socket_dir_watched = False
+
+        self.watch_task = threading.Thread(target=self.watch,
+                                           name="session_inventory_thread",
+                                           daemon=True)
+
+
+    def start(self):
+        """
+        Starts the watcher thread.
+        """
+        self.watch_task.start()
+
+
+    def get(self, max_age=None, count=True):
+        """
+        Returns the list of sessions, rescanning it first if it is too old or
+        has been invalidated.
+
+        :param max_age: As for get_versioned().
+        :param count: As for get_versioned().
+        :return: A list of session dictionaries. The caller must not modify it.
+        """
+        return self.get_versioned(max_age, count)[0]
+
+
+    def get_versioned(self, max_age=None, count=True):
+        """
+        Returns the list of sessions and its version tag, rescanning it first
+        if it is too old or has been invalidated. If another thread is already
+        scanning, waits for that scan instead of starting another.
+
+        :param max_age: Number of seconds old the list may be, measured from
+                        the call. Defaults to max_staleness. 0 only accepts a
+                        scan started after the call.
+        :param count: Whether to include the read in the counters.
+        :return: A (sessions, version) tuple. sessions is a list of session
+                 dictionaries, which the caller must not modify.
+        """
+        if max_age is None:
+            max_age = self.max_staleness
+        oldest = time.monotonic() - max(max_age, 0)
+        waited = False
+        with self.condition:
+            while True:
+                if self.scanned_at is not None and self.scanned_at >= oldest:
+                    if count:
+                        if waited:
+                            self.coalesced += 1
+                        else:
+                            self.hits += 1
+                    return self.sessions, self.version
+                if not self.scanning:
+                    break
+                # :NOTE: A scan that started too long ago is waited for too,
+                #        after which one of the waiters starts the next scan
+                #        and the rest wait for that.
+                waited = True
+                self.condition.wait()
+
+            # Scan without holding the lock, so that fresh enough reads
+            # aren't held up behind it.
+            self.scanning = True
+            self.scan_started_at = time.monotonic()
+            if count:
+                self.scans += 1
+            try:
+                self.condition.release()
+                try:
+                    sessions = self.scan()
+                finally:
+                    self.condition.acquire()
+                if sessions != self.sessions:
+                    self.version_count += 1
+                    self.version = "{0}-{1}".format(self.version_prefix, self.version_count)
+                    self.notify_listeners(self.sessions, sessions)
+                self.sessions = sessions
+                # A list invalidated while it was being scanned is out of date
+                # already, though still the best there is for this read.
+                if self.invalidated_at is None or self.invalidated_at < self.scan_started_at:
+                    self.scanned_at = self.scan_started_at
+                return self.sessions, self.version
+            finally:
+                self.scanning = False
+                self.condition.notify_all()
+
+
+    def notify_listeners(self, old_sessions, new_sessions):
+        """
+        Tells the listeners about the sessions that started or ended between
+        two lists. The lock must be held, and version must already be that of
+        the new list.
+
+        :param old_sessions: The list of sessions before the scan.
+        :param new_sessions: The list of sessions after the scan.
+        """
+        old_pids = {session["pid"] for session in old_sessions}
+        new_pids = {session["pid"] for session in new_sessions}
+        events = []
+        for session in old_sessions:
+            if session["pid"] not in new_pids:
+                if session["pid"] in self.killed_pids:
+                    events.append(("session_killed", session))
+                else:
+                    events.append(("session_exited", session))
+        for session in new_sessions:
+            if session["pid"] not in old_pids:
+                events.append(("session_started", session))
+        self.killed_pids &= new_pids
+
+        for event, session in events:
+            self.log.debug("{0}: {1}".format(event, session))
+            for listener in self.listeners:
+                try:
+                    listener(event, session, self.version)
+                except Exception:
+                    self.log.exception("Session event listener failed")
+
+
+    def subscribe(self, listener):
+        """
+        Adds a listener to be told of each session that starts or ends, and
+        returns the list of sessions it should start from.
+
+        :param listener: A callable taking the event name (session_started,
+                         session_exited or session_killed), the session
+                         dictionary and the version of the new list. It is
+                         called with the lock held, from whichever thread
+                         scanned, so it must not block or call back into
+                         the inventory.
+        :return: A (sessions, version) tuple, as for get_versioned(). Every
+                 change after this list is passed to the listener.
+        """
+        self.get_versioned()
+        with self.condition:
+            self.listeners.append(listener)
+            return self.sessions, self.version
+
+
+    def unsubscribe(self, listener):
+        """
+        Removes a listener added by subscribe().
+
+        :param listener: The listener.
+        """
+        with self.condition:
+            self.listeners.remove(listener)
+
+
+    def killed(self, pid):
+        """
+        Records that a session was killed, so that its end is reported as
+        session_killed rather than session_exited, and invalidates the list.
+
+        :param pid: The PID of the session.
+        """
+        with self.condition:
+            self.killed_pids.add(pid)
+        self.invalidate()
+
+
+    def stats(self):
+        """
+        Returns the read counters.
+
+        :return: A dictionary with the keys hits, scans and coalesced.
+        """
+        with self.condition:
+            return {"hits": self.hits,
+                    "scans": self.scans,
+                    "coalesced": self.coalesced}
+
+
+    def invalidate(self):
+        """
+        Marks the list as out of date, so the next read rescans it. Safe to
+        call from any thread.
+        """
+        self.mark_stale()
+        try:
+            os.write(self.wakeup_write_fd, b"\0")
+        except BlockingIOError:
+            # The watcher already has a wake up waiting.
+            pass
+
+
+    def mark_stale(self):
+        """
+        Marks the list as out of date, without waking the watcher.
+        """
+        with self.condition:
+            self.scanned_at = None
+            self.invalidated_at = time.monotonic()
+
+
+    def watch(self):
+        """
+        Invalidates and refreshes the list when it may be out of date. Runs
+        as a seperate thread.
+        """
+        self.open_inotify()
+        while True:
+            try:
+                self.watch_once()
+            except Exception:
+                # :NOTE: A failed scan or wait mustn't stop the watcher, or
+                #        the list would only be refreshed by reads from then
+                #        on. The list is marked out of date and the watcher
+                #        tries again after a pause.
+                self.log.exception("Session watcher failed")
+                self.mark_stale()
+                time.sleep(self.retry_interval)
+
+
+    def watch_once(self):
+        """
+        Refreshes the list if it is due, then waits for something that may
+        invalidate it, or for it to be due a refresh.
+        """
+        # Refresh the list if it is due, and track the processes in it.
+        sessions = self.get(max_age=self.refresh_interval, count=False)
+        pids = {session["pid"] for session in sessions}
+        self.track_pids(pids)
+        self.watch_x11_socket_dir()
+
+        # Wait for something to happen, or for the list to be due a refresh.
+        with self.condition:
+            if self.scanned_at is None:
+                timeout = 0
+            else:
+                timeout = max(self.scanned_at + self.refresh_interval - time.monotonic(), 0)
+        # :NOTE: poll() is used rather than select(), which can't wait on fds
+        #        numbered 1024 or above, and there is a pidfd per session.
+        poller = select.poll()
+        poller.register(self.wakeup_read_fd, select.POLLIN)
+        for pidfd in self.pidfds.values():
+            poller.register(pidfd, select.POLLIN)
+        if self.inotify_fd is not None:
+            poller.register(self.inotify_fd, select.POLLIN)
+        events = poller.poll(timeout * 1000)
+
+        # Work out whether anything that happened invalidates the list.
+        invalidated = False
+        for fd, event in events:
+            if fd == self.wakeup_read_fd:
+                self.drain(fd)
+            elif fd == self.inotify_fd:
+                self.drain(fd)
+                self.log.debug("X11 socket directory changed.")
+                invalidated = True
+            else:
+                # :NOTE: The pidfd stays readable once the process has
+                #        exited, so it is closed and the PID isn't tracked
+                #        again, in case it lingers in the list as a zombie.
+                for pid, pidfd in list(self.pidfds.items()):
+                    if pidfd == fd:
+                        self.log.debug("Tracked Xvnc process {} exited.".format(pid))
+                        os.close(self.pidfds.pop(pid))
+                        self.exited_pids.add(pid)
+                invalidated = True
+        if invalidated:
+            self.mark_stale()
+
+
+    def drain(self, fd):
+        """
+        Reads and discards everything waiting on a non-blocking fd.
+
+        :param fd: The file descriptor.
+        """
+        try:
+            while os.read(fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+    def track_pids(self, pids):
+        """
+        Opens pidfds for the PIDs not yet tracked and closes those for PIDs no
+        longer in the list.
+
+        :param pids: The set of PIDs (strings) in the list.
+        """
+        for pid in list(self.pidfds):
+            if pid not in pids:
+                os.close(self.pidfds.pop(pid))
+        self.exited_pids &= pids
+        if not hasattr(os, "pidfd_open"):
+            return
+        for pid in pids:
+            if pid not in self.pidfds and pid not in self.exited_pids:
+                try:
+                    self.pidfds[pid] = os.pidfd_open(int(pid))
+                except OSError:
+                    # The process has already exited; the next refresh drops it.
+                    pass
+
+
+    def open_inotify(self):
+        """
+        Creates the inotify instance used to watch the X11 socket directory.
+        Leaves inotify_fd as None if inotify isn't available.
+        """
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = self.libc.inotify_init1(IN_NONBLOCK)
+        except (OSError, AttributeError):
+            fd = -1
+        if fd < 0:
+            self.log.warning("inotify is unavailable. Relying on pidfds and refresh_interval.")
+            return
+        self.inotify_fd = fd
+
+
+    def watch_x11_socket_dir(self):
+        """
+        Adds an inotify watch on the X11 socket directory, if there isn't one
+        already. The directory only exists once an X server has been started,
+        so this is retried on each pass of the watcher.
+        """
+        if self.inotify_fd is None or self.x11_socket_dir_watched:
+            return
+        wd = self.libc.inotify_add_watch(self.inotify_fd,
+                                         os.fsencode(self.x11_socket_dir),
+                                         IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+        if wd >= 0:
+            self.log.debug("Watching {}".format(self.x11_socket_dir))
+            self.x11_socket_dir_watched = True
@@ -1,11 +1,102 @@
+import collections
 import datetime
+import time
+
+
+# A frozen copy of a SessionServerInfo object that can be handed to other
+# threads without holding the lock that protects the original.
+SessionServerSnapshot = collections.namedtuple("SessionServerSnapshot",
+                                               ["hostname",
+                                                "ip_address",
+                                                "port",
+                                                "first_seen",
+                                                "last_seen",
+                                                "health"],
+                                               defaults=[None])
+
+
+class ServerHealth(collections.namedtuple("ServerHealth",
+                                          ["load_avg",
+                                           "cpu_count",
+                                           "mem_available",
+                                           "session_count",
+                                           "free_displays",
+                                           "inventory_version"])):
+    """
+    The health and capacity of a session-server, as last announced.
+
+    load_avg is a tuple of the 1, 5 and 15 minute load averages, and
+    mem_available the MiB of memory available, or None if the session-server
+    didn't say.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_fields(cls, msg_fields):
+        """
+        Pulls the health fields out of an announce message.
+
+        :param msg_fields: A dictionary of the announce message fields.
+        :return: A ServerHealth, or None if the message has no health fields
+                 (e.g. it is from an older session-server) or they are malformed.
+        """
+        if "load_avg" not in msg_fields:
+            return None
+        try:
+            load_avg = tuple(float(load) for load in msg_fields["load_avg"].split(","))
+            mem_available = msg_fields.get("mem_available")
+            return cls(load_avg,
+                       int(msg_fields["cpu_count"]),
+                       None if mem_available is None else int(mem_available),
+                       int(msg_fields["session_count"]),
+                       int(msg_fields["free_displays"]),
+                       msg_fields.get("inventory_version", ""))
+        except (KeyError, ValueError):
+            return None
+
+    @property
+    def load_per_cpu(self):
+        """
+        The 1 minute load average divided by the number of CPUs.
+        """
+        return self.load_avg[0] / max(self.cpu_count, 1)
+
 
 class SessionServerInfo(object):
     """
     A class to hold information that describes a session-server.
+
+    The fields are plain attributes held in __slots__ so that each instance
+    is small and updating them on every announce message is a simple store.
+
+    Liveness is tracked with last_heard, a time.monotonic() value that is not
+    affected by changes to the wall-clock. The first_seen and last_seen
+    wall-clock times are kept for display only.
+
+    announce_interval holds a smoothed estimate of the number of seconds
+    between announce messages from the session-server, or None until two
+    announce messages have been heard.
+
+    health holds the ServerHealth from the latest announce message, or None if
+    the session-server doesn't announce its health.
     """
 
-    def __init__(self, hostname=None, ip_address=None, port=None, last_seen=None):
+    # Announce messages heard closer together than this many seconds are
+    # treated as duplicates (e.g. the same announce sent both by broadcast
+    # and unicast) and don't count towards the announce interval.
+    MIN_ANNOUNCE_INTERVAL = 1.0
+
+    __slots__ = ("hostname",
+                 "ip_address",
+                 "port",
+                 "first_seen",
+                 "last_seen",
+                 "last_heard",
+                 "announce_interval",
+                 "health")
+
+    def __init__(self, hostname=None, ip_address=None, port=None, last_seen=None, last_heard=None):
         """
         Class constructor.
 
@@ -13,6 +104,8 @@ class SessionServerInfo(object):
         :param ip_address:  String ip address of the session server. Optional.
         :param port: Integer port of the session server. Optional.
         :param last_seen: DateTime last_seen time of the last announcement from the session server. Optional.
+        :param last_heard: Float time.monotonic() time of the last announcement from the session server.
+                           Optional. Defaults to now if last_seen is given.
         :return:
         """
 
@@ -21,45 +114,69 @@ class SessionServerInfo(object):
         assert ip_address is None or isinstance(ip_address, str)
         assert port is None or isinstance(port, int)
         assert last_seen is None or isinstance(last_seen, datetime.datetime)
+        assert last_heard is None or isinstance(last_heard, (int, float))
 
-        self._hostname = hostname
-        self._ip_address = ip_address
-        self._port = port
-        self._last_seen = last_seen
+        if last_heard is None and last_seen is not None:
+            last_heard = time.monotonic()
 
+        self.hostname = hostname
+        self.ip_address = ip_address
+        self.port = port
+        self.first_seen = last_seen
+        self.last_seen = last_seen
+        self.last_heard = last_heard
+        self.announce_interval = None
+        self.health = None
 
-    @property
-    def hostname(self):
-        return self._hostname
 
-    @hostname.setter
-    def hostname(self, val):
-        assert isinstance(val, str)
-        self._hostname = val
+    def heard(self, now=None, wall_now=None):
+        """
+        Records that an announce message was received from the session-server.
 
-    @property
-    def ip_address(self):
-        return self._ip_address
+        :param now: Float time.monotonic() time the message was received. Optional.
+        :param wall_now: DateTime wall-clock time the message was received. Optional.
+        """
+        if now is None:
+            now = time.monotonic()
 
-    @ip_address.setter
-    def ip_address(self, val):
-        assert isinstance(val, str)
-        self._ip_address = val
+        # Fold the time since the last announce into the announce interval
+        # estimate using an exponentially weighted moving average.
+        if self.last_heard is not None:
+            interval = now - self.last_heard
+            if interval < self.MIN_ANNOUNCE_INTERVAL:
+                pass
+            elif self.announce_interval is None:
+                self.announce_interval = interval
+            else:
+                self.announce_interval += (interval - self.announce_interval) / 4
 
-    @property
-    def port(self):
-        return self._port
+        self.last_heard = now
+        self.last_seen = datetime.datetime.now() if wall_now is None else wall_now
+        if self.first_seen is None:
+            self.first_seen = self.last_seen
 
-    @port.setter
-    def port(self, val):
-        assert isinstance(val, int)
-        self._port = val
 
-    @property
-    def last_seen(self):
-        return self._last_seen
+    def silent_for(self, now=None):
+        """
+        Returns the number of seconds since an announce message was received
+        from the session-server, or None if one never was.
+
+        :param now: Float time.monotonic() time to measure against. Optional.
+        """
+        if self.last_heard is None:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return now - self.last_heard
+
 
-    @last_seen.setter
-    def last_seen(self, val):
-        assert isinstance(val, datetime.datetime)
-        self._last_seen = val
+    def snapshot(self):
+        """
+        Returns a SessionServerSnapshot (an immutable copy) of this object.
+        """
+        return SessionServerSnapshot(self.hostname,
+                                     self.ip_address,
+                                     self.port,
+                                     self.first_seen,
+                                     self.last_seen,
+                                     self.health)
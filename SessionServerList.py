@@ -1,5 +1,24 @@
+import bisect
+import collections
+import heapq
+import itertools
+
 from SessionServerInfo import SessionServerInfo
 
+
+# The kinds of change published on the change feed of a SessionServerList.
+ADDED = "added"
+UPDATED = "updated"
+REMOVED = "removed"
+
+# An entry on the change feed. The server is a SessionServerSnapshot of the
+# session-server as it was just after the change.
+SessionServerChange = collections.namedtuple("SessionServerChange",
+                                             ["version",
+                                              "kind",
+                                              "server"])
+
+
 class SessionServerList(list):
     """
     A class that maintains a sorted list of SessionServerInfo objects.
@@ -8,37 +27,397 @@ class SessionServerList(list):
     work with SessionServerInfo objects and that the insert(), reverse()
     and sort() methods are unavailable (they don't make sense in a
     #sorted list), this class maintains the API exposed by the list() class.
+
+    Internally, the list keeps a hash index of the servers by IP address
+    and a parallel list of sort keys so that look-ups by IP address are
+    O(1) and new servers are placed with a binary search instead of
+    re-sorting the whole list.
+
+    It also keeps a min-heap of the time each server is next due to expire
+    so that stale servers can be found without scanning the whole list.
+
+    Every change to the membership of the list, or to the hostname or port
+    of a server in it, is published on a change feed as a SessionServerChange
+    with a version number that increases by one per change. Consumers can
+    replay the changes since the last version they saw with changes_since(),
+    or subscribe() a callback to hear about changes as they are made.
     """
 
-    def __init__(self, iterable=[]):
-        # Confirm all items in iterable are of type SessionServerInfo
-        for item in iterable:
-            assert isinstance(item, SessionServerInfo)
-        super().__init__(iterable)
+    def __init__(self, iterable=[], history=4096):
+        # The sort keys, kept in the same order as the list itself, and
+        # the hash index of IP address to SessionServerInfo object.
+        self._keys = []
+        self._by_ip = {}
+
+        # A min-heap of (deadline, sequence number, ip address) entries and
+        # the sequence number of the one live heap entry for each IP address.
+        # Heap entries whose sequence number doesn't match are stale and are
+        # skipped.
+        self._deadlines = []
+        self._scheduled = {}
+        self._sequence = itertools.count()
+
+        # The change feed: the version number of the latest change, a bounded
+        # history of the most recent changes and the subscribed callbacks.
+        self._version = 0
+        self._changes = collections.deque(maxlen=history)
+        self._subscribers = []
+
+        super().__init__()
 
         if iterable is not None:
-            self._sort_by_hostname()
+            # Confirm all items in iterable are of type SessionServerInfo
+            items = list(iterable)
+            for item in items:
+                assert isinstance(item, SessionServerInfo)
+            for item in items:
+                self._insert_sorted(item)
 
     def append(self, item):
         assert isinstance(item, SessionServerInfo)
-        super().append(item)
-        self._sort_by_hostname()
+        self._insert_sorted(item)
 
     def extend(self, iterable):
-        for item in iterable:
+        items = list(iterable)
+        for item in items:
             assert isinstance(item, SessionServerInfo)
-        super().extend(iterable)
-        self._sort_by_hostname()
+        for item in items:
+            self._insert_sorted(item)
+
+    def __iadd__(self, iterable):
+        self.extend(iterable)
+        return self
+
+    def remove(self, item):
+        idx = self.index(item)
+        self._remove_at(idx)
+
+    def pop(self, index=-1):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("pop index out of range")
+        return self._remove_at(index)
+
+    def clear(self):
+        for item in list(self):
+            self._publish(REMOVED, item)
+        super().clear()
+        self._keys.clear()
+        self._by_ip.clear()
+        self._deadlines.clear()
+        self._scheduled.clear()
+
+    def index(self, item, *args):
+        # Use the sort key to find the item with a binary search rather than
+        # the linear scan done by list.index().
+        if isinstance(item, SessionServerInfo) and not args:
+            idx = self._find(item)
+            if idx is not None:
+                return idx
+        return super().index(item, *args)
+
+    def __contains__(self, item):
+        if isinstance(item, SessionServerInfo):
+            return self._find(item) is not None
+        return False
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            for idx in sorted(range(*index.indices(len(self))), reverse=True):
+                self._remove_at(idx)
+        else:
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("list assignment index out of range")
+            self._remove_at(index)
+
+
+    def get_by_ip(self, ip_address, default=None):
+        """
+        Returns the SessionServerInfo object with the given IP address.
+
+        :param ip_address: String IP address of the session-server to find.
+        :param default: The value to return if no server has the IP address.
+        :return: A SessionServerInfo object or the default value.
+        """
+        return self._by_ip.get(ip_address, default)
+
+    def remove_by_ip(self, ip_address):
+        """
+        Removes the session-server with the given IP address from the list.
+
+        :param ip_address: String IP address of the session-server to remove.
+        :return: The SessionServerInfo object that was removed.
+        :raises KeyError: If no session-server has the IP address.
+        """
+        item = self._by_ip[ip_address]
+        return self._remove_at(self.index(item))
+
+    def get_by_hostname(self, hostname):
+        """
+        Returns a list of the SessionServerInfo objects with the given hostname.
+
+        :param hostname: String hostname of the session-server(s) to find.
+        :return: A (possibly empty) list of SessionServerInfo objects.
+        """
+        start = bisect.bisect_left(self._keys, (hostname, ""))
+        matches = []
+        for idx in range(start, len(self)):
+            if self._keys[idx][0] != hostname:
+                break
+            matches.append(list.__getitem__(self, idx))
+        return matches
+
+    def iter_hostnames(self, start=None, stop=None):
+        """
+        Iterates, in hostname order, over the session-servers with a hostname
+        in the range [start, stop). Finding the first item is O(log n).
+
+        :param start: String hostname to start from. None starts at the beginning.
+        :param stop: String hostname to stop before. None runs to the end.
+        """
+        if start is None:
+            idx = 0
+        else:
+            idx = bisect.bisect_left(self._keys, (start, ""))
+        if stop is None:
+            end = len(self)
+        else:
+            end = bisect.bisect_left(self._keys, (stop, ""))
+        for idx in range(idx, end):
+            yield list.__getitem__(self, idx)
+
+    def update_hostname(self, item, hostname):
+        """
+        Changes the hostname of a session-server in the list and moves it to
+        its new sorted position.
+
+        :param item: The SessionServerInfo object to update.
+        :param hostname: The new string hostname of the session-server.
+        """
+        self.update(item, hostname=hostname)
+
+    def update(self, item, hostname=None, port=None, health=None):
+        """
+        Changes the hostname, port and/or health of a session-server in the
+        list, keeping it at its sorted position, and publishes an "updated"
+        change if anything was different.
+
+        :param item: The SessionServerInfo object to update.
+        :param hostname: The new string hostname of the session-server. Optional.
+        :param port: The new integer port of the session-server. Optional.
+        :param health: The new ServerHealth of the session-server. Optional.
+        :return: True if the session-server was changed.
+        """
+        changed = False
+        if hostname is not None and hostname != item.hostname:
+            idx = self.index(item)
+            self._unlink(idx)
+            item.hostname = hostname
+            self._link(item)
+            changed = True
+        if port is not None and port != item.port:
+            item.port = port
+            changed = True
+        if health is not None and health != item.health:
+            item.health = health
+            changed = True
+        if changed:
+            self._publish(UPDATED, item)
+        return changed
+
+
+    @property
+    def version(self):
+        """
+        The version number of the latest change made to the list.
+        """
+        return self._version
+
+    def changes_since(self, version):
+        """
+        Returns the changes made to the list after the given version, oldest
+        first. If the history no longer reaches back that far, None is returned
+        and the caller should resynchronise with snapshot().
+
+        :param version: The integer version number the caller last saw.
+        :return: A list of SessionServerChange tuples, or None.
+        """
+        if version >= self._version:
+            return []
+        count = self._version - version
+        if count > len(self._changes):
+            return None
+        return list(itertools.islice(self._changes, len(self._changes) - count, None))
+
+    def snapshot(self):
+        """
+        Returns the current version number and a list of SessionServerSnapshot
+        tuples of the servers in the list, in hostname order.
+        """
+        return self._version, [item.snapshot() for item in self]
+
+    def subscribe(self, callback, since_version=None):
+        """
+        Registers a callback to be passed each SessionServerChange as it is
+        published. Callbacks are called by the thread making the change, with
+        whatever lock protects the list held, so they should be quick.
+
+        :param callback: A callable that takes a SessionServerChange.
+        :param since_version: If given, the changes made after this version are
+                              replayed to the callback first.
+        :raises ValueError: If the changes to replay are no longer in the history.
+        """
+        if since_version is not None:
+            changes = self.changes_since(since_version)
+            if changes is None:
+                raise ValueError("Changes since version {} are no longer available".format(since_version))
+            for change in changes:
+                callback(change)
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """
+        Removes a callback registered with subscribe().
+        """
+        self._subscribers.remove(callback)
+
+
+    def next_deadline(self):
+        """
+        Returns the earliest time.monotonic() time that a session-server in the
+        list may expire, or None if the list is empty. The time may be early
+        (a server may have been heard from since). It may also be late: a
+        check is scheduled with the time-to-live known at the time, so if a
+        server's time-to-live shrinks afterwards (e.g. it starts announcing
+        more often), it expires late by at most the amount it shrank.
+        """
+        while self._deadlines:
+            deadline, sequence, ip_address = self._deadlines[0]
+            if self._scheduled.get(ip_address) == sequence:
+                return deadline
+            heapq.heappop(self._deadlines)
+        return None
+
+    def pop_expired(self, now, ttl):
+        """
+        Removes and returns the session-servers that have not been heard from
+        within their time-to-live. Only the servers due to expire are looked at,
+        so the cost is proportional to the number of expirations and not the
+        size of the list.
+
+        :param now: Float time.monotonic() time to check the deadlines against.
+        :param ttl: A callable that is passed a SessionServerInfo object and returns
+                    the number of seconds the server may stay silent before it expires.
+        :return: A list of the SessionServerInfo objects that were removed.
+        """
+        expired = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, sequence, ip_address = heapq.heappop(self._deadlines)
+            if self._scheduled.get(ip_address) != sequence:
+                # Stale entry; the server was removed or rescheduled.
+                continue
+            item = self._by_ip[ip_address]
+            if item.last_heard is None:
+                new_deadline = now
+            else:
+                new_deadline = item.last_heard + ttl(item)
+            if new_deadline <= now:
+                expired.append(self._remove_at(self.index(item)))
+            else:
+                # The server was heard from since this entry was scheduled.
+                self._schedule(ip_address, new_deadline)
+        return expired
+
+
+    @staticmethod
+    def _sort_key(item):
+        """
+        A private method that returns the key used to order the list. The
+        IP address breaks ties between session-servers with the same hostname.
+        """
+        return (item.hostname or "", item.ip_address or "")
 
+    def _find(self, item):
+        """
+        A private method that uses a binary search to find the index of
+        the item in the list. Returns None if the item is not in the list.
+        """
+        key = self._sort_key(item)
+        idx = bisect.bisect_left(self._keys, key)
+        while idx < len(self) and self._keys[idx] == key:
+            if list.__getitem__(self, idx) is item:
+                return idx
+            idx += 1
+        return None
 
-    def _sort_by_hostname(self):
+    def _insert_sorted(self, item):
         """
-        A private method that sorts the underlying list in-place
+        A private method that places the item at its sorted position
         by the hostname of the SessionServerInfo object.
+        """
+        if item.ip_address in self._by_ip:
+            raise ValueError("A session-server with IP address {} is already in the list".format(item.ip_address))
+        self._link(item)
+        self._by_ip[item.ip_address] = item
+        self._publish(ADDED, item)
+
+        # Schedule the server for an expiry check. The last time it was
+        # heard from is used as the deadline because it is the earliest
+        # the server could expire; the real deadline is worked out once
+        # the time-to-live is known.
+        self._schedule(item.ip_address, item.last_heard or 0.0)
 
-        :return:
+    def _remove_at(self, idx):
         """
-        super().sort(key=lambda x: x.hostname)
+        A private method that removes the item at the index, keeping the
+        sort keys, hash index and expiry schedule in step with the list.
+        """
+        item = self._unlink(idx)
+        del self._by_ip[item.ip_address]
+        self._scheduled.pop(item.ip_address, None)
+        self._publish(REMOVED, item)
+        return item
+
+    def _link(self, item):
+        """
+        A private method that places the item and its sort key in the list.
+        """
+        key = self._sort_key(item)
+        idx = bisect.bisect_right(self._keys, key)
+        self._keys.insert(idx, key)
+        super().insert(idx, item)
+
+    def _unlink(self, idx):
+        """
+        A private method that takes the item and its sort key out of the list.
+        """
+        item = list.__getitem__(self, idx)
+        super().__delitem__(idx)
+        del self._keys[idx]
+        return item
+
+    def _publish(self, kind, item):
+        """
+        A private method that records a change on the change feed and passes
+        it to the subscribers.
+        """
+        self._version += 1
+        change = SessionServerChange(self._version, kind, item.snapshot())
+        self._changes.append(change)
+        for callback in self._subscribers:
+            callback(change)
+
+    def _schedule(self, ip_address, deadline):
+        """
+        A private method that pushes an expiry check for the IP address on to
+        the deadline heap, superseding any check already scheduled for it.
+        """
+        sequence = next(self._sequence)
+        self._scheduled[ip_address] = sequence
+        heapq.heappush(self._deadlines, (deadline, sequence, ip_address))
 
 
     # Mark these mothods not-implemented as they don't make sense
@@ -52,3 +431,5 @@ class SessionServerList(list):
     def sort(key=None, reverse=False):
         raise NotImplementedError
 
+    def __setitem__(self, index, item):
+        raise NotImplementedError
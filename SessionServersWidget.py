@@ -1,5 +1,6 @@
 import sys
 import os
+import bisect
 import threading
 import logging
 import logging.handlers
@@ -9,6 +10,18 @@ from tkinter import *
 from tkinter import ttk
 from PIL import ImageTk, Image
 
+import KeepTreeviewView
+import VirtualTreeview
+
+
+# The capacity columns the rows can be sorted by, and how each gets its sort
+# value from a SessionServerInfo.ServerHealth. The most capacity sorts first.
+# A value of None (unknown) sorts last.
+CAPACITY_SORT_VALUES = {"Load": lambda health: health.load_per_cpu,
+                        "Free Mem": lambda health: None if health.mem_available is None else -health.mem_available,
+                        "Sessions": lambda health: health.session_count,
+                        "Free Displays": lambda health: -health.free_displays}
+
 
 class SessionServersWidget(object):
     """
@@ -16,11 +29,13 @@ class SessionServersWidget(object):
     The "View" in the MVC pattern.
     """
 
-    def __init__(self, parent):
+    def __init__(self, parent, virtual=False):
         """
         Constructs the GUI widget.
 
         :param parent: A Tk widget that acts as the parent to this widget.
+        :param virtual: If True, only the rows in view are created as Tk items
+                        (see VirtualTreeview).
         """
         # Determine where the source code is to be found
         # :NOTE: Refer to documentation of sys.path for why this works.
@@ -46,17 +61,26 @@ class SessionServersWidget(object):
 
         # Create the TreeView component that will display the list of session-servers.
         self.session_server_tv = ttk.Treeview(self.session_servers_frame)
+        if virtual:
+            self.session_server_tv = VirtualTreeview.VirtualTreeview(self.session_server_tv)
         self.session_server_tv.grid(column=0, row=0, padx=4, pady=4, sticky=(N, S, E, W))
         self.session_server_tv["selectmode"] = "browse"
-        self.session_server_tv["columns"] = ("Hostname", "IP Address", "Port")
+        self.session_server_tv["columns"] = ("Hostname", "IP Address", "Port", "Load", "Free Mem", "Sessions", "Free Displays")
         self.session_server_tv.column(column="#0", anchor="center", minwidth=40, stretch=False, width=40)
         self.session_server_tv.heading(column="#0", text="")
         self.session_server_tv.column(column="Hostname", anchor="e", minwidth=64, stretch=True, width=200)
-        self.session_server_tv.heading(column="Hostname", text="Hostname")
+        self.session_server_tv.heading(column="Hostname", text="Hostname",
+                                       command=lambda: self.sort_by("Hostname"))
         self.session_server_tv.column(column="IP Address", anchor="e", minwidth=64, stretch=False, width=140)
         self.session_server_tv.heading(column="IP Address", text="IP Address")
         self.session_server_tv.column(column="Port", anchor="e", minwidth=64, stretch=False, width=50)
         self.session_server_tv.heading(column="Port", text="Port")
+        # :NOTE: Clicking the heading of a capacity column sorts the rows by
+        #        it, and clicking Hostname puts them back in hostname order.
+        for column, width in (("Load", 50), ("Free Mem", 70), ("Sessions", 60), ("Free Displays", 90)):
+            self.session_server_tv.column(column=column, anchor="e", minwidth=40, stretch=False, width=width)
+            self.session_server_tv.heading(column=column, text=column,
+                                           command=lambda column=column: self.sort_by(column))
 
         # Create H and V scroll bars to allow changing the view point of the listbox.
         self.log_vscroll = ttk.Scrollbar(self.session_servers_frame, orient='vertical', command=self.session_server_tv.yview)
@@ -69,7 +93,18 @@ class SessionServersWidget(object):
 
         # Treeview widgets don't give you a way to iterate over their items. You
         # must store references to the items, yourself. Which is stupid...but, oh well...
-        self.items_in_tv = []
+        # :NOTE: The rows are keyed by the IP address of the session-server, which
+        #        maps to a (Treeview item, row values, health) tuple. row_keys
+        #        holds the sort key of each row (see row_key()) in display order.
+        self.items_in_tv = {}
+        self.row_keys = []
+
+        # The column the rows are sorted by.
+        self.sort_column = "Hostname"
+
+        # The version of the SessionServerList change feed the rows reflect,
+        # or None if the rows have not been synchronised with a list yet.
+        self.version = None
 
         # A list of method references to call when the selection changes and
         # register an initial handler to call when the treeview selection changes.
@@ -84,18 +119,21 @@ class SessionServersWidget(object):
         Clears the TreeView of all items.
         """
         self.log.debug("Clearing TreeView")
-        for item in self.items_in_tv:
+        for item, values, health in self.items_in_tv.values():
             self.session_server_tv.delete(item)
         self.items_in_tv.clear()
+        self.row_keys.clear()
+        self.version = None
 
 
-    def insert(self, idx, hostname, ip_address, port):
+    def insert(self, idx, hostname, ip_address, port, health=None):
         """
 
         :param idx:
         :param hostname:
         :param ip_address:
         :param port:
+        :param health: The SessionServerInfo.ServerHealth of the session-server, if known.
         :return:
         """
         index = 'end' if idx == -1 else idx
@@ -103,12 +141,155 @@ class SessionServersWidget(object):
                                                                 ip_address,
                                                                 port,
                                                                 index))
+        values = self.row_values(hostname, ip_address, port, health)
         new_item = self.session_server_tv.insert('',
                                                  index=index,
                                                  text='',
                                                  image=self.server_icon,
-                                                 values=(hostname, ip_address, port))
-        self.items_in_tv.append(new_item)
+                                                 values=values)
+        self.items_in_tv[ip_address] = (new_item, values, health)
+        self.row_keys.insert(len(self.row_keys) if idx == -1 else idx, self.row_key(hostname, ip_address, health))
+        return new_item
+
+
+    def upsert(self, hostname, ip_address, port, health=None):
+        """
+        Adds a row for the session-server, or updates its existing row, keeping
+        the rows sorted by the sort column. Nothing is done if the row is unchanged.
+
+        :param hostname: String hostname of the session-server.
+        :param ip_address: String IP address of the session-server. This is the row key.
+        :param port: Integer port of the session-server.
+        :param health: The SessionServerInfo.ServerHealth of the session-server, if known.
+        """
+        values = self.row_values(hostname, ip_address, port, health)
+        key = self.row_key(hostname, ip_address, health)
+        if ip_address in self.items_in_tv:
+            item, old_values, old_health = self.items_in_tv[ip_address]
+            if old_values == values and old_health == health:
+                return
+            self.log.debug("Updating item: {0}:{1}:{2}".format(hostname, ip_address, port))
+            self.session_server_tv.item(item, values=values)
+            self.items_in_tv[ip_address] = (item, values, health)
+            old_key = self.row_key(old_values[0], ip_address, old_health)
+            if old_key != key:
+                # The sort key changed so move the row to its new position.
+                del self.row_keys[bisect.bisect_left(self.row_keys, old_key)]
+                idx = bisect.bisect_left(self.row_keys, key)
+                self.row_keys.insert(idx, key)
+                self.session_server_tv.move(item, '', idx)
+        else:
+            self.insert(bisect.bisect_left(self.row_keys, key), hostname, ip_address, port, health)
+
+
+    def remove(self, ip_address):
+        """
+        Removes the row for the session-server, if there is one.
+
+        :param ip_address: String IP address of the session-server.
+        """
+        if ip_address not in self.items_in_tv:
+            return
+        item, values, health = self.items_in_tv.pop(ip_address)
+        self.log.debug("Removing item: {0}:{1}:{2}".format(*values))
+        del self.row_keys[bisect.bisect_left(self.row_keys, self.row_key(values[0], ip_address, health))]
+        self.session_server_tv.delete(item)
+
+
+    def apply_changes(self, changes):
+        """
+        Applies changes from the change feed of a SessionServerList to the rows.
+        Only the rows that changed are touched, so the selection and scroll
+        position are kept.
+
+        :param changes: An iterable of SessionServerList.SessionServerChange tuples.
+        """
+        with self.keep_view():
+            for change in changes:
+                server = change.server
+                if change.kind == "removed":
+                    self.remove(server.ip_address)
+                else:
+                    self.upsert(server.hostname, server.ip_address, server.port, server.health)
+
+
+    def reconcile(self, servers):
+        """
+        Brings the rows in line with a complete list of session-servers,
+        inserting, moving, updating or deleting only the rows that differ.
+
+        :param servers: An iterable of objects with hostname, ip_address, port and
+                        health attributes.
+        """
+        servers = list(servers)
+        with self.keep_view():
+            wanted = set(server.ip_address for server in servers)
+            for ip_address in [ip for ip in self.items_in_tv if ip not in wanted]:
+                self.remove(ip_address)
+            for server in servers:
+                self.upsert(server.hostname, server.ip_address, server.port, server.health)
+
+
+    def row_values(self, hostname, ip_address, port, health):
+        """
+        Builds the column values of a row.
+
+        :param hostname: String hostname of the session-server.
+        :param ip_address: String IP address of the session-server.
+        :param port: Integer port of the session-server.
+        :param health: The SessionServerInfo.ServerHealth of the session-server, or None.
+        :return: A tuple of the values, in column order. The capacity columns are
+                 blank if the health isn't known.
+        """
+        if health is None:
+            return (hostname, ip_address, port, "", "", "", "")
+        return (hostname,
+                ip_address,
+                port,
+                "{:.2f}".format(health.load_per_cpu),
+                "" if health.mem_available is None else "{} MiB".format(health.mem_available),
+                health.session_count,
+                health.free_displays)
+
+
+    def row_key(self, hostname, ip_address, health):
+        """
+        Builds the sort key of a row, for the column the rows are sorted by.
+
+        :param hostname: String hostname of the session-server.
+        :param ip_address: String IP address of the session-server.
+        :param health: The SessionServerInfo.ServerHealth of the session-server, or None.
+        :return: A tuple that sorts the rows in display order.
+        """
+        if self.sort_column not in CAPACITY_SORT_VALUES:
+            return (hostname, ip_address)
+        value = None if health is None else CAPACITY_SORT_VALUES[self.sort_column](health)
+        return (value is None, value or 0, hostname, ip_address)
+
+
+    def sort_by(self, column):
+        """
+        Sorts the rows by a column: Hostname, or one of the capacity columns,
+        with the most capacity first.
+
+        :param column: The name of the column.
+        """
+        self.log.debug("Sorting by {}".format(column))
+        self.sort_column = column
+        rows = sorted(self.items_in_tv.items(),
+                      key=lambda row: self.row_key(row[1][1][0], row[0], row[1][2]))
+        self.row_keys = [self.row_key(values[0], ip_address, health)
+                         for ip_address, (item, values, health) in rows]
+        for idx, (ip_address, (item, values, health)) in enumerate(rows):
+            self.session_server_tv.move(item, '', idx)
+
+
+    def keep_view(self):
+        """
+        Returns a context manager that keeps the row at the top of the view
+        at the top of the view while rows above it are added or removed.
+        """
+        return KeepTreeviewView.KeepTreeviewView(self.session_server_tv)
 
 
     def add_selection_event_handler(self, callback, *args):
@@ -135,6 +316,20 @@ class SessionServersWidget(object):
             handler(*args)
 
 
+    def select(self, ip_address):
+        """
+        Selects the row of a session-server and scrolls it into view, which
+        fires the selection event handlers as if the user had clicked it.
+
+        :param ip_address: String IP address of the session-server.
+        """
+        if ip_address not in self.items_in_tv:
+            return
+        item = self.items_in_tv[ip_address][0]
+        self.session_server_tv.selection_set(item)
+        self.session_server_tv.see(item)
+
+
     def get_selected_item_info(self):
         """
         Returns a dictionary of the columns names and their associated
@@ -158,4 +353,4 @@ class SessionServersWidget(object):
         vals = {}
         for idx, key in enumerate(keys):
             vals[key] = selected_vals[idx]
-        return vals
\ No newline at end of file
+        return vals
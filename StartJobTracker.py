@@ -0,0 +1,347 @@
+import os
+import socket
+import threading
+import itertools
+import time
+import logging
+
+
+# The states a start job goes through. A job ends up either ready or failed.
+RESERVED = "reserved"
+SPAWNED = "spawned"
+LISTENING = "listening"
+READY = "ready"
+FAILED = "failed"
+
+
+class StartJob(object):
+    """
+    A class that holds the progress of starting one VNC session.
+    """
+
+    def __init__(self, job_id, username, display_number):
+        """
+        Class constructor.
+
+        :param job_id: The unique ID of the job.
+        :param username: The user the session is started for.
+        :param display_number: The display the session is started on, as a string.
+        """
+        self.job_id = job_id
+        self.username = username
+        self.display_number = display_number
+        self.state = RESERVED
+        self.pid = None
+        self.error = None
+        self.stderr = None
+        self.created_at = time.monotonic()
+        self.finished_at = None
+
+
+    def is_finished(self):
+        """
+        :return: True if the job is ready or has failed.
+        """
+        return self.state in (READY, FAILED)
+
+
+    def get_fields(self):
+        """
+        Returns the details of the job as message fields.
+
+        :return: A dictionary with the keys job_id, state, username, display_number,
+                 elapsed and, where known, pid, error and stderr.
+        """
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        fields = {"job_id": self.job_id,
+                  "state": self.state,
+                  "username": self.username,
+                  "display_number": self.display_number,
+                  "elapsed": "{:.3f}".format(end - self.created_at)}
+        if self.pid is not None:
+            fields["pid"] = self.pid
+        if self.error is not None:
+            fields["error"] = self.error
+        if self.stderr:
+            fields["stderr"] = self.stderr
+        return fields
+
+
+class StartJobTracker(object):
+    """
+    A class that starts VNC sessions in the background and tracks each start
+    as a job, so that clients can be told when the session is actually
+    usable rather than when it was kicked off.
+
+    A job is reserved when it is created. It is spawned once the process that
+    runs vncserver has started, listening once Xvnc accepts connections on
+    port 5900 + display number, and then ready once the session shows up in
+    the inventory, with its PID. It fails if vncserver exits with an error
+    (its stderr is kept), or Xvnc isn't listening or the session doesn't
+    show up within start_timeout, in which case whatever the start left
+    running is killed.
+    """
+
+    def __init__(self, session_inventory, spawn, start_timeout=30.0, retention=300.0, max_wait=60.0,
+                 poll_interval=0.1):
+        """
+        Class constructor.
+
+        :param session_inventory: The SessionInventory of this host.
+        :param spawn: A callable taking the start_active_session message fields. It
+                      starts vncserver and returns an object following it, with
+                      an exitcode attribute (None while it runs), a join(timeout)
+                      method, a read_stderr() method returning what it wrote
+                      to stderr and a kill_process_group() method killing it and
+                      the Xvnc it started.
+        :param start_timeout: Number of seconds Xvnc has to start listening.
+        :param retention: Number of seconds finished jobs are kept for.
+        :param max_wait: The most seconds get() waits for a job to finish.
+        :param poll_interval: Number of seconds between checks for Xvnc listening.
+        """
+        # Configure logging
+        self.log = logging.getLogger("StartJobTracker")
+        self.log.debug("Starting up...")
+
+        self.session_inventory = session_inventory
+        self.spawn = spawn
+        self.start_timeout = start_timeout
+        self.retention = retention
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+
+        # The jobs by ID, and the condition that arbitrates access to them from
+        # different threads and is notified when one finishes.
+        self.jobs = {}
+        self.condition = threading.Condition()
+
+        # The callables to call once a job finishes, by job ID.
+        self.finish_callbacks = {}
+
+        # Unique job IDs. The random prefix keeps a restarted server from
+        # reusing the IDs it handed out before.
+        self.job_id_prefix = os.urandom(4).hex()
+        self.job_ids = itertools.count()
+
+
+    def reserve(self, msg_fields):
+        """
+        Creates a job to start a session, reserving its display.
+
+        :param msg_fields: A dictionary of the start_active_session message fields.
+        :return: The StartJob, or None if the display already has a job in progress.
+        """
+        with self.condition:
+            self.prune()
+            if msg_fields["display_number"] in self.reserved_displays():
+                return None
+            job = StartJob("{0}-{1}".format(self.job_id_prefix, next(self.job_ids)),
+                           msg_fields["username"],
+                           msg_fields["display_number"])
+            self.jobs[job.job_id] = job
+        self.log.info("Start job {0} reserved display {1}".format(job.job_id, job.display_number))
+        return job
+
+
+    def launch(self, job, msg_fields):
+        """
+        Starts the session of a reserved job in the background.
+
+        :param job: The StartJob returned by reserve().
+        :param msg_fields: A dictionary of the start_active_session message fields.
+        """
+        job_thread = threading.Thread(target=self.run_job,
+                                      name="start_job_{}".format(job.job_id),
+                                      args=(job, msg_fields),
+                                      daemon=True)
+        job_thread.start()
+
+
+    def get(self, job_id, wait=0):
+        """
+        Returns the details of a job, optionally waiting for it to finish.
+
+        :param job_id: The ID of the job.
+        :param wait: Number of seconds to wait for the job to finish. At most max_wait.
+        :return: A dictionary of the job fields, as for StartJob.get_fields(), or
+                 None if there is no such job.
+        """
+        deadline = time.monotonic() + min(wait, self.max_wait)
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            while not job.is_finished():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return job.get_fields()
+
+
+    def when_finished(self, job_id, callback):
+        """
+        Arranges for a callable to be called once a job has finished, so it
+        can be waited for without holding a thread as get() does.
+
+        :param job_id: The ID of the job.
+        :param callback: Called with no arguments once the job is ready or has
+                         failed. Called on the thread that finished the job,
+                         so it must not block.
+        :return: A callable that cancels the call, or None if there is no such
+                 job or it has already finished.
+        """
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.is_finished():
+                return None
+            self.finish_callbacks.setdefault(job_id, []).append(callback)
+
+        def cancel():
+            with self.condition:
+                callbacks = self.finish_callbacks.get(job_id, [])
+                if callback in callbacks:
+                    callbacks.remove(callback)
+                if not callbacks:
+                    self.finish_callbacks.pop(job_id, None)
+        return cancel
+
+
+    def reserved_displays(self):
+        """
+        :return: The set of display numbers (strings) with jobs in progress.
+        """
+        with self.condition:
+            return {job.display_number for job in self.jobs.values() if not job.is_finished()}
+
+
+    def prune(self):
+        """
+        Drops the jobs that finished more than retention seconds ago. The
+        lock must be held.
+        """
+        now = time.monotonic()
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.is_finished() and now - job.finished_at > self.retention]:
+            del self.jobs[job_id]
+
+
+    def set_state(self, job, state, error=None, stderr=None):
+        """
+        Moves a job on to a new state, waking anything waiting for it if it
+        has finished.
+
+        :param job: The StartJob.
+        :param state: The new state.
+        :param error: If the job failed, why.
+        :param stderr: If the job failed, what vncserver wrote to stderr.
+        """
+        callbacks = []
+        with self.condition:
+            job.state = state
+            job.error = error
+            job.stderr = stderr
+            if job.is_finished():
+                job.finished_at = time.monotonic()
+                self.condition.notify_all()
+                callbacks = self.finish_callbacks.pop(job.job_id, [])
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                self.log.exception("Start job callback failed")
+        if state == FAILED:
+            self.log.warning("Start job {0} failed: {1} {2}".format(job.job_id, error, stderr or ""))
+        else:
+            self.log.info("Start job {0} is {1}".format(job.job_id, state))
+
+
+    def run_job(self, job, msg_fields):
+        """
+        Starts the session of a job and follows it until it is ready or has
+        failed. Runs as a seperate thread.
+
+        :param job: The StartJob.
+        :param msg_fields: A dictionary of the start_active_session message fields.
+        """
+        try:
+            port = 5900 + int(job.display_number)
+        except ValueError:
+            self.set_state(job, FAILED, error="Invalid display number: {}".format(job.display_number))
+            return
+
+        try:
+            process = self.spawn(msg_fields)
+        except (OSError, KeyError) as ex:
+            self.set_state(job, FAILED, error="Could not spawn vncserver: {}".format(ex))
+            return
+        self.set_state(job, SPAWNED)
+        self.session_inventory.invalidate()
+
+        try:
+            # Wait for Xvnc to listen for viewers. vncserver exits once Xvnc
+            # has started, so it exiting with an error means the start failed.
+            deadline = time.monotonic() + self.start_timeout
+            while not self.is_listening(port):
+                if process.exitcode not in (None, 0):
+                    self.fail(job, process, "vncserver exited with status {}".format(process.exitcode))
+                    return
+                if time.monotonic() > deadline:
+                    self.fail(job, process,
+                              "Xvnc wasn't listening on port {0} after {1} seconds".format(port, self.start_timeout))
+                    return
+                time.sleep(self.poll_interval)
+            self.set_state(job, LISTENING)
+
+            # Wait for the new session to show up in the inventory, and take
+            # its PID.
+            while True:
+                for session in self.session_inventory.get(max_age=0):
+                    if str(session["display_number"]) == job.display_number:
+                        job.pid = session["pid"]
+                if job.pid is not None:
+                    break
+                if time.monotonic() > deadline:
+                    self.fail(job, process,
+                              "Session on display {0} wasn't found after {1} seconds".format(job.display_number,
+                                                                                            self.start_timeout))
+                    return
+                time.sleep(self.poll_interval)
+            self.set_state(job, READY)
+        except Exception as ex:
+            self.log.exception("Start job {} broke down".format(job.job_id))
+            self.fail(job, process, "Start broke down: {}".format(ex))
+        finally:
+            # :NOTE: Wait for vncserver to exit and be reaped, to avoid
+            #        leaving a zombie behind.
+            process.join(self.start_timeout)
+
+
+    def fail(self, job, process, error):
+        """
+        Fails a job whose vncserver has been spawned, killing vncserver and
+        any Xvnc it started, so a failed start doesn't leave a session running
+        that nothing knows about.
+
+        :param job: The StartJob.
+        :param process: The object following vncserver, returned by spawn.
+        :param error: Why the job failed.
+        """
+        try:
+            process.kill_process_group()
+        except OSError as ex:
+            self.log.warning("Could not kill the processes of start job {0}: {1}".format(job.job_id, ex))
+        self.set_state(job, FAILED, error=error, stderr=process.read_stderr())
+
+
+    def is_listening(self, port):
+        """
+        :param port: A TCP port on this host.
+        :return: True if something accepts connections on the port.
+        """
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=self.poll_interval):
+                return True
+        except OSError:
+            return False
+
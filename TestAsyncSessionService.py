@@ -0,0 +1,218 @@
+import unittest
+import socket
+import threading
+import asyncio
+import time
+
+import MortProtocol
+from AsyncSessionService import AsyncSessionService
+
+
+def handle_request(msg_fields, remote_addr):
+    """
+    Answers pings, and echoes the name of the thread that did the work. Fails
+    requests of type fail, and doesn't answer anything else.
+    """
+    if msg_fields.get("msg_type") == "fail":
+        raise RuntimeError("Failed")
+    if msg_fields.get("msg_type") != "ping":
+        return None
+    return {"msg_type": "pong", "thread": threading.current_thread().name}
+
+
+async def handle_wait(msg_fields, remote_addr):
+    """
+    Answers after a short wait, on the event loop.
+    """
+    await asyncio.sleep(0.2)
+    return {"msg_type": "waited"}
+
+
+class FakeSubscription(object):
+    """
+    A subscription handler that answers with a greeting, and records the push
+    callable and whether the subscription was cancelled.
+    """
+
+    def __init__(self):
+        self.push = None
+        self.subscribed = threading.Event()
+        self.cancelled = threading.Event()
+
+    def __call__(self, msg_fields, remote_addr, push):
+        self.push = push
+        self.subscribed.set()
+        return {"msg_type": "subscribed"}, self.cancelled.set
+
+
+class TestAsyncSessionService(unittest.TestCase):
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        self.subscription = FakeSubscription()
+        self.inst = AsyncSessionService(self.sock, handle_request, idle_timeout=5, max_connections=2, max_workers=1,
+                                        subscription_handlers={"subscribe": self.subscription}, max_subscriptions=1,
+                                        async_handlers={"wait": handle_wait})
+        threading.Thread(target=self.inst.run, daemon=True).start()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+
+    def connect(self):
+        client = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+        self.clients.append(client)
+        return client
+
+    def read_frames(self, client, count):
+        decoder = MortProtocol.FrameDecoder()
+        messages = []
+        while len(messages) < count:
+            try:
+                data = client.recv(16384)
+            except ConnectionResetError:
+                break
+            if not data:
+                break
+            messages += decoder.feed(data)
+        return messages
+
+    def test_legacy_request(self):
+        """
+        Send a legacy request and check it is answered in kind and the
+        connection is closed.
+        """
+        client = self.connect()
+        client.sendall(b"msg_type:ping\n")
+        resp = b""
+        while True:
+            data = client.recv(16384)
+            if not data:
+                break
+            resp += data
+        self.assertEqual(MortProtocol.decode_legacy(resp),
+                         {"msg_type": "pong", "thread": "session_worker_0"})
+
+    def test_pipelined_requests(self):
+        """
+        Send several framed requests at once and check each is answered, in
+        order, on the same connection, by the bounded worker pool.
+        """
+        client = self.connect()
+        client.sendall(b"".join(MortProtocol.encode_frame({"msg_type": "ping", "request_id": str(i)})
+                                for i in range(3)))
+        messages = self.read_frames(client, 3)
+        self.assertEqual([fields["request_id"] for version, fields in messages], ["0", "1", "2"])
+        self.assertEqual({fields["thread"] for version, fields in messages}, {"session_worker_0"})
+
+    def test_error_responses(self):
+        """
+        Send framed requests that aren't answered or that fail, pipelined with
+        a ping, and check each gets an error response with its request_id.
+        """
+        client = self.connect()
+        with self.assertLogs("AsyncSessionService", "ERROR"):
+            client.sendall(MortProtocol.encode_frame({"msg_type": "unknown", "request_id": "0"}) +
+                           MortProtocol.encode_frame({"msg_type": "fail", "request_id": "1"}) +
+                           MortProtocol.encode_frame({"msg_type": "ping", "request_id": "2"}))
+            messages = self.read_frames(client, 3)
+        self.assertEqual([fields for version, fields in messages[:2]],
+                         [{"msg_type": "error", "error": "no response", "request_id": "0"},
+                          {"msg_type": "error", "error": "internal error", "request_id": "1"}])
+        self.assertEqual(messages[2][1]["msg_type"], "pong")
+
+    def test_async_handler(self):
+        """
+        Send a request with an async handler and check it doesn't hold up a
+        request on another connection, though there is only one worker.
+        """
+        waiting = self.connect()
+        waiting.sendall(MortProtocol.encode_frame({"msg_type": "wait", "request_id": "1"}))
+        start = time.monotonic()
+        pinging = self.connect()
+        pinging.sendall(MortProtocol.encode_frame({"msg_type": "ping"}))
+        self.assertEqual(self.read_frames(pinging, 1)[0][1]["msg_type"], "pong")
+        self.assertLess(time.monotonic() - start, 0.2)
+        self.assertEqual(self.read_frames(waiting, 1), [(1, {"msg_type": "waited", "request_id": "1"})])
+
+    def test_max_connections(self):
+        """
+        Open more connections than allowed and check the extra one is answered
+        with a busy error and closed.
+        """
+        first = self.connect()
+        second = self.connect()
+        first.sendall(MortProtocol.encode_frame({"msg_type": "ping"}))
+        second.sendall(MortProtocol.encode_frame({"msg_type": "ping"}))
+        self.assertEqual(len(self.read_frames(first, 1)), 1)
+        self.assertEqual(len(self.read_frames(second, 1)), 1)
+
+        third = self.connect()
+        third.sendall(MortProtocol.encode_frame({"msg_type": "ping", "request_id": "3"}))
+        messages = self.read_frames(third, 2)
+        self.assertEqual([fields for version, fields in messages],
+                         [{"msg_type": "error", "error": "busy", "request_id": "3"}])
+        self.assertTrue(MortProtocol.is_busy(messages[0][1]))
+
+        # Legacy clients are answered in kind.
+        fourth = self.connect()
+        fourth.sendall(b"msg_type:ping\n")
+        self.assertEqual(MortProtocol.decode_legacy(fourth.recv(16384)), {"msg_type": "error", "error": "busy"})
+
+    def test_subscription(self):
+        """
+        Subscribe, push a message from another thread and check both the
+        response and the message arrive, and that closing the connection
+        cancels the subscription.
+        """
+        client = self.connect()
+        client.sendall(MortProtocol.encode_frame({"msg_type": "subscribe", "request_id": "7"}))
+        self.assertTrue(self.subscription.subscribed.wait(5))
+        threading.Thread(target=self.subscription.push, args=({"msg_type": "event"},)).start()
+        messages = self.read_frames(client, 2)
+        self.assertEqual([fields for version, fields in messages],
+                         [{"msg_type": "subscribed", "request_id": "7"}, {"msg_type": "event"}])
+        client.close()
+        self.assertTrue(self.subscription.cancelled.wait(5))
+
+    def test_heartbeat(self):
+        """
+        Subscribe and check a heartbeat is sent once the subscription has had
+        nothing to send for heartbeat_interval.
+        """
+        self.inst.heartbeat_interval = 0.05
+        client = self.connect()
+        client.sendall(MortProtocol.encode_frame({"msg_type": "subscribe"}))
+        messages = self.read_frames(client, 3)
+        self.assertEqual([fields for version, fields in messages],
+                         [{"msg_type": "subscribed"}, {"msg_type": "heartbeat"}, {"msg_type": "heartbeat"}])
+
+    def test_max_subscriptions(self):
+        """
+        Subscribe more times than allowed and check the extra subscription is
+        refused as busy, without the subscriptions using up the connections
+        for requests.
+        """
+        first = self.connect()
+        first.sendall(MortProtocol.encode_frame({"msg_type": "subscribe"}))
+        self.assertEqual(len(self.read_frames(first, 1)), 1)
+
+        second = self.connect()
+        second.sendall(MortProtocol.encode_frame({"msg_type": "subscribe", "request_id": "2"}))
+        messages = self.read_frames(second, 2)
+        self.assertEqual([fields for version, fields in messages],
+                         [{"msg_type": "error", "error": "busy", "request_id": "2"}])
+
+        for i in range(2):
+            client = self.connect()
+            client.sendall(MortProtocol.encode_frame({"msg_type": "ping"}))
+            self.assertEqual(self.read_frames(client, 1)[0][1]["msg_type"], "pong")
+
+
+if __name__ == '__main__':
+    unittest.main()
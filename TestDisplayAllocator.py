@@ -0,0 +1,126 @@
+import unittest
+import os
+import tempfile
+import threading
+import time
+
+from DisplayAllocator import DisplayAllocator
+
+
+class FakeInventory(object):
+    """
+    A session inventory that lists the given sessions.
+    """
+
+    def __init__(self, sessions=None):
+        self.sessions = sessions or []
+
+    def get(self, max_age=None):
+        return self.sessions
+
+
+class TestDisplayAllocator(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.reserved = set()
+        self.inventory = FakeInventory([{"pid": "10", "display_number": "1"}])
+        self.inst = DisplayAllocator(self.inventory, lambda: set(self.reserved), tmp_dir=self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def reserve(self, display_number):
+        """
+        Reserves a display, as the start jobs would, unless it is reserved already.
+        """
+        if display_number in self.reserved:
+            return None
+        self.reserved.add(display_number)
+        return display_number
+
+    def test_lowest_free_skips_displays_in_use(self):
+        """
+        Mark displays in use through the inventory, lock files, sockets and
+        starts in progress, and check the lowest free display is handed out.
+        """
+        open(os.path.join(self.tmp_dir.name, ".X2-lock"), "w").close()
+        os.mkdir(os.path.join(self.tmp_dir.name, ".X11-unix"))
+        open(os.path.join(self.tmp_dir.name, ".X11-unix", "X3"), "w").close()
+        self.reserved.add("4")
+        self.assertEqual(self.inst.claim(self.reserve), "5")
+        self.assertEqual(self.inst.claim(self.reserve), "6")
+
+    def test_lease_then_claim(self):
+        """
+        Lease a display and check it isn't handed out to anyone else, and that
+        claiming with the lease gets it.
+        """
+        lease_id, display_number = self.inst.lease()
+        self.assertEqual(display_number, "2")
+        self.assertEqual(self.inst.lease()[1], "3")
+        self.assertEqual(self.inst.claim(self.reserve), "4")
+        self.assertEqual(self.inst.claim(self.reserve, lease_id=lease_id), "2")
+        self.assertNotIn(lease_id, self.inst.leases)
+
+    def test_expired_and_released_leases(self):
+        """
+        Check a display is free again once its lease expires or is released.
+        """
+        self.inst.lease_time = 0.01
+        lease_id, display_number = self.inst.lease()
+        time.sleep(0.02)
+        self.assertEqual(self.inst.lease()[1], display_number)
+        self.inst.lease_time = 60
+        lease_id, display_number = self.inst.lease()
+        self.inst.release(lease_id)
+        self.assertEqual(self.inst.lease()[1], display_number)
+
+    def test_display_asked_for(self):
+        """
+        Check a display asked for by number is given if it is free, even with
+        a leftover lock file, and refused if it is in use or leased.
+        """
+        open(os.path.join(self.tmp_dir.name, ".X7-lock"), "w").close()
+        self.assertEqual(self.inst.claim(self.reserve, display_number="7"), "7")
+        self.assertIsNone(self.inst.claim(self.reserve, display_number="1"))
+        self.assertIsNone(self.inst.claim(self.reserve, display_number="x"))
+        self.assertIsNone(self.inst.claim(self.reserve, display_number="100000"))
+        lease_id, display_number = self.inst.lease()
+        self.assertIsNone(self.inst.claim(self.reserve, display_number=display_number))
+
+    def test_no_free_display(self):
+        """
+        Check nothing is handed out once every display is in use.
+        """
+        self.inst.last_display = 2
+        self.assertEqual(self.inst.claim(self.reserve), "2")
+        self.assertIsNone(self.inst.lease())
+        self.assertIsNone(self.inst.claim(self.reserve))
+
+    def test_free_count(self):
+        """
+        Check the free displays are counted, less those in use or leased.
+        """
+        self.inst.last_display = 10
+        self.reserved.add("4")
+        self.inst.lease()
+        self.assertEqual(self.inst.free_count(), 7)
+
+    def test_concurrent_claims_never_collide(self):
+        """
+        Claim displays from many threads at once and check each gets its own.
+        """
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.inst.claim(self.reserve)))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertNotIn(None, results)
+        self.assertEqual(len(set(results)), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
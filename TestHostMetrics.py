@@ -0,0 +1,43 @@
+import unittest
+import os
+import tempfile
+
+import HostMetrics
+
+
+class TestHostMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.meminfo_path = os.path.join(self.tmp_dir.name, "meminfo")
+        with open(self.meminfo_path, "w") as f:
+            f.write("MemTotal:       16318480 kB\n"
+                    "MemFree:         1146792 kB\n"
+                    "MemAvailable:    8388608 kB\n")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_mem_available(self):
+        """
+        Check the available memory is read in MiB, and None if it can't be.
+        """
+        self.assertEqual(HostMetrics.mem_available(self.meminfo_path), 8192)
+        self.assertIsNone(HostMetrics.mem_available(os.path.join(self.tmp_dir.name, "nope")))
+
+    def test_health_fields(self):
+        """
+        Check the health fields are all strings, in the announce message format.
+        """
+        fields = HostMetrics.health_fields(3, 96, "abcd-7", meminfo_path=self.meminfo_path)
+        self.assertEqual(len(fields["load_avg"].split(",")), 3)
+        self.assertEqual(fields["cpu_count"], str(os.cpu_count()))
+        self.assertEqual(fields["mem_available"], "8192")
+        self.assertEqual(fields["session_count"], "3")
+        self.assertEqual(fields["free_displays"], "96")
+        self.assertEqual(fields["inventory_version"], "abcd-7")
+        self.assertTrue(all(isinstance(value, str) for value in fields.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import unittest
+import socket
+import select
+import threading
+
+from SessionServerList import SessionServerList
+from LauncherAnnounceTask import LauncherAnnounceTask
+
+
+def announce(hostname, ip_address, port, **fields):
+    """
+    Builds a session-server announce message.
+    """
+    msg = "msg_type:session_server_announce\nhostname:{0}\nip_address:{1}\nport:{2}\n".format(hostname,
+                                                                                             ip_address,
+                                                                                             port)
+    msg += "".join("{0}:{1}\n".format(key, value) for key, value in fields.items())
+    return msg.encode('utf8')
+
+
+class TestLauncherAnnounceTask(unittest.TestCase):
+
+    def setUp(self):
+        self.known_servers = SessionServerList()
+        self.known_servers_cv = threading.Condition()
+        # Listen on a free port of the loopback interface rather than the
+        # well-known announce port.
+        self.inst = LauncherAnnounceTask(self.known_servers, self.known_servers_cv, port=0)
+        self.addr = ("127.0.0.1", self.inst.announce_sock.getsockname()[1])
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.sender.close()
+        self.inst.announce_sock.close()
+
+    def send(self, *msgs):
+        for msg in msgs:
+            self.sender.sendto(msg, self.addr)
+
+    def drain(self, count):
+        """
+        Drains the socket until count messages have been read, or nothing more arrives.
+        """
+        batch = []
+        while len(batch) < count:
+            robj, wobj, xobj = select.select([self.inst.announce_sock], [], [], 1)
+            if not robj:
+                break
+            batch += self.inst.drain_socket()
+        return batch
+
+    def test_drain_socket(self):
+        self.send(*(announce("h{}".format(n), "10.0.0.{}".format(n), 42000) for n in range(5)))
+        batch = self.drain(5)
+        self.assertEqual(len(batch), 5)
+        self.assertEqual(batch[0][0], announce("h0", "10.0.0.0", 42000))
+        self.assertEqual(batch[0][1][0], "127.0.0.1")
+
+        # Nothing left, and it doesn't block.
+        self.assertEqual(self.inst.drain_socket(), [])
+
+    def test_drain_socket_max_batch_size(self):
+        self.inst.max_batch_size = 3
+        self.send(*(announce("h{}".format(n), "10.0.0.{}".format(n), 42000) for n in range(5)))
+        select.select([self.inst.announce_sock], [], [], 1)
+        first = self.inst.drain_socket()
+        self.assertLessEqual(len(first), 3)
+        rest = self.drain(5 - len(first))
+        self.assertEqual(len(first) + len(rest), 5)
+
+    def test_parse_announce(self):
+        msg_fields = self.inst.parse_announce(announce("a.b.c", "192.168.7.220", 42124,
+                                                       load_avg="1.0,0.5,0.25",
+                                                       cpu_count=4,
+                                                       mem_available=2048,
+                                                       session_count=3,
+                                                       free_displays=7),
+                                              self.addr)
+        self.assertEqual(msg_fields["hostname"], "a.b.c")
+        self.assertEqual(msg_fields["port"], 42124)
+        self.assertEqual(msg_fields["health"].session_count, 3)
+        self.assertEqual(msg_fields["health"].load_per_cpu, 0.25)
+
+        # The health fields are optional.
+        msg_fields = self.inst.parse_announce(announce("a.b.c", "192.168.7.220", 42124), self.addr)
+        self.assertIsNone(msg_fields["health"])
+
+    def test_parse_announce_malformed(self):
+        for msg in (b"\xff\xfe",
+                    b"",
+                    b"hostname:a.b.c\nip_address:192.168.7.220\nport:42124\n",
+                    b"msg_type:other\nhostname:a.b.c\nip_address:192.168.7.220\nport:42124\n",
+                    b"msg_type:session_server_announce\nip_address:192.168.7.220\nport:42124\n",
+                    b"msg_type:session_server_announce\nhostname:a.b.c\nport:42124\n",
+                    b"msg_type:session_server_announce\nhostname:a.b.c\nip_address:192.168.7.220\n",
+                    announce("a.b.c", "192.168.7.220", "not-a-port")):
+            with self.subTest(msg=msg):
+                with self.assertLogs("LauncherAnnounceTask", "WARNING"):
+                    self.assertIsNone(self.inst.parse_announce(msg, self.addr))
+
+    def test_apply_announces_append_then_update(self):
+        first = self.inst.parse_announce(announce("x.y.z", "192.168.7.220", 42124), self.addr)
+        self.inst.apply_announces([first])
+        self.assertEqual(len(self.known_servers), 1)
+        server = self.known_servers.get_by_ip("192.168.7.220")
+        self.assertEqual(server.hostname, "x.y.z")
+        version = self.known_servers.snapshot()[0]
+
+        # The same server again, renamed; it is updated in place and moved
+        # ahead of the other server.
+        self.inst.apply_announces([self.inst.parse_announce(announce("m.n.o", "192.168.7.100", 42124), self.addr)])
+        self.inst.apply_announces([self.inst.parse_announce(announce("a.b.c", "192.168.7.220", 51662), self.addr)])
+        self.assertEqual(len(self.known_servers), 2)
+        self.assertIs(self.known_servers.get_by_ip("192.168.7.220"), server)
+        self.assertEqual(server.port, 51662)
+        self.assertEqual([item.hostname for item in self.known_servers], ["a.b.c", "m.n.o"])
+        self.assertGreater(self.known_servers.snapshot()[0], version)
+
+    def test_apply_announces_unchanged(self):
+        msg_fields = self.inst.parse_announce(announce("a.b.c", "192.168.7.220", 42124), self.addr)
+        self.inst.apply_announces([msg_fields])
+        version = self.known_servers.snapshot()[0]
+        self.inst.apply_announces([msg_fields])
+        self.assertEqual(len(self.known_servers), 1)
+        self.assertEqual(self.known_servers.snapshot()[0], version)
+
+
+if __name__ == '__main__':
+    unittest.main()
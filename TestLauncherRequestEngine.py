@@ -0,0 +1,458 @@
+import unittest
+import socket
+import threading
+import asyncio
+import time
+import json
+import concurrent.futures
+
+import MortProtocol
+
+from LauncherRequestEngine import LauncherRequestEngine, is_idempotent
+
+
+# The ping each server is sent first to find out its protocol.
+PING = (1, {"msg_type": "ping"})
+
+
+class FakeSessionServer(object):
+    """
+    A TCP server on the loopback interface that answers each request with a
+    fixed response, optionally after a delay.
+
+    A framed server answers in the protocol the request was sent in, and
+    keeps the connection open for more requests if keep_alive is set. A
+    legacy server closes the connection without answering framed requests,
+    like servers that predate the framed protocol.
+
+    A busy server answers every framed request with a busy error. A server
+    that drops requests answers pings, but closes the connection without
+    answering anything else.
+    """
+
+    def __init__(self, resp, delay=0, framed=True, keep_alive=False, busy=False, drop=False):
+        self.resp = resp
+        self.delay = delay
+        self.framed = framed
+        self.keep_alive = keep_alive
+        self.busy = busy
+        self.drop = drop
+        self.requests = []
+        self.connections = []
+        self.release = threading.Event()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            self.connections.append(conn)
+            threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+
+    def serve_connection(self, conn):
+        decoder = MortProtocol.FrameDecoder()
+        while True:
+            try:
+                data = conn.recv(16384)
+            except OSError:
+                break
+            if not data:
+                break
+            if not MortProtocol.is_framed(data) and not decoder.buffer:
+                self.requests.append((0, MortProtocol.decode_legacy(data)))
+                self.respond(conn, MortProtocol.encode_legacy(self.resp))
+                break
+            if not self.framed:
+                break
+            for version, fields in decoder.feed(data):
+                request_id = fields.pop("request_id", None)
+                self.requests.append((version, fields))
+                if self.busy:
+                    resp = MortProtocol.error_response(MortProtocol.BUSY)
+                elif fields["msg_type"] == "ping":
+                    resp = {"msg_type": "pong"}
+                elif self.drop:
+                    conn.close()
+                    return
+                else:
+                    resp = dict(self.resp)
+                if request_id is not None:
+                    resp["request_id"] = request_id
+                self.respond(conn, MortProtocol.encode_frame(resp))
+            if not self.keep_alive:
+                break
+        conn.close()
+
+    def respond(self, conn, resp):
+        if self.delay:
+            self.release.wait(self.delay)
+        try:
+            conn.sendall(resp)
+        except OSError:
+            pass
+
+    def close_connections(self):
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        self.release.set()
+        self.close_connections()
+        self.sock.close()
+
+
+class TestLauncherRequestEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.inst = LauncherRequestEngine(default_timeout=2)
+        self.inst.start()
+        self.servers = []
+
+    def tearDown(self):
+        self.inst.stop()
+        for server in self.servers:
+            server.close()
+
+    def make_server(self, resp, delay=0, framed=True, keep_alive=False, busy=False, drop=False):
+        server = FakeSessionServer(resp, delay, framed, keep_alive, busy, drop)
+        self.servers.append(server)
+        return server
+
+    def test_submit_returns_response(self):
+        """
+        Submit a request and check the future resolves to the response fields.
+        """
+        resp = {"msg_type": "active_sessions_list", "active_sessions": "[]"}
+        server = self.make_server(resp)
+        future = self.inst.submit("127.0.0.1", server.port, {"msg_type": "get_active_sessions"})
+        self.assertEqual(future.result(timeout=5), resp)
+        # The server is pinged first to find out its protocol.
+        self.assertEqual(server.requests, [PING, (1, {"msg_type": "get_active_sessions"})])
+
+    def test_large_response(self):
+        """
+        Submit a request whose response is much larger than one read and check
+        it arrives whole.
+        """
+        resp = {"msg_type": "active_sessions_list", "active_sessions": "x" * 1000000}
+        server = self.make_server(resp)
+        future = self.inst.submit("127.0.0.1", server.port, {"msg_type": "get_active_sessions"})
+        self.assertEqual(future.result(timeout=5), resp)
+
+    def test_legacy_fallback(self):
+        """
+        Submit requests to a server that doesn't speak the framed protocol and
+        check they are sent as legacy messages, and that the server is remembered.
+        """
+        resp = {"msg_type": "active_sessions_list", "active_sessions": "[]"}
+        server = self.make_server(resp, framed=False)
+        future = self.inst.submit("127.0.0.1", server.port, {"msg_type": "get_active_sessions"})
+        self.assertEqual(future.result(timeout=5), resp)
+        future = self.inst.submit("127.0.0.1", server.port, {"msg_type": "get_active_sessions"})
+        self.assertEqual(future.result(timeout=5), resp)
+        self.assertEqual(server.requests, [(0, {"msg_type": "get_active_sessions"}),
+                                           (0, {"msg_type": "get_active_sessions"})])
+
+    def test_pool_reuses_connection(self):
+        """
+        Submit back-to-back requests to a keep-alive server and check they
+        share one connection.
+        """
+        server = self.make_server({"msg_type": "x"}, keep_alive=True)
+        for i in range(3):
+            future = self.inst.submit("127.0.0.1", server.port, {"msg_type": "get_active_sessions"})
+            self.assertEqual(future.result(timeout=5), {"msg_type": "x"})
+        self.assertEqual(len(server.connections), 1)
+        self.assertEqual(server.requests[0], PING)
+        self.assertEqual(len(server.requests), 4)
+
+    def test_pool_reconnects_after_server_closes(self):
+        """
+        Close the server's end of a pooled connection and check the next
+        request is sent on a new connection.
+        """
+        server = self.make_server({"msg_type": "x"}, keep_alive=True)
+        future = self.inst.submit("127.0.0.1", server.port, {"msg_type": "get_active_sessions"})
+        self.assertEqual(future.result(timeout=5), {"msg_type": "x"})
+        server.close_connections()
+        future = self.inst.submit("127.0.0.1", server.port, {"msg_type": "get_active_sessions"})
+        self.assertEqual(future.result(timeout=5), {"msg_type": "x"})
+        self.assertEqual(len(server.connections), 2)
+        self.assertEqual(len(server.requests), 3)
+
+    def test_health_check_pings_idle_connections(self):
+        """
+        Leave a pooled connection idle past the health check interval and
+        check it is pinged and kept.
+        """
+        self.inst.stop()
+        self.inst = LauncherRequestEngine(default_timeout=2, health_check_interval=0.1)
+        self.inst.start()
+        server = self.make_server({"msg_type": "x"}, keep_alive=True)
+        future = self.inst.submit("127.0.0.1", server.port, {"msg_type": "get_active_sessions"})
+        self.assertEqual(future.result(timeout=5), {"msg_type": "x"})
+        time.sleep(0.35)
+        self.assertIn((1, {"msg_type": "ping"}), server.requests)
+        future = self.inst.submit("127.0.0.1", server.port, {"msg_type": "get_active_sessions"})
+        self.assertEqual(future.result(timeout=5), {"msg_type": "x"})
+        self.assertEqual(len(server.connections), 1)
+
+    def test_probe(self):
+        """
+        Probe a server and check the round trip time is measured and kept,
+        and that a server that doesn't answer the ping with a pong fails.
+        """
+        server = self.make_server({"msg_type": "x"}, delay=0.05)
+        rtt = self.inst.probe("127.0.0.1", server.port).result(timeout=5)
+        self.assertGreaterEqual(rtt, 0.05)
+        self.assertEqual(server.requests, [PING, PING])
+        # The detection ping is timed too, and folded into the estimate.
+        self.assertGreaterEqual(self.inst.rtts[("127.0.0.1", server.port)], 0.05)
+
+        server = self.make_server({"msg_type": "x"}, framed=False)
+        with self.assertRaises(MortProtocol.ProtocolError):
+            self.inst.probe("127.0.0.1", server.port).result(timeout=5)
+
+    def test_unidempotent_request_not_resent(self):
+        """
+        Submit a request that mustn't be carried out twice and check it gets a
+        connection of its own, and isn't sent again when that is closed
+        without an answer.
+        """
+        server = self.make_server({"msg_type": "x"}, keep_alive=True, drop=True)
+        kill = {"msg_type": "kill_active_session", "pid": "42"}
+        future = self.inst.submit("127.0.0.1", server.port, kill)
+        with self.assertRaises(MortProtocol.ConnectionClosedError):
+            future.result(timeout=5)
+        self.assertEqual(server.requests, [PING, (1, kill)])
+        self.assertEqual(len(server.connections), 2)
+
+    def test_idempotent(self):
+        """
+        Check which requests may be sent again.
+        """
+        self.assertTrue(is_idempotent({"msg_type": "get_active_sessions"}))
+        self.assertFalse(is_idempotent({"msg_type": "start_active_session"}))
+        self.assertFalse(is_idempotent({"msg_type": "lease_display"}))
+        self.assertTrue(is_idempotent({"msg_type": "batch",
+                                       "operations": json.dumps([{"msg_type": "get_start_job"},
+                                                                 {"msg_type": "get_active_sessions"}])}))
+        self.assertFalse(is_idempotent({"msg_type": "batch",
+                                        "operations": json.dumps([{"msg_type": "kill_active_session"},
+                                                                  {"msg_type": "get_active_sessions"}])}))
+        self.assertFalse(is_idempotent({"msg_type": "batch", "operations": "nonsense"}))
+
+    def test_pipelined(self):
+        """
+        Submit pipelined requests to a keep-alive server and check they share
+        one connection and get a response each.
+        """
+        server = self.make_server({"msg_type": "x"}, keep_alive=True)
+        requests = [{"msg_type": "get_start_job", "job_id": str(i)} for i in range(3)]
+        future = self.inst.submit_pipelined("127.0.0.1", server.port, requests)
+        self.assertEqual(future.result(timeout=5), [{"msg_type": "x"}] * 3)
+        self.assertEqual(server.requests, [PING] + [(1, fields) for fields in requests])
+        self.assertEqual(len(server.connections), 1)
+
+    def test_batch(self):
+        """
+        Submit a batch and check it is sent as one message and the results
+        are unpacked.
+        """
+        results = [{"msg_type": "kill_active_session_response", "outcome": "killed"}, None]
+        server = self.make_server({"msg_type": "batch_response", "results": json.dumps(results)})
+        operations = [{"msg_type": "kill_active_session", "pid": "42"},
+                      {"msg_type": "get_active_sessions"}]
+        future = self.inst.submit_batch("127.0.0.1", server.port, operations)
+        self.assertEqual(future.result(timeout=5), results)
+        self.assertEqual(server.requests, [PING, (1, {"msg_type": "batch", "operations": json.dumps(operations)})])
+
+    def test_batch_legacy_fallback(self):
+        """
+        Submit a batch to a server that doesn't speak the framed protocol and
+        check the operations are sent one by one.
+        """
+        server = self.make_server({"msg_type": "x"}, framed=False)
+        operations = [{"msg_type": "kill_active_session", "pid": "42"},
+                      {"msg_type": "get_active_sessions"}]
+        future = self.inst.submit_batch("127.0.0.1", server.port, operations)
+        self.assertEqual(future.result(timeout=5), [{"msg_type": "x"}] * 2)
+        self.assertEqual(server.requests[-2:], [(0, fields) for fields in operations])
+
+    def test_callback_gets_future(self):
+        """
+        Submit a request with a callback and check it is called with the future.
+        """
+        server = self.make_server({"msg_type": "x"})
+        done = []
+        called = threading.Event()
+        def callback(future):
+            done.append(future)
+            called.set()
+        future = self.inst.submit("127.0.0.1", server.port, {"msg_type": "y"}, callback=callback)
+        self.assertTrue(called.wait(5))
+        self.assertIs(done[0], future)
+
+    def test_timeout(self):
+        """
+        Submit a request to a server that answers too late and check it times out.
+        """
+        server = self.make_server({"msg_type": "x"}, delay=5)
+        future = self.inst.submit("127.0.0.1", server.port, {"msg_type": "y"}, timeout=0.2)
+        with self.assertRaises(asyncio.TimeoutError):
+            future.result(timeout=5)
+
+    def test_connection_refused(self):
+        """
+        Submit a request to a port nobody listens on and check it fails with an OSError.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        future = self.inst.submit("127.0.0.1", port, {"msg_type": "y"})
+        with self.assertRaises(OSError):
+            future.result(timeout=5)
+
+    def test_cancel(self):
+        """
+        Cancel a request in flight and check its future reports it.
+        """
+        server = self.make_server({"msg_type": "x"}, delay=5)
+        future = self.inst.submit("127.0.0.1", server.port, {"msg_type": "y"})
+        future.cancel()
+        with self.assertRaises(concurrent.futures.CancelledError):
+            future.result(timeout=5)
+        self.assertTrue(future.cancelled())
+
+    def test_key_cancels_superseded_request(self):
+        """
+        Submit two requests with the same key and check only the first is cancelled.
+        """
+        slow_server = self.make_server({"msg_type": "slow"}, delay=5)
+        fast_server = self.make_server({"msg_type": "fast"})
+        first = self.inst.submit("127.0.0.1", slow_server.port, {"msg_type": "y"}, key="refresh")
+        second = self.inst.submit("127.0.0.1", fast_server.port, {"msg_type": "y"}, key="refresh")
+        self.assertEqual(second.result(timeout=5), {"msg_type": "fast"})
+        self.assertTrue(first.cancelled())
+
+    def test_subscribe(self):
+        """
+        Subscribe to a server and check the messages it sends are passed on
+        until it closes the connection.
+        """
+        server = self.make_server({"msg_type": "active_sessions_list"}, keep_alive=True)
+        messages = []
+        future = self.inst.subscribe("127.0.0.1", server.port, {"msg_type": "subscribe_sessions"}, messages.append)
+        deadline = time.monotonic() + 5
+        while not messages and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(messages, [{"msg_type": "active_sessions_list"}])
+        self.assertFalse(future.done())
+        server.close_connections()
+        self.assertEqual(future.result(timeout=5), 1)
+
+    def test_subscription_heartbeat_and_timeout(self):
+        """
+        Subscribe to a server, check its heartbeats aren't passed on, and that
+        the subscription fails once the server has sent nothing for
+        subscription_timeout.
+        """
+        self.inst.subscription_timeout = 0.2
+        server = self.make_server({"msg_type": "active_sessions_list"}, keep_alive=True)
+        messages = []
+        future = self.inst.subscribe("127.0.0.1", server.port, {"msg_type": "subscribe_sessions"}, messages.append)
+        deadline = time.monotonic() + 5
+        while not messages and time.monotonic() < deadline:
+            time.sleep(0.01)
+        for i in range(3):
+            server.connections[-1].sendall(MortProtocol.encode_frame({"msg_type": "heartbeat"}))
+            time.sleep(0.1)
+        self.assertFalse(future.done())
+        with self.assertRaises(asyncio.TimeoutError):
+            future.result(timeout=5)
+        self.assertEqual(messages, [{"msg_type": "active_sessions_list"}])
+
+    def test_subscribe_legacy_server(self):
+        """
+        Subscribe to a server that doesn't speak the framed protocol and check
+        the subscription fails without any messages.
+        """
+        server = self.make_server({"msg_type": "x"}, framed=False)
+        messages = []
+        future = self.inst.subscribe("127.0.0.1", server.port, {"msg_type": "subscribe_sessions"}, messages.append)
+        with self.assertRaises(MortProtocol.ProtocolError):
+            future.result(timeout=5)
+        self.assertEqual(messages, [])
+        self.assertEqual(server.requests, [])
+
+    def test_busy_server(self):
+        """
+        Submit a request to a server that turns connections away as busy and
+        check it fails without the server being taken for a legacy one.
+        """
+        server = self.make_server({"msg_type": "x"}, busy=True)
+        for i in range(2):
+            future = self.inst.submit("127.0.0.1", server.port, {"msg_type": "start_active_session"})
+            with self.assertRaises(MortProtocol.ServerBusyError):
+                future.result(timeout=5)
+        self.assertEqual(self.inst.protocol_versions[("127.0.0.1", server.port)], 1)
+        self.assertNotIn(0, [version for version, fields in server.requests])
+
+        future = self.inst.subscribe("127.0.0.1", server.port, {"msg_type": "subscribe_sessions"}, lambda fields: None)
+        with self.assertRaises(MortProtocol.ServerBusyError):
+            future.result(timeout=5)
+
+    def test_unanswered_request_not_resent_as_legacy(self):
+        """
+        Submit a request to a framed server that closes the connection without
+        answering it and check it fails, rather than being sent again as a
+        legacy message.
+        """
+        server = self.make_server({"msg_type": "x"}, keep_alive=True, drop=True)
+        future = self.inst.submit("127.0.0.1", server.port, {"msg_type": "kill_active_session", "pid": "42"})
+        with self.assertRaises(MortProtocol.ConnectionClosedError):
+            future.result(timeout=5)
+        self.assertNotIn(0, [version for version, fields in server.requests])
+
+        # The protocol is found out again, in case the server was replaced.
+        self.assertNotIn(("127.0.0.1", server.port), self.inst.protocol_versions)
+        future = self.inst.submit("127.0.0.1", server.port, {"msg_type": "ping"})
+        self.assertEqual(future.result(timeout=5), {"msg_type": "pong"})
+        self.assertEqual(server.requests[-2:], [PING, PING])
+        self.assertEqual(self.inst.protocol_versions[("127.0.0.1", server.port)], 1)
+
+    def test_connection_closed_part_way(self):
+        """
+        Have a server close the connection part way through its answer and
+        check the request fails with a connection error.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(1)
+
+        def serve():
+            conn, addr = sock.accept()
+            conn.recv(16384)
+            conn.sendall(MortProtocol.encode_frame({"msg_type": "pong"})[:-2])
+            conn.close()
+
+        threading.Thread(target=serve, daemon=True).start()
+        future = self.inst.submit("127.0.0.1", sock.getsockname()[1], {"msg_type": "ping"})
+        with self.assertRaises(MortProtocol.ConnectionClosedError):
+            future.result(timeout=5)
+        self.assertNotIn(("127.0.0.1", sock.getsockname()[1]), self.inst.protocol_versions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import unittest
+import logging
+
+try:
+    import LogBoxWidget
+except ImportError:
+    # PIL isn't installed.
+    LogBoxWidget = None
+
+from LogRecordBuffer import LogRecordBuffer
+
+
+def record(n, levelname="INFO"):
+    return logging.LogRecord("test", getattr(logging, levelname), __file__, 0, "record {}".format(n), None, None)
+
+
+class FakeText(object):
+    """
+    Stands in for a Tk Text widget holding one line per inserted record.
+    """
+
+    def __init__(self, at_bottom=True):
+        self.lines = []
+        self.images = 0
+        self.seen = False
+        self.at_bottom = at_bottom
+
+    def yview(self):
+        return (0.0, 1.0 if self.at_bottom else 0.5)
+
+    def image_create(self, index, **options):
+        self.images += 1
+
+    def insert(self, index, text):
+        self.lines.append(text)
+
+    def index(self, index):
+        # Like Tk, the last line after the inserted newlines is empty.
+        assert index == 'end-1c'
+        return "{}.0".format(len(self.lines) + 1)
+
+    def delete(self, first, last):
+        del self.lines[int(first.split('.')[0]) - 1:int(last.split('.')[0]) - 1]
+
+    def see(self, index):
+        self.seen = True
+
+
+class FakeLabel(object):
+
+    def __init__(self):
+        self.text = ""
+
+    def configure(self, text):
+        self.text = text
+
+
+class FakeDispatcher(object):
+
+    def __init__(self):
+        self.posts = []
+
+    def post(self, func, key=None):
+        self.posts.append(func)
+
+
+@unittest.skipIf(LogBoxWidget is None, "PIL is not installed")
+class TestLogBoxWidget(unittest.TestCase):
+
+    def setUp(self):
+        # Build the widget without Tk, with fakes in place of its widgets.
+        self.inst = object.__new__(LogBoxWidget.LogBoxWidget)
+        self.inst.max_lines = 5
+        self.inst.batch_size = 3
+        self.inst.pending_records = LogRecordBuffer(max_pending=10)
+        self.inst.msg_icons = dict.fromkeys(['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
+        self.inst.logbox = FakeText()
+        self.inst.dropped_label = FakeLabel()
+        self.inst.ui_dispatcher = FakeDispatcher()
+
+    def test_show_records_in_batches(self):
+        for n in range(4):
+            self.inst.pending_records.put(record(n))
+        self.inst.show_records()
+        self.assertEqual(len(self.inst.logbox.lines), 3)
+        self.assertEqual(self.inst.logbox.images, 3)
+        self.assertTrue(self.inst.logbox.seen)
+        # The rest are left for the next tick.
+        self.assertEqual(self.inst.ui_dispatcher.posts, [self.inst.show_records])
+
+        self.inst.show_records()
+        self.assertEqual(len(self.inst.logbox.lines), 4)
+        self.assertIn("record 3", self.inst.logbox.lines[-1])
+        self.assertEqual(len(self.inst.ui_dispatcher.posts), 1)
+
+    def test_show_records_trims_oldest_lines(self):
+        for n in range(9):
+            self.inst.pending_records.put(record(n))
+        for tick in range(3):
+            self.inst.show_records()
+        self.assertEqual(len(self.inst.logbox.lines), 5)
+        self.assertIn("record 4", self.inst.logbox.lines[0])
+
+    def test_show_records_keeps_scroll_position(self):
+        self.inst.logbox.at_bottom = False
+        self.inst.pending_records.put(record(0))
+        self.inst.show_records()
+        self.assertFalse(self.inst.logbox.seen)
+
+    def test_dropped_label(self):
+        self.inst.show_records()
+        self.assertEqual(self.inst.dropped_label.text, "")
+        for n in range(12):
+            self.inst.pending_records.put(record(n))
+        self.inst.show_records()
+        self.assertEqual(self.inst.dropped_label.text, "Dropped records: 2")
+
+
+if __name__ == '__main__':
+    unittest.main()
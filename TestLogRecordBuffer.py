@@ -0,0 +1,58 @@
+import unittest
+import queue
+import threading
+import logging
+
+from LogRecordBuffer import LogRecordBuffer
+
+
+def record(n):
+    return logging.LogRecord("test", logging.INFO, __file__, 0, "record {}".format(n), None, None)
+
+
+class TestLogRecordBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.inst = LogRecordBuffer(max_pending=5)
+
+    def test_take_in_order(self):
+        for n in range(3):
+            self.inst.put(record(n))
+        self.assertEqual(len(self.inst), 3)
+        self.assertEqual([item.msg for item in self.inst.take(2)], ["record 0", "record 1"])
+        self.assertEqual([item.msg for item in self.inst.take(2)], ["record 2"])
+        self.assertEqual(self.inst.take(2), [])
+        self.assertEqual(self.inst.dropped, 0)
+
+    def test_full_buffer_drops_oldest(self):
+        for n in range(8):
+            self.inst.put(record(n))
+        self.assertEqual(len(self.inst), 5)
+        self.assertEqual(self.inst.dropped, 3)
+        self.assertEqual([item.msg for item in self.inst.take(10)],
+                         ["record {}".format(n) for n in range(3, 8)])
+
+    def test_fill_from_drains_waiting_records(self):
+        log_queue = queue.Queue()
+        for n in range(4):
+            log_queue.put(record(n))
+        self.assertEqual(self.inst.fill_from(log_queue, 3), 3)
+        self.assertEqual(log_queue.qsize(), 1)
+        self.assertEqual(self.inst.fill_from(log_queue, 3), 1)
+        self.assertTrue(log_queue.empty())
+        self.assertEqual(len(self.inst), 4)
+
+    def test_fill_from_blocks_for_first_record(self):
+        log_queue = queue.Queue()
+        moved = []
+        filler = threading.Thread(target=lambda: moved.append(self.inst.fill_from(log_queue, 10)))
+        filler.start()
+        filler.join(0.05)
+        self.assertTrue(filler.is_alive())
+        log_queue.put(record(0))
+        filler.join(1)
+        self.assertEqual(moved, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+
+import MortProtocol
+
+
+class TestMortProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.fields = {"msg_type": "active_sessions_list",
+                       "active_sessions": '[{"pid": "1234"}]'}
+
+    def test_frame_round_trip(self):
+        """
+        Encode a message as a frame and check it decodes to the same fields.
+        """
+        decoder = MortProtocol.FrameDecoder()
+        messages = decoder.feed(MortProtocol.encode_frame(self.fields))
+        self.assertEqual(messages, [(MortProtocol.PROTOCOL_VERSION, self.fields)])
+        self.assertEqual(len(decoder.buffer), 0)
+
+    def test_frame_split_across_reads(self):
+        """
+        Feed a frame one byte at a time and check it is only returned once complete.
+        """
+        decoder = MortProtocol.FrameDecoder()
+        frame = MortProtocol.encode_frame(self.fields)
+        for i in range(len(frame) - 1):
+            self.assertEqual(decoder.feed(frame[i:i+1]), [])
+        self.assertEqual(decoder.feed(frame[-1:]), [(MortProtocol.PROTOCOL_VERSION, self.fields)])
+
+    def test_frames_joined_in_one_read(self):
+        """
+        Feed two frames and the start of a third in one go and check the first
+        two are returned and the third is kept for later.
+        """
+        decoder = MortProtocol.FrameDecoder()
+        frame = MortProtocol.encode_frame(self.fields)
+        messages = decoder.feed(frame + frame + frame[:5])
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(decoder.feed(frame[5:]), [(MortProtocol.PROTOCOL_VERSION, self.fields)])
+
+    def test_pending(self):
+        """
+        Check pending() reports the bytes still needed once the header is in.
+        """
+        decoder = MortProtocol.FrameDecoder()
+        frame = MortProtocol.encode_frame(self.fields)
+        decoder.feed(frame[:MortProtocol.HEADER.size - 1])
+        self.assertIsNone(decoder.pending())
+        decoder.feed(frame[MortProtocol.HEADER.size - 1:MortProtocol.HEADER.size])
+        self.assertEqual(decoder.pending(), len(frame) - MortProtocol.HEADER.size)
+
+    def test_frame_too_large(self):
+        """
+        Check a frame larger than max_frame_size is refused from its header alone.
+        """
+        decoder = MortProtocol.FrameDecoder(max_frame_size=64)
+        frame = MortProtocol.encode_frame({"msg_type": "x", "y": "z" * 100})
+        with self.assertRaises(MortProtocol.ProtocolError):
+            decoder.feed(frame[:MortProtocol.HEADER.size])
+
+    def test_bad_magic(self):
+        """
+        Check a frame with the wrong magic is refused.
+        """
+        decoder = MortProtocol.FrameDecoder()
+        with self.assertRaises(MortProtocol.ProtocolError):
+            decoder.feed(b"\x00XXX" + MortProtocol.encode_frame(self.fields)[4:])
+
+    def test_missing_msg_type(self):
+        """
+        Check a message without a msg_type can't be encoded.
+        """
+        with self.assertRaises(MortProtocol.ProtocolError):
+            MortProtocol.encode_frame({"outcome": "success"})
+        with self.assertRaises(MortProtocol.ProtocolError):
+            MortProtocol.encode_legacy({"outcome": "success"})
+
+    def test_is_framed(self):
+        """
+        Check framed and legacy messages are told apart by their first byte.
+        """
+        self.assertTrue(MortProtocol.is_framed(MortProtocol.encode_frame(self.fields)))
+        self.assertFalse(MortProtocol.is_framed(MortProtocol.encode_legacy(self.fields)))
+
+    def test_legacy_round_trip(self):
+        """
+        Encode a message as legacy lines and check it decodes to the same fields.
+        """
+        data = MortProtocol.encode_legacy(self.fields)
+        self.assertTrue(data.startswith(b"msg_type:active_sessions_list\n"))
+        self.assertEqual(MortProtocol.decode_legacy(data), self.fields)
+
+    def test_decode_legacy_without_trailing_newline(self):
+        """
+        Check a legacy message whose last line has no newline, or which has
+        lines without a ':', still decodes.
+        """
+        self.assertEqual(MortProtocol.decode_legacy(b"msg_type:kill_active_session\npid:42"),
+                         {"msg_type": "kill_active_session", "pid": "42"})
+        self.assertEqual(MortProtocol.decode_legacy(b"junk\nmsg_type:x\n"),
+                         {"msg_type": "x"})
+
+
+if __name__ == '__main__':
+    unittest.main()
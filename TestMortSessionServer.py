@@ -0,0 +1,339 @@
+import unittest
+import json
+import socket
+import threading
+import asyncio
+import time
+
+import MortProtocol
+import SessionInventory
+import StartJobTracker
+import mort_session_server
+
+
+REMOTE_ADDR = ("127.0.0.1", 50000)
+
+
+class TestHandleRequest(unittest.TestCase):
+
+    def handle(self, msg_fields):
+        with self.assertLogs(level="WARNING"):
+            return mort_session_server.handle_request(msg_fields, REMOTE_ADDR)
+
+    def test_missing_msg_type(self):
+        self.assertEqual(self.handle({"pid": "1"}), {"msg_type": "error", "error": "missing msg_type"})
+
+    def test_unknown_msg_type(self):
+        self.assertEqual(self.handle({"msg_type": "reboot"}), {"msg_type": "error", "error": "unknown msg_type"})
+
+    def test_missing_fields(self):
+        self.assertEqual(self.handle({"msg_type": "kill_active_session"}),
+                         {"msg_type": "error", "error": "missing pid"})
+        self.assertEqual(self.handle({"msg_type": "start_active_session"}),
+                         {"msg_type": "error", "error": "missing username"})
+        self.assertEqual(self.handle({"msg_type": "get_start_job", "job_id": "1", "wait": "soon"}),
+                         {"msg_type": "error", "error": "missing job_id or invalid wait"})
+
+    def test_invalid_batch(self):
+        self.assertEqual(self.handle({"msg_type": "batch", "operations": "{}"}),
+                         {"msg_type": "error", "error": "missing or invalid operations"})
+
+        resp = mort_session_server.handle_request({"msg_type": "batch",
+                                                   "operations": json.dumps([{"msg_type": "ping"}, "ping",
+                                                                             {"msg_type": "batch"}])},
+                                                  REMOTE_ADDR)
+        self.assertEqual(json.loads(resp["results"]),
+                         [{"msg_type": "pong"},
+                          {"msg_type": "error", "error": "invalid operation"},
+                          {"msg_type": "error", "error": "invalid operation"}])
+
+
+class FakeAllocator(object):
+    """
+    A display allocator that hands out displays from a list, and records the
+    leases given up.
+    """
+
+    lease_time = 60.0
+
+    def __init__(self, free_displays):
+        self.free_displays = list(free_displays)
+        self.leases = {}
+        self.released = []
+
+    def lease(self):
+        if not self.free_displays:
+            return None
+        lease_id = "lease-{}".format(len(self.leases))
+        self.leases[lease_id] = self.free_displays.pop(0)
+        return lease_id, self.leases[lease_id]
+
+    def release(self, lease_id):
+        self.released.append(lease_id)
+        self.leases.pop(lease_id, None)
+
+    def claim(self, reserve, display_number=None, lease_id=None):
+        leased = self.leases.pop(lease_id, None)
+        if display_number is not None:
+            if display_number not in self.free_displays:
+                return None
+        elif leased is not None:
+            display_number = leased
+        elif self.free_displays:
+            display_number = self.free_displays[0]
+        else:
+            return None
+        if display_number in self.free_displays:
+            self.free_displays.remove(display_number)
+        return reserve(display_number)
+
+
+class FakePool(object):
+    """
+    A warm pool that hands over the given entry, if any, and records the
+    claims made.
+    """
+
+    def __init__(self, entry=None):
+        self.entry = entry
+        self.claims = []
+
+    def claim(self, username, display_name, geometry, pixelformat):
+        self.claims.append((username, display_name, geometry, pixelformat))
+        entry, self.entry = self.entry, None
+        return entry
+
+
+class FakeEntry(object):
+    """
+    Stands in for an idle server of the warm pool.
+    """
+
+    display_number = "9"
+    pid = "909"
+
+
+class FakeTracker(object):
+    """
+    A start job tracker that records the jobs launched, and fails to launch
+    them if told to.
+    """
+
+    def __init__(self, launch_error=None):
+        self.launch_error = launch_error
+        self.jobs = {}
+        self.launched = []
+
+    def reserve(self, msg_fields):
+        job = StartJobTracker.StartJob(str(len(self.jobs)), msg_fields["username"], msg_fields["display_number"])
+        self.jobs[job.job_id] = job
+        return job
+
+    def launch(self, job, msg_fields):
+        if self.launch_error is not None:
+            raise self.launch_error
+        self.launched.append((job, msg_fields))
+
+    def set_state(self, job, state, error=None, stderr=None):
+        job.state = state
+        job.error = error
+
+    def get(self, job_id, wait=0):
+        job = self.jobs.get(job_id)
+        return None if job is None else job.get_fields()
+
+
+class TestStartRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.allocator = FakeAllocator(["5", "6"])
+        self.pool = FakePool()
+        self.tracker = FakeTracker()
+        self.swap(display_allocator=self.allocator, warm_pool=self.pool, start_jobs=self.tracker)
+
+    def swap(self, **globals):
+        for name, value in globals.items():
+            self.addCleanup(setattr, mort_session_server, name, getattr(mort_session_server, name))
+            setattr(mort_session_server, name, value)
+
+    def handle(self, **msg_fields):
+        return mort_session_server.handle_request(msg_fields, REMOTE_ADDR)
+
+    def test_pool_claim(self):
+        self.pool.entry = FakeEntry()
+        lease = self.handle(msg_type="lease_display")
+        resp = self.handle(msg_type="start_active_session", username="mike", display_name="Desk",
+                           lease_id=lease["lease_id"])
+        self.assertEqual(resp, {"msg_type": "start_active_session_response",
+                                "outcome": "success",
+                                "display_number": "9",
+                                "pid": "909",
+                                "state": StartJobTracker.READY})
+        self.assertEqual(self.pool.claims, [("mike", "Desk", "", "")])
+        self.assertEqual(self.allocator.released, [lease["lease_id"]])
+        self.assertEqual(self.tracker.launched, [])
+
+    def test_lease_then_claim(self):
+        lease = self.handle(msg_type="lease_display")
+        self.assertEqual(lease, {"msg_type": "lease_display_response",
+                                 "outcome": "success",
+                                 "lease_id": "lease-0",
+                                 "display_number": "5",
+                                 "lease_time": "60.0"})
+        resp = self.handle(msg_type="start_active_session", username="mike", display_number="",
+                           lease_id=lease["lease_id"])
+        self.assertEqual(resp["outcome"], "success")
+        self.assertEqual(resp["display_number"], "5")
+        self.assertEqual(resp["state"], StartJobTracker.RESERVED)
+        [(job, msg_fields)] = self.tracker.launched
+        self.assertEqual(job.job_id, resp["job_id"])
+        self.assertEqual(msg_fields["display_number"], "5")
+        self.assertEqual(self.allocator.leases, {})
+
+    def test_release_display(self):
+        lease = self.handle(msg_type="lease_display")
+        self.assertEqual(self.handle(msg_type="release_display", lease_id=lease["lease_id"]),
+                         {"msg_type": "release_display_response"})
+        self.assertEqual(self.allocator.released, [lease["lease_id"]])
+        self.assertEqual(self.handle(msg_type="release_display"), {"msg_type": "release_display_response"})
+
+    def test_no_free_display(self):
+        self.allocator.free_displays = []
+        self.assertEqual(self.handle(msg_type="lease_display"),
+                         {"msg_type": "lease_display_response", "outcome": "no free display"})
+        with self.assertLogs(level="WARNING"):
+            resp = self.handle(msg_type="start_active_session", username="mike")
+        self.assertEqual(resp, {"msg_type": "start_active_session_response", "outcome": "no free display"})
+
+    def test_display_in_use(self):
+        resp = self.handle(msg_type="start_active_session", username="mike", display_number="7")
+        self.assertEqual(resp, {"msg_type": "start_active_session_response", "outcome": "display in use"})
+        # A display asked for by number isn't taken from the pool.
+        self.assertEqual(self.pool.claims, [])
+
+    def test_launch_fails(self):
+        self.tracker.launch_error = RuntimeError("No threads left")
+        with self.assertLogs(level="ERROR"):
+            resp = self.handle(msg_type="start_active_session", username="mike")
+        self.assertEqual(resp, {"msg_type": "start_active_session_response",
+                                "outcome": "failed",
+                                "display_number": "5",
+                                "job_id": "0",
+                                "state": StartJobTracker.FAILED,
+                                "error": "Could not launch: No threads left"})
+        self.assertEqual(self.tracker.jobs["0"].state, StartJobTracker.FAILED)
+
+    def test_get_start_job(self):
+        job_id = self.handle(msg_type="start_active_session", username="mike")["job_id"]
+        resp = self.handle(msg_type="get_start_job", job_id=job_id, wait="0")
+        self.assertEqual(resp["msg_type"], "start_job_status")
+        self.assertEqual((resp["job_id"], resp["state"], resp["username"], resp["display_number"]),
+                         (job_id, StartJobTracker.RESERVED, "mike", "5"))
+        self.assertEqual(self.handle(msg_type="get_start_job", job_id="nope"),
+                         {"msg_type": "start_job_status", "job_id": "nope", "state": "unknown"})
+
+
+class FailedProcess(object):
+    """
+    Stands in for a vncserver that exited with an error.
+    """
+
+    exitcode = 1
+
+    def join(self, timeout=None):
+        pass
+
+    def kill_process_group(self):
+        pass
+
+    def read_stderr(self):
+        return None
+
+
+class TestAwaitStartJob(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+        def spawn(msg_fields):
+            self.release.wait(5)
+            return FailedProcess()
+
+        start_jobs = StartJobTracker.StartJobTracker(SessionInventory.SessionInventory(lambda: []), spawn,
+                                                     poll_interval=0.01)
+        self.addCleanup(setattr, mort_session_server, "start_jobs", mort_session_server.start_jobs)
+        mort_session_server.start_jobs = start_jobs
+        msg_fields = {"username": "mike", "display_number": "7"}
+        self.job = start_jobs.reserve(msg_fields)
+        start_jobs.launch(self.job, msg_fields)
+
+    def await_start_job(self, **fields):
+        return asyncio.run(mort_session_server.await_start_job(dict(fields, msg_type="get_start_job"), REMOTE_ADDR))
+
+    def test_wait_is_up(self):
+        resp = self.await_start_job(job_id=self.job.job_id, wait="0.05")
+        self.assertEqual(resp["msg_type"], "start_job_status")
+        self.assertEqual(resp["state"], StartJobTracker.RESERVED)
+
+    def test_job_finishes(self):
+        threading.Timer(0.05, self.release.set).start()
+        start = time.monotonic()
+        resp = self.await_start_job(job_id=self.job.job_id, wait="5")
+        self.assertEqual(resp["state"], StartJobTracker.FAILED)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(mort_session_server.start_jobs.finish_callbacks, {})
+
+    def test_invalid_request(self):
+        self.assertEqual(self.await_start_job(job_id="nope"), {"msg_type": "start_job_status",
+                                                               "job_id": "nope",
+                                                               "state": "unknown"})
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(self.await_start_job(job_id=self.job.job_id, wait="soon"),
+                             {"msg_type": "error", "error": "missing job_id or invalid wait"})
+
+
+class TestServeSubscription(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in (("session_inventory", SessionInventory.SessionInventory(lambda: [])),
+                            ("subscription_slots", threading.BoundedSemaphore(1))):
+            self.addCleanup(setattr, mort_session_server, name, getattr(mort_session_server, name))
+            setattr(mort_session_server, name, value)
+        self.client, self.server = socket.socketpair()
+        self.client.settimeout(5)
+        self.addCleanup(self.client.close)
+        self.addCleanup(self.server.close)
+
+    def read_frames(self, count):
+        decoder = MortProtocol.FrameDecoder()
+        messages = []
+        while len(messages) < count:
+            data = self.client.recv(16384)
+            if not data:
+                break
+            messages += [fields for version, fields in decoder.feed(data)]
+        return messages
+
+    def test_heartbeat(self):
+        subscriber = threading.Thread(target=mort_session_server.serve_subscription,
+                                      args=(self.server, REMOTE_ADDR, {"msg_type": "subscribe_sessions"}, 1, 0))
+        subscriber.start()
+        messages = self.read_frames(2)
+        self.assertEqual([fields["msg_type"] for fields in messages], ["active_sessions_list", "heartbeat"])
+
+        # The slot is given back once the subscriber closes the connection.
+        self.client.close()
+        subscriber.join(5)
+        self.assertTrue(mort_session_server.subscription_slots.acquire(blocking=False))
+
+    def test_max_subscriptions(self):
+        mort_session_server.subscription_slots.acquire()
+        with self.assertLogs(level="WARNING"):
+            mort_session_server.serve_subscription(self.server, REMOTE_ADDR,
+                                                   {"msg_type": "subscribe_sessions", "request_id": "5"}, 1, 10)
+        self.assertEqual(self.read_frames(1), [{"msg_type": "error", "error": "busy", "request_id": "5"}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+import subprocess
+import threading
+import sys
+
+from ProcessReaper import ProcessReaper
+
+
+class FlakyPopen(object):
+    """
+    Stands in for a subprocess.Popen whose first poll fails.
+    """
+
+    pid = 1
+
+    def __init__(self):
+        self.polls = 0
+
+    def poll(self):
+        self.polls += 1
+        if self.polls == 1:
+            raise OSError("Poll failed")
+        return 0
+
+    def wait(self):
+        return 0
+
+
+class TestProcessReaper(unittest.TestCase):
+
+    def setUp(self):
+        self.inst = ProcessReaper(poll_interval=0.01)
+        self.inst.start()
+
+    def test_reaps_exited_process(self):
+        """
+        Start a process that exits with an error and check it is reaped, with
+        its exit code passed to the callback.
+        """
+        exited = threading.Event()
+        returncodes = []
+
+        def callback(returncode):
+            returncodes.append(returncode)
+            exited.set()
+
+        popen = subprocess.Popen([sys.executable, "-c", "import sys; sys.exit(3)"])
+        self.inst.watch(popen, callback)
+        self.assertTrue(exited.wait(5))
+        self.assertEqual(returncodes, [3])
+        self.assertEqual(popen.returncode, 3)
+        self.assertEqual(self.inst.by_pidfd, {})
+
+    def test_polled_process(self):
+        """
+        Check a process that couldn't be given a pidfd is reaped by polling.
+        """
+        inst = ProcessReaper(poll_interval=0.01)
+        exited = threading.Event()
+        popen = subprocess.Popen([sys.executable, "-c", "pass"])
+        inst.polled.append((popen, lambda returncode: exited.set()))
+        inst.start()
+        self.assertTrue(exited.wait(5))
+        self.assertEqual(popen.returncode, 0)
+        self.assertEqual(inst.polled, [])
+
+    def test_reaper_survives_failure(self):
+        """
+        Check an error is logged and the reaper carries on.
+        """
+        inst = ProcessReaper(poll_interval=0.01)
+        exited = threading.Event()
+        inst.polled.append((FlakyPopen(), lambda returncode: exited.set()))
+        with self.assertLogs("ProcessReaper", "ERROR"):
+            inst.start()
+            self.assertTrue(exited.wait(5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+from SessionServerInfo import ServerHealth
+from ServerPlacement import Candidate, ServerPlacement
+
+
+def health(load=0.0, cpu_count=4, mem_available=4096, session_count=0, free_displays=10):
+    return ServerHealth((load, load, load), cpu_count, mem_available, session_count, free_displays, 1)
+
+
+class TestServerPlacement(unittest.TestCase):
+
+    def setUp(self):
+        self.inst = ServerPlacement()
+
+    def test_rank(self):
+        busy = Candidate("busy", "10.0.0.1", 5000, health(load=8.0, session_count=20), 0.01)
+        idle = Candidate("idle", "10.0.0.2", 5000, health(load=0.4, session_count=2), 0.01)
+        far = Candidate("far", "10.0.0.3", 5000, health(load=0.4, session_count=2), 0.2)
+        ranked = self.inst.rank([busy, idle, far])
+        self.assertEqual([placement.candidate.hostname for placement in ranked], ["idle", "far", "busy"])
+        self.assertLess(ranked[0].score, ranked[1].score)
+
+    def test_rank_ties_by_hostname(self):
+        b = Candidate("b", "10.0.0.1", 5000, health(), None)
+        a = Candidate("a", "10.0.0.2", 5000, health(), None)
+        self.assertEqual([placement.candidate.hostname for placement in self.inst.rank([b, a])], ["a", "b"])
+
+    def test_full_servers_left_out(self):
+        full = Candidate("full", "10.0.0.1", 5000, health(free_displays=0), 0.001)
+        self.assertIsNone(self.inst.score(full))
+        self.assertEqual(self.inst.rank([full]), [])
+
+    def test_unknown_health(self):
+        inst = ServerPlacement(unknown_cost=2.0)
+        placement = inst.score(Candidate("old", "10.0.0.1", 5000, None, None))
+        # load, memory, sessions and rtt all unknown.
+        self.assertAlmostEqual(placement.score, 2.0 * (1 + 1 + 0.5 + 1))
+        self.assertIn("load unknown", placement.reasons)
+        self.assertIn("rtt unknown", placement.reasons)
+
+    def test_unknown_memory(self):
+        placement = self.inst.score(Candidate("x", "10.0.0.1", 5000, health(mem_available=None), 0.0))
+        self.assertIn("memory unknown", placement.reasons)
+
+    def test_weights(self):
+        inst = ServerPlacement(weights={"rtt": 1.0})
+        near = Candidate("near", "10.0.0.1", 5000, health(load=8.0), 0.01)
+        far = Candidate("far", "10.0.0.2", 5000, health(load=0.0), 0.2)
+        ranked = inst.rank([far, near])
+        self.assertEqual(ranked[0].candidate.hostname, "near")
+        self.assertAlmostEqual(ranked[0].score, 0.1)
+        self.assertEqual(ranked[0].reasons, ["rtt 10 ms"])
+
+    def test_custom_term(self):
+        inst = ServerPlacement(weights={"name": 1.0},
+                               terms={"name": lambda candidate: (len(candidate.hostname), candidate.hostname)})
+        ranked = inst.rank([Candidate("longer", "10.0.0.1", 5000, None, None),
+                            Candidate("short", "10.0.0.2", 5000, None, None)])
+        self.assertEqual([placement.score for placement in ranked], [5, 6])
+
+    def test_explain(self):
+        placement = ServerPlacement(weights={"load": 1.0, "rtt": 1.0}).score(
+            Candidate("a.b.c", "192.168.7.220", 5000, health(load=1.0), 0.012))
+        self.assertEqual(ServerPlacement.explain(placement),
+                         "a.b.c (192.168.7.220): score 0.37 - load 0.25/CPU, rtt 12 ms")
+
+
+if __name__ == '__main__':
+    unittest.main()
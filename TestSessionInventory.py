@@ -0,0 +1,205 @@
+import unittest
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+from SessionInventory import SessionInventory
+
+
+class FakeScan(object):
+    """
+    A scan callable that returns the given sessions and counts its calls.
+    """
+
+    def __init__(self, sessions=None, delay=0):
+        self.sessions = sessions or []
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        return list(self.sessions)
+
+
+class TestSessionInventory(unittest.TestCase):
+
+    def wait_for_calls(self, scan, calls, timeout=5):
+        deadline = time.monotonic() + timeout
+        while scan.calls < calls and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return scan.calls
+
+    def test_served_from_memory(self):
+        """
+        Read the inventory several times and check it is only scanned once.
+        """
+        scan = FakeScan([{"pid": "1"}])
+        inst = SessionInventory(scan, max_staleness=60)
+        for i in range(3):
+            self.assertEqual(inst.get(), [{"pid": "1"}])
+        self.assertEqual(scan.calls, 1)
+
+    def test_max_age(self):
+        """
+        Check a read that needs a fresh list, or finds the list too old,
+        rescans it.
+        """
+        scan = FakeScan()
+        inst = SessionInventory(scan, max_staleness=60)
+        inst.get()
+        inst.get(max_age=0)
+        self.assertEqual(scan.calls, 2)
+        inst.max_staleness = 0.01
+        time.sleep(0.02)
+        inst.get()
+        self.assertEqual(scan.calls, 3)
+
+    def test_invalidate(self):
+        """
+        Invalidate the inventory and check the next read rescans it.
+        """
+        scan = FakeScan([{"pid": "1"}])
+        inst = SessionInventory(scan, max_staleness=60)
+        inst.get()
+        scan.sessions = [{"pid": "2"}]
+        inst.invalidate()
+        self.assertEqual(inst.get(), [{"pid": "2"}])
+        self.assertEqual(scan.calls, 2)
+
+    def test_version_changes_with_list(self):
+        """
+        Rescan the inventory and check its version only changes when the list
+        does, and that another inventory's versions differ.
+        """
+        scan = FakeScan([{"pid": "1"}])
+        inst = SessionInventory(scan, max_staleness=60)
+        sessions, first_version = inst.get_versioned()
+        self.assertEqual(inst.get_versioned(max_age=0), ([{"pid": "1"}], first_version))
+        scan.sessions = [{"pid": "2"}]
+        sessions, second_version = inst.get_versioned(max_age=0)
+        self.assertEqual(sessions, [{"pid": "2"}])
+        self.assertNotEqual(second_version, first_version)
+        self.assertNotEqual(SessionInventory(scan).get_versioned()[1], second_version)
+
+    def test_listeners_told_of_changes(self):
+        """
+        Subscribe to the inventory, start, end and kill sessions, and check
+        the listener is told of each change once.
+        """
+        scan = FakeScan([{"pid": "1"}, {"pid": "2"}])
+        inst = SessionInventory(scan, max_staleness=60)
+        events = []
+        listener = lambda event, session, version: events.append((event, session["pid"], version))
+        self.assertEqual(inst.subscribe(listener)[0], [{"pid": "1"}, {"pid": "2"}])
+        scan.sessions = [{"pid": "2"}, {"pid": "3"}]
+        inst.killed("2")
+        sessions, version = inst.get_versioned()
+        self.assertEqual(events, [("session_exited", "1", version), ("session_started", "3", version)])
+        scan.sessions = [{"pid": "3"}]
+        inst.invalidate()
+        sessions, version = inst.get_versioned()
+        self.assertEqual(events[2:], [("session_killed", "2", version)])
+        inst.unsubscribe(listener)
+        scan.sessions = []
+        inst.get(max_age=0)
+        self.assertEqual(len(events), 3)
+
+    def test_concurrent_reads_coalesced(self):
+        """
+        Read the inventory from several threads at once and check they share
+        one scan, and that the counters say so.
+        """
+        scan = FakeScan([{"pid": "1"}], delay=0.2)
+        inst = SessionInventory(scan, max_staleness=60)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(inst.get())) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [[{"pid": "1"}]] * 8)
+        self.assertEqual(scan.calls, 1)
+        self.assertEqual(inst.stats(), {"hits": 0, "scans": 1, "coalesced": 7})
+        inst.get()
+        self.assertEqual(inst.stats()["hits"], 1)
+
+    def test_fresh_read_waits_for_next_scan(self):
+        """
+        Ask for a fresh list while an older scan is in progress and check a
+        second scan is made for it.
+        """
+        scan = FakeScan(delay=0.2)
+        inst = SessionInventory(scan, max_staleness=60)
+        first = threading.Thread(target=inst.get)
+        first.start()
+        time.sleep(0.05)
+        inst.get(max_age=0)
+        first.join()
+        self.assertEqual(scan.calls, 2)
+        self.assertEqual(inst.stats(), {"hits": 0, "scans": 2, "coalesced": 0})
+
+    @unittest.skipUnless(hasattr(os, "pidfd_open"), "pidfds are not supported")
+    def test_process_exit_invalidates(self):
+        """
+        Track a running process and check the watcher rescans once it exits.
+        """
+        process = subprocess.Popen(["sleep", "60"])
+        self.addCleanup(process.wait)
+        scan = FakeScan([{"pid": str(process.pid)}])
+        inst = SessionInventory(scan, max_staleness=60, refresh_interval=60)
+        inst.start()
+        # Wait for the watcher to track the process before it exits.
+        deadline = time.monotonic() + 5
+        while str(process.pid) not in inst.pidfds and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(scan.calls, 1)
+        scan.sessions = []
+        process.kill()
+        self.assertEqual(self.wait_for_calls(scan, 2), 2)
+        self.assertEqual(inst.get(), [])
+
+    def test_x11_socket_dir_change_invalidates(self):
+        """
+        Create a file in the watched X11 socket directory and check the
+        watcher rescans.
+        """
+        socket_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(socket_dir.cleanup)
+        scan = FakeScan()
+        inst = SessionInventory(scan, max_staleness=60, refresh_interval=60, x11_socket_dir=socket_dir.name)
+        inst.start()
+        self.assertEqual(self.wait_for_calls(scan, 1), 1)
+        if inst.inotify_fd is None:
+            self.skipTest("inotify is not supported")
+        # Wait for the watch to be added before making the change.
+        deadline = time.monotonic() + 5
+        while not inst.x11_socket_dir_watched and time.monotonic() < deadline:
+            time.sleep(0.01)
+        open(os.path.join(socket_dir.name, "X5"), "w").close()
+        self.assertEqual(self.wait_for_calls(scan, 2), 2)
+
+    def test_watcher_survives_failure(self):
+        """
+        Make the first scan fail and check the watcher logs it and scans
+        again.
+        """
+        scan = FakeScan()
+        failures = [OSError("Scan failed")]
+
+        def scan_once_failing():
+            if failures:
+                raise failures.pop()
+            return scan()
+
+        inst = SessionInventory(scan_once_failing, max_staleness=60, refresh_interval=60)
+        inst.retry_interval = 0.01
+        with self.assertLogs("SessionInventory", "ERROR"):
+            inst.start()
+            self.assertEqual(self.wait_for_calls(scan, 1), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@ import unittest
 import datetime
 
 from SessionServerInfo import SessionServerInfo as ssi
+from SessionServerInfo import ServerHealth
 
 class TestSessionServerInfo(unittest.TestCase):
 
@@ -164,3 +165,115 @@ class TestSessionServerInfo(unittest.TestCase):
 
         self.assertRaises(AssertionError, inst.last_seen, "Aug 3 2016")
 
+
+
+    def test_constructor_last_heard(self):
+        """
+        Create an instance with a last_seen time and check the monotonic
+        last_heard time and the first_seen time are filled in.
+        """
+        expected_time = datetime.datetime.now()
+        inst = ssi("test_session_server", "192.168.7.220", 42124, expected_time)
+
+        self.assertIsInstance(inst.last_heard, float)
+        self.assertEqual(inst.first_seen, expected_time)
+
+
+    def test_no_instance_dict(self):
+        """
+        Check instances use __slots__ and don't carry a per-object dict.
+        """
+        inst = ssi()
+
+        self.assertFalse(hasattr(inst, "__dict__"))
+        self.assertRaises(AttributeError, setattr, inst, "not_a_field", 1)
+
+
+    def test_heard(self):
+        """
+        Create an instance and record announce messages being heard.
+        """
+        first_time = datetime.datetime(2016, 8, 3, 12, 0, 0)
+        second_time = datetime.datetime(2016, 8, 3, 12, 0, 10)
+        inst = ssi()
+
+        self.assertIsNone(inst.silent_for())
+
+        inst.heard(100.0, first_time)
+        self.assertEqual(inst.first_seen, first_time)
+        self.assertEqual(inst.last_seen, first_time)
+        self.assertEqual(inst.silent_for(104.5), 4.5)
+
+        inst.heard(110.0, second_time)
+        self.assertEqual(inst.first_seen, first_time)
+        self.assertEqual(inst.last_seen, second_time)
+        self.assertEqual(inst.silent_for(110.0), 0.0)
+
+
+    def test_snapshot(self):
+        """
+        Take a snapshot of an instance and check it is a frozen copy.
+        """
+        inst = ssi("test_session_server", "192.168.7.220", 42124, datetime.datetime.now())
+        snap = inst.snapshot()
+
+        self.assertEqual(snap.hostname, "test_session_server")
+        self.assertEqual(snap.ip_address, "192.168.7.220")
+        self.assertEqual(snap.port, 42124)
+        self.assertRaises(AttributeError, setattr, snap, "port", 1)
+
+        inst.port = 51662
+        self.assertEqual(snap.port, 42124)
+
+
+    def test_announce_interval(self):
+        """
+        Record announce messages and check the announce interval estimate.
+        """
+        inst = ssi()
+
+        inst.heard(100.0)
+        self.assertIsNone(inst.announce_interval)
+
+        inst.heard(110.0)
+        self.assertEqual(inst.announce_interval, 10.0)
+
+        # A duplicate announce doesn't count towards the interval
+        inst.heard(110.2)
+        self.assertEqual(inst.announce_interval, 10.0)
+
+        inst.heard(130.2)
+        self.assertAlmostEqual(inst.announce_interval, 12.5)
+
+
+    def test_health_from_fields(self):
+        """
+        Pull the health out of announce message fields, and check messages
+        without it or with malformed fields give None.
+        """
+        health = ServerHealth.from_fields({"load_avg": "3.00,2.50,2.00",
+                                           "cpu_count": "4",
+                                           "mem_available": "2048",
+                                           "session_count": "7",
+                                           "free_displays": "90",
+                                           "inventory_version": "abcd-3"})
+        self.assertEqual(health, ServerHealth((3.0, 2.5, 2.0), 4, 2048, 7, 90, "abcd-3"))
+        self.assertEqual(health.load_per_cpu, 0.75)
+
+        health = ServerHealth.from_fields({"load_avg": "0.5,0.5,0.5", "cpu_count": "1",
+                                           "session_count": "0", "free_displays": "1"})
+        self.assertIsNone(health.mem_available)
+
+        self.assertIsNone(ServerHealth.from_fields({"hostname": "old_server"}))
+        self.assertIsNone(ServerHealth.from_fields({"load_avg": "high", "cpu_count": "4",
+                                                    "session_count": "0", "free_displays": "1"}))
+
+
+    def test_snapshot_health(self):
+        """
+        Check the snapshot carries the health, which defaults to None.
+        """
+        inst = ssi("test_session_server", "192.168.7.220", 42124, datetime.datetime.now())
+        self.assertIsNone(inst.snapshot().health)
+        inst.health = ServerHealth((1.0, 1.0, 1.0), 2, 512, 1, 10, "abcd-1")
+        self.assertEqual(inst.snapshot().health.free_displays, 10)
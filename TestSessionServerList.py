@@ -3,6 +3,7 @@ import datetime
 
 from SessionServerInfo import SessionServerInfo as ssi
 from SessionServerList import SessionServerList as sslist
+from SessionServerInfo import ServerHealth
 
 class TestSessionServerList(unittest.TestCase):
     """
@@ -97,3 +98,165 @@ class TestSessionServerList(unittest.TestCase):
         self.assertRaises(NotImplementedError,
                           sslist().sort)
 
+
+    def test_get_by_ip(self):
+        inst = sslist((self.ssi2, self.ssi1, self.ssi0))
+
+        # Look up each server by its IP address
+        self.assertIs(inst.get_by_ip("192.168.7.220"), self.ssi0)
+        self.assertIs(inst.get_by_ip("192.168.7.100"), self.ssi1)
+        self.assertIs(inst.get_by_ip("192.168.5.40"), self.ssi2)
+
+        # Check an unknown IP address returns the default value
+        self.assertIsNone(inst.get_by_ip("10.0.0.1"))
+
+    def test_remove_by_ip(self):
+        inst = sslist((self.ssi2, self.ssi1, self.ssi0))
+
+        # Remove the middle item and check the order of the rest is kept
+        removed = inst.remove_by_ip("192.168.7.100")
+        self.assertIs(removed, self.ssi1)
+        self.assertListEqual(inst, [self.ssi0, self.ssi2])
+        self.assertIsNone(inst.get_by_ip("192.168.7.100"))
+
+        # Check removing an unknown IP address raises a KeyError
+        self.assertRaises(KeyError,
+                          inst.remove_by_ip,
+                          "192.168.7.100")
+
+    def test_remove_keeps_index(self):
+        inst = sslist((self.ssi2, self.ssi1, self.ssi0))
+
+        # Remove an item using the list API and check the index follows along
+        inst.remove(self.ssi0)
+        self.assertListEqual(inst, [self.ssi1, self.ssi2])
+        self.assertIsNone(inst.get_by_ip("192.168.7.220"))
+
+        # Check the removed server can be added back in
+        inst.append(self.ssi0)
+        self.assertListEqual(inst, [self.ssi0, self.ssi1, self.ssi2])
+
+    def test_append_duplicate_ip(self):
+        inst = sslist((self.ssi0,))
+
+        # Try and add a second server with the same IP address
+        self.assertRaises(ValueError,
+                          inst.append,
+                          ssi("d.e.f", "192.168.7.220", 42124, datetime.datetime.now()))
+
+    def test_update_hostname(self):
+        inst = sslist((self.ssi2, self.ssi1, self.ssi0))
+
+        # Rename the first item so it should sort to the end of the list
+        inst.update_hostname(self.ssi0, "z.z.z")
+        self.assertEqual(self.ssi0.hostname, "z.z.z")
+        self.assertListEqual(inst, [self.ssi1, self.ssi2, self.ssi0])
+        self.assertIs(inst.get_by_ip("192.168.7.220"), self.ssi0)
+
+    def test_iter_hostnames(self):
+        inst = sslist((self.ssi2, self.ssi1, self.ssi0))
+
+        self.assertListEqual(list(inst.iter_hostnames()), [self.ssi0, self.ssi1, self.ssi2])
+        self.assertListEqual(list(inst.iter_hostnames("b")), [self.ssi1, self.ssi2])
+        self.assertListEqual(list(inst.iter_hostnames("b", "x")), [self.ssi1])
+        self.assertListEqual(inst.get_by_hostname("m.n.o"), [self.ssi1])
+        self.assertListEqual(inst.get_by_hostname("q.r.s"), [])
+
+    def test_pop_expired(self):
+        # Give each server a known last heard time
+        self.ssi0.last_heard = 100.0
+        self.ssi1.last_heard = 110.0
+        self.ssi2.last_heard = 120.0
+        inst = sslist((self.ssi2, self.ssi1, self.ssi0))
+        ttl = lambda server: 30.0
+
+        # Nothing has expired yet
+        self.assertListEqual(inst.pop_expired(125.0, ttl), [])
+        self.assertEqual(inst.next_deadline(), 130.0)
+
+        # The first server expires once its TTL has passed
+        self.assertListEqual(inst.pop_expired(131.0, ttl), [self.ssi0])
+        self.assertListEqual(inst, [self.ssi1, self.ssi2])
+        self.assertEqual(inst.next_deadline(), 140.0)
+
+        # A server that was heard from in the mean time is rescheduled
+        self.ssi1.last_heard = 135.0
+        self.assertListEqual(inst.pop_expired(141.0, ttl), [])
+        self.assertEqual(inst.next_deadline(), 150.0)
+        self.assertListEqual(inst.pop_expired(200.0, ttl), [self.ssi2, self.ssi1])
+        self.assertListEqual(inst, [])
+        self.assertIsNone(inst.next_deadline())
+
+    def test_pop_expired_after_remove(self):
+        self.ssi0.last_heard = 100.0
+        self.ssi1.last_heard = 110.0
+        inst = sslist((self.ssi1, self.ssi0))
+        ttl = lambda server: 30.0
+
+        # A server removed by other means is not reported as expired
+        inst.remove(self.ssi0)
+        self.assertEqual(inst.next_deadline(), 110.0)
+        self.assertListEqual(inst.pop_expired(200.0, ttl), [self.ssi1])
+
+    def test_change_feed(self):
+        inst = sslist()
+        self.assertEqual(inst.version, 0)
+        self.assertListEqual(inst.changes_since(0), [])
+
+        # Add, update and remove servers and check each change is published
+        inst.append(self.ssi1)
+        inst.append(self.ssi0)
+        inst.update(self.ssi1, port=40000)
+        inst.update(self.ssi1, port=40000)
+        inst.remove(self.ssi0)
+
+        changes = inst.changes_since(0)
+        self.assertEqual(inst.version, 4)
+        self.assertListEqual([change.version for change in changes], [1, 2, 3, 4])
+        self.assertListEqual([change.kind for change in changes], ["added", "added", "updated", "removed"])
+        self.assertListEqual([change.server.ip_address for change in changes],
+                             ["192.168.7.100", "192.168.7.220", "192.168.7.100", "192.168.7.220"])
+        self.assertEqual(changes[2].server.port, 40000)
+
+        # Replay from part way through the feed
+        self.assertListEqual(inst.changes_since(3), changes[3:])
+        self.assertListEqual(inst.changes_since(4), [])
+
+    def test_change_feed_history(self):
+        inst = sslist(history=2)
+        inst.extend([self.ssi0, self.ssi1, self.ssi2])
+
+        # Only the last two changes are kept
+        self.assertEqual(len(inst.changes_since(1)), 2)
+        self.assertIsNone(inst.changes_since(0))
+
+        # A snapshot gives a consistent starting point
+        version, servers = inst.snapshot()
+        self.assertEqual(version, 3)
+        self.assertListEqual([server.hostname for server in servers], ["a.b.c", "m.n.o", "x.y.z"])
+
+    def test_subscribe(self):
+        inst = sslist()
+        inst.append(self.ssi0)
+
+        # Subscribe, replaying the change already made
+        received = []
+        inst.subscribe(received.append, since_version=0)
+        inst.append(self.ssi1)
+        inst.unsubscribe(received.append)
+        inst.append(self.ssi2)
+
+        self.assertListEqual([change.version for change in received], [1, 2])
+        self.assertListEqual([change.kind for change in received], ["added", "added"])
+
+    def test_update_health(self):
+        """
+        Check a change of health is published, and the same health isn't.
+        """
+        inst = sslist([self.ssi0])
+        health = ServerHealth((1.0, 1.0, 1.0), 2, 512, 1, 10, "abcd-1")
+        self.assertTrue(inst.update(self.ssi0, health=health))
+        self.assertFalse(inst.update(self.ssi0, health=ServerHealth((1.0, 1.0, 1.0), 2, 512, 1, 10, "abcd-1")))
+        changes = inst.changes_since(0)
+        self.assertListEqual([change.kind for change in changes], ["added", "updated"])
+        self.assertEqual(changes[-1].server.health, health)
@@ -0,0 +1,206 @@
+import unittest
+import socket
+import threading
+
+import StartJobTracker
+
+
+class FakeInventory(object):
+    """
+    A session inventory that lists the given sessions.
+    """
+
+    def __init__(self, sessions=None):
+        self.sessions = sessions or []
+        self.invalidated = 0
+
+    def invalidate(self):
+        self.invalidated += 1
+
+    def get(self, max_age=None):
+        return self.sessions
+
+
+class FakeProcess(object):
+    """
+    Stands in for the process running vncserver.
+    """
+
+    def __init__(self, exitcode=None, stderr=None):
+        self.exitcode = exitcode
+        self.stderr = stderr
+        self.killed = False
+
+    def join(self, timeout=None):
+        pass
+
+    def kill_process_group(self):
+        self.killed = True
+
+    def read_stderr(self):
+        return self.stderr
+
+
+class TestStartJobTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.listeners = []
+
+    def tearDown(self):
+        for sock in self.listeners:
+            sock.close()
+
+    def free_display(self):
+        """
+        Finds a display number whose VNC port is free.
+        """
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        if port < 5901:
+            return self.free_display()
+        return str(port - 5900)
+
+    def listen(self, display_number):
+        """
+        Listens on the VNC port of a display, as Xvnc would.
+        """
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 5900 + int(display_number)))
+        sock.listen(1)
+        self.listeners.append(sock)
+
+    def msg_fields(self, display_number):
+        return {"msg_type": "start_active_session",
+                "username": "mike",
+                "display_number": display_number}
+
+    def start(self, inst, display_number):
+        msg_fields = self.msg_fields(display_number)
+        job = inst.reserve(msg_fields)
+        inst.launch(job, msg_fields)
+        return job
+
+    def test_ready(self):
+        """
+        Start a session that starts listening and check the job ends up ready
+        with the PID of the session.
+        """
+        display_number = self.free_display()
+        inventory = FakeInventory([{"pid": "42", "display_number": display_number}])
+
+        def spawn(msg_fields):
+            self.listen(msg_fields["display_number"])
+            return FakeProcess()
+
+        inst = StartJobTracker.StartJobTracker(inventory, spawn, start_timeout=5, poll_interval=0.01)
+        msg_fields = self.msg_fields(display_number)
+        job = inst.reserve(msg_fields)
+        self.assertEqual(job.state, StartJobTracker.RESERVED)
+        inst.launch(job, msg_fields)
+        fields = inst.get(job.job_id, wait=5)
+        self.assertEqual(fields["state"], StartJobTracker.READY)
+        self.assertEqual(fields["pid"], "42")
+        self.assertGreaterEqual(inventory.invalidated, 1)
+
+    def test_vncserver_fails(self):
+        """
+        Start a session whose vncserver exits with an error and check the job
+        fails with vncserver's stderr.
+        """
+        process = FakeProcess(exitcode=29, stderr="A VNC server is already running as :1")
+        inst = StartJobTracker.StartJobTracker(FakeInventory(), lambda msg_fields: process,
+                                               start_timeout=5, poll_interval=0.01)
+        job = self.start(inst, self.free_display())
+        fields = inst.get(job.job_id, wait=5)
+        self.assertEqual(fields["state"], StartJobTracker.FAILED)
+        self.assertIn("29", fields["error"])
+        self.assertEqual(fields["stderr"], "A VNC server is already running as :1")
+        self.assertTrue(process.killed)
+
+    def test_timeout(self):
+        """
+        Start a session that never listens and check the job fails once the
+        start timeout is up.
+        """
+        process = FakeProcess()
+        inst = StartJobTracker.StartJobTracker(FakeInventory(), lambda msg_fields: process,
+                                               start_timeout=0.1, poll_interval=0.01)
+        job = self.start(inst, self.free_display())
+        fields = inst.get(job.job_id, wait=5)
+        self.assertEqual(fields["state"], StartJobTracker.FAILED)
+        self.assertIn("listening", fields["error"])
+        self.assertTrue(process.killed)
+
+    def test_session_not_found(self):
+        """
+        Start a session that listens but never shows up in the inventory and
+        check the job fails rather than being ready without a PID.
+        """
+        process = FakeProcess()
+
+        def spawn(msg_fields):
+            self.listen(msg_fields["display_number"])
+            return process
+
+        inst = StartJobTracker.StartJobTracker(FakeInventory(), spawn, start_timeout=0.1, poll_interval=0.01)
+        job = self.start(inst, self.free_display())
+        fields = inst.get(job.job_id, wait=5)
+        self.assertEqual(fields["state"], StartJobTracker.FAILED)
+        self.assertIn("wasn't found", fields["error"])
+        self.assertNotIn("pid", fields)
+        self.assertTrue(process.killed)
+
+    def test_when_finished(self):
+        """
+        Check a callback is called once a job finishes, unless cancelled, and
+        isn't taken for a job that has already finished.
+        """
+        release = threading.Event()
+
+        def spawn(msg_fields):
+            release.wait(5)
+            return FakeProcess(exitcode=1)
+
+        inst = StartJobTracker.StartJobTracker(FakeInventory(), spawn, start_timeout=5, poll_interval=0.01)
+        job = self.start(inst, self.free_display())
+        finished = threading.Event()
+        cancelled = []
+        self.assertIsNotNone(inst.when_finished(job.job_id, finished.set))
+        inst.when_finished(job.job_id, lambda: cancelled.append(True))()
+        release.set()
+        self.assertTrue(finished.wait(5))
+        self.assertEqual(cancelled, [])
+        self.assertEqual(inst.finish_callbacks, {})
+        self.assertIsNone(inst.when_finished(job.job_id, finished.set))
+        self.assertIsNone(inst.when_finished("nope", finished.set))
+
+    def test_display_reserved(self):
+        """
+        Check a display with a start in progress can't be reserved again until
+        that start has finished.
+        """
+        inst = StartJobTracker.StartJobTracker(FakeInventory(), lambda msg_fields: FakeProcess(),
+                                               start_timeout=0.1, poll_interval=0.01)
+        display_number = self.free_display()
+        job = self.start(inst, display_number)
+        self.assertIsNone(inst.reserve(self.msg_fields(display_number)))
+        self.assertEqual(inst.reserved_displays(), {display_number})
+        inst.get(job.job_id, wait=5)
+        self.assertIsNotNone(inst.reserve(self.msg_fields(display_number)))
+
+    def test_wait_is_capped(self):
+        """
+        Check get() doesn't wait longer than max_wait, and returns None for an
+        unknown job.
+        """
+        inst = StartJobTracker.StartJobTracker(FakeInventory(), lambda msg_fields: FakeProcess(),
+                                               start_timeout=5, max_wait=0.05, poll_interval=0.01)
+        job = self.start(inst, self.free_display())
+        self.assertEqual(inst.get(job.job_id, wait=5)["state"], StartJobTracker.SPAWNED)
+        self.assertIsNone(inst.get("nope"))
+
+
+if __name__ == '__main__':
+    unittest.main()
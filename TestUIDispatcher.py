@@ -0,0 +1,93 @@
+import unittest
+import time
+
+from UIDispatcher import UIDispatcher
+
+
+class FakeRoot(object):
+    """
+    Stands in for the Tk root widget by collecting the callables passed to after().
+    """
+
+    def __init__(self):
+        self.scheduled = []
+
+    def after(self, ms, func):
+        self.scheduled.append(func)
+        return len(self.scheduled)
+
+    def after_cancel(self, after_id):
+        pass
+
+    def run_next_tick(self):
+        self.scheduled.pop(0)()
+
+
+class TestUIDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.root = FakeRoot()
+        self.inst = UIDispatcher(self.root)
+        self.calls = []
+
+    def test_post_runs_in_order(self):
+        """
+        Post some callables and check a tick runs them in the order posted.
+        """
+        self.inst.post(self.calls.append, 1)
+        self.inst.post(self.calls.append, 2)
+        self.inst.post(self.calls.append, 3)
+
+        self.inst.start()
+        self.root.run_next_tick()
+
+        self.assertListEqual(self.calls, [1, 2, 3])
+        self.assertEqual(len(self.root.scheduled), 1)
+
+    def test_post_with_key_coalesces(self):
+        """
+        Post callables with the same key and check only the latest runs,
+        in the place of the first.
+        """
+        self.inst.post(self.calls.append, "old", key="widget")
+        self.inst.post(self.calls.append, "other")
+        self.inst.post(self.calls.append, "new", key="widget")
+
+        self.inst.start()
+        self.root.run_next_tick()
+
+        self.assertListEqual(self.calls, ["new", "other"])
+        self.assertEqual(self.inst.coalesced, 1)
+
+    def test_frame_budget(self):
+        """
+        Set a frame budget that is used up by the first callable and check the
+        rest are left for the next tick.
+        """
+        def slow():
+            self.calls.append("slow")
+            time.sleep(0.002)
+
+        self.inst.frame_budget = 0.001
+        self.inst.post(slow)
+        self.inst.post(self.calls.append, "fast")
+
+        self.inst.start()
+        self.root.run_next_tick()
+        self.assertListEqual(self.calls, ["slow"])
+
+        self.root.run_next_tick()
+        self.assertListEqual(self.calls, ["slow", "fast"])
+
+    def test_exception_does_not_stop_tick(self):
+        """
+        Post a callable that raises and check the following callables still run.
+        """
+        self.inst.post(lambda: 1 / 0)
+        self.inst.post(self.calls.append, 1)
+
+        self.inst.start()
+        with self.assertLogs("UIDispatcher", level="ERROR"):
+            self.root.run_next_tick()
+
+        self.assertListEqual(self.calls, [1])
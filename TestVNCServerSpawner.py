@@ -0,0 +1,119 @@
+import unittest
+import os
+import pwd
+import signal
+import time
+import tempfile
+
+import VNCServerSpawner
+from ProcessReaper import ProcessReaper
+
+
+class TestVNCServerSpawner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.reaper = ProcessReaper(poll_interval=0.01)
+        self.reaper.start()
+        self.username = pwd.getpwuid(os.geteuid()).pw_name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def fake_vncserver(self, script):
+        """
+        Writes a shell script to stand in for vncserver.
+        """
+        path = os.path.join(self.tmp_dir.name, "vncserver")
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\n" + script)
+        os.chmod(path, 0o755)
+        return path
+
+    def test_vncserver_args(self):
+        """
+        Check the optional arguments are only passed if they are set.
+        """
+        self.assertEqual(VNCServerSpawner.vncserver_args("5", "", None, ""), ["vncserver", ":5"])
+        self.assertEqual(VNCServerSpawner.vncserver_args("5", "Desk", "800x600", "RGB888"),
+                         ["vncserver", ":5", "-name", "Desk", "-geometry", "800x600", "-pixelformat", "RGB888"])
+
+    def test_lookup_user_is_cached(self):
+        """
+        Check repeated lookups of a user are answered from the cache.
+        """
+        VNCServerSpawner.lookup_user.cache_clear()
+        pw, groups = VNCServerSpawner.lookup_user(self.username)
+        self.assertEqual(pw.pw_uid, os.geteuid())
+        self.assertIn(pw.pw_gid, groups)
+        VNCServerSpawner.lookup_user(self.username)
+        self.assertEqual(VNCServerSpawner.lookup_user.cache_info().hits, 1)
+        with self.assertRaises(KeyError):
+            VNCServerSpawner.lookup_user("no such user here")
+
+    def test_spawn(self):
+        """
+        Spawn a vncserver that fails and check its arguments, environment,
+        exit code and stderr are as expected, and it was reaped.
+        """
+        command = self.fake_vncserver('echo "$@" $USER $HOME "$(pwd)" >&2\nexit 29\n')
+        spawned = VNCServerSpawner.spawn_vnc_server(self.username, "7", "Desk", "", "", self.reaper,
+                                                    command=command)
+        spawned.join(5)
+        self.assertEqual(spawned.exitcode, 29)
+        home = VNCServerSpawner.lookup_user(self.username)[0].pw_dir
+        self.assertEqual(spawned.read_stderr().split(),
+                         [":7", "-name", "Desk", self.username, home, os.path.realpath(home)])
+        self.assertEqual(spawned.popen.returncode, 29)
+
+    def test_kill_process_group(self):
+        """
+        Spawn a vncserver that starts a child, as vncserver starts Xvnc, and
+        check both are killed.
+        """
+        pid_path = os.path.join(self.tmp_dir.name, "child.pid")
+        command = self.fake_vncserver('sleep 60 &\necho $! > {}\nsleep 60\n'.format(pid_path))
+        spawned = VNCServerSpawner.spawn_vnc_server(self.username, "7", "", "", "", self.reaper,
+                                                    command=command)
+        deadline = time.monotonic() + 5
+        child_pid = None
+        while child_pid is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+            try:
+                with open(pid_path) as f:
+                    child_pid = int(f.read())
+            except (FileNotFoundError, ValueError):
+                pass
+
+        spawned.kill_process_group()
+        spawned.join(5)
+        self.assertEqual(spawned.exitcode, -signal.SIGKILL)
+        deadline = time.monotonic() + 5
+        while self.is_running(child_pid) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(self.is_running(child_pid))
+
+        # Killing it again does no harm.
+        spawned.kill_process_group()
+
+    def is_running(self, pid):
+        """
+        Returns True if a process exists and isn't a zombie.
+        """
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+        except FileNotFoundError:
+            return False
+
+    def test_spawn_missing_command(self):
+        """
+        Check a missing vncserver raises OSError.
+        """
+        with self.assertRaises(OSError):
+            VNCServerSpawner.spawn_vnc_server(self.username, "7", "", "", "", self.reaper,
+                                              command=os.path.join(self.tmp_dir.name, "nope"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+import unittest
+
+from VirtualTreeview import VirtualTreeview
+
+
+class FakeTreeview(object):
+    """
+    Stands in for a ttk.Treeview, keeping its items in dictionaries and
+    collecting the callables passed to after_idle().
+    """
+
+    def __init__(self):
+        self.items = {'': {"children": []}}
+        self.count = 0
+        self.selected = ()
+        self.focused = ''
+        self.idle = {}
+        self.item_calls = 0
+
+    def bind(self, sequence=None, func=None, add=None):
+        pass
+
+    def after_idle(self, func, *args):
+        self.count += 1
+        self.idle[self.count] = (func, args)
+        return self.count
+
+    def after_cancel(self, after_id):
+        self.idle.pop(after_id, None)
+
+    def run_idle(self):
+        while self.idle:
+            func, args = self.idle.pop(min(self.idle))
+            func(*args)
+
+    def insert(self, parent, index, **kw):
+        self.count += 1
+        iid = "I{}".format(self.count)
+        self.items[iid] = dict(kw, parent=parent, children=[])
+        self.items[parent]["children"].append(iid)
+        return iid
+
+    def item(self, iid, **kw):
+        self.item_calls += 1
+        self.items[iid].update(kw)
+
+    def delete(self, *iids):
+        for iid in iids:
+            self.delete(*self.items[iid]["children"])
+            self.items[self.items[iid]["parent"]]["children"].remove(iid)
+            del self.items[iid]
+            self.selected = tuple(item for item in self.selected if item != iid)
+
+    def get_children(self, item=''):
+        return tuple(self.items[item]["children"])
+
+    def parent(self, iid):
+        return self.items[iid]["parent"]
+
+    def index(self, iid):
+        return self.items[self.parent(iid)]["children"].index(iid)
+
+    def selection(self):
+        return self.selected
+
+    def selection_set(self, *items):
+        self.selected = items
+
+    def selection_remove(self, *items):
+        self.selected = tuple(item for item in self.selected if item not in items)
+
+    def focus(self, item=None):
+        return self.focused
+
+    def texts(self, parent=''):
+        """
+        Returns the text drawn in each real item under the parent.
+        """
+        return [self.items[iid].get("text") for iid in self.items[parent]["children"]]
+
+
+class TestVirtualTreeview(unittest.TestCase):
+
+    def setUp(self):
+        self.tv = FakeTreeview()
+        self.inst = VirtualTreeview(self.tv, overscan=2)
+        self.inst.visible_rows = 5
+        for n in range(20):
+            self.inst.insert('', 'end', iid="row{}".format(n), text="row {}".format(n), values=(n,))
+        self.tv.run_idle()
+
+    def rows_drawn(self):
+        return self.tv.texts()
+
+    def test_window(self):
+        # Only the rows in view and the overscan get real items.
+        self.assertEqual(self.rows_drawn(), ["row {}".format(n) for n in range(7)])
+        self.assertEqual(len(self.inst.get_children()), 20)
+        self.assertEqual(self.inst.yview(), (0.0, 0.25))
+
+    def test_window_shrinks_with_model(self):
+        self.inst.delete(*("row{}".format(n) for n in range(17)))
+        self.tv.run_idle()
+        self.assertEqual(self.rows_drawn(), ["row 17", "row 18", "row 19"])
+
+    def test_scroll(self):
+        scrolls = []
+        self.inst.configure(yscrollcommand=lambda first, last: scrolls.append((first, last)))
+
+        self.inst.yview("scroll", 3, "units")
+        self.assertEqual(self.rows_drawn(), ["row {}".format(n) for n in range(3, 10)])
+        self.assertEqual(scrolls[-1], (0.15, 0.4))
+
+        self.inst.yview("scroll", 1, "pages")
+        self.assertEqual(self.rows_drawn()[0], "row 8")
+
+        # The view stops at the last page and the first row.
+        self.inst.yview_moveto(1.0)
+        self.assertEqual(self.inst.first, 15)
+        self.assertEqual(self.rows_drawn()[:5], ["row {}".format(n) for n in range(15, 20)])
+        self.inst.yview("scroll", -100, "units")
+        self.assertEqual(self.inst.first, 0)
+
+    def test_scroll_reuses_slots(self):
+        slots = list(self.tv.get_children())
+        self.inst.yview("scroll", 3, "units")
+        self.assertEqual(list(self.tv.get_children()), slots)
+
+    def test_upsert(self):
+        # Updating a row only redraws the slot it is in.
+        self.assertRaises(ValueError, self.inst.insert, '', 'end', iid="row3")
+        self.tv.item_calls = 0
+        self.inst.item("row3", text="row 3*", values=(33,))
+        self.tv.run_idle()
+        self.assertEqual(self.tv.item_calls, 1)
+        self.assertEqual(self.inst.item("row3", "values"), (33,))
+        self.assertEqual(self.rows_drawn()[3], "row 3*")
+
+        # Updating a row out of view doesn't touch the real items.
+        self.tv.item_calls = 0
+        self.inst.item("row15", text="row 15*")
+        self.tv.run_idle()
+        self.assertEqual(self.tv.item_calls, 0)
+
+        # Inserting a row in view shifts the rows below it.
+        self.inst.insert('', 1, iid="new", text="new")
+        self.tv.run_idle()
+        self.assertEqual(self.rows_drawn()[:3], ["row 0", "new", "row 1"])
+
+    def test_move(self):
+        self.inst.move("row19", '', 0)
+        self.tv.run_idle()
+        self.assertEqual(self.inst.index("row19"), 0)
+        self.assertEqual(self.rows_drawn()[:2], ["row 19", "row 0"])
+
+    def test_remove(self):
+        self.inst.delete("row1", "missing")
+        self.tv.run_idle()
+        self.assertFalse(self.inst.exists("row1"))
+        self.assertEqual(self.rows_drawn()[:3], ["row 0", "row 2", "row 3"])
+        self.assertEqual(len(self.inst.get_children()), 19)
+
+    def test_children(self):
+        self.inst.insert("row2", 'end', iid="child", text="child", values=("c",))
+        self.tv.run_idle()
+        slot = self.tv.get_children()[2]
+        # A closed row with children gets a placeholder.
+        self.assertEqual(self.tv.texts(slot), [''])
+
+        self.inst.item("row2", open=True)
+        self.tv.run_idle()
+        self.assertEqual(self.tv.texts(slot), ["child"])
+        self.assertEqual(self.inst.parent("child"), "row2")
+
+        # Deleting the parent deletes the child.
+        self.inst.delete("row2")
+        self.tv.run_idle()
+        self.assertFalse(self.inst.exists("child"))
+
+    def test_selection(self):
+        selections = []
+        self.inst.bind("<<TreeviewSelect>>", lambda e: selections.append(self.inst.selection()))
+
+        self.inst.selection_set("row4")
+        self.tv.run_idle()
+        self.assertEqual(selections, [("row4",)])
+        self.assertEqual(self.tv.selection(), (self.tv.get_children()[4],))
+
+        # Scrolling the row out of view clears the real selection, but not
+        # the model's, and doesn't call the handlers.
+        self.inst.yview_moveto(0.5)
+        self.assertEqual(self.tv.selection(), ())
+        self.assertEqual(self.inst.selection(), ("row4",))
+        self.inst.handle_select(None)
+        self.assertEqual(len(selections), 1)
+
+        # see() brings it back into view, selected.
+        self.inst.see("row4")
+        self.assertEqual(self.inst.first, 4)
+        self.assertEqual(self.tv.selection(), (self.tv.get_children()[0],))
+
+        # Selecting the same row again doesn't call the handlers.
+        self.inst.selection_set("row4")
+        self.tv.run_idle()
+        self.assertEqual(len(selections), 1)
+
+    def test_select_real_item(self):
+        # A click on a real item selects the row drawn in it.
+        selections = []
+        self.inst.bind("<<TreeviewSelect>>", lambda e: selections.append(self.inst.selection()))
+        self.inst.yview("scroll", 10, "units")
+        self.tv.selection_set(self.tv.get_children()[1])
+        self.inst.handle_select(None)
+        self.assertEqual(selections, [("row11",)])
+
+    def test_delete_selected(self):
+        self.inst.selection_set("row4")
+        self.tv.run_idle()
+        self.inst.delete("row4")
+        self.tv.run_idle()
+        self.assertEqual(self.inst.selection(), ())
+        self.assertEqual(self.tv.selection(), ())
+
+
+if __name__ == '__main__':
+    unittest.main()
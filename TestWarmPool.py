@@ -0,0 +1,372 @@
+import unittest
+import os
+import sys
+import pwd
+import json
+import signal
+import socket
+import struct
+import subprocess
+import tempfile
+import time
+
+import WarmPool
+import VNCServerSpawner
+from ProcessReaper import ProcessReaper
+
+
+# Stands in for Xvnc: listens on the -rfbport given and waits to be killed.
+FAKE_XVNC = """
+import socket, sys, time
+sock = socket.socket()
+sock.bind(("127.0.0.1", int(sys.argv[sys.argv.index("-rfbport") + 1])))
+sock.listen(1)
+time.sleep(60)
+"""
+
+
+class FakeInventory(object):
+    """
+    A session inventory that lists the given sessions and counts
+    invalidations.
+    """
+
+    def __init__(self, sessions=None):
+        self.sessions = sessions or []
+        self.invalidated = 0
+
+    def invalidate(self):
+        self.invalidated += 1
+
+    def get(self, max_age=None):
+        return self.sessions
+
+
+class FakeAllocator(object):
+    """
+    A display allocator that hands out displays with free VNC ports.
+    """
+
+    def claim(self, reserve):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        if port < 5901:
+            return self.claim(reserve)
+        return reserve(str(port - 5900))
+
+
+class TestWarmPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        xvnc_path = os.path.join(self.tmp_dir.name, "Xvnc")
+        with open(xvnc_path, "w") as f:
+            f.write("#!{}\n{}".format(sys.executable, FAKE_XVNC))
+        os.chmod(xvnc_path, 0o755)
+        self.reaper = ProcessReaper(poll_interval=0.01)
+        self.reaper.start()
+        self.inventory = FakeInventory()
+        self.username = pwd.getpwuid(os.geteuid()).pw_name
+        self.inst = WarmPool.WarmPool(FakeAllocator(), self.inventory, self.reaper, size=2,
+                                      geometry="1280x720", pixelformat="RGB888",
+                                      max_load_per_cpu=1000, min_free_memory=0, refill_interval=0.05,
+                                      start_timeout=5, pool_dir=os.path.join(self.tmp_dir.name, "pool"),
+                                      xvnc_command=xvnc_path, xvnc_user=self.username)
+
+    def tearDown(self):
+        self.inst.size = 0
+        with self.inst.lock:
+            pids = [entry.pid for entry in self.inst.idle]
+        for pid in pids:
+            os.kill(int(pid), signal.SIGKILL)
+        self.tmp_dir.cleanup()
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_xauthority_entry(self):
+        """
+        Check the Xauthority entry is laid out as xauth would write it.
+        """
+        cookie = bytes(range(16))
+        entry = WarmPool.xauthority_entry("12", cookie)
+        self.assertEqual(entry, struct.pack(">HH", 0xFFFF, 0) + b"\x00\x0212" +
+                         b"\x00\x12MIT-MAGIC-COOKIE-1" + b"\x00\x10" + cookie)
+
+    def test_refill(self):
+        """
+        Check the refiller fills the pool, idle servers are left out of the
+        session list and their displays are reported as in use.
+        """
+        self.inst.start()
+        self.wait_for(lambda: len(self.inst.idle) == 2)
+        displays = self.inst.displays()
+        self.assertEqual(len(displays), 2)
+        pids = [entry.pid for entry in self.inst.idle]
+        sessions = [{"pid": pid, "username": "root"} for pid in pids] + [{"pid": "1", "username": "mike"}]
+        self.assertEqual(self.inst.annotate(sessions), [{"pid": "1", "username": "mike"}])
+        with open(self.inst.idle[0].passwd_path, "rb") as f:
+            self.assertEqual(len(f.read()), 8)
+
+    def test_exited_server_is_replaced(self):
+        """
+        Kill an idle server and check it is dropped and replaced.
+        """
+        self.inst.size = 1
+        self.inst.start()
+        self.wait_for(lambda: len(self.inst.idle) == 1)
+        entry = self.inst.idle[0]
+        os.kill(int(entry.pid), signal.SIGKILL)
+        self.wait_for(lambda: len(self.inst.idle) == 1 and self.inst.idle[0] is not entry)
+        self.assertFalse(os.path.exists(entry.entry_dir))
+
+    def test_claim_mismatch_or_empty(self):
+        """
+        Check nothing is handed over if the pool is empty, or the geometry or
+        pixelformat asked for differ from the pool's.
+        """
+        self.assertIsNone(self.inst.claim("mike", "", "", ""))
+        self.inst.start()
+        self.wait_for(lambda: len(self.inst.idle) == 2)
+        self.assertIsNone(self.inst.claim("mike", "", "800x600", ""))
+        self.assertIsNone(self.inst.claim("mike", "", "", "BGR233"))
+        self.assertEqual(len(self.inst.idle), 2)
+
+    def test_annotate_owned(self):
+        """
+        Check a handed over server is listed as its user's.
+        """
+        entry = WarmPool.PoolEntry("5", self.tmp_dir.name)
+        entry.pid = "99"
+        entry.username = "mike"
+        entry.display_name = ""
+        self.inst.owned["99"] = entry
+        sessions = self.inst.annotate([{"pid": "99", "username": "root", "display_name": "mort-pool"}])
+        self.assertEqual(sessions, [{"pid": "99", "username": "mike", "display_name": "mike:5"}])
+
+    def test_check_private_dir(self):
+        """
+        Check directories others could tamper with are refused.
+        """
+        WarmPool.check_private_dir(self.tmp_dir.name)
+        shared = os.path.join(self.tmp_dir.name, "shared")
+        os.mkdir(shared)
+        os.chmod(shared, 0o1777)
+        with self.assertRaises(PermissionError):
+            WarmPool.check_private_dir(shared)
+        link = os.path.join(self.tmp_dir.name, "link")
+        os.symlink(self.tmp_dir.name, link)
+        with self.assertRaises(NotADirectoryError):
+            WarmPool.check_private_dir(link)
+
+        # The pool isn't started in a directory others can write to.
+        self.inst.pool_dir = os.path.join(shared, "pool")
+        with self.assertLogs("WarmPool", "WARNING"):
+            self.assertFalse(self.inst.launch(self.inst.reserve("5")))
+        self.assertFalse(os.path.exists(self.inst.pool_dir))
+
+    def test_write_private_replaces_symlink(self):
+        """
+        Check a symlink planted at the path is replaced, not written through.
+        """
+        target = os.path.join(self.tmp_dir.name, "target")
+        with open(target, "wb") as f:
+            f.write(b"untouched")
+        path = os.path.join(self.tmp_dir.name, "passwd")
+        os.symlink(target, path)
+        self.inst.write_private(path, b"secret")
+        self.assertFalse(os.path.islink(path))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"secret")
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), b"untouched")
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), ["Xvnc", "passwd", "target"])
+
+    def fake_user(self):
+        """
+        Makes a home directory for the user the tests run as, with a VNC
+        password and an xstartup that records its environment, and has the
+        user looked up with it.
+        """
+        home = os.path.join(self.tmp_dir.name, "home")
+        os.makedirs(os.path.join(home, ".vnc"))
+        with open(os.path.join(home, ".vnc", "passwd"), "wb") as f:
+            f.write(b"userpass")
+        xstartup_path = os.path.join(home, ".vnc", "xstartup")
+        with open(xstartup_path, "w") as f:
+            f.write('#!/bin/sh\necho "$DISPLAY $XAUTHORITY $(id -u)" > "$HOME/started"\n')
+        os.chmod(xstartup_path, 0o755)
+
+        pw = pwd.getpwuid(os.geteuid())
+        fake_pw = pwd.struct_passwd((pw.pw_name, pw.pw_passwd, pw.pw_uid, pw.pw_gid, pw.pw_gecos, home, pw.pw_shell))
+        lookup_user = VNCServerSpawner.lookup_user
+        self.addCleanup(setattr, VNCServerSpawner, "lookup_user", lookup_user)
+        VNCServerSpawner.lookup_user = lambda username: (fake_pw, [pw.pw_gid])
+        return home
+
+    def test_hand_over(self):
+        """
+        Hand an idle server over and check the user's password is let in, the
+        user's xstartup runs on the display with a copy of the cookie, and the
+        server is recorded as the user's.
+        """
+        home = self.fake_user()
+        self.inst.size = 1
+        self.inst.start()
+        self.wait_for(lambda: len(self.inst.idle) == 1)
+        entry = self.inst.claim(self.username, "Desk", "", "rgb888")
+        self.assertIsNotNone(entry)
+        self.assertEqual(self.inst.owned, {entry.pid: entry})
+        self.assertGreaterEqual(self.inventory.invalidated, 1)
+
+        with open(entry.passwd_path, "rb") as f:
+            self.assertEqual(f.read(), b"userpass")
+        user_xauth_path = entry.xauth_path + "-" + self.username
+        with open(user_xauth_path, "rb") as f:
+            self.assertEqual(f.read(), WarmPool.xauthority_entry(entry.display_number, entry.cookie))
+        started_path = os.path.join(home, "started")
+        self.wait_for(lambda: os.path.exists(started_path) and os.path.getsize(started_path))
+        with open(started_path) as f:
+            self.assertEqual(f.read().split(), [":" + entry.display_number, user_xauth_path, str(os.geteuid())])
+        with open(entry.state_path) as f:
+            self.assertEqual(json.load(f), {"pid": entry.pid, "username": self.username, "display_name": "Desk"})
+
+        # The pool is refilled.
+        self.wait_for(lambda: len(self.inst.idle) == 1)
+        os.kill(int(entry.pid), signal.SIGKILL)
+        self.wait_for(lambda: not self.inst.owned)
+
+    def test_hand_over_without_password(self):
+        """
+        Check a user without a VNC password isn't handed a server, and it is
+        kept idle.
+        """
+        home = self.fake_user()
+        os.remove(os.path.join(home, ".vnc", "passwd"))
+        self.inst.size = 1
+        self.inst.start()
+        self.wait_for(lambda: len(self.inst.idle) == 1)
+        with self.assertLogs("WarmPool", "WARNING"):
+            self.assertIsNone(self.inst.claim(self.username, "", "", ""))
+        self.assertEqual(len(self.inst.idle), 1)
+        self.assertEqual(self.inst.owned, {})
+
+    def test_hand_over_fails_once_given_access(self):
+        """
+        Make writing the user's password fail once the user has a copy of the
+        X cookie, and check the server is killed rather than handed out
+        again.
+        """
+        self.fake_user()
+        self.inst.size = 1
+        self.inst.start()
+        self.wait_for(lambda: len(self.inst.idle) == 1)
+        entry = self.inst.idle[0]
+
+        write_private = self.inst.write_private
+
+        def failing_write_private(path, data, uid=None, gid=None):
+            if path == entry.passwd_path:
+                raise OSError("Disk full")
+            write_private(path, data, uid, gid)
+
+        self.inst.write_private = failing_write_private
+        with self.assertLogs("WarmPool", "WARNING"):
+            self.assertIsNone(self.inst.claim(self.username, "", "", ""))
+        self.assertTrue(entry.removed)
+        self.assertNotIn(entry, self.inst.idle)
+        self.assertEqual(self.inst.owned, {})
+        self.assertFalse(os.path.exists(entry.entry_dir))
+        self.wait_for(lambda: not os.path.exists("/proc/{}".format(entry.pid)))
+
+        # A new server takes its place.
+        self.inst.write_private = write_private
+        self.wait_for(lambda: len(self.inst.idle) == 1)
+        self.assertIsNot(self.inst.idle[0], entry)
+
+    def test_hand_over_fails_once_session_started(self):
+        """
+        Make following the user's session fail, and check both the session
+        and the server are killed.
+        """
+        home = self.fake_user()
+        with open(os.path.join(home, ".vnc", "xstartup"), "w") as f:
+            f.write('#!/bin/sh\necho $$ > "$HOME/started"\nexec sleep 60\n')
+        self.inst.size = 1
+        self.inst.start()
+        self.wait_for(lambda: len(self.inst.idle) == 1)
+        entry = self.inst.idle[0]
+
+        watch = self.reaper.watch
+
+        def failing_watch(popen, callback=None):
+            if popen.args[0] == "/bin/sh":
+                raise OSError("No pidfd")
+            return watch(popen, callback)
+
+        self.reaper.watch = failing_watch
+        self.addCleanup(setattr, self.reaper, "watch", watch)
+        with self.assertLogs("WarmPool", "WARNING"):
+            self.assertIsNone(self.inst.claim(self.username, "", "", ""))
+        self.assertNotIn(entry, self.inst.idle)
+        self.assertEqual(self.inst.owned, {})
+        self.wait_for(lambda: not os.path.exists("/proc/{}".format(entry.pid)))
+        started_path = os.path.join(home, "started")
+        if os.path.exists(started_path) and os.path.getsize(started_path):
+            with open(started_path) as f:
+                self.assertFalse(os.path.exists("/proc/{}".format(f.read().strip())))
+
+    def test_shared_xvnc_user(self):
+        """
+        Check the pool isn't started without an account of its own to run
+        Xvnc as.
+        """
+        for xvnc_user in ("", "nobody"):
+            self.inst.xvnc_user = xvnc_user
+            self.inst.size = 1
+            with self.assertLogs("WarmPool", "ERROR"):
+                self.inst.start()
+            self.assertFalse(self.inst.refill_task.is_alive())
+            self.assertEqual(self.inst.idle, [])
+
+    def test_reclaim(self):
+        """
+        Leave the state of an earlier run in pool_dir and check a running
+        server that was handed over is listed as its user's again, an idle
+        one is killed and the files of the rest are removed.
+        """
+        idle = subprocess.Popen(["sleep", "60"])
+        self.addCleanup(idle.wait)
+        pool_dir = self.inst.pool_dir
+        os.mkdir(pool_dir)
+        for display_number, state in (("5", {"pid": "99", "username": "mike", "display_name": ""}),
+                                       ("6", {"pid": str(idle.pid), "username": None, "display_name": None}),
+                                       ("7", {"pid": "77", "username": "bob", "display_name": ""})):
+            os.mkdir(os.path.join(pool_dir, display_number))
+            with open(os.path.join(pool_dir, display_number, "state"), "w") as f:
+                json.dump(state, f)
+        os.mkdir(os.path.join(pool_dir, "8"))
+        self.inventory.sessions = [{"pid": "99", "display_number": "5"},
+                                   {"pid": str(idle.pid), "display_number": 6}]
+
+        with self.assertLogs("WarmPool", "WARNING"):
+            self.inst.reclaim()
+        self.assertEqual(list(self.inst.owned), ["99"])
+        self.assertEqual(self.inst.owned["99"].username, "mike")
+        self.assertEqual(os.listdir(pool_dir), ["5"])
+        self.assertEqual(idle.wait(5), -signal.SIGKILL)
+
+        # It is forgotten once it is no longer running.
+        self.assertEqual(self.inst.annotate([]), [])
+        self.assertEqual(self.inst.owned, {})
+        self.assertEqual(os.listdir(pool_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
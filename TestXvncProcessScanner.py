@@ -0,0 +1,100 @@
+import unittest
+import os
+import pwd
+import tempfile
+
+import XvncProcessScanner
+
+
+class TestXvncProcessScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.proc_dir = tempfile.TemporaryDirectory()
+        self.uid = os.getuid()
+        self.username = pwd.getpwuid(self.uid).pw_name
+
+    def tearDown(self):
+        self.proc_dir.cleanup()
+
+    def make_process(self, pid, comm, argv, uid=None):
+        """
+        Creates the comm, cmdline and status files of a process in the fake /proc.
+        """
+        if uid is None:
+            uid = self.uid
+        path = os.path.join(self.proc_dir.name, str(pid))
+        os.mkdir(path)
+        with open(os.path.join(path, "comm"), "wb") as f:
+            f.write(comm + b"\n")
+        with open(os.path.join(path, "cmdline"), "wb") as f:
+            f.write(b"".join(arg + b"\0" for arg in argv))
+        with open(os.path.join(path, "status"), "wb") as f:
+            f.write("Name:\t{0}\nUid:\t{1}\t{1}\t{1}\t{1}\n".format(comm.decode(), uid).encode())
+
+    def test_scan_finds_only_xvnc(self):
+        """
+        Fill a fake /proc with Xvnc and other processes and check only the Xvnc
+        processes are returned, with their details pulled from argv.
+        """
+        self.make_process(100, b"bash", [b"/bin/bash"])
+        self.make_process(200, b"Xvnc", [b"/usr/bin/Xvnc", b":5", b"-desktop", b"My Desk (x)",
+                                         b"-geometry", b"1280x720", b"-depth", b"16"])
+        os.mkdir(os.path.join(self.proc_dir.name, "self"))
+        sessions = XvncProcessScanner.scan_xvnc_processes(self.proc_dir.name)
+        self.assertEqual(sessions, [{"username": self.username,
+                                     "pid": "200",
+                                     "display_number": "5",
+                                     "display_name": "My Desk (x)",
+                                     "geometry": "1280x720",
+                                     "pixelformat": "RGB565"}])
+
+    def test_scan_skips_zombies_and_vanished_processes(self):
+        """
+        Check a process with an empty command line, or whose files are missing,
+        is skipped.
+        """
+        self.make_process(300, b"Xvnc", [])
+        os.mkdir(os.path.join(self.proc_dir.name, "400"))
+        self.assertEqual(XvncProcessScanner.scan_xvnc_processes(self.proc_dir.name), [])
+
+    def test_username_for_unknown_uid(self):
+        """
+        Check a UID without a user name is reported as a number, like ps does.
+        """
+        self.assertEqual(XvncProcessScanner.username_for_uid(4000000000), "4000000000")
+
+    def test_parse_defaults(self):
+        """
+        Parse args without any of the options and check the defaults.
+        """
+        info = XvncProcessScanner.parse_xvnc_args("mike", "42", [])
+        self.assertEqual(info, {"username": "mike",
+                                "pid": "42",
+                                "display_number": 0,
+                                "display_name": "mike:0",
+                                "geometry": "Unknown",
+                                "pixelformat": "RGB888"})
+
+    def test_parse_pixelformat(self):
+        """
+        Check -pixelformat wins over -depth and is upper-cased, and that -depth
+        maps to its default pixelformat.
+        """
+        info = XvncProcessScanner.parse_xvnc_args("mike", "42", [":3", "-depth", "8", "-pixelformat", "bgr888"])
+        self.assertEqual(info["pixelformat"], "BGR888")
+        info = XvncProcessScanner.parse_xvnc_args("mike", "42", [":3", "-depth", "8"])
+        self.assertEqual(info["pixelformat"], "BGR233")
+        info = XvncProcessScanner.parse_xvnc_args("mike", "42", [":3", "-depth", "15"])
+        self.assertEqual(info["pixelformat"], "Unknown")
+        self.assertEqual(info["display_name"], "mike:3")
+
+    def test_parse_option_without_value(self):
+        """
+        Check an option at the end of the args, without a value, is ignored.
+        """
+        info = XvncProcessScanner.parse_xvnc_args("mike", "42", [":3", "-geometry"])
+        self.assertEqual(info["geometry"], "Unknown")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import threading
+import collections
+import itertools
+import logging
+import time
+
+
+class UIDispatcher(object):
+    """
+    A class that lets background threads hand work to the Tk main loop.
+
+    Tk is not thread-safe, so threads other than the one running the main
+    loop must not touch widgets. Instead, they post() callables here and the
+    main loop drains them on a root.after() tick.
+
+    Posts made with a key coalesce: if a callable with the same key is still
+    waiting to run, it is replaced by the newer one (keeping its place in the
+    queue), so a burst of updates to one widget results in one render. Each
+    tick stops draining once the frame budget is used up, so a burst of posts
+    never freezes the GUI; the rest run on the following ticks.
+    """
+
+    def __init__(self, root, tick_interval=20, frame_budget=15):
+        """
+        Class constructor.
+
+        :param root: The Tk root widget whose main loop will run the posted callables.
+        :param tick_interval: Integer number of milliseconds between ticks.
+        :param frame_budget: Number of milliseconds a tick may spend running callables.
+        """
+        # Configure logging
+        self.log = logging.getLogger("UIDispatcher")
+        self.log.debug("Starting up...")
+
+        self.root = root
+        self.tick_interval = tick_interval
+        self.frame_budget = frame_budget / 1000
+
+        # The callables waiting to run, in the order they were first posted,
+        # and the lock that arbitrates access to them from different threads.
+        self.pending = collections.OrderedDict()
+        self.pending_lock = threading.Lock()
+
+        # Unique keys for posts that don't coalesce.
+        self.sequence = itertools.count()
+
+        # The id of the scheduled tick, or None if one isn't scheduled.
+        self.after_id = None
+
+        # Count of posts that were superseded before they ran.
+        self.coalesced = 0
+
+
+    def start(self):
+        """
+        Schedules the first tick. Must be called from the main loop's thread.
+        """
+        if self.after_id is None:
+            self.after_id = self.root.after(self.tick_interval, self.tick)
+
+
+    def stop(self):
+        """
+        Cancels the scheduled tick. Must be called from the main loop's thread.
+        """
+        if self.after_id is not None:
+            self.root.after_cancel(self.after_id)
+            self.after_id = None
+
+
+    def post(self, callback, *args, key=None):
+        """
+        Queues the callback to be called with *args on the main loop's thread.
+        Safe to call from any thread.
+
+        :param callback: The callable to run.
+        :param key: If given, any callable posted with the same key that hasn't
+                    run yet is replaced by this one.
+        """
+        if key is None:
+            key = next(self.sequence)
+        with self.pending_lock:
+            if key in self.pending:
+                self.coalesced += 1
+            self.pending[key] = (callback, args)
+
+
+    def tick(self):
+        """
+        Runs the queued callables until the queue is empty or the frame
+        budget is used up, then schedules the next tick.
+        """
+        # :NOTE: A callable may run a nested event loop (e.g. a messagebox)
+        #        which can run a nested tick. Clearing after_id first means
+        #        only one of them schedules the next tick.
+        self.after_id = None
+        deadline = time.monotonic() + self.frame_budget
+        while time.monotonic() < deadline:
+            with self.pending_lock:
+                if not self.pending:
+                    break
+                key, (callback, args) = self.pending.popitem(last=False)
+            try:
+                callback(*args)
+            except Exception:
+                self.log.exception("Posted callable {} raised an exception".format(callback))
+
+        if self.after_id is None:
+            self.after_id = self.root.after(self.tick_interval, self.tick)
@@ -0,0 +1,182 @@
+import os
+import pwd
+import signal
+import subprocess
+import threading
+import tempfile
+import functools
+import logging
+
+
+@functools.lru_cache(maxsize=256)
+def lookup_user(username):
+    """
+    Looks up a user in the password database. The answers are cached, so
+    starting sessions for the same users doesn't read it each time.
+
+    :param username: The name of the user.
+    :return: A (pwd.struct_passwd, groups) tuple, where groups is the list of
+             group IDs the user is a member of.
+    :raises KeyError: If there is no such user.
+    """
+    pw = pwd.getpwnam(username)
+    return pw, os.getgrouplist(username, pw.pw_gid)
+
+
+def vncserver_args(display_number, display_name, geometry, pixelformat, command="vncserver"):
+    """
+    Builds the command line that starts vncserver on a display.
+
+    :param display_number: The display to start on, as a string.
+    :param display_name: The desktop name, or None or "" for vncserver's default.
+    :param geometry: The desktop size, or None or "" for vncserver's default.
+    :param pixelformat: The pixel format, or None or "" for the default of the depth.
+    :param command: The vncserver executable.
+    :return: The list of arguments.
+    """
+    args = [command, ":{}".format(display_number)]
+    if display_name:
+        args += ["-name", display_name]
+    if geometry:
+        args += ["-geometry", geometry]
+    if pixelformat:
+        args += ["-pixelformat", pixelformat]
+    return args
+
+
+def user_popen_args(username, **extra_env):
+    """
+    Builds the subprocess.Popen arguments that run a process as a given
+    user, in the user's home directory and with the user's environment.
+
+    :param username: The name of the user.
+    :param extra_env: More environment variables to set.
+    :return: A dictionary of keyword arguments for subprocess.Popen.
+    :raises KeyError: If there is no such user.
+    """
+    pw, groups = lookup_user(username)
+
+    # Get the current environment and modify it to represent the new user
+    new_env = os.environ.copy()
+    new_env["USER"] = username
+    new_env["LOGNAME"] = username
+    new_env["HOME"] = pw.pw_dir
+    new_env["CWD"] = pw.pw_dir
+    new_env.update(extra_env)
+
+    popen_args = {"env": new_env, "cwd": pw.pw_dir}
+    # :NOTE: Switching user needs root. A server already running as the user
+    #        (e.g. while testing) starts the process as itself.
+    if os.geteuid() != pw.pw_uid:
+        popen_args.update(user=pw.pw_uid, group=pw.pw_gid, extra_groups=groups)
+    return popen_args
+
+
+class SpawnedVNCServer(object):
+    """
+    A class that follows a vncserver started by spawn_vnc_server(). It looks
+    enough like a multiprocessing.Process (exitcode, join()) to be tracked as
+    a start job.
+    """
+
+    def __init__(self, popen, stderr_file):
+        """
+        Class constructor.
+
+        :param popen: The subprocess.Popen running vncserver.
+        :param stderr_file: The file vncserver's stderr goes to.
+        """
+        self.popen = popen
+        self.pid = popen.pid
+        self.stderr_file = stderr_file
+        self.exitcode = None
+        self.exited = threading.Event()
+
+
+    def handle_exit(self, returncode):
+        """
+        Records the exit code of vncserver once it has been reaped.
+
+        :param returncode: The exit code.
+        """
+        self.exitcode = returncode
+        self.exited.set()
+
+
+    def join(self, timeout=None):
+        """
+        Waits for vncserver to exit and be reaped.
+
+        :param timeout: The most seconds to wait, or None to wait for ever.
+        """
+        self.exited.wait(timeout)
+
+
+    def kill_process_group(self):
+        """
+        Kills vncserver and the Xvnc it started, if they are still running.
+        """
+        # :NOTE: vncserver is started in a session of its own, so its process
+        #        group holds it and the Xvnc it starts, and nothing else.
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+    def read_stderr(self):
+        """
+        Reads what vncserver wrote to stderr so far, and closes the file.
+
+        :return: The text.
+        """
+        try:
+            self.stderr_file.seek(0)
+            return self.stderr_file.read(65536).decode('utf8', 'replace')
+        except (OSError, ValueError):
+            return None
+        finally:
+            self.stderr_file.close()
+
+
+def spawn_vnc_server(username, display_number, display_name, geometry, pixelformat, reaper,
+                     command="vncserver"):
+    """
+    Starts vncserver as a given user, straight from this process.
+
+    Unlike CreateNewVNCServer, which forks the whole server and switches user
+    in Python, this leaves the fork, the switch of user and groups and the
+    exec to subprocess, which does them in C (with vfork or posix_spawn where
+    it can) so nothing of the server is copied or run in the child.
+
+    :param username: The user to run vncserver as.
+    :param display_number: The display to start on, as a string.
+    :param display_name: The desktop name, or None or "".
+    :param geometry: The desktop size, or None or "".
+    :param pixelformat: The pixel format, or None or "".
+    :param reaper: The ProcessReaper that reaps vncserver when it exits.
+    :param command: The vncserver executable.
+    :return: The SpawnedVNCServer.
+    :raises KeyError: If there is no such user.
+    :raises OSError: If vncserver couldn't be started.
+    """
+    log = logging.getLogger("VNCServerSpawner")
+    log.info("Creating a VNC server for {}".format(username))
+
+    # :NOTE: stderr goes to a file rather than a pipe, as Xvnc inherits it
+    #        and keeps it open long after vncserver has exited.
+    stderr_file = tempfile.TemporaryFile()
+    try:
+        popen = subprocess.Popen(vncserver_args(display_number, display_name, geometry, pixelformat, command),
+                                 stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=stderr_file,
+                                 start_new_session=True,
+                                 **user_popen_args(username))
+    except BaseException:
+        stderr_file.close()
+        raise
+
+    spawned = SpawnedVNCServer(popen, stderr_file)
+    reaper.watch(popen, spawned.handle_exit)
+    return spawned
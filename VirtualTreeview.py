@@ -0,0 +1,428 @@
+import itertools
+import logging
+from tkinter import ttk
+
+
+class VirtualTreeview(object):
+    """
+    A class that stands in for a ttk.Treeview, holding its rows in a Python
+    model and only creating real Tk items for the rows in view (plus a few
+    rows of overscan).
+
+    The row methods of ttk.Treeview (insert(), item(), move(), delete(),
+    get_children(), parent(), index(), exists(), selection(), selection_set(),
+    focus(), see(), yview() and yview_moveto()) work on the model, using the
+    model's item ids. Everything else (column(), heading(), grid(), ...) is
+    passed straight through to the real Treeview.
+
+    A fixed pool of real top-level items is re-used as the view scrolls.
+    Child rows are only created as real items when their parent is open; a
+    closed parent with children gets a single placeholder child so that Tk
+    still draws its expand indicator.
+    """
+
+    def __init__(self, tv, overscan=5):
+        """
+        Class constructor.
+
+        :param tv: The ttk.Treeview to draw the rows in.
+        :param overscan: The number of rows past the bottom of the view to
+                         create real items for.
+        """
+        # :NOTE: __setattr__ is not overridden, but __getattr__ is, so set the
+        #        real Treeview first to avoid recursing on missing attributes.
+        self.tv = tv
+
+        # Configure logging
+        self.log = logging.getLogger("VirtualTreeview")
+
+        self.overscan = overscan
+
+        # The model. roots holds the top-level item ids in display order. Each
+        # node maps an item id to a dictionary of its options, parent and children.
+        self.roots = []
+        self.nodes = {}
+        self.ids = itertools.count()
+
+        # The view. first is the index in roots of the top row in view. slots
+        # holds the real Treeview items that rows are drawn in and slot_state
+        # the (item id, options, open, children) each slot was last drawn with.
+        self.first = 0
+        self.visible_rows = 1
+        self.slots = []
+        self.slot_state = []
+
+        # The item id of the selected row, or '' if nothing is selected, and
+        # the item id last reported to the <<TreeviewSelect>> handlers.
+        self.selected = ''
+        self.reported = ''
+
+        # Handlers bound to virtual events through this object, and the
+        # yscrollcommand to keep the scrollbar up to date.
+        self.select_handlers = []
+        self.open_handlers = []
+        self.close_handlers = []
+        self.yscrollcommand = None
+
+        # The id of the pending render, or None if one isn't scheduled.
+        self.render_id = None
+
+        self.tv.bind("<<TreeviewSelect>>", self.handle_select)
+        self.tv.bind("<<TreeviewOpen>>", self.handle_open)
+        self.tv.bind("<<TreeviewClose>>", self.handle_close)
+        self.tv.bind("<Configure>", self.handle_configure)
+        self.tv.bind("<MouseWheel>", self.handle_wheel)
+        self.tv.bind("<Button-4>", self.handle_wheel)
+        self.tv.bind("<Button-5>", self.handle_wheel)
+        self.tv.bind("<Up>", self.handle_arrow)
+        self.tv.bind("<Down>", self.handle_arrow)
+
+
+    def __getattr__(self, name):
+        # Pass anything not handled by the model through to the real Treeview.
+        return getattr(self.tv, name)
+
+    def __setitem__(self, key, value):
+        self.tv[key] = value
+
+    def __getitem__(self, key):
+        return self.tv[key]
+
+
+    def configure(self, cnf=None, **kw):
+        """
+        Passes options through to the real Treeview, except yscrollcommand
+        which is driven from the model.
+        """
+        if "yscrollcommand" in kw:
+            self.yscrollcommand = kw.pop("yscrollcommand")
+            self.schedule_render()
+        if cnf is None and not kw:
+            return None
+        return self.tv.configure(cnf, **kw)
+
+    config = configure
+
+
+    def bind(self, sequence=None, func=None, add=None):
+        """
+        Binds handlers for the Treeview virtual events to the model, and passes
+        any other bindings through to the real Treeview.
+        """
+        if sequence == "<<TreeviewSelect>>":
+            self.select_handlers.append(func)
+        elif sequence == "<<TreeviewOpen>>":
+            self.open_handlers.append(func)
+        elif sequence == "<<TreeviewClose>>":
+            self.close_handlers.append(func)
+        else:
+            return self.tv.bind(sequence, func, add)
+
+
+    #
+    # Model methods, mirroring those of ttk.Treeview.
+    #
+
+    def insert(self, parent, index, iid=None, **kw):
+        if iid is None:
+            iid = "V{}".format(next(self.ids))
+        if iid in self.nodes:
+            raise ValueError("Item {} already exists".format(iid))
+        node = {"text": kw.get("text", ""),
+                "image": kw.get("image", ""),
+                "values": kw.get("values", ""),
+                "tags": kw.get("tags", ""),
+                "open": kw.get("open", False),
+                "parent": parent,
+                "children": []}
+        self.nodes[iid] = node
+        siblings = self._siblings(parent)
+        siblings.insert(len(siblings) if index == "end" else index, iid)
+        self.schedule_render()
+        return iid
+
+    def item(self, iid, option=None, **kw):
+        if isinstance(iid, (tuple, list)):
+            # Like Tk, treat an empty selection as an item with no values.
+            if not iid:
+                return "" if option is not None else {"text": "", "image": "", "values": "", "open": 0, "tags": ""}
+            iid = iid[0]
+        node = self.nodes[iid]
+        if kw:
+            for key, value in kw.items():
+                node[key] = value
+            self.schedule_render()
+            return None
+        options = {"text": node["text"],
+                   "image": node["image"],
+                   "values": node["values"],
+                   "open": node["open"],
+                   "tags": node["tags"]}
+        return options if option is None else options[option]
+
+    def move(self, iid, parent, index):
+        node = self.nodes[iid]
+        self._siblings(node["parent"]).remove(iid)
+        node["parent"] = parent
+        self._siblings(parent).insert(index, iid)
+        self.schedule_render()
+
+    def delete(self, *iids):
+        for iid in iids:
+            if iid not in self.nodes:
+                continue
+            node = self.nodes[iid]
+            self.delete(*node["children"])
+            self._siblings(node["parent"]).remove(iid)
+            del self.nodes[iid]
+            if self.selected == iid:
+                self.selected = ''
+        self.schedule_render()
+
+    def get_children(self, item=''):
+        return tuple(self._siblings(item))
+
+    def parent(self, iid):
+        return self.nodes[iid]["parent"]
+
+    def index(self, iid):
+        return self._siblings(self.nodes[iid]["parent"]).index(iid)
+
+    def exists(self, iid):
+        return iid in self.nodes
+
+    def selection(self):
+        return (self.selected,) if self.selected else ()
+
+    def selection_set(self, *items):
+        if len(items) == 1 and isinstance(items[0], (tuple, list)):
+            items = items[0]
+        new_selected = items[0] if items else ''
+        if new_selected != self.selected:
+            self.selected = new_selected
+            self.schedule_render()
+            # :NOTE: Like Tk, the handlers are called once the program is idle.
+            self.tv.after_idle(self.report_selection, None)
+
+    def focus(self, item=None):
+        if item is None:
+            iid = self._real_to_model(self.tv.focus())
+            return '' if iid is None else iid
+        self.selection_set(item)
+
+    def see(self, iid):
+        node = self.nodes[iid]
+        root = iid if node["parent"] == '' else node["parent"]
+        idx = self.roots.index(root)
+        if idx < self.first:
+            self._scroll_to(idx)
+        elif idx >= self.first + self.visible_rows:
+            self._scroll_to(idx - self.visible_rows + 1)
+
+    def yview(self, *args):
+        if not args:
+            if not self.roots:
+                return (0.0, 1.0)
+            return (self.first / len(self.roots),
+                    min((self.first + self.visible_rows) / len(self.roots), 1.0))
+        if args[0] == "moveto":
+            self.yview_moveto(float(args[1]))
+        elif args[0] == "scroll":
+            count = int(args[1])
+            if args[2] == "pages":
+                count *= self.visible_rows
+            self._scroll_to(self.first + count)
+
+    def yview_moveto(self, fraction):
+        self._scroll_to(int(round(float(fraction) * len(self.roots))))
+
+
+    #
+    # Event handlers for the real Treeview.
+    #
+
+    def handle_select(self, e):
+        """
+        Maps the selection of a real item back to the model and calls the bound
+        handlers if the selected row changed.
+        """
+        # :NOTE: The real selection is cleared when the selected row scrolls out
+        #        of view, and set again when it scrolls back in. Neither of those
+        #        is a change to the model's selection.
+        real_selection = self.tv.selection()
+        if real_selection:
+            iid = self._real_to_model(real_selection[0])
+            if iid is not None:
+                self.selected = iid
+        self.report_selection(e)
+
+    def report_selection(self, e):
+        """
+        Calls the bound <<TreeviewSelect>> handlers if the selected row is not
+        the one they were last told about.
+        """
+        if self.selected == self.reported:
+            return
+        self.reported = self.selected
+        for handler in self.select_handlers:
+            handler(e)
+
+    def handle_open(self, e):
+        iid = self._real_to_model(self.tv.focus())
+        if iid is None:
+            return
+        self.nodes[iid]["open"] = True
+        for handler in self.open_handlers:
+            handler(e)
+        self.render()
+
+    def handle_close(self, e):
+        iid = self._real_to_model(self.tv.focus())
+        if iid is None:
+            return
+        self.nodes[iid]["open"] = False
+        for handler in self.close_handlers:
+            handler(e)
+        self.render()
+
+    def handle_configure(self, e):
+        # Work out how many rows fit in the widget.
+        # :NOTE: The heading takes up about one row.
+        rowheight = ttk.Style().lookup("Treeview", "rowheight") or 20
+        visible_rows = max(1, e.height // int(rowheight) - 1)
+        if visible_rows != self.visible_rows:
+            self.visible_rows = visible_rows
+            self.schedule_render()
+
+    def handle_wheel(self, e):
+        if e.num == 4 or getattr(e, "delta", 0) > 0:
+            self._scroll_to(self.first - 3)
+        else:
+            self._scroll_to(self.first + 3)
+        return "break"
+
+    def handle_arrow(self, e):
+        # Move the selection a top-level row at a time across the whole model,
+        # not just the rows that have real items.
+        if not self.roots:
+            return "break"
+        if self.selected:
+            node = self.nodes[self.selected]
+            root = self.selected if node["parent"] == '' else node["parent"]
+            idx = self.roots.index(root) + (-1 if e.keysym == "Up" else 1)
+        else:
+            idx = 0
+        idx = min(max(idx, 0), len(self.roots) - 1)
+        self.selection_set(self.roots[idx])
+        self.see(self.roots[idx])
+        return "break"
+
+
+    #
+    # Rendering.
+    #
+
+    def schedule_render(self):
+        """
+        Schedules the real items to be brought in line with the model once
+        Tk is idle, so that a batch of model changes results in one render.
+        """
+        if self.render_id is None:
+            self.render_id = self.tv.after_idle(self.render)
+
+    def render(self):
+        """
+        Brings the real items in line with the rows of the model in view.
+        Only the slots whose row changed are touched.
+        """
+        if self.render_id is not None:
+            self.tv.after_cancel(self.render_id)
+            self.render_id = None
+
+        self.first = max(0, min(self.first, len(self.roots) - self.visible_rows))
+        window = self.roots[self.first:self.first + self.visible_rows + self.overscan]
+
+        # Create or delete slots so there is one per row in the window.
+        while len(self.slots) < len(window):
+            self.slots.append(self.tv.insert('', 'end'))
+            self.slot_state.append(None)
+        while len(self.slots) > len(window):
+            self.tv.delete(self.slots.pop())
+            self.slot_state.pop()
+
+        real_selected = ()
+        for idx, iid in enumerate(window):
+            slot = self.slots[idx]
+            node = self.nodes[iid]
+            options = (node["text"], node["image"], node["values"], node["tags"])
+            children = tuple((child, self.nodes[child]["text"], self.nodes[child]["image"],
+                              self.nodes[child]["values"], self.nodes[child]["tags"])
+                             for child in node["children"]) if node["open"] else bool(node["children"])
+            state = (iid, options, node["open"], children)
+            if self.slot_state[idx] != state:
+                self._draw_slot(slot, node, state)
+                self.slot_state[idx] = state
+            if self.selected == iid:
+                real_selected = (slot,)
+            elif self.selected and self.selected in node["children"] and node["open"]:
+                real_selected = (self.tv.get_children(slot)[node["children"].index(self.selected)],)
+
+        if tuple(self.tv.selection()) != real_selected:
+            if real_selected:
+                self.tv.selection_set(*real_selected)
+            else:
+                self.tv.selection_remove(*self.tv.selection())
+
+        if self.yscrollcommand is not None:
+            first, last = self.yview()
+            self.yscrollcommand(first, last)
+
+    def _draw_slot(self, slot, node, state):
+        """
+        A private method that draws a row of the model, and its children if
+        it is open, in a slot.
+        """
+        iid, options, is_open, children = state
+        text, image, values, tags = options
+        self.tv.item(slot, text=text, image=image, values=values, tags=tags, open=is_open)
+        self.tv.delete(*self.tv.get_children(slot))
+        if is_open:
+            for child, text, image, values, tags in children:
+                self.tv.insert(slot, 'end', text=text, image=image, values=values, tags=tags)
+        elif children:
+            # A placeholder so Tk draws the expand indicator.
+            self.tv.insert(slot, 'end', text='')
+
+    def _real_to_model(self, real_item):
+        """
+        A private method that returns the model item id drawn in a real item,
+        or None if the real item isn't showing a row of the model.
+        """
+        if real_item in self.slots:
+            idx = self.slots.index(real_item)
+            state = self.slot_state[idx]
+            return None if state is None else state[0]
+        real_parent = self.tv.parent(real_item)
+        if real_parent in self.slots:
+            parent_iid = self._real_to_model(real_parent)
+            if parent_iid is not None and self.nodes[parent_iid]["open"]:
+                children = self.nodes[parent_iid]["children"]
+                idx = self.tv.index(real_item)
+                if idx < len(children):
+                    return children[idx]
+        return None
+
+    def _siblings(self, parent):
+        """
+        A private method that returns the list of item ids under a parent.
+        """
+        return self.roots if parent == '' else self.nodes[parent]["children"]
+
+    def _scroll_to(self, first):
+        """
+        A private method that scrolls the view so the row at index first is at the top.
+        """
+        first = max(0, min(first, len(self.roots) - self.visible_rows))
+        if first != self.first:
+            self.first = first
+            self.render()
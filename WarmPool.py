@@ -0,0 +1,635 @@
+import os
+import stat
+import errno
+import signal
+import shutil
+import socket
+import struct
+import subprocess
+import threading
+import functools
+import json
+import time
+import logging
+
+import HostMetrics
+import VNCServerSpawner
+
+
+# The desktop name idle pooled Xvnc servers run under.
+POOL_DESKTOP_NAME = "mort-pool"
+
+# The accounts pooled Xvnc servers may not run as: none configured, or ones
+# other daemons run as too, which could read the VNC passwords of the users
+# handed a server.
+SHARED_ACCOUNTS = ("", "nobody")
+
+# Run by sh as the user on a handed over display: the user's xstartup if it
+# is executable, otherwise the session command passed as $0.
+# :NOTE: The check is made by the user's shell, with the user's credentials,
+#        rather than by the server, which could see files the user can't.
+SESSION_SCRIPT = 'if [ -x "$HOME/.vnc/xstartup" ]; then exec "$HOME/.vnc/xstartup"; fi; exec "$0"'
+
+
+def check_private_dir(path):
+    """
+    Checks a directory can't be tampered with by other users: it is a real
+    directory (not a symlink to one), owned by root or this process's user
+    and not writable by group or others.
+
+    :param path: The path of the directory.
+    :raises OSError: If it doesn't exist or could be tampered with.
+    """
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        raise NotADirectoryError(errno.ENOTDIR, "Not a directory", path)
+    if st.st_uid not in (0, os.geteuid()) or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(errno.EPERM, "Directory could be written by other users", path)
+
+
+def kill_process_group(pid):
+    """
+    Kills a process started in a session of its own, and whatever it started.
+
+    :param pid: The PID of the process, as a string or int.
+    """
+    try:
+        os.killpg(int(pid), signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def xauthority_entry(display_number, cookie):
+    """
+    Builds an Xauthority file entry that grants a MIT-MAGIC-COOKIE-1 for a
+    display from any address.
+
+    :param display_number: The display, as a string.
+    :param cookie: The 16 byte cookie.
+    :return: The bytes of the entry.
+    """
+    def field(data):
+        return struct.pack(">H", len(data)) + data
+
+    # :NOTE: The family 0xFFFF is FamilyWild, which matches any address.
+    return (struct.pack(">H", 0xFFFF) + field(b"") + field(str(display_number).encode('ascii')) +
+            field(b"MIT-MAGIC-COOKIE-1") + field(cookie))
+
+
+class PoolEntry(object):
+    """
+    A class that holds one pre-started Xvnc server of the pool.
+    """
+
+    def __init__(self, display_number, entry_dir):
+        """
+        Class constructor.
+
+        :param display_number: The display of the server, as a string.
+        :param entry_dir: The directory the server's password and Xauthority
+                          files are kept in.
+        """
+        self.display_number = display_number
+        self.entry_dir = entry_dir
+        self.passwd_path = os.path.join(entry_dir, "passwd")
+        self.xauth_path = os.path.join(entry_dir, "Xauthority")
+        self.state_path = os.path.join(entry_dir, "state")
+        self.cookie = os.urandom(16)
+        self.pid = None
+        self.username = None
+        self.display_name = None
+        self.removed = False
+
+
+class WarmPool(object):
+    """
+    A class that keeps a pool of pre-started, idle Xvnc servers and hands
+    them over to users, so a session starts in milliseconds rather than
+    after the seconds vncserver and Xvnc take to start up.
+
+    An idle server runs as xvnc_user, an unprivileged account of the pool's
+    own (the pool isn't started without one), with a random VNC
+    password nobody knows and a random X cookie. Handing one over copies the
+    user's VNC password over the random one (Xvnc reads its password file
+    each time a viewer connects), gives the user a copy of the X cookie and
+    runs the user's xstartup as the user on the display. From then on the
+    session is listed as the user's. The user's files are only ever read
+    with the user's credentials.
+
+    The files of each server are kept in a directory of its own under
+    pool_dir, which must be in a directory only root (or the session
+    server's user) can write to, along with a record of its PID and user.
+    When the session server restarts, servers that were handed over are
+    listed as their users' again, and idle ones left over are killed.
+
+    A background refiller keeps the pool at size servers, but only starts
+    one while the load per CPU is at most max_load_per_cpu and at least
+    min_free_memory MiB of memory are available.
+    """
+
+    def __init__(self, display_allocator, session_inventory, reaper, size=0, geometry="", pixelformat="",
+                 max_load_per_cpu=0.75, min_free_memory=1024, refill_interval=5.0, start_timeout=30.0,
+                 pool_dir="/run/mort-pool", xvnc_command="Xvnc", session_command="/etc/X11/Xsession",
+                 xvnc_user=""):
+        """
+        Class constructor.
+
+        :param display_allocator: The DisplayAllocator the pool's displays are claimed from.
+        :param session_inventory: The SessionInventory of this host.
+        :param reaper: The ProcessReaper that reaps the pool's processes.
+        :param size: The number of idle servers to keep. 0 turns the pool off.
+        :param geometry: The desktop size of the pooled servers, or "" for Xvnc's default.
+        :param pixelformat: The pixel format of the pooled servers, or "" for the default.
+        :param max_load_per_cpu: The highest load per CPU a server is started at.
+        :param min_free_memory: The fewest MiB of available memory a server is started with.
+        :param refill_interval: Number of seconds between checks that the pool is full.
+        :param start_timeout: Number of seconds a pooled Xvnc has to start listening.
+        :param pool_dir: The directory the pool's files are kept in. Its parent
+                         must only be writable by root or the session server's user.
+        :param xvnc_command: The Xvnc executable.
+        :param session_command: What is run as the user on a handed over display
+                                if the user has no executable ~/.vnc/xstartup.
+        :param xvnc_user: The account the pooled Xvnc servers run as. It must be
+                          one of their own, as it can read the VNC passwords
+                          of the users handed a server. The pool isn't
+                          started without it.
+        """
+        # Configure logging
+        self.log = logging.getLogger("WarmPool")
+        self.log.debug("Starting up...")
+
+        self.display_allocator = display_allocator
+        self.session_inventory = session_inventory
+        self.reaper = reaper
+        self.size = size
+        self.geometry = geometry
+        self.pixelformat = pixelformat
+        self.max_load_per_cpu = max_load_per_cpu
+        self.min_free_memory = min_free_memory
+        self.refill_interval = refill_interval
+        self.start_timeout = start_timeout
+        self.pool_dir = pool_dir
+        self.xvnc_command = xvnc_command
+        self.session_command = session_command
+        self.xvnc_user = xvnc_user
+
+        # The servers still starting, by display number, the idle ones, and
+        # the ones handed over, by PID, and the lock that arbitrates access
+        # to them from different threads.
+        self.starting = {}
+        self.idle = []
+        self.owned = {}
+        self.lock = threading.Lock()
+
+        # Wakes the refiller up when a server is handed over or exits.
+        self.wakeup = threading.Event()
+
+        self.refill_task = threading.Thread(target=self.refill,
+                                            name="warm_pool_refill_thread",
+                                            daemon=True)
+
+
+    def start(self):
+        """
+        Reclaims the servers left by an earlier run, and starts the refiller
+        thread, if the pool is turned on.
+        """
+        self.reclaim()
+        if self.size <= 0:
+            return
+        if self.xvnc_user in SHARED_ACCOUNTS:
+            self.log.error("Not starting the pool: xvnc_user must be an account of its own, "
+                           "not '{}'".format(self.xvnc_user))
+            return
+        self.refill_task.start()
+
+
+    def reclaim(self):
+        """
+        Takes stock of the servers an earlier run of the session server left
+        in pool_dir. Servers that were handed over and are still running are
+        listed as their users' again. Idle ones are killed, as nobody knows
+        their password, and the files of the rest are removed.
+        """
+        try:
+            check_private_dir(self.pool_dir)
+            names = os.listdir(self.pool_dir)
+        except FileNotFoundError:
+            return
+        except OSError as ex:
+            self.log.warning("Could not reclaim the pool: {}".format(ex))
+            return
+
+        running = {session["pid"]: session for session in self.session_inventory.get(max_age=0)}
+        for name in names:
+            entry = PoolEntry(name, os.path.join(self.pool_dir, name))
+            try:
+                with open(entry.state_path) as f:
+                    state = json.load(f)
+                entry.pid = state["pid"]
+                entry.username = state.get("username")
+                entry.display_name = state.get("display_name")
+            except (OSError, ValueError, KeyError, TypeError):
+                self.log.warning("Removing the unreadable pool entry {}".format(entry.entry_dir))
+                shutil.rmtree(entry.entry_dir, ignore_errors=True)
+                continue
+
+            # :NOTE: The inventory only lists Xvnc processes, so a PID that
+            #        has been reused by anything else isn't matched.
+            session = running.get(entry.pid)
+            if session is not None and str(session["display_number"]) == entry.display_number:
+                if entry.username is not None:
+                    self.log.info("Reclaimed display {0} of {1}".format(entry.display_number, entry.username))
+                    with self.lock:
+                        self.owned[entry.pid] = entry
+                    continue
+                self.log.info("Killing the idle pooled Xvnc left on display {}".format(entry.display_number))
+                try:
+                    os.kill(int(entry.pid), signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            shutil.rmtree(entry.entry_dir, ignore_errors=True)
+        self.session_inventory.invalidate()
+
+
+    def displays(self):
+        """
+        :return: The set of display numbers (strings) of the servers starting
+                 or idle in the pool. (Servers handed over are in the inventory.)
+        """
+        with self.lock:
+            return set(self.starting) | {entry.display_number for entry in self.idle}
+
+
+    def annotate(self, sessions):
+        """
+        Fixes up a scanned list of sessions for the pool: idle servers are
+        left out, and servers handed over are shown as their user's. Servers
+        handed over that are missing from the list have exited, and are
+        forgotten.
+
+        :param sessions: The list of session dictionaries, as scanned.
+        :return: The new list.
+        """
+        with self.lock:
+            pool_pids = {entry.pid for entry in self.idle}
+            pool_pids.update(entry.pid for entry in self.starting.values())
+            owned = dict(self.owned)
+
+        # :NOTE: Servers reclaimed after a restart aren't children of this
+        #        process, so their exit is only noticed here.
+        scanned_pids = {session["pid"] for session in sessions}
+        for pid, entry in owned.items():
+            if pid not in scanned_pids:
+                self.log.info("Handed over Xvnc on display {} has exited".format(entry.display_number))
+                self.remove(entry)
+
+        annotated = []
+        for session in sessions:
+            if session["pid"] in pool_pids:
+                continue
+            entry = owned.get(session["pid"])
+            if entry is not None:
+                session = dict(session,
+                               username=entry.username,
+                               display_name=entry.display_name or "{0}:{1}".format(entry.username,
+                                                                                   entry.display_number))
+            annotated.append(session)
+        return annotated
+
+
+    def claim(self, username, display_name, geometry, pixelformat):
+        """
+        Hands an idle server over to a user, if there is one that fits.
+
+        :param username: The user to hand the server to.
+        :param display_name: The desktop name asked for, or "".
+        :param geometry: The desktop size asked for, or "" for any.
+        :param pixelformat: The pixel format asked for, or "" for any.
+        :return: The PoolEntry handed over, or None.
+        """
+        if geometry and geometry != self.geometry:
+            return None
+        if pixelformat and pixelformat.upper() != self.pixelformat.upper():
+            return None
+        with self.lock:
+            if not self.idle:
+                return None
+            entry = self.idle.pop(0)
+
+        try:
+            self.hand_over(entry, username, display_name)
+        except (OSError, KeyError) as ex:
+            self.log.warning("Could not hand display {0} over to {1}: {2}".format(entry.display_number, username, ex))
+            # :NOTE: A server hand_over() has killed isn't put back, and is
+            #        replaced by the refiller.
+            with self.lock:
+                if not entry.removed:
+                    self.idle.append(entry)
+            if entry.removed:
+                self.session_inventory.invalidate()
+                self.wakeup.set()
+            return None
+
+        self.log.info("Handed display {0} over to {1}".format(entry.display_number, username))
+        self.session_inventory.invalidate()
+        self.wakeup.set()
+        return entry
+
+
+    def hand_over(self, entry, username, display_name):
+        """
+        Gives an idle server to a user: the user's VNC password, a copy of the
+        X cookie and the user's session started on it.
+
+        :param entry: The PoolEntry.
+        :param username: The user to hand the server to.
+        :param display_name: The desktop name asked for, or "".
+        :raises KeyError: If there is no such user.
+        :raises OSError: If the user has no VNC password or the session couldn't
+                         start. If the server was already given some of the
+                         user's access, it has been killed and removed.
+        """
+        pw = VNCServerSpawner.lookup_user(username)[0]
+        user_popen_args = VNCServerSpawner.user_popen_args(username)
+        xvnc_pw = self.xvnc_account()
+
+        # Read the user's VNC password as the user, so that nobody can have
+        # the server read a file they can't read themselves.
+        passwd_path = os.path.join(pw.pw_dir, ".vnc", "passwd")
+        try:
+            result = subprocess.run(["head", "-c", "64", "--", passwd_path],
+                                    stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL,
+                                    timeout=self.start_timeout,
+                                    **user_popen_args)
+        except subprocess.TimeoutExpired:
+            raise OSError(errno.ETIMEDOUT, "Timed out reading the VNC password", passwd_path)
+        if result.returncode != 0 or not result.stdout:
+            raise OSError(errno.ENOENT, "Could not read the VNC password", passwd_path)
+        passwd = result.stdout
+
+        # :NOTE: From here on the server has been given some of the user's
+        #        access, so it can't go back in the pool. If anything fails,
+        #        it is killed, along with the user's session if it started.
+        user_xauth_path = entry.xauth_path + "-" + username
+        session = None
+        try:
+            self.write_private(user_xauth_path, xauthority_entry(entry.display_number, entry.cookie),
+                               pw.pw_uid, pw.pw_gid)
+            self.write_private(entry.passwd_path, passwd, xvnc_pw.pw_uid, xvnc_pw.pw_gid)
+
+            # Record whose it is in case the session server restarts.
+            with self.lock:
+                entry.username = username
+                entry.display_name = display_name
+                self.owned[entry.pid] = entry
+            self.write_state(entry)
+
+            session = subprocess.Popen(["/bin/sh", "-c", SESSION_SCRIPT, self.session_command],
+                                       stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.DEVNULL,
+                                       start_new_session=True,
+                                       **VNCServerSpawner.user_popen_args(username,
+                                                                          DISPLAY=":{}".format(entry.display_number),
+                                                                          XAUTHORITY=user_xauth_path))
+            self.reaper.watch(session)
+        except BaseException:
+            if session is not None:
+                kill_process_group(session.pid)
+                session.wait()
+            kill_process_group(entry.pid)
+            self.remove(entry)
+            raise
+
+
+    def refill(self):
+        """
+        Keeps the pool at size idle servers, within the CPU and memory budget.
+        Runs as a seperate thread.
+        """
+        while True:
+            with self.lock:
+                missing = self.size - len(self.idle) - len(self.starting)
+            if missing > 0 and self.within_budget():
+                entry = self.display_allocator.claim(self.reserve)
+                if entry is None:
+                    self.log.warning("No free display to add to the pool.")
+                elif self.launch(entry):
+                    # Carry on filling the pool.
+                    continue
+            self.wakeup.wait(self.refill_interval)
+            self.wakeup.clear()
+
+
+    def within_budget(self):
+        """
+        :return: True if there is the CPU and memory to start another server.
+        """
+        load = HostMetrics.load_per_cpu()
+        free_memory = HostMetrics.mem_available()
+        if load > self.max_load_per_cpu or (free_memory is not None and free_memory < self.min_free_memory):
+            self.log.debug("Not refilling the pool: load per CPU {0:.2f}, {1} MiB free".format(load, free_memory))
+            return False
+        return True
+
+
+    def reserve(self, display_number):
+        """
+        Reserves a display for a new server of the pool. Called by the display
+        allocator under its lock.
+
+        :param display_number: The display, as a string.
+        :return: The new PoolEntry.
+        """
+        entry = PoolEntry(display_number, os.path.join(self.pool_dir, display_number))
+        with self.lock:
+            self.starting[display_number] = entry
+        return entry
+
+
+    def launch(self, entry):
+        """
+        Starts the Xvnc server of a reserved entry and waits for it to listen.
+
+        :param entry: The PoolEntry.
+        :return: True if it is idle in the pool, False if it didn't start.
+        """
+        port = 5900 + int(entry.display_number)
+        args = [self.xvnc_command, ":{}".format(entry.display_number),
+                "-desktop", POOL_DESKTOP_NAME,
+                "-rfbport", str(port),
+                "-rfbauth", entry.passwd_path,
+                "-auth", entry.xauth_path,
+                "-SecurityTypes", "VncAuth"]
+        if self.geometry:
+            args += ["-geometry", self.geometry]
+        if self.pixelformat:
+            args += ["-pixelformat", self.pixelformat]
+
+        try:
+            xvnc_pw = self.xvnc_account()
+            self.make_entry_dir(entry)
+            # Nobody knows the password until the server is handed over.
+            # Xvnc reads both files as xvnc_user.
+            self.write_private(entry.passwd_path, os.urandom(8), xvnc_pw.pw_uid, xvnc_pw.pw_gid)
+            self.write_private(entry.xauth_path, xauthority_entry(entry.display_number, entry.cookie),
+                               xvnc_pw.pw_uid, xvnc_pw.pw_gid)
+            popen_args = {"cwd": "/"}
+            if os.geteuid() != xvnc_pw.pw_uid:
+                popen_args.update(user=xvnc_pw.pw_uid, group=xvnc_pw.pw_gid, extra_groups=[])
+            popen = subprocess.Popen(args,
+                                     stdin=subprocess.DEVNULL,
+                                     stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL,
+                                     start_new_session=True,
+                                     **popen_args)
+        except (OSError, KeyError) as ex:
+            self.log.warning("Could not start Xvnc for the pool: {}".format(ex))
+            self.remove(entry)
+            return False
+        entry.pid = str(popen.pid)
+        self.reaper.watch(popen, functools.partial(self.handle_exit, entry))
+        try:
+            self.write_state(entry)
+        except OSError as ex:
+            self.log.warning("Could not record pooled Xvnc on display {0}: {1}".format(entry.display_number, ex))
+            popen.kill()
+            return False
+
+        deadline = time.monotonic() + self.start_timeout
+        while not self.is_listening(port):
+            if popen.poll() is not None or time.monotonic() > deadline:
+                self.log.warning("Pooled Xvnc on display {} didn't start".format(entry.display_number))
+                popen.kill()
+                return False
+            time.sleep(0.1)
+
+        with self.lock:
+            if self.starting.pop(entry.display_number, None) is None:
+                # It exited while starting.
+                return False
+            self.idle.append(entry)
+        self.log.info("Display {} is idle in the pool".format(entry.display_number))
+        return True
+
+
+    def handle_exit(self, entry, returncode):
+        """
+        Drops a server of the pool once its Xvnc has exited. Called on the
+        reaper thread.
+
+        :param entry: The PoolEntry.
+        :param returncode: The exit code of Xvnc.
+        """
+        self.log.info("Pooled Xvnc on display {0} exited with status {1}".format(entry.display_number, returncode))
+        self.remove(entry)
+        self.session_inventory.invalidate()
+        self.wakeup.set()
+
+
+    def remove(self, entry):
+        """
+        Forgets a server of the pool and removes its files.
+
+        :param entry: The PoolEntry.
+        """
+        with self.lock:
+            entry.removed = True
+            if self.starting.get(entry.display_number) is entry:
+                del self.starting[entry.display_number]
+            if entry in self.idle:
+                self.idle.remove(entry)
+            self.owned.pop(entry.pid, None)
+        shutil.rmtree(entry.entry_dir, ignore_errors=True)
+
+
+    def xvnc_account(self):
+        """
+        :return: The pwd.struct_passwd of the account pooled Xvnc servers run as.
+        :raises KeyError: If there is no such account.
+        """
+        return VNCServerSpawner.lookup_user(self.xvnc_user)[0]
+
+
+    def make_entry_dir(self, entry):
+        """
+        Creates the directory of an entry afresh, and pool_dir if need be,
+        checking nobody else can tamper with either.
+
+        :param entry: The PoolEntry.
+        :raises OSError: If the directories couldn't be made, or could be
+                         tampered with.
+        """
+        # :NOTE: The directories are created rather than taken as found, and
+        #        checked with lstat() before anything is written in them, so
+        #        another user can't have them made or planted in advance.
+        #        They can be searched by the users, so they can reach their
+        #        copy of the X cookie, but not listed.
+        check_private_dir(os.path.dirname(os.path.abspath(self.pool_dir)))
+        try:
+            os.mkdir(self.pool_dir, 0o711)
+        except FileExistsError:
+            pass
+        check_private_dir(self.pool_dir)
+        os.chmod(self.pool_dir, 0o711)
+
+        # A leftover of an entry that didn't start.
+        shutil.rmtree(entry.entry_dir, ignore_errors=True)
+        os.mkdir(entry.entry_dir, 0o711)
+        check_private_dir(entry.entry_dir)
+        os.chmod(entry.entry_dir, 0o711)
+
+
+    def write_state(self, entry):
+        """
+        Records the PID of an entry and who it was handed over to, if anyone,
+        for reclaim().
+
+        :param entry: The PoolEntry.
+        """
+        self.write_private(entry.state_path, json.dumps({"pid": entry.pid,
+                                                         "username": entry.username,
+                                                         "display_name": entry.display_name}).encode('utf8'))
+
+
+    def write_private(self, path, data, uid=None, gid=None):
+        """
+        Writes a file only its owner can read, replacing any file already at
+        the path. The directory must be one that only the session server's
+        user can write to.
+
+        :param path: The path of the file.
+        :param data: The bytes to write.
+        :param uid: The user to own the file. Defaults to the session server's.
+        :param gid: The group to own the file, if uid is given.
+        """
+        # :NOTE: The file is written under a new name and renamed over the
+        #        path, so whatever is at the path (e.g. a symlink) is replaced
+        #        rather than written through. O_EXCL and O_NOFOLLOW make sure
+        #        the new name is a new file.
+        tmp_path = "{0}.{1}".format(path, os.urandom(4).hex())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if uid is not None and uid != os.geteuid():
+                    os.fchown(f.fileno(), uid, gid)
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+    def is_listening(self, port):
+        """
+        :param port: A TCP port on this host.
+        :return: True if something accepts connections on the port.
+        """
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                return True
+        except OSError:
+            return False
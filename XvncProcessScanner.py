@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import os
+import pwd
+import re
+import functools
+import subprocess
+import logging
+import timeit
+
+
+def scan_xvnc_processes(proc_dir="/proc"):
+    """
+    Walks the /proc file system for Xvnc processes and returns details of
+    each process, such as its PID and the command line args each process
+    was called with.
+
+    :param proc_dir: The path /proc is mounted at.
+    :return: A list of dictionaries, one per Xvnc process, with the keys
+             username, pid, display_number, display_name, geometry and
+             pixelformat.
+    """
+    active_sessions = []
+    for entry in os.scandir(proc_dir):
+        if not entry.name.isdigit():
+            continue
+
+        # :NOTE: Processes can exit part way through being looked at, in which
+        #        case their files vanish (or can no longer be read) and they
+        #        are skipped.
+        try:
+            # Check the process name first as it is the cheapest to read.
+            with open(os.path.join(entry.path, "comm"), "rb") as f:
+                if f.read().rstrip(b"\n") != b"Xvnc":
+                    continue
+            with open(os.path.join(entry.path, "cmdline"), "rb") as f:
+                cmdline = f.read()
+            with open(os.path.join(entry.path, "status"), "rb") as f:
+                status = f.read()
+        except OSError:
+            continue
+
+        # The command line is the argv list, each arg ended by a NUL.
+        argv = [arg.decode('utf8', 'replace') for arg in cmdline.split(b"\0")]
+        if argv and argv[-1] == "":
+            argv.pop()
+        if not argv:
+            # A zombie process has no command line.
+            continue
+
+        # Like ps, report the effective user of the process.
+        euid = None
+        for line in status.splitlines():
+            if line.startswith(b"Uid:"):
+                euid = int(line.split()[2])
+                break
+        if euid is None:
+            continue
+
+        active_sessions.append(parse_xvnc_args(username_for_uid(euid), entry.name, argv[1:]))
+    return active_sessions
+
+
+@functools.lru_cache(maxsize=256)
+def username_for_uid(uid):
+    """
+    Returns the name of the user with the given UID, or the UID as a string
+    if the user has no name (as ps does).
+
+    :param uid: The integer UID.
+    """
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+
+def parse_xvnc_args(username, pid, args):
+    """
+    Pulls the session details out of the command line args of an Xvnc
+    process.
+
+    :param username: The name of the user running the process.
+    :param pid: The PID of the process, as a string.
+    :param args: The list of command line args, not including the program name.
+    :return: A dictionary with the keys username, pid, display_number,
+             display_name, geometry and pixelformat.
+    """
+    # Get the display number from the args
+    match = re.match(r":(?P<display_number>\d+)", args[0]) if args else None
+    if match is None:
+        display_number = 0
+    else:
+        display_number = match.group("display_number")
+
+    # Get the values of the options of interest.
+    # :NOTE: Each option is followed by its value as the next arg.
+    options = {}
+    for idx in range(len(args) - 1):
+        if args[idx] in ("-desktop", "-geometry", "-pixelformat", "-depth"):
+            options[args[idx]] = args[idx + 1]
+
+    # Get the display name from the args
+    display_name = options.get("-desktop", "{0}:{1}".format(username, display_number))
+
+    # Get the geometry from the args
+    geometry = options.get("-geometry", "Unknown")
+
+    # Get the pixelformat from the args, which if not present, can be inferred
+    # from the depth parameter if it is present in the args
+    # :NOTE: Consult the Xvnc man page for details on the defaults for
+    #        pixelformat and depth.
+    if "-pixelformat" in options:
+        pixelformat = options["-pixelformat"].upper()
+    elif "-depth" in options:
+        # :NOTE: The Xvnc man page doesn't give a default for 15bpp
+        pixelformat = {"8": "BGR233",
+                       "16": "RGB565",
+                       "24": "RGB888"}.get(options["-depth"], "Unknown")
+    else:
+        # Assume default depth of 24 and default pixelformat of RGB888
+        pixelformat = "RGB888"
+
+    new_session_info = {}
+    new_session_info["username"] = username
+    new_session_info["pid"] = pid
+    new_session_info["display_number"] = display_number
+    new_session_info["display_name"] = display_name
+    new_session_info["geometry"] = geometry
+    new_session_info["pixelformat"] = pixelformat
+    return new_session_info
+
+
+def scan_xvnc_processes_ps():
+    """
+    Queries the OS for a list of Xvnc processes using ps. Slower than
+    scan_xvnc_processes() as it forks a process, but works without /proc.
+
+    :return: As for scan_xvnc_processes().
+    """
+    # Configure logging
+    log = logging.getLogger("scan_xvnc_processes_ps")
+
+    # Get a list of all the Xvnc processes running
+    log.debug("Querying list of Xvnc processes from OS...")
+    try:
+        process_list = subprocess.check_output(["ps", "--no-header", "-ww", "-C", "Xvnc", "-o", "user=WIDE-USER-COLUMN,pid,args"])
+    except subprocess.CalledProcessError:
+        # If 'ps' returns nothing, it sets the returncode to '1', which causes the
+        # CalledProcessError exception to be thrown. In this case, it is ok for
+        # there to be no Xvnc processes running and thus nothing for ps to return.
+        process_list = b""
+    process_list = process_list.decode('utf8')
+    process_list = process_list.splitlines()
+
+    # Parse out the server information from the listing returned
+    active_sessions = []
+    log.debug("Parsing Xvnc process list...")
+    for process in process_list:
+        matches = re.search(r"^(?P<username>(\w|-)+)\s+(?P<pid>\d+)\s+(?P<exe>[\w/]+)\s+(?P<args>.+$)",
+                            process)
+        username, pid, exe, args = matches.group("username", "pid", "exe", "args")
+
+        # Get the display number from the args
+        match = re.search(r"^:(?P<display_number>\d+)", args)
+        if match is None:
+            display_number = 0
+        else:
+            display_number = match.group("display_number")
+
+        # Get the display name from the args
+        match = re.search(r"-desktop\s+(?P<display_name>[ a-zA-Z0-9/\-|.:()]+?)\s+(-|$)", args)
+        if match is None:
+            display_name = "{0}:{1}".format(username, display_number)
+        else:
+            display_name = match.group("display_name")
+
+        # Get the geometry from the args
+        match = re.search(r"-geometry\s+(?P<geometry>[ 0-9x]+?)\s+(-|$)", args)
+        if match is None:
+            geometry = "Unknown"
+        else:
+            geometry = match.group("geometry")
+
+        # Get the pixelformat from the args, which if not present, can be inferred
+        # from the depth parameter if it is present in the args
+        # :NOTE: Consult the Xvnc man page for details on the defaults for
+        #        pixelformat and depth.
+        match = re.search(r"-pixelformat\s+(?P<pixelformat>[a-zA-Z0-9]+?)\s+(-|$)", args)
+        if match is None:
+            match = re.search(r"-depth\s+(?P<depth>[0-9]+?)\s+(-|$)", args)
+            if match is None:
+                # Assume default depth of 24 and default pixelformat of RGB888
+                pixelformat = "RGB888"
+            else:
+                depth = match.group("depth")
+                if depth == "8":
+                    pixelformat = "BGR233"
+                elif depth == "15":
+                    # :NOTE: The Xvnc man page doesn't give a default for 15bpp
+                    pixelformat = "Unknown"
+                elif depth == "16":
+                    pixelformat = "RGB565"
+                elif depth == "24":
+                    pixelformat = "RGB888"
+                else:
+                    pixelformat = "Unknown"
+        else:
+            pixelformat = match.group("pixelformat").upper()
+
+        # Add the session to the list of sessions to return to the client.
+        new_session_info = {}
+        new_session_info["username"] = username
+        new_session_info["pid"] = pid
+        new_session_info["display_number"] = display_number
+        new_session_info["display_name"] = display_name
+        new_session_info["geometry"] = geometry
+        new_session_info["pixelformat"] = pixelformat
+
+        active_sessions.append(new_session_info)
+
+    log.debug("Found {0} Xvnc servers running.".format(len(active_sessions)))
+    return active_sessions
+
+
+if __name__ == "__main__":
+    # Benchmark the /proc scanner against ps.
+    iterations = 200
+    for name, scan in (("/proc", scan_xvnc_processes), ("ps", scan_xvnc_processes_ps)):
+        sessions = scan()
+        seconds = timeit.timeit(scan, number=iterations)
+        print("{0:6}: {1:8.3f} ms per scan, {2} Xvnc processes found".format(name,
+                                                                              seconds / iterations * 1000,
+                                                                              len(sessions)))
@@ -4,14 +4,14 @@ import sys
 import os.path
 import subprocess
 import multiprocessing
-import socket
 import threading
 import logging
 import logging.handlers
 import LogFilter
 import queue
 import json
-import time
+import functools
+import asyncio
 from tkinter import *
 from tkinter import ttk
 from tkinter import messagebox
@@ -22,11 +22,15 @@ import SessionServerList
 import LauncherAnnounceTask
 import ServerPurgeTask
 
+import MortProtocol
+import LauncherRequestEngine
+import UIDispatcher
 import SessionServersWidget
 import ActiveSessionsWidget
 import RegisteredSessionsWidget
 import LogBoxWidget
 import NewVNCSessionForm
+import ServerPlacement
 
 def main():
     """
@@ -102,6 +106,12 @@ def main():
     root.columnconfigure(0, weight=1)
     root.rowconfigure(0, weight=1)
 
+    # Create the dispatcher that background threads use to hand GUI updates
+    # to the Tk main loop.
+    ui_dispatcher = UIDispatcher.UIDispatcher(root,
+                                              tick_interval=cfg.getint("UI", "tick_interval_ms", fallback=20),
+                                              frame_budget=cfg.getint("UI", "frame_budget_ms", fallback=15))
+
     v_panes0 = ttk.PanedWindow(root, orient='vertical')
     v_panes0.grid(column=0, row=0, sticky=(N, S, E, W))
     v_panes0.columnconfigure(0, weight=1)
@@ -118,19 +128,26 @@ def main():
     h_panes0.rowconfigure(0, weight=1)
 
     # Create the session-servers widget as a child of the first horizontal PanedWindow widget
-    session_servers_widget = SessionServersWidget.SessionServersWidget(h_panes0)
+    session_servers_widget = SessionServersWidget.SessionServersWidget(h_panes0,
+                                                                       virtual=cfg.getboolean("UI", "virtual_treeviews", fallback=False))
 
     v_panes1 = ttk.PanedWindow(h_panes0, orient='vertical')
     h_panes0.add(v_panes1, weight=1)
 
     # Create the active-sessions widget as a child of the second vertical PanedWindow widget
-    active_sessions_widget = ActiveSessionsWidget.ActiveSessionsWidget(v_panes1)
+    active_sessions_widget = ActiveSessionsWidget.ActiveSessionsWidget(v_panes1,
+                                                                       virtual=cfg.getboolean("UI", "virtual_treeviews", fallback=False))
 
     # Create the registered-sessions widget as a child of the second vertical PanedWindow widget
     registered_sessions_widget = RegisteredSessionsWidget.RegisteredSessionsWidget(v_panes1)
 
     # Create the log-box widget as a child of the first vertical PanedWindow widget
-    log_box_widget = LogBoxWidget.LogBoxWidget(v_panes0, log_queue)
+    log_box_widget = LogBoxWidget.LogBoxWidget(v_panes0,
+                                               log_queue,
+                                               ui_dispatcher,
+                                               max_lines=cfg.getint("LOGBOX", "max_lines", fallback=5000),
+                                               batch_size=cfg.getint("LOGBOX", "batch_size", fallback=200),
+                                               max_pending=cfg.getint("LOGBOX", "max_pending", fallback=10000))
 
     #
     exit_button_icon = Image.open(SRC_DIR+"/icons/user_exit.png")
@@ -143,35 +160,70 @@ def main():
                              command=sys.exit)
     v_panes0.add(exit_button)
 
-    # Register call backs to happen when the various GUI items are interacted with
-    session_servers_widget.add_selection_event_handler(fetch_active_sessions,
-                                                       session_servers_widget,
-                                                       active_sessions_widget)
+    # Create the engine that sends requests to the session-servers without
+    # blocking the GUI.
+    request_engine = LauncherRequestEngine.LauncherRequestEngine(ui_dispatcher,
+                                                                 default_timeout=cfg.getfloat("REQUESTS", "timeout", fallback=5.0),
+                                                                 pool_size=cfg.getint("REQUESTS", "pool_size", fallback=2),
+                                                                 pool_idle_timeout=cfg.getfloat("REQUESTS", "pool_idle_timeout", fallback=20.0),
+                                                                 health_check_interval=cfg.getfloat("REQUESTS", "health_check_interval", fallback=10.0),
+                                                                 subscription_timeout=cfg.getfloat("REQUESTS", "subscription_timeout", fallback=30.0))
+    request_engine.start()
+    refresh_active_sessions = functools.partial(fetch_active_sessions,
+                                                session_servers_widget,
+                                                active_sessions_widget,
+                                                request_engine)
+    watch_active_sessions = functools.partial(subscribe_active_sessions,
+                                              session_servers_widget,
+                                              active_sessions_widget,
+                                              request_engine,
+                                              refresh_active_sessions)
 
-    active_sessions_widget.add_refresh_button_clicked_event_handler(fetch_active_sessions,
-                                                                    session_servers_widget,
-                                                                    active_sessions_widget)
+    # A list of session-servers already seen and a lock to use
+    # to arbitrate access from different threads
+    known_servers = SessionServerList.SessionServerList()
+    known_servers_cv = threading.Condition()
 
-    active_sessions_widget.add_new_button_clicked_event_handler(new_active_session,
-                                                                active_sessions_widget)
-    active_sessions_widget.add_new_button_clicked_event_handler(fetch_active_sessions,
-                                                                session_servers_widget,
-                                                                active_sessions_widget)
+    # Register call backs to happen when the various GUI items are interacted with
+    # :NOTE: The requests complete after the handlers return, so the new and
+    #        kill handlers refresh the active-sessions widget themselves once
+    #        the server has replied. The kill handler gets the updated listing
+    #        in the same batch as the kill. Selecting a server subscribes
+    #        to its session events, which keeps the active-sessions widget
+    #        up to date without polling.
+    session_servers_widget.add_selection_event_handler(watch_active_sessions)
+
+    active_sessions_widget.add_refresh_button_clicked_event_handler(refresh_active_sessions)
+
+    # :NOTE: In the auto placement mode, new sessions go on the session-server
+    #        that scores best rather than the one selected.
+    if cfg.get("PLACEMENT", "mode", fallback="manual") == "auto":
+        placement = ServerPlacement.ServerPlacement(weights={name: cfg.getfloat("PLACEMENT", "weight_" + name, fallback=weight)
+                                                             for name, weight in ServerPlacement.DEFAULT_WEIGHTS.items()})
+        active_sessions_widget.add_new_button_clicked_event_handler(auto_new_active_session,
+                                                                    active_sessions_widget,
+                                                                    session_servers_widget,
+                                                                    request_engine,
+                                                                    known_servers,
+                                                                    known_servers_cv,
+                                                                    placement,
+                                                                    cfg.getint("PLACEMENT", "max_probes", fallback=3),
+                                                                    refresh_active_sessions,
+                                                                    cfg.getint("REQUESTS", "start_refresh_delay_ms", fallback=2000))
+    else:
+        active_sessions_widget.add_new_button_clicked_event_handler(new_active_session,
+                                                                    active_sessions_widget,
+                                                                    request_engine,
+                                                                    refresh_active_sessions,
+                                                                    cfg.getint("REQUESTS", "start_refresh_delay_ms", fallback=2000))
 
     active_sessions_widget.add_kill_button_clicked_event_handler(kill_active_session,
-                                                                 active_sessions_widget)
-    active_sessions_widget.add_kill_button_clicked_event_handler(fetch_active_sessions,
-                                                                 session_servers_widget,
-                                                                 active_sessions_widget)
+                                                                 active_sessions_widget,
+                                                                 request_engine)
 
     active_sessions_widget.add_connect_button_clicked_event_handler(connect_to_active_session,
                                                                  active_sessions_widget)
 
-    # A list of session-servers already seen and a lock to use
-    # to arbitrate access from different threads
-    known_servers = SessionServerList.SessionServerList()
-    known_servers_cv = threading.Condition()
-
     # Start a thread to handle announce messages from the session-servers
     announce_task = LauncherAnnounceTask.LauncherAnnounceTask(known_servers, known_servers_cv)
     announce_task.start()
@@ -183,45 +235,151 @@ def main():
 
     session_servers_update_task = threading.Thread(target=update_session_servers_task,
                                                    name="update_session_servers_task",
-                                                   args=(session_servers_widget, known_servers, known_servers_cv),
+                                                   args=(ui_dispatcher, session_servers_widget, known_servers, known_servers_cv),
                                                    daemon=True)
     session_servers_update_task.start()
 
     # Start Tk's mainloop to wait for GUI events
+    ui_dispatcher.start()
     root.mainloop()
 
 
-def update_session_servers_task(session_servers_widget, known_servers, known_servers_cv):
+def update_session_servers_task(ui_dispatcher, session_servers_widget, known_servers, known_servers_cv):
     """
+    Watches the change feed of the known_servers list and asks the Tk main
+    loop to update the session-servers widget when it changes.
 
-    :param known_servers_cv:
+    :param ui_dispatcher: The UIDispatcher used to run code on the Tk main loop.
+    :param session_servers_widget: The SessionServersWidget to update.
+    :param known_servers: The SessionServerList of known session-servers.
+    :param known_servers_cv: The threading.Condition that guards known_servers.
     :return:
     """
     # Configure logging
     log = logging.getLogger("update_session_servers_task")
     log.debug("Starting up...")
 
-    with known_servers_cv:
-        while True:
-            # Clear treeview of all entries present
-            session_servers_widget.clear()
-            # Insert entries from known_servers list
-            for server in known_servers:
-                new_item = session_servers_widget.insert(-1,
-                                                         server.hostname,
-                                                         server.ip_address,
-                                                         server.port)
+    # The version of the known_servers list last posted to the main loop.
+    version = None
+    while True:
+        with known_servers_cv:
             # Wait for updates to happen to the underlying list
             # :NOTE: After wait() resumes, it re-aquires the lock.
-            known_servers_cv.wait()
+            while version is not None and known_servers.version == version:
+                known_servers_cv.wait()
+            version = known_servers.version
 
+        # :NOTE: The post is keyed so that, if the main loop hasn't got
+        #        around to the last one yet, the two coalesce into one render.
+        ui_dispatcher.post(render_session_servers,
+                           ui_dispatcher,
+                           session_servers_widget,
+                           known_servers,
+                           known_servers_cv,
+                           key="render_session_servers")
 
-def fetch_active_sessions(session_servers_widget, active_sessions_widget):
+
+def render_session_servers(ui_dispatcher, session_servers_widget, known_servers, known_servers_cv, max_changes=500):
+    """
+    Brings the session-servers widget up to date with the known_servers list.
+    Must be run on the Tk main loop.
+
+    :param ui_dispatcher: The UIDispatcher used to run code on the Tk main loop.
+    :param session_servers_widget: The SessionServersWidget to update.
+    :param known_servers: The SessionServerList of known session-servers.
+    :param known_servers_cv: The threading.Condition that guards known_servers.
+    :param max_changes: The most changes to apply in one go. Any more are left
+                        for another render so a burst doesn't freeze the GUI.
+    :return:
     """
-    :param info: A dictionary of key:value pairs representing the name
-                 and value of the columns of the selected item.
+    # Find out what changed since the widget was last updated. If that isn't
+    # known, take a copy of the whole list.
+    with known_servers_cv:
+        if session_servers_widget.version is None:
+            changes = None
+        else:
+            changes = known_servers.changes_since(session_servers_widget.version)
+        if changes is None:
+            version, servers = known_servers.snapshot()
+        else:
+            version = known_servers.version
+
+    # Apply just the changes to the widget, or, if the change history
+    # didn't reach back far enough, bring the widget in line with the
+    # whole list.
+    if changes is None:
+        session_servers_widget.reconcile(servers)
+    elif len(changes) > max_changes:
+        session_servers_widget.apply_changes(changes[:max_changes])
+        version = changes[max_changes - 1].version
+        ui_dispatcher.post(render_session_servers,
+                           ui_dispatcher,
+                           session_servers_widget,
+                           known_servers,
+                           known_servers_cv,
+                           key="render_session_servers")
+    else:
+        session_servers_widget.apply_changes(changes)
+    session_servers_widget.version = version
+
+
+def get_response_fields(log, future, server_info):
+    """
+    Gets the response of a finished request (or the results of a finished
+    batch), logging the reason if there isn't one.
+
+    :param log: The logger to report problems to.
+    :param future: The future of a request submitted to the LauncherRequestEngine.
+    :param server_info: A dictionary with the "IP Address" and "Port" of the server.
+    :return: A dictionary of the response fields (or a list of them for a batch),
+             or None if there is no response.
+    """
+    if future.cancelled():
+        log.debug("Request to {0[IP Address]}:{0[Port]} was cancelled.".format(server_info))
+        return None
 
+    # :NOTE: asyncio.TimeoutError is a subclass of OSError in newer Pythons,
+    #        so it must be caught first.
+    try:
+        return future.result()
+    except asyncio.TimeoutError:
+        msg = ("Did not receive response from server."
+               " IP Address: {0}"
+               " Port: {1}"
+               " Timed out.".format(server_info["IP Address"],
+                                    server_info["Port"]))
+        log.critical(msg)
+        return None
+    except OSError as ex:
+        msg = ("Unable to exchange messages with remote host."
+               " IP Address: {0}"
+               " Port: {1}"
+               " Error No: {2}"
+               " Error Msg: {3}".format(server_info["IP Address"],
+                                        server_info["Port"],
+                                        ex.errno,
+                                        ex.strerror))
+        log.critical(msg)
+        return None
+    except MortProtocol.ProtocolError as ex:
+        msg = ("Invalid response from server."
+               " IP Address: {0}"
+               " Port: {1}"
+               " Error Msg: {2}".format(server_info["IP Address"],
+                                        server_info["Port"],
+                                        ex))
+        log.critical(msg)
+        return None
+
+
+def fetch_active_sessions(session_servers_widget, active_sessions_widget, request_engine):
+    """
+    Asks the selected session-server for its active sessions. The
+    active-sessions widget is updated when the response arrives.
+
+    :param session_servers_widget:
     :param active_sessions_widget:
+    :param request_engine: The LauncherRequestEngine to send the request with.
     :return:
     """
     # Configure logging
@@ -237,100 +395,219 @@ def fetch_active_sessions(session_servers_widget, active_sessions_widget):
         return
 
     # Construct the request message
-    msg = ("msg_type:get_active_sessions\n")
+    msg = {"msg_type": "get_active_sessions"}
+
+    # If the listing shown came from the same server, pass on the version of
+    # it, so the server can answer with a short not-modified message instead
+    # of the whole list if nothing has changed.
+    current_server_info = active_sessions_widget.get_server_info()
+    if (current_server_info["IP Address"] == server_info["IP Address"] and
+        current_server_info["Port"] == server_info["Port"]):
+        version = active_sessions_widget.get_sessions_version()
+        if version is not None:
+            msg["version"] = version
 
-    # Construct a TCP socket to communicate with the server
-    try:
-        log.debug("Creating socket...")
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.settimeout(5)
-    except OSError as ex:
-        msg = ("Unable to create TCP socket."
-               " Error No: {0}"
-               " Error Msg: {1}".format(ex.errno, ex.strerror))
-        log.critical(msg)
-        return
+    # Send the request
+    # :NOTE: The request is keyed so that a newer refresh cancels an older
+    #        one still waiting on a (possibly different) server.
+    log.debug("Sending list_active_sessions request to {0[IP Address]}:{0[Port]}...".format(server_info))
+    request_engine.submit(server_info["IP Address"],
+                          server_info["Port"],
+                          msg,
+                          callback=functools.partial(show_active_sessions, active_sessions_widget, server_info),
+                          key="fetch_active_sessions")
 
-    # Connect to the remote server
-    try:
-        log.debug("Connecting to server {0}:{1}...".format(server_info["IP Address"], server_info["Port"]))
-        sock.connect((server_info["IP Address"], server_info["Port"]))
-    except OSError as ex:
-        msg = ("Unable to connect to remote host."
-               " IP Address: {0}"
-               " Port: {1}"
-               " Error No: {2}"
-               " Error Msg: {3}".format(server_info["IP Address"],
-                                        server_info["Port"],
-                                        ex.errno,
-                                        ex.strerror))
-        log.critical(msg)
+
+def subscribe_active_sessions(session_servers_widget, active_sessions_widget, request_engine, refresh):
+    """
+    Subscribes to the session events of the selected session-server, so the
+    active-sessions widget is updated as sessions start and end. Any earlier
+    subscription is ended.
+
+    :param session_servers_widget:
+    :param active_sessions_widget:
+    :param request_engine: The LauncherRequestEngine to send the request with.
+    :param refresh: A callable that refreshes the active-sessions widget, used
+                    for servers that don't support subscriptions.
+    :return:
+    """
+    # Configure logging
+    log = logging.getLogger("subscribe_active_sessions")
+
+    # Get the server info
+    # :NOTE: If no item is selected, "None" will be returned, in which case,
+    #        don't proceed any further.
+    server_info = session_servers_widget.get_selected_item_info()
+    if server_info is None:
+        log.debug("No server info returned from session_servers_widget. Nothing selected?")
+        log.debug("Nothing to do. Returning early to caller.")
         return
 
+    # Construct the request message
+    # :NOTE: The first message back is the listing, as for get_active_sessions,
+    #        so pass on the version of the listing shown, if it came from the
+    #        same server.
+    msg = {"msg_type": "subscribe_sessions"}
+    current_server_info = active_sessions_widget.get_server_info()
+    if (current_server_info["IP Address"] == server_info["IP Address"] and
+        current_server_info["Port"] == server_info["Port"]):
+        version = active_sessions_widget.get_sessions_version()
+        if version is not None:
+            msg["version"] = version
+
     # Send the request
-    try:
-        log.debug("Sending list_active_sessions request...")
-        sock.sendall(msg.encode('utf8'))
-    except OSError as ex:
-        msg = ("Unable to send message to TCP socket."
-               " IP Address: {0}"
-               " Port: {1}"
-               " Error No: {2}"
-               " Error Msg: {3}".format(server_info["IP Address"],
-                                        server_info["Port"],
-                                        ex.errno,
-                                        ex.strerror))
-        log.critical(msg)
+    # :NOTE: The subscription is keyed so that subscribing to another server
+    #        ends the subscription to the last one.
+    log.debug("Subscribing to session events of {0[IP Address]}:{0[Port]}...".format(server_info))
+    request_engine.subscribe(server_info["IP Address"],
+                             server_info["Port"],
+                             msg,
+                             on_message=functools.partial(show_session_event, active_sessions_widget, server_info),
+                             callback=functools.partial(end_session_events, server_info, refresh),
+                             key="subscribe_active_sessions")
+
+
+def show_session_event(active_sessions_widget, server_info, resp_fields):
+    """
+    Displays a message from a session events subscription. Runs on the Tk
+    main loop.
+
+    :param active_sessions_widget:
+    :param server_info: The info of the server the subscription is to.
+    :param resp_fields: A dictionary of the message fields.
+    :return:
+    """
+    # Configure logging
+    log = logging.getLogger("subscribe_active_sessions")
+
+    if resp_fields.get("msg_type") != "session_event":
+        # The listing the subscription starts with.
+        update_active_sessions(active_sessions_widget, server_info, resp_fields)
+        return
+
+    # Only apply the event if the listing came from the same server.
+    current_server_info = active_sessions_widget.get_server_info()
+    if (current_server_info["IP Address"] != server_info["IP Address"] or
+        current_server_info["Port"] != server_info["Port"]):
+        log.debug("Discarding session event for a listing no longer shown.")
         return
 
-    # Wait for the response then close the socket
     try:
-        log.debug("Waiting for response...")
-        resp = sock.recv(16384)
-    except OSError as ex:
-        msg = ("Did not receive response from server."
-               " IP Address: {0}"
-               " Port: {1}"
-               " Error No: {2}"
-               " Error Msg: {3}".format(server_info["IP Address"],
-                                        server_info["Port"],
-                                        ex.errno,
-                                        ex.strerror))
-        log.critical(msg)
+        event = resp_fields["event"]
+        session = json.loads(resp_fields["session"])
+        session["pid"]
+    except (KeyError, TypeError, ValueError):
+        msg = ("Invalid session event message from {0}:{1}."
+               " Discarding".format(server_info["IP Address"],
+                                    server_info["Port"]))
+        log.warning(msg)
+        return
+
+    log.info("{0}: {1[display_name]} on display {1[display_number]} of {2}".format(event,
+                                                                                  session,
+                                                                                  server_info["Hostname"]))
+    active_sessions_widget.apply_event(event, session)
+    active_sessions_widget.set_sessions_version(resp_fields.get("version"))
+
+
+def end_session_events(server_info, refresh, future):
+    """
+    Logs the end of a session events subscription. Runs on the Tk main loop.
+
+    :param server_info: The info of the server the subscription was to.
+    :param refresh: A callable that refreshes the active-sessions widget.
+    :param future: The future of the subscription.
+    :return:
+    """
+    # Configure logging
+    log = logging.getLogger("subscribe_active_sessions")
+
+    if future.cancelled():
         return
+    try:
+        count = future.result()
+    except (asyncio.TimeoutError, OSError, MortProtocol.ProtocolError) as ex:
+        log.debug("Session events subscription to {0}:{1} failed: {2}".format(server_info["IP Address"],
+                                                                             server_info["Port"],
+                                                                             ex))
+        count = 0
+    if count == 0:
+        # The server doesn't support subscriptions (or is down), so fall back
+        # to asking it for the listing.
+        refresh()
     else:
-        log.debug("Received {0} bytes".format(len(resp)))
-        resp = resp.decode('utf8')
-    finally:
-        log.debug("Closing socket")
-        sock.close()
-
-    # Break the response down into its key/value pairs
-    log.debug("Parsing message...")
-    resp_lines = resp.splitlines()
-    resp_fields = {}
-    for resp_line in resp_lines:
-        resp_field = resp_line.split(':', 1)
-        resp_fields[resp_field[0]] = resp_field[1]
+        log.debug("Session events subscription to {0}:{1} ended.".format(server_info["IP Address"],
+                                                                         server_info["Port"]))
+
+
+def show_active_sessions(active_sessions_widget, server_info, future):
+    """
+    Displays the active sessions in the response to a get_active_sessions
+    request. Runs on the Tk main loop.
+
+    :param active_sessions_widget:
+    :param server_info: The info of the server the request was sent to.
+    :param future: The future of the request.
+    :return:
+    """
+    # Configure logging
+    log = logging.getLogger("fetch_active_sessions")
+
+    resp_fields = get_response_fields(log, future, server_info)
+    if resp_fields is None:
+        return
+    update_active_sessions(active_sessions_widget, server_info, resp_fields)
+
+
+def update_active_sessions(active_sessions_widget, server_info, resp_fields):
+    """
+    Displays the active sessions in an active_sessions_list message.
+
+    :param active_sessions_widget:
+    :param server_info: The info of the server the message came from.
+    :param resp_fields: A dictionary of the message fields.
+    :return:
+    """
+    # Configure logging
+    log = logging.getLogger("fetch_active_sessions")
 
     # Check for the correct message type. If this isn't a active_sessions_list
     # message then discard it and move on.
     if "msg_type" in resp_fields.keys():
-        if resp_fields["msg_type"] == "active_sessions_list":
-            # Clear the current listing of all entries present
-            active_sessions_widget.clear()
+        if resp_fields["msg_type"] == "active_sessions_not_modified":
+            # The listing is up to date, so there is nothing to parse or redraw.
+            # :NOTE: Only if the listing is still from that server and of that
+            #        version, as it may have changed while waiting.
+            current_server_info = active_sessions_widget.get_server_info()
+            if (current_server_info["IP Address"] == server_info["IP Address"] and
+                current_server_info["Port"] == server_info["Port"] and
+                active_sessions_widget.get_sessions_version() == resp_fields.get("version")):
+                log.debug("Active sessions not modified.")
+            else:
+                msg = ("Unexpected not-modified message from {0}:{1}."
+                       " Discarding".format(server_info["IP Address"],
+                                            server_info["Port"]))
+                log.warning(msg)
+
+        elif resp_fields["msg_type"] == "active_sessions_list":
+            # The rows are keyed by PID, which is only unique per server, so
+            # clear the current listing if it came from a different server.
+            current_server_info = active_sessions_widget.get_server_info()
+            if (current_server_info["IP Address"] != server_info["IP Address"] or
+                current_server_info["Port"] != server_info["Port"]):
+                active_sessions_widget.clear()
             # Display the results in the active-sessions Treeview
             if "active_sessions" in resp_fields.keys():
                 active_sessions_json = resp_fields["active_sessions"]
                 sessions = json.loads(active_sessions_json)
                 log.debug("Message is good. Contains {} entries.".format(len(sessions)))
-                for session in sessions:
-                    active_sessions_widget.insert(-1, **session)
+                active_sessions_widget.reconcile(sessions)
                 # Update the server info to identify where the entries came from
                 active_sessions_widget.set_server_info(server_info["Hostname"],
                                                        server_info["IP Address"],
                                                        server_info["Port"])
+                # Older servers don't give a version.
+                active_sessions_widget.set_sessions_version(resp_fields.get("version"))
 
             else:
                 # Discard message; not active-sessions listing.
@@ -358,10 +635,14 @@ def fetch_active_sessions(session_servers_widget, active_sessions_widget):
 
 
 
-def new_active_session(active_sessions_widget):
+def new_active_session(active_sessions_widget, request_engine, refresh, refresh_delay):
     """
 
     :param active_sessions_widget:
+    :param request_engine: The LauncherRequestEngine to send the request with.
+    :param refresh: A callable that refreshes the active-sessions widget.
+    :param refresh_delay: Integer number of milliseconds to wait after a session
+                          is started before refreshing the active-sessions widget.
     :return:
     """
     # Configure logging
@@ -377,14 +658,54 @@ def new_active_session(active_sessions_widget):
         log.debug("Nothing to do. Returning early to caller.")
         return
 
-    # Get the next lowest available display that can be used and use it as
-    # the default when asking the user for the new VNC session parameters.
-    display_numbers_in_use = active_sessions_widget.get_display_numbers_in_use()
+    # Ask the server to hold the next free display for the new session, to
+    # use as the default when asking the user for the session parameters.
+    log.debug("Sending lease_display request to {0[IP Address]}:{0[Port]}...".format(server_info))
+    request_engine.submit(server_info["IP Address"],
+                          server_info["Port"],
+                          {"msg_type": "lease_display"},
+                          callback=functools.partial(show_new_active_session_form,
+                                                     active_sessions_widget,
+                                                     request_engine,
+                                                     server_info,
+                                                     refresh,
+                                                     refresh_delay))
+
+
+def show_new_active_session_form(active_sessions_widget, request_engine, server_info, refresh, refresh_delay, future):
+    """
+    Asks the user for the parameters of a new session and asks the server
+    to start it. Runs on the Tk main loop.
+
+    :param active_sessions_widget:
+    :param request_engine: The LauncherRequestEngine to send the request with.
+    :param server_info: The info of the server to start the session on.
+    :param refresh: A callable that refreshes the active-sessions widget.
+    :param refresh_delay: Integer number of milliseconds to wait after a session
+                          is started before refreshing the active-sessions widget.
+    :param future: The future of the lease_display request.
+    :return:
+    """
+    # Configure logging
+    log = logging.getLogger("new_active_session")
+
+    lease_id = None
     next_available_display = ""
-    for display_num in range(1, 1000):
-        if display_num not in display_numbers_in_use:
-            next_available_display = str(display_num)
-            break
+    resp_fields = get_response_fields(log, future, server_info)
+    if resp_fields is not None and resp_fields.get("msg_type") == "lease_display_response":
+        if resp_fields.get("outcome") == "success":
+            lease_id = resp_fields.get("lease_id")
+            next_available_display = resp_fields.get("display_number", "")
+        else:
+            log.warning("Server {0[IP Address]}:{0[Port]} has no free display.".format(server_info))
+    else:
+        # The server doesn't hand out displays, so guess the next lowest
+        # available one from the listing.
+        display_numbers_in_use = active_sessions_widget.get_display_numbers_in_use()
+        for display_num in range(1, 1000):
+            if display_num not in display_numbers_in_use:
+                next_available_display = str(display_num)
+                break
 
     # Get the parameters of the new server to create
     form = NewVNCSessionForm.NewVNCSessionForm()
@@ -395,101 +716,101 @@ def new_active_session(active_sessions_widget):
     # Check if the user wants to abort
     if not form.ok_was_clicked:
         log.debug("User didn't click OK.")
+        if lease_id is not None:
+            request_engine.submit(server_info["IP Address"],
+                                  server_info["Port"],
+                                  {"msg_type": "release_display", "lease_id": lease_id})
         return
 
     # Construct the request message
+    # :NOTE: If the display number is left blank, the server picks one.
+    #        The leased display is only shown to the user, and is left out
+    #        unless they changed it, so the server is free to hand over an
+    #        idle server of its warm pool (on another display) instead. The
+    #        lease_id gets the leased display otherwise.
     username = os.environ["USER"]
-    msg = ("msg_type:start_active_session\n"
-           "username:{0}\n"
-           "display_number:{1[display_number]}\n"
-           "display_name:{1[display_name]}\n"
-           "geometry:{1[geometry]}\n"
-           "pixelformat:{1[pixelformat]}\n").format(username, form_info)
-
-    # Construct a TCP socket to communicate with the server
-    try:
-        log.debug("Creating socket...")
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.settimeout(5)
-    except OSError as ex:
-        msg = ("Unable to create TCP socket."
-               " Error No: {0}"
-               " Error Msg: {1}".format(ex.errno, ex.strerror))
-        log.critical(msg)
-        return
-
-    # Connect to the remote server
-    try:
-        log.debug("Connecting to server {0}:{1}...".format(server_info["IP Address"], server_info["Port"]))
-        sock.connect((server_info["IP Address"], server_info["Port"]))
-    except OSError as ex:
-        msg = ("Unable to connect to remote host."
-               " IP Address: {0}"
-               " Port: {1}"
-               " Error No: {2}"
-               " Error Msg: {3}".format(server_info["IP Address"],
-                                        server_info["Port"],
-                                        ex.errno,
-                                        ex.strerror))
-        log.critical(msg)
-        return
+    display_number = form_info["display_number"]
+    if lease_id is not None and display_number == next_available_display:
+        display_number = ""
+    msg = {"msg_type": "start_active_session",
+           "username": username,
+           "display_number": display_number,
+           "display_name": form_info["display_name"],
+           "geometry": form_info["geometry"],
+           "pixelformat": form_info["pixelformat"]}
+    if lease_id is not None:
+        msg["lease_id"] = lease_id
 
     # Send the request
-    try:
-        log.debug("Sending start_active_session request...")
-        sock.sendall(msg.encode('utf8'))
-    except OSError as ex:
-        msg = ("Unable to send message to TCP socket."
-               " IP Address: {0}"
-               " Port: {1}"
-               " Error No: {2}"
-               " Error Msg: {3}".format(server_info["IP Address"],
-                                        server_info["Port"],
-                                        ex.errno,
-                                        ex.strerror))
-        log.critical(msg)
-        return
+    log.debug("Sending start_active_session request to {0[IP Address]}:{0[Port]}...".format(server_info))
+    request_engine.submit(server_info["IP Address"],
+                          server_info["Port"],
+                          msg,
+                          callback=functools.partial(show_new_active_session_outcome,
+                                                     active_sessions_widget,
+                                                     request_engine,
+                                                     server_info,
+                                                     username,
+                                                     form_info,
+                                                     refresh,
+                                                     refresh_delay))
+
+
+def show_new_active_session_outcome(active_sessions_widget, request_engine, server_info, username, form_info, refresh, refresh_delay, future):
+    """
+    Tells the user the outcome of a start_active_session request, or, if the
+    server tracks the start as a job, waits for the job to finish. Runs on
+    the Tk main loop.
 
-    # Wait for the response then close the socket
-    try:
-        log.debug("Waiting for response...")
-        resp = sock.recv(16384)
-    except OSError as ex:
-        msg = ("Did not receive response from server."
-               " IP Address: {0}"
-               " Port: {1}"
-               " Error No: {2}"
-               " Error Msg: {3}".format(server_info["IP Address"],
-                                        server_info["Port"],
-                                        ex.errno,
-                                        ex.strerror))
-        log.critical(msg)
+    :param active_sessions_widget:
+    :param request_engine: The LauncherRequestEngine to follow the start job with.
+    :param server_info: The info of the server the request was sent to.
+    :param username: The user the session was requested for.
+    :param form_info: The session parameters the user entered.
+    :param refresh: A callable that refreshes the active-sessions widget.
+    :param refresh_delay: Integer number of milliseconds to wait after a session
+                          is started before refreshing the active-sessions widget.
+    :param future: The future of the request.
+    :return:
+    """
+    # Configure logging
+    log = logging.getLogger("new_active_session")
+
+    resp_fields = get_response_fields(log, future, server_info)
+    if resp_fields is None:
         return
-    else:
-        log.debug("Received {0} bytes".format(len(resp)))
-        resp = resp.decode('utf8')
-    finally:
-        log.debug("Closing socket")
-        sock.close()
-
-    # Break the response down into its key/value pairs
-    log.debug("Parsing message...")
-    resp_lines = resp.splitlines()
-    resp_fields = {}
-    for resp_line in resp_lines:
-        resp_field = resp_line.split(':', 1)
-        resp_fields[resp_field[0]] = resp_field[1]
-
-   # Check for the correct message type. If this isn't a strart_active_session_response
+
+    # Servers that pick the display say which one they picked.
+    if "display_number" in resp_fields:
+        form_info = dict(form_info, display_number=resp_fields["display_number"])
+
+    # Check for the correct message type. If this isn't a strart_active_session_response
     # message then discard it and move on.
     if "msg_type" in resp_fields.keys():
         if resp_fields["msg_type"] == "start_active_session_response":
             if "outcome" in resp_fields.keys():
-                if resp_fields["outcome"].lower() == "success":
+                if resp_fields["outcome"].lower() == "success" and "job_id" in resp_fields:
+                    # The server is starting the session in the background.
+                    # Wait for it to say the session is ready or has failed.
+                    log.info("Session Starting- svr={0[IP Address]}:{0[Port]} uname={1} disp={2[display_number]}".format(server_info,
+                                                                                                                         username,
+                                                                                                                         form_info))
+                    wait_for_start_job(request_engine, server_info, resp_fields["job_id"], username, form_info, refresh)
+                elif resp_fields["outcome"].lower() == "success":
                     log.info("Session Started- svr={0[IP Address]}:{0[Port]} uname={1} disp={2[display_number]}".format(server_info,
                                                                                                                         username,
                                                                                                                         form_info))
+                    # Servers that don't track starts answer once the VNC server
+                    # has been kicked off, which is before its Xvnc process is
+                    # running. Give it a moment to start before refreshing,
+                    # unless the server handed over a session that is already
+                    # running (from its warm pool).
+                    # :NOTE: after() schedules the refresh on the Tk main loop
+                    #        rather than blocking it.
+                    if resp_fields.get("state") == "ready":
+                        refresh()
+                    else:
+                        active_sessions_widget.active_sessions_frame.after(refresh_delay, refresh)
                     messagebox.showinfo(title="Start New Session Feedback",
                                         message="Success - New session created on {}, display {}".format(server_info["IP Address"],
                                                                                                          form_info["display_number"]),
@@ -497,10 +818,24 @@ def new_active_session(active_sessions_widget):
                                         default="ok")
                 elif resp_fields["outcome"].lower() == "display in use":
                     log.warning("The display number selected is already in use.")
+                    refresh()
                     messagebox.showinfo(title="Start New Session Feedback",
                                         message="The display number chosen is alread in use",
                                         icon="warning",
                                         default="ok")
+                elif resp_fields["outcome"].lower() == "no free display":
+                    log.warning("The server has no free display.")
+                    messagebox.showinfo(title="Start New Session Feedback",
+                                        message="There is no free display on the server",
+                                        icon="warning",
+                                        default="ok")
+                elif resp_fields["outcome"].lower() == "failed":
+                    error = resp_fields.get("error", "Unknown error")
+                    log.warning("The server could not start the session: {}".format(error))
+                    messagebox.showinfo(title="Start New Session Feedback",
+                                        message="Failed - {}".format(error),
+                                        icon="warning",
+                                        default="ok")
                 else:
                     log.warning("Unexpected server reply: {}".format(resp_fields["outcome"]))
                     messagebox.showinfo(title="Start New Session Feedback",
@@ -528,18 +863,436 @@ def new_active_session(active_sessions_widget):
                " Discarding".format(server_info["IP Address"],
                                     server_info["Port"]))
         log.warning(msg)
-    # :TODO: Fix this hack! It's gross. I'm personally offended by it :)
-    # Wait a few seconds for the server process to startup before leaving this
-    # method so that the widget update will see the new process.
-    # :NOTE: This is a HACK!!!! There has to be a better way.
-    time.sleep(2)
     log.debug("Done.")
 
 
-def kill_active_session(active_sessions_widget):
+def wait_for_start_job(request_engine, server_info, job_id, username, form_info, refresh, reason=None, on_failed=None):
+    """
+    Asks a session-server to answer once a session start job has finished.
+
+    :param request_engine: The LauncherRequestEngine to send the request with.
+    :param server_info: The info of the server starting the session.
+    :param job_id: The ID of the start job.
+    :param username: The user the session was requested for.
+    :param form_info: The session parameters the user entered.
+    :param refresh: A callable that refreshes the active-sessions widget.
+    :param reason: If given, why the server was chosen, to tell the user.
+    :param on_failed: If given, called with the error instead of telling the
+                      user if the start fails.
+    :return:
     """
+    # :NOTE: The server holds the request until the job finishes or the wait
+    #        is up, so allow the request that long on top of the usual timeout.
+    wait = 30
+    msg = {"msg_type": "get_start_job",
+           "job_id": job_id,
+           "wait": str(wait)}
+    request_engine.submit(server_info["IP Address"],
+                          server_info["Port"],
+                          msg,
+                          callback=functools.partial(show_start_job_outcome,
+                                                     request_engine,
+                                                     server_info,
+                                                     job_id,
+                                                     username,
+                                                     form_info,
+                                                     refresh,
+                                                     reason,
+                                                     on_failed),
+                          timeout=wait + request_engine.default_timeout)
+
+
+def show_start_job_outcome(request_engine, server_info, job_id, username, form_info, refresh, reason, on_failed, future):
+    """
+    Tells the user the outcome of a session start job, or keeps waiting if
+    it hasn't finished yet. Runs on the Tk main loop.
+
+    :param request_engine: The LauncherRequestEngine to send the request with.
+    :param server_info: The info of the server starting the session.
+    :param job_id: The ID of the start job.
+    :param username: The user the session was requested for.
+    :param form_info: The session parameters the user entered.
+    :param refresh: A callable that refreshes the active-sessions widget.
+    :param reason: As for wait_for_start_job().
+    :param on_failed: As for wait_for_start_job().
+    :param future: The future of the get_start_job request.
+    :return:
+    """
+    # Configure logging
+    log = logging.getLogger("new_active_session")
+
+    resp_fields = get_response_fields(log, future, server_info)
+    if resp_fields is None:
+        return
+    if resp_fields.get("msg_type") != "start_job_status" or resp_fields.get("job_id") != job_id:
+        msg = ("Invalid start job status message from {0}:{1}."
+               " Discarding".format(server_info["IP Address"],
+                                    server_info["Port"]))
+        log.warning(msg)
+        return
+
+    state = resp_fields.get("state")
+    if state == "ready":
+        log.info("Session Started- svr={0[IP Address]}:{0[Port]} uname={1} disp={2[display_number]}"
+                 " in {3} seconds".format(server_info,
+                                          username,
+                                          form_info,
+                                          resp_fields.get("elapsed")))
+        refresh()
+        message = "Success - New session created on {}, display {}".format(server_info["IP Address"],
+                                                                          form_info["display_number"])
+        if reason is not None:
+            message += "\n\nChosen as {}".format(reason)
+        messagebox.showinfo(title="Start New Session Feedback",
+                            message=message,
+                            icon="info",
+                            default="ok")
+    elif state == "failed":
+        error = resp_fields.get("error", "Unknown error")
+        stderr = resp_fields.get("stderr", "")
+        log.warning("Session start failed- svr={0[IP Address]}:{0[Port]} disp={1[display_number]}: {2}".format(server_info,
+                                                                                                               form_info,
+                                                                                                               error))
+        for line in stderr.splitlines():
+            log.warning("vncserver: {}".format(line))
+        if on_failed is not None:
+            on_failed(error)
+            return
+        # Show the end of vncserver's output, which is where the reason
+        # for failing usually is.
+        stderr_tail = "\n".join(stderr.splitlines()[-10:])
+        messagebox.showinfo(title="Start New Session Feedback",
+                            message="Failed - {}\n\n{}".format(error, stderr_tail).strip(),
+                            icon="warning",
+                            default="ok")
+    elif state == "unknown":
+        log.warning("Server {0[IP Address]}:{0[Port]} no longer knows start job {1}".format(server_info, job_id))
+    else:
+        # Still starting; keep waiting.
+        log.debug("Start job {0} is {1}".format(job_id, state))
+        wait_for_start_job(request_engine, server_info, job_id, username, form_info, refresh, reason, on_failed)
+
+
+def auto_new_active_session(active_sessions_widget, session_servers_widget, request_engine, known_servers, known_servers_cv,
+                            placement, max_probes, refresh, refresh_delay):
+    """
+    Asks the user for the parameters of a new session and places it on the
+    session-server that scores best, rather than the one selected. Used
+    instead of new_active_session() in the auto placement mode.
+
+    The servers are first ranked by the health they announce. The best
+    max_probes of them are then pinged, and ranked again with the round trip
+    times, before the session is started on the best one.
+
+    :param active_sessions_widget:
+    :param session_servers_widget: The widget to select the chosen server in.
+    :param request_engine: The LauncherRequestEngine to send the requests with.
+    :param known_servers: The SessionServerList of known session-servers.
+    :param known_servers_cv: The threading.Condition that guards known_servers.
+    :param placement: The ServerPlacement that ranks the servers.
+    :param max_probes: The most servers to ping.
+    :param refresh: A callable that refreshes the active-sessions widget.
+    :param refresh_delay: Integer number of milliseconds to wait after a session
+                          is started before refreshing the active-sessions widget.
+    :return:
+    """
+    # Configure logging
+    log = logging.getLogger("new_active_session")
+
+    with known_servers_cv:
+        version, servers = known_servers.snapshot()
+    ranked = placement.rank(ServerPlacement.Candidate(server.hostname,
+                                                      server.ip_address,
+                                                      server.port,
+                                                      server.health,
+                                                      request_engine.rtts.get((server.ip_address, server.port)))
+                            for server in servers)
+    if not ranked:
+        log.warning("No session server with a free display is known.")
+        messagebox.showinfo(title="Start New Session Feedback",
+                            message="There is no session server with a free display",
+                            icon="warning",
+                            default="ok")
+        return
+
+    # Get the parameters of the new server to create
+    # :NOTE: The display number is left blank, so each server picks its own.
+    form = NewVNCSessionForm.NewVNCSessionForm()
+    form.show()
+    form_info = form.get_info()
+
+    # Check if the user wants to abort
+    if not form.ok_was_clicked:
+        log.debug("User didn't click OK.")
+        return
+
+    # Measure the round trip time to the best servers.
+    shortlist = [placement_choice.candidate for placement_choice in ranked[:max_probes]]
+    on_probed = functools.partial(place_new_active_session,
+                                  active_sessions_widget,
+                                  session_servers_widget,
+                                  request_engine,
+                                  placement,
+                                  form_info,
+                                  refresh,
+                                  refresh_delay)
+    probed = {}
+    for candidate in shortlist:
+        request_engine.probe(candidate.ip_address,
+                             candidate.port,
+                             callback=functools.partial(collect_probe, candidate, shortlist, probed, on_probed))
+
+
+def collect_probe(candidate, shortlist, probed, on_probed, future):
+    """
+    Records the round trip time to a server, and once all of the shortlist
+    have answered (or failed to), places the session. Runs on the Tk main loop.
+
+    :param candidate: The ServerPlacement.Candidate that was pinged.
+    :param shortlist: The list of Candidates pinged.
+    :param probed: A dictionary of the Candidates with their round trip times, by
+                   IP address, or None for those that couldn't be reached.
+    :param on_probed: Called with the list of Candidates that could be reached.
+    :param future: The future of the ping.
+    :return:
+    """
+    # Configure logging
+    log = logging.getLogger("new_active_session")
+
+    # :NOTE: asyncio.TimeoutError is a subclass of OSError in newer Pythons,
+    #        so it must be caught first.
+    if future.cancelled():
+        probed[candidate.ip_address] = None
+    else:
+        try:
+            probed[candidate.ip_address] = candidate._replace(rtt=future.result())
+        except asyncio.TimeoutError:
+            log.warning("Server {0} ({1}) didn't answer a ping in time.".format(candidate.hostname, candidate.ip_address))
+            probed[candidate.ip_address] = None
+        except OSError as ex:
+            log.warning("Server {0} ({1}) can't be reached: {2}".format(candidate.hostname, candidate.ip_address, ex))
+            probed[candidate.ip_address] = None
+        except MortProtocol.ProtocolError:
+            # An older server that doesn't answer pings.
+            probed[candidate.ip_address] = candidate
+        except Exception as ex:
+            # :NOTE: Any other failure still counts as an answer, so the
+            #        session is placed once the whole shortlist is in.
+            log.warning("Ping of server {0} ({1}) failed: {2!r}".format(candidate.hostname, candidate.ip_address, ex))
+            probed[candidate.ip_address] = None
+
+    if len(probed) == len(shortlist):
+        on_probed([probed[candidate.ip_address] for candidate in shortlist
+                   if probed[candidate.ip_address] is not None])
+
+
+def place_new_active_session(active_sessions_widget, session_servers_widget, request_engine, placement, form_info,
+                             refresh, refresh_delay, candidates):
+    """
+    Ranks the servers again with their round trip times, and starts the new
+    session on the best. Runs on the Tk main loop.
 
     :param active_sessions_widget:
+    :param session_servers_widget: The widget to select the chosen server in.
+    :param request_engine: The LauncherRequestEngine to send the requests with.
+    :param placement: The ServerPlacement that ranks the servers.
+    :param form_info: The session parameters the user entered.
+    :param refresh: A callable that refreshes the active-sessions widget.
+    :param refresh_delay: Integer number of milliseconds to wait after a session
+                          is started before refreshing the active-sessions widget.
+    :param candidates: The list of ServerPlacement.Candidates that could be reached.
+    :return:
+    """
+    # Configure logging
+    log = logging.getLogger("new_active_session")
+
+    ranked = placement.rank(candidates)
+    for placement_choice in ranked:
+        log.debug("Placement candidate {}".format(placement.explain(placement_choice)))
+    try_placement(active_sessions_widget, session_servers_widget, request_engine, os.environ["USER"], form_info,
+                  refresh, refresh_delay, ranked, [])
+
+
+def try_placement(active_sessions_widget, session_servers_widget, request_engine, username, form_info,
+                  refresh, refresh_delay, ranked, failures):
+    """
+    Asks the best of the ranked servers to start the new session, or tells
+    the user the session couldn't be placed if none are left.
+
+    :param active_sessions_widget:
+    :param session_servers_widget: The widget to select the chosen server in.
+    :param request_engine: The LauncherRequestEngine to send the requests with.
+    :param username: The user the session is for.
+    :param form_info: The session parameters the user entered.
+    :param refresh: A callable that refreshes the active-sessions widget.
+    :param refresh_delay: Integer number of milliseconds to wait after a session
+                          is started before refreshing the active-sessions widget.
+    :param ranked: The list of ServerPlacement.Placements still to try, best first.
+    :param failures: A list of descriptions of the servers already tried and why
+                     they failed.
+    :return:
+    """
+    # Configure logging
+    log = logging.getLogger("new_active_session")
+
+    if not ranked:
+        log.warning("Could not place the new session on any server.")
+        messagebox.showinfo(title="Start New Session Feedback",
+                            message="Failed - No server could start the session\n\n{}".format("\n".join(failures)).strip(),
+                            icon="warning",
+                            default="ok")
+        return
+
+    candidate = ranked[0].candidate
+    server_info = {"Hostname": candidate.hostname,
+                   "IP Address": candidate.ip_address,
+                   "Port": candidate.port}
+    log.info("Placing new session on {}".format(ServerPlacement.ServerPlacement.explain(ranked[0])))
+
+    msg = {"msg_type": "start_active_session",
+           "username": username,
+           "display_number": form_info["display_number"],
+           "display_name": form_info["display_name"],
+           "geometry": form_info["geometry"],
+           "pixelformat": form_info["pixelformat"]}
+    request_engine.submit(server_info["IP Address"],
+                          server_info["Port"],
+                          msg,
+                          callback=functools.partial(show_placement_outcome,
+                                                     active_sessions_widget,
+                                                     session_servers_widget,
+                                                     request_engine,
+                                                     username,
+                                                     form_info,
+                                                     refresh,
+                                                     refresh_delay,
+                                                     ranked,
+                                                     failures))
+
+
+def show_placement_outcome(active_sessions_widget, session_servers_widget, request_engine, username, form_info,
+                           refresh, refresh_delay, ranked, failures, future):
+    """
+    Follows a start_active_session request sent to a placed server. If the
+    server turns it down (e.g. the display is in use), can't be reached,
+    closes the connection without answering or the start fails, the next
+    best server is tried. If the server doesn't
+    answer in time, the start may still be in progress, so the user is told
+    and no other server is tried. Runs on the Tk main loop.
+
+    :param active_sessions_widget:
+    :param session_servers_widget: The widget to select the chosen server in.
+    :param request_engine: The LauncherRequestEngine to send the requests with.
+    :param username: The user the session is for.
+    :param form_info: The session parameters the user entered.
+    :param refresh: A callable that refreshes the active-sessions widget.
+    :param refresh_delay: Integer number of milliseconds to wait after a session
+                          is started before refreshing the active-sessions widget.
+    :param ranked: As for try_placement(), with the server the request went to first.
+    :param failures: As for try_placement().
+    :param future: The future of the request.
+    :return:
+    """
+    # Configure logging
+    log = logging.getLogger("new_active_session")
+
+    candidate = ranked[0].candidate
+    server_info = {"Hostname": candidate.hostname,
+                   "IP Address": candidate.ip_address,
+                   "Port": candidate.port}
+    reason = ServerPlacement.ServerPlacement.explain(ranked[0])
+    try_next = functools.partial(placement_failed,
+                                 functools.partial(try_placement,
+                                                   active_sessions_widget,
+                                                   session_servers_widget,
+                                                   request_engine,
+                                                   username,
+                                                   form_info,
+                                                   refresh,
+                                                   refresh_delay,
+                                                   ranked[1:],
+                                                   failures),
+                                 failures,
+                                 candidate)
+
+    resp_fields = get_response_fields(log, future, server_info)
+    if resp_fields is None:
+        if future.cancelled():
+            return
+        # :NOTE: Another server is only tried if the server refused the
+        #        connection, turned it away as busy or closed it without
+        #        answering. A request that timed out or whose connection was
+        #        reset may have started the session anyway, and trying the
+        #        next server could leave the user with two.
+        if isinstance(future.exception(), (ConnectionRefusedError,
+                                           MortProtocol.ServerBusyError,
+                                           MortProtocol.ConnectionClosedError)):
+            try_next("no response")
+            return
+        log.warning("No answer from {0[IP Address]}:{0[Port]}. The session may still be starting there.".format(server_info))
+        session_servers_widget.select(candidate.ip_address)
+        messagebox.showinfo(title="Start New Session Feedback",
+                            message="No answer from {} - The session may still be starting there, so no other server"
+                                    " was tried".format(candidate.hostname),
+                            icon="warning",
+                            default="ok")
+        return
+    if resp_fields.get("msg_type") != "start_active_session_response" or resp_fields.get("outcome", "").lower() != "success":
+        try_next(resp_fields.get("outcome", "invalid response"))
+        return
+
+    # Show the sessions of the chosen server.
+    form_info = dict(form_info, display_number=resp_fields.get("display_number", form_info["display_number"]))
+    session_servers_widget.select(candidate.ip_address)
+
+    if "job_id" in resp_fields:
+        log.info("Session Starting- svr={0[IP Address]}:{0[Port]} uname={1} disp={2[display_number]}".format(server_info,
+                                                                                                             username,
+                                                                                                             form_info))
+        wait_for_start_job(request_engine, server_info, resp_fields["job_id"], username, form_info, refresh,
+                           reason=reason, on_failed=try_next)
+    else:
+        log.info("Session Started- svr={0[IP Address]}:{0[Port]} uname={1} disp={2[display_number]}".format(server_info,
+                                                                                                            username,
+                                                                                                            form_info))
+        if resp_fields.get("state") == "ready":
+            refresh()
+        else:
+            active_sessions_widget.active_sessions_frame.after(refresh_delay, refresh)
+        messagebox.showinfo(title="Start New Session Feedback",
+                            message="Success - New session created on {}, display {}\n\nChosen as {}".format(server_info["IP Address"],
+                                                                                                             form_info["display_number"],
+                                                                                                             reason),
+                            icon="info",
+                            default="ok")
+
+
+def placement_failed(try_next, failures, candidate, why):
+    """
+    Records why a placed server couldn't start the session, and moves on to
+    the next best server.
+
+    :param try_next: Called with no arguments to try the next server.
+    :param failures: As for try_placement().
+    :param candidate: The ServerPlacement.Candidate that failed.
+    :param why: A description of why it failed.
+    :return:
+    """
+    # Configure logging
+    log = logging.getLogger("new_active_session")
+
+    log.warning("Server {0} ({1}) couldn't start the session: {2}. Trying the next server.".format(candidate.hostname,
+                                                                                                  candidate.ip_address,
+                                                                                                  why))
+    failures.append("{0}: {1}".format(candidate.hostname, why))
+    try_next()
+
+
+def kill_active_session(active_sessions_widget, request_engine):
+    """
+
+    :param active_sessions_widget:
+    :param request_engine: The LauncherRequestEngine to send the request with.
     :return:
     """
     # Configure logging
@@ -565,84 +1318,45 @@ def kill_active_session(active_sessions_widget):
         return
 
     # Construct the request message
-    msg = ("msg_type:kill_active_session\n"
-           "pid:{}".format(session_info["PID"]))
-
-
-    # Construct a TCP socket to communicate with the server
-    try:
-        log.debug("Creating socket...")
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.settimeout(5)
-    except OSError as ex:
-        msg = ("Unable to create TCP socket."
-               " Error No: {0}"
-               " Error Msg: {1}".format(ex.errno, ex.strerror))
-        log.critical(msg)
-        return
+    msg = {"msg_type": "kill_active_session",
+           "pid": str(session_info["PID"])}
+
+    # Send the request, along with a request for the updated listing so that
+    # both are done in one round trip.
+    log.debug("Sending kill_active_session request to {0[IP Address]}:{0[Port]}...".format(server_info))
+    request_engine.submit_batch(server_info["IP Address"],
+                                server_info["Port"],
+                                [msg, {"msg_type": "get_active_sessions"}],
+                                callback=functools.partial(show_kill_active_session_outcome,
+                                                           active_sessions_widget,
+                                                           server_info,
+                                                           session_info))
+
+
+def show_kill_active_session_outcome(active_sessions_widget, server_info, session_info, future):
+    """
+    Tells the user the outcome of a kill_active_session request and shows
+    the updated listing sent with it. Runs on the Tk main loop.
 
-    # Connect to the remote server
-    try:
-        log.debug("Connecting to server {0}:{1}...".format(server_info["IP Address"], server_info["Port"]))
-        sock.connect((server_info["IP Address"], server_info["Port"]))
-    except OSError as ex:
-        msg = ("Unable to connect to remote host."
-               " IP Address: {0}"
-               " Port: {1}"
-               " Error No: {2}"
-               " Error Msg: {3}".format(server_info["IP Address"],
-                                        server_info["Port"],
-                                        ex.errno,
-                                        ex.strerror))
-        log.critical(msg)
-        return
+    :param active_sessions_widget:
+    :param server_info: The info of the server the request was sent to.
+    :param session_info: The info of the session that was to be killed.
+    :param future: The future of the batch request.
+    :return:
+    """
+    # Configure logging
+    log = logging.getLogger("kill_active_session")
 
-    # Send the request
-    try:
-        log.debug("Sending list_active_sessions request...")
-        sock.sendall(msg.encode('utf8'))
-    except OSError as ex:
-        msg = ("Unable to send message to TCP socket."
-               " IP Address: {0}"
-               " Port: {1}"
-               " Error No: {2}"
-               " Error Msg: {3}".format(server_info["IP Address"],
-                                        server_info["Port"],
-                                        ex.errno,
-                                        ex.strerror))
-        log.critical(msg)
+    results = get_response_fields(log, future, server_info)
+    if results is None:
         return
+    resp_fields, listing_fields = results
 
-    # Wait for the response then close the socket
-    try:
-        log.debug("Waiting for response...")
-        resp = sock.recv(16384)
-    except OSError as ex:
-        msg = ("Did not receive response from server."
-               " IP Address: {0}"
-               " Port: {1}"
-               " Error No: {2}"
-               " Error Msg: {3}".format(server_info["IP Address"],
-                                        server_info["Port"],
-                                        ex.errno,
-                                        ex.strerror))
-        log.critical(msg)
-        return
-    else:
-        log.debug("Received {0} bytes".format(len(resp)))
-        resp = resp.decode('utf8')
-    finally:
-        log.debug("Closing socket")
-        sock.close()
-
-    # Break the response down into its key/value pairs
-    log.debug("Parsing message...")
-    resp_lines = resp.splitlines()
-    resp_fields = {}
-    for resp_line in resp_lines:
-        resp_field = resp_line.split(':', 1)
-        resp_fields[resp_field[0]] = resp_field[1]
+    # The listing is out of date whatever the outcome was.
+    if listing_fields is not None:
+        update_active_sessions(active_sessions_widget, server_info, listing_fields)
+    if resp_fields is None:
+        resp_fields = {}
 
     # Check for the correct message type. If this isn't a kill_active_session_response
     # message then discard it and move on.
@@ -8,15 +8,27 @@ import socket
 import errno
 import select
 import threading
+import time
 import logging
 import logging.handlers
 import json
-import subprocess
-import re
+import queue
+import asyncio
+import functools
 import configparser
 
+import MortProtocol
+import AsyncSessionService
 import ServerAnnounceTask
 import CreateNewVNCServer
+import XvncProcessScanner
+import SessionInventory
+import StartJobTracker
+import DisplayAllocator
+import VNCServerSpawner
+import ProcessReaper
+import WarmPool
+import HostMetrics
 
 
 def main():
@@ -94,12 +106,69 @@ def main():
 
     # Start the session-server announce thread
     log.info("Starting session-server announce task")
-    announce_task = ServerAnnounceTask.ServerAnnounceTask(my_hostname, my_ip_address, my_port)
+    announce_task = ServerAnnounceTask.ServerAnnounceTask(my_hostname, my_ip_address, my_port, health=announce_health)
     announce_task.start()
 
+    # The number of seconds a connection is kept open waiting for the next
+    # request from a framed client.
+    idle_timeout = cfg.getfloat("SERVICE", "idle_timeout", fallback=30.0)
+
+    # The most subscribed connections served at once, and the number of
+    # seconds a subscribed connection may go without a message before it is
+    # sent a heartbeat.
+    global subscription_slots
+    max_subscriptions = cfg.getint("SERVICE", "max_subscriptions", fallback=16)
+    subscription_slots = threading.BoundedSemaphore(max_subscriptions)
+    heartbeat_interval = cfg.getfloat("SERVICE", "heartbeat_interval", fallback=10.0)
+
+    # Start keeping the list of Xvnc processes up to date in memory.
+    session_inventory.max_staleness = cfg.getfloat("INVENTORY", "max_staleness", fallback=10.0)
+    session_inventory.refresh_interval = cfg.getfloat("INVENTORY", "refresh_interval", fallback=5.0)
+    session_inventory.start()
+
+    # Configure the tracking of session starts.
+    start_jobs.start_timeout = cfg.getfloat("START_JOBS", "start_timeout", fallback=30.0)
+    start_jobs.retention = cfg.getfloat("START_JOBS", "retention", fallback=300.0)
+    start_jobs.max_wait = cfg.getfloat("START_JOBS", "max_wait", fallback=60.0)
+    if cfg.get("START_JOBS", "spawn_method", fallback="direct") == "process":
+        start_jobs.spawn = fork_vnc_server
+    process_reaper.start()
+
+    # Configure the displays handed out to new sessions.
+    display_allocator.first_display = cfg.getint("DISPLAYS", "first_display", fallback=1)
+    display_allocator.last_display = cfg.getint("DISPLAYS", "last_display", fallback=999)
+    display_allocator.lease_time = cfg.getfloat("DISPLAYS", "lease_time", fallback=60.0)
+
+    # Start keeping the pool of idle Xvnc servers full, if there is one.
+    warm_pool.size = cfg.getint("WARM_POOL", "size", fallback=0)
+    warm_pool.geometry = cfg.get("WARM_POOL", "geometry", fallback="")
+    warm_pool.pixelformat = cfg.get("WARM_POOL", "pixelformat", fallback="")
+    warm_pool.max_load_per_cpu = cfg.getfloat("WARM_POOL", "max_load_per_cpu", fallback=0.75)
+    warm_pool.min_free_memory = cfg.getint("WARM_POOL", "min_free_memory", fallback=1024)
+    warm_pool.refill_interval = cfg.getfloat("WARM_POOL", "refill_interval", fallback=5.0)
+    warm_pool.pool_dir = cfg.get("WARM_POOL", "pool_dir", fallback="/run/mort-pool")
+    warm_pool.session_command = cfg.get("WARM_POOL", "session_command", fallback="/etc/X11/Xsession")
+    warm_pool.xvnc_user = cfg.get("WARM_POOL", "xvnc_user", fallback="")
+    warm_pool.start()
+
     # Start listening for service requests
     sock.setblocking(False)
-    sock.listen(5)
+    sock.listen(cfg.getint("SERVICE", "listen_backlog", fallback=5))
+
+    # Serve the requests from an asyncio event loop if configured to.
+    # Otherwise, fall through to the thread per connection service loop.
+    if cfg.get("SERVICE", "mode", fallback="threaded") == "asyncio":
+        service = AsyncSessionService.AsyncSessionService(sock,
+                                                          handle_request,
+                                                          idle_timeout=idle_timeout,
+                                                          max_connections=cfg.getint("SERVICE", "max_connections", fallback=64),
+                                                          max_workers=cfg.getint("SERVICE", "max_workers", fallback=4),
+                                                          subscription_handlers={"subscribe_sessions": subscribe_sessions},
+                                                          async_handlers={"get_start_job": await_start_job},
+                                                          max_subscriptions=max_subscriptions,
+                                                          heartbeat_interval=heartbeat_interval)
+        service.run()
+        return
 
     # Enter the service loop
     log.info("Starting service loop")
@@ -118,7 +187,7 @@ def main():
 
         new_thread = threading.Thread(target=handle_socket_task,
                                       name=handler_thread_name,
-                                      args=(conn, remote_addr),
+                                      args=(conn, remote_addr, idle_timeout, heartbeat_interval),
                                       daemon=True)
         new_thread.start()
 
@@ -142,93 +211,111 @@ def get_xvnc_process_info():
     # Configure logging
     log = logging.getLogger("get_xvnc_process_info")
 
-    # Get a list of all the Xvnc processes running
+    # Read the process details straight out of /proc where there is one,
+    # rather than forking ps.
     log.debug("Querying list of Xvnc processes from OS...")
-    try:
-        process_list = subprocess.check_output(["ps", "--no-header", "-ww", "-C", "Xvnc", "-o", "user=WIDE-USER-COLUMN,pid,args"])
-    except subprocess.CalledProcessError:
-        # If 'ps' returns nothing, it sets the returncode to '1', which causes the
-        # CalledProcessError exception to be thrown. In this case, it is ok for
-        # there to be no Xvnc processes running and thus nothing for ps to return.
-        process_list = b""
-    process_list = process_list.decode('utf8')
-    process_list = process_list.splitlines()
-
-    # Parse out the server information from the listing returned
-    active_sessions = []
-    log.debug("Parsing Xvnc process list...")
-    for process in process_list:
-        matches = re.search(r"^(?P<username>(\w|-)+)\s+(?P<pid>\d+)\s+(?P<exe>[\w/]+)\s+(?P<args>.+$)",
-                            process)
-        username, pid, exe, args = matches.group("username", "pid", "exe", "args")
-
-        # Get the display number from the args
-        match = re.search(r"^:(?P<display_number>\d+)", args)
-        if match is None:
-            display_number = 0
-        else:
-            display_number = match.group("display_number")
+    if os.path.isdir("/proc/self"):
+        active_sessions = XvncProcessScanner.scan_xvnc_processes()
+    else:
+        active_sessions = XvncProcessScanner.scan_xvnc_processes_ps()
 
-        # Get the display name from the args
-        match = re.search(r"-desktop\s+(?P<display_name>[ a-zA-Z0-9/\-|.:()]+?)\s+(-|$)", args)
-        if match is None:
-            display_name = "{0}:{1}".format(username, display_number)
-        else:
-            display_name = match.group("display_name")
+    log.debug("Found {0} Xvnc servers running.".format(len(active_sessions)))
+    return active_sessions
 
-        # Get the geometry from the args
-        match = re.search(r"-geometry\s+(?P<geometry>[ 0-9x]+?)\s+(-|$)", args)
-        if match is None:
-            geometry = "Unknown"
-        else:
-            geometry = match.group("geometry")
-
-        # Get the pixelformat from the args, which if not present, can be inferred
-        # from the depth parameter if it is present in the args
-        # :NOTE: Consult the Xvnc man page for details on the defaults for
-        #        pixelformat and depth.
-        match = re.search(r"-pixelformat\s+(?P<pixelformat>[a-zA-Z0-9]+?)\s+(-|$)", args)
-        if match is None:
-            match = re.search(r"-depth\s+(?P<depth>[0-9]+?)\s+(-|$)", args)
-            if match is None:
-                # Assume default depth of 24 and default pixelformat of RGB888
-                pixelformat = "RGB888"
-            else:
-                depth = match.group("depth")
-                if depth == "8":
-                    pixelformat = "BGR233"
-                elif depth == "15":
-                    # :NOTE: The Xvnc man page doesn't give a default for 15bpp
-                    pixelformat = "Unknown"
-                elif depth == "16":
-                    pixelformat = "RGB565"
-                elif depth == "24":
-                    pixelformat = "RGB888"
-                else:
-                    pixelformat = "Unknown"
-        else:
-            pixelformat = match.group("pixelformat").upper()
 
-        # Add the session to the list of sessions to return to the client.
-        new_session_info = {}
-        new_session_info["username"] = username
-        new_session_info["pid"] = pid
-        new_session_info["display_number"] = display_number
-        new_session_info["display_name"] = display_name
-        new_session_info["geometry"] = geometry
-        new_session_info["pixelformat"] = pixelformat
+# The list of Xvnc processes, kept in memory so requests for it are answered
+# without scanning the process table each time. Idle servers of the warm pool
+# are left out of it. Configured and started by main().
+session_inventory = SessionInventory.SessionInventory(lambda: warm_pool.annotate(get_xvnc_process_info()))
 
-        active_sessions.append(new_session_info)
 
-    log.debug("Found {0} Xvnc servers running.".format(len(active_sessions)))
-    return active_sessions
+def spawn_vnc_server(msg_fields):
+    """
+    Starts vncserver for a start_active_session request, straight from this
+    process.
+
+    :param msg_fields: A dictionary of the start_active_session message fields.
+    :return: The VNCServerSpawner.SpawnedVNCServer.
+    """
+    # Configure logging
+    log = logging.getLogger("{}".format(threading.current_thread().name))
+
+    log.debug("Spawning VNC server for user: {}, disp: {}, name: {}, geo: {}, pf: {}".format(msg_fields["username"],
+                                                                                             msg_fields["display_number"],
+                                                                                             msg_fields["display_name"],
+                                                                                             msg_fields["geometry"],
+                                                                                             msg_fields["pixelformat"]))
+    return VNCServerSpawner.spawn_vnc_server(msg_fields["username"],
+                                             msg_fields["display_number"],
+                                             msg_fields["display_name"],
+                                             msg_fields["geometry"],
+                                             msg_fields["pixelformat"],
+                                             process_reaper)
+
+
+def fork_vnc_server(msg_fields):
+    """
+    Starts a forked process that runs vncserver for a start_active_session
+    request. Used instead of spawn_vnc_server() if spawn_method is process.
+
+    :param msg_fields: A dictionary of the start_active_session message fields.
+    :return: The started CreateNewVNCServer process.
+    """
+    # Configure logging
+    log = logging.getLogger("{}".format(threading.current_thread().name))
+
+    log.debug("Creating VNC server for user: {}, disp: {}, name: {}, geo: {}, pf: {}".format(msg_fields["username"],
+                                                                                             msg_fields["display_number"],
+                                                                                             msg_fields["display_name"],
+                                                                                             msg_fields["geometry"],
+                                                                                             msg_fields["pixelformat"]))
+    new_server = CreateNewVNCServer.CreateNewVNCServer("create_new_vnc_server",
+                                                       msg_fields["username"],
+                                                       msg_fields["display_number"],
+                                                       msg_fields["display_name"],
+                                                       msg_fields["geometry"],
+                                                       msg_fields["pixelformat"])
+    new_server.start()
+    return new_server
+
 
+# Reaps the vncserver processes started by spawn_vnc_server(). Started by main().
+process_reaper = ProcessReaper.ProcessReaper()
 
-def handle_socket_task(sock, remote_addr):
+# The session starts in progress or recently finished. Configured by main().
+start_jobs = StartJobTracker.StartJobTracker(session_inventory, spawn_vnc_server)
+
+# Hands out the display numbers of new sessions. Configured by main().
+display_allocator = DisplayAllocator.DisplayAllocator(session_inventory,
+                                                      lambda: start_jobs.reserved_displays() | warm_pool.displays())
+
+# The pre-started Xvnc servers handed over to users. Configured and started by main().
+warm_pool = WarmPool.WarmPool(display_allocator, session_inventory, process_reaper)
+
+# The slots of the subscribed connections served at once, in threaded mode.
+subscription_slots = threading.BoundedSemaphore(16)
+
+def announce_health():
+    """
+    Gathers the health and capacity fields of the announce message.
+
+    :return: A dictionary of the fields, as for HostMetrics.health_fields().
+    """
+    # :NOTE: A session list up to max_staleness seconds old will do, which
+    #        the inventory's background refresh keeps in memory.
+    active_sessions, version = session_inventory.get_versioned(count=False)
+    return HostMetrics.health_fields(len(active_sessions), display_allocator.free_count(), version)
+
+
+def handle_socket_task(sock, remote_addr, idle_timeout, heartbeat_interval):
     """
 
     :param sock:
     :param remote_addr:
+    :param idle_timeout: Number of seconds a framed connection is kept open
+                         waiting for the next request.
+    :param heartbeat_interval: Number of seconds a subscribed connection may go
+                               without a message before it is sent a heartbeat.
     :return:
     """
 
@@ -238,11 +325,54 @@ def handle_socket_task(sock, remote_addr):
     log = logging.getLogger("{}".format(threading.current_thread().name))
     log.debug("Starting up...")
 
-    # Read out the message data
+    # Serve requests until the client closes the connection or stops
+    # sending them.
+    # :NOTE: Framed clients keep the connection open between requests,
+    #        saving the connection setup and a thread spawn for each one.
+    #        Legacy clients read the response until the connection is
+    #        closed, so they only get one request per connection.
     try:
-        log.debug("Reading out request message...")
         sock.settimeout(5)
-        msg = sock.recv(16384)
+        for version, msg_fields in iter_requests(sock, idle_timeout):
+            # A subscription takes over the connection for pushing session
+            # events to the client. Legacy clients can't be pushed to.
+            if msg_fields.get("msg_type") == "subscribe_sessions" and version > 0:
+                serve_subscription(sock, remote_addr, msg_fields, version, heartbeat_interval)
+                return
+
+            # Carry out the request.
+            # :NOTE: A framed client waits for a response to each request, so
+            #        a request that fails is answered with an error response
+            #        rather than the connection being dropped.
+            try:
+                resp = handle_request(msg_fields, remote_addr)
+            except Exception:
+                log.exception("Could not carry out a request from {0}:{1}".format(remote_addr[0], remote_addr[1]))
+                resp = MortProtocol.error_response("internal error")
+
+            # Label the response with the ID of the request, if it had one,
+            # so clients that send several requests without waiting for
+            # each response (pipelining) can match them up.
+            if resp is not None and "request_id" in msg_fields:
+                resp["request_id"] = msg_fields["request_id"]
+
+            # If a response was generated, attempt to send it using the same
+            # protocol the request was sent with.
+            try:
+                if resp is not None:
+                    log.debug("Sending response message...")
+                    sock.sendall(MortProtocol.encode_response(resp, version))
+            except OSError as ex:
+                msg = ("Could not send response message back to client."
+                       " IP Address: {0}"
+                       " Port: {1}"
+                       " Error No: {2}"
+                       " Error Msg: {3}".format(remote_addr[0],
+                                                remote_addr[1],
+                                                ex.errno,
+                                                ex.strerror))
+                log.critical(msg)
+                return
     except OSError as ex:
         msg = ("Could not read request message from client."
                " IP Address: {0}"
@@ -253,94 +383,416 @@ def handle_socket_task(sock, remote_addr):
                                         ex.errno,
                                         ex.strerror))
         log.critical(msg)
+    except MortProtocol.ProtocolError as ex:
+        msg = ("Invalid message from {0}:{1}."
+               " {2}."
+               " Discarding".format(remote_addr[0],
+                                    remote_addr[1],
+                                    ex))
+        log.warning(msg)
+    finally:
+        # Close the socket as we are done with it.
+        log.debug("Closing socket...")
+        sock.close()
+    log.debug("Done.")
+
+
+def iter_requests(sock, idle_timeout):
+    """
+    Reads the request messages a client sends on a connection, which may be
+    either framed messages or a single legacy "key:value\\n" message.
+
+    :param sock: The socket connected to the client.
+    :param idle_timeout: Number of seconds to wait for another framed request
+                         once one has been served.
+    :return: A generator of (version, fields) tuples. The version is 0 for a
+             legacy message. It finishes when the client closes the connection
+             or is idle for idle_timeout.
+    """
+    # Configure logging
+    log = logging.getLogger("{}".format(threading.current_thread().name))
+
+    decoder = MortProtocol.FrameDecoder()
+    first_read = True
+    while True:
+        try:
+            data = sock.recv(max(decoder.pending() or 0, 16384))
+        except socket.timeout:
+            if first_read or decoder.buffer:
+                raise
+            log.debug("Connection idle for {} seconds.".format(idle_timeout))
+            return
+        if not data:
+            if decoder.buffer:
+                raise MortProtocol.ProtocolError("Connection closed part way through a request")
+            log.debug("Connection closed by client.")
+            return
+
+        if first_read and not MortProtocol.is_framed(data):
+            # :NOTE: Legacy clients send the whole (small) request in one go and
+            #        then wait for the response without closing their end, so
+            #        there is no way to tell the request is complete other than
+            #        taking what the first read returns.
+            yield 0, MortProtocol.decode_legacy(data)
+            return
+        first_read = False
+
+        for message in decoder.feed(data):
+            yield message
+            sock.settimeout(idle_timeout)
+
+
+def active_sessions_response(active_sessions, version, client_version):
+    """
+    Prepares the response to a request for the list of active sessions.
+
+    :param active_sessions: The list of session dictionaries.
+    :param version: The version tag of the list.
+    :param client_version: The version tag of the list the client already has,
+                           or None.
+    :return: A dictionary of the response message fields.
+    """
+    # Configure logging
+    log = logging.getLogger("{}".format(threading.current_thread().name))
+
+    if client_version == version:
+        # The client already has this list, so just tell it so.
+        log.debug("Active sessions not modified since version {}".format(version))
+        return {"msg_type": "active_sessions_not_modified",
+                "version": version}
+
+    # Encode the list of active sessions as JSON and send it to the client.
+    log.debug("Preparing response message...")
+    active_sessions_json = json.dumps(active_sessions)
+    return {"msg_type": "active_sessions_list",
+            "active_sessions": active_sessions_json,
+            "version": version}
+
+
+def subscribe_sessions(msg_fields, remote_addr, push):
+    """
+    Subscribes a client to the sessions starting and ending on this host.
+
+    :param msg_fields: A dictionary of the subscribe_sessions message fields.
+    :param remote_addr: The (ip address, port) tuple of the client.
+    :param push: A callable that sends a dictionary of message fields to the
+                 client. Called from whichever thread notices the change, so
+                 it must not block.
+    :return: A (resp, cancel) tuple. resp is a dictionary of the response
+             message fields, as for get_active_sessions, which must be sent
+             before any pushed message. cancel is a callable that ends the
+             subscription.
+    """
+    # Configure logging
+    log = logging.getLogger("{}".format(threading.current_thread().name))
+    log.info("Subscribing {0}:{1} to session events".format(remote_addr[0], remote_addr[1]))
+
+    def listener(event, session, version):
+        push({"msg_type": "session_event",
+              "event": event,
+              "session": json.dumps(session),
+              "version": version})
+
+    active_sessions, version = session_inventory.subscribe(listener)
+    resp = active_sessions_response(active_sessions, version, msg_fields.get("version"))
+    return resp, functools.partial(session_inventory.unsubscribe, listener)
+
+
+def serve_subscription(sock, remote_addr, msg_fields, version, heartbeat_interval):
+    """
+    Sends a subscribed client the session events, or a heartbeat if there
+    are none for heartbeat_interval seconds, until it closes the connection.
+
+    :param sock: The socket connected to the client.
+    :param remote_addr: The (ip address, port) tuple of the client.
+    :param msg_fields: A dictionary of the subscribe_sessions message fields.
+    :param version: The protocol version the client spoke.
+    :param heartbeat_interval: Number of seconds the client may go without a
+                               message before it is sent a heartbeat.
+    """
+    # Configure logging
+    log = logging.getLogger("{}".format(threading.current_thread().name))
+
+    # :NOTE: A subscriber holds its connection and thread for as long as it
+    #        likes, so only so many are served at once.
+    if not subscription_slots.acquire(blocking=False):
+        log.warning("Refusing subscription from {0}:{1}."
+                    " Already serving the most subscriptions.".format(remote_addr[0], remote_addr[1]))
+        resp = MortProtocol.error_response(MortProtocol.BUSY)
+        if "request_id" in msg_fields:
+            resp["request_id"] = msg_fields["request_id"]
+        sock.sendall(MortProtocol.encode_response(resp, version))
         return
-    else:
-        log.debug("Received {0} bytes".format(len(msg)))
-        msg = msg.decode('utf8')
 
-    # Break the message down into its key/value pairs
-    log.debug("Parsing message...")
-    msg_lines = msg.splitlines()
-    msg_fields = {}
-    for msg_line in msg_lines:
-        msg_field = msg_line.split(':', 1)
-        msg_fields[msg_field[0]] = msg_field[1]
+    try:
+        events = queue.Queue()
+        resp, cancel = subscribe_sessions(msg_fields, remote_addr, events.put)
+        try:
+            if "request_id" in msg_fields:
+                resp["request_id"] = msg_fields["request_id"]
+            sock.sendall(MortProtocol.encode_response(resp, version))
+            last_sent = time.monotonic()
+            while True:
+                try:
+                    event = events.get(timeout=1.0)
+                except queue.Empty:
+                    # Check whether the client has gone away. Anything it sends
+                    # on a subscribed connection is ignored.
+                    robj, wobj, xobj = select.select([sock], [], [], 0)
+                    if robj and not sock.recv(16384):
+                        log.debug("Subscriber closed the connection.")
+                        return
+                    if time.monotonic() - last_sent < heartbeat_interval:
+                        continue
+                    event = {"msg_type": MortProtocol.HEARTBEAT}
+                sock.sendall(MortProtocol.encode_response(event, version))
+                last_sent = time.monotonic()
+        finally:
+            cancel()
+    finally:
+        subscription_slots.release()
+
+
+async def await_start_job(msg_fields, remote_addr):
+    """
+    Answers a get_start_job request on the asyncio event loop. The wait for
+    the job to finish is spent on the loop rather than a worker thread, so
+    clients following their starts don't hold up the other requests.
+
+    :param msg_fields: A dictionary of the get_start_job message fields.
+    :param remote_addr: The (ip address, port) tuple of the client.
+    :return: A dictionary of the response message fields, as for handle_request().
+    """
+    try:
+        wait = min(float(msg_fields.get("wait", 0)), start_jobs.max_wait)
+        job_id = msg_fields["job_id"]
+    except (KeyError, ValueError):
+        # Let handle_request() turn it down.
+        return handle_request(msg_fields, remote_addr)
+
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+
+    def set_finished():
+        if not finished.done():
+            finished.set_result(None)
+
+    cancel = start_jobs.when_finished(job_id, lambda: loop.call_soon_threadsafe(set_finished))
+    if cancel is not None:
+        try:
+            await asyncio.wait_for(finished, wait)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            cancel()
+    # The job has finished or the wait is up, so this doesn't block.
+    return handle_request(dict(msg_fields, wait="0"), remote_addr)
+
+
+def handle_request(msg_fields, remote_addr):
+    """
+    Carries out a request from a client.
+
+    :param msg_fields: A dictionary of the request message fields.
+    :param remote_addr: The (ip address, port) tuple of the client.
+    :return: A dictionary of the response message fields. A request that is
+             malformed or of an unknown type gets an error response (see
+             MortProtocol.error_response()), so that a client waiting for the
+             response isn't left waiting until it times out.
+    """
+    # Configure logging
+    log = logging.getLogger("{}".format(threading.current_thread().name))
 
     # Check for the existance of a msg_type field, and if one exists, decode
     # it and carry out the requested operation.
-    # Prepare a response message if necessary.
-    resp = None
+    # Prepare a response message.
     if "msg_type" in msg_fields.keys():
         log.debug("Message type: {}".format(msg_fields["msg_type"]))
 
-        if msg_fields["msg_type"] == "get_active_sessions":
-            # Get a list of all the Xvnc processes running
-            active_sessions = get_xvnc_process_info()
-            # Encode the list of active sessions as JSON and send it to the client.
-            log.debug("Preparing response message...")
-            active_sessions_json = json.dumps(active_sessions)
-            resp = ("msg_type:active_sessions_list\n"
-                    "active_sessions:{0}\n".format(active_sessions_json))
+        if msg_fields["msg_type"] == "batch":
+            # Carry out each operation in turn and send back all of their
+            # responses in one message, in the same order.
+            # :NOTE: Batches may not be nested.
+            try:
+                operations = json.loads(msg_fields["operations"])
+                if not isinstance(operations, list):
+                    raise ValueError
+            except (KeyError, ValueError):
+                msg = ("Invalid batch message from {0}:{1}."
+                       " Missing or invalid operations field."
+                       " Discarding".format(remote_addr[0],
+                                            remote_addr[1]))
+                log.warning(msg)
+                resp = MortProtocol.error_response("missing or invalid operations")
+            else:
+                log.debug("Batch of {} operations".format(len(operations)))
+                results = []
+                for operation in operations:
+                    if not isinstance(operation, dict) or operation.get("msg_type") == "batch":
+                        results.append(MortProtocol.error_response("invalid operation"))
+                    else:
+                        results.append(handle_request(operation, remote_addr))
+                resp = {"msg_type": "batch_response",
+                        "results": json.dumps(results)}
+
+        elif msg_fields["msg_type"] == "ping":
+            # Used by clients to check a kept-alive connection is still open.
+            resp = {"msg_type": "pong"}
+
+        elif msg_fields["msg_type"] == "get_active_sessions":
+            # Get a list of all the Xvnc processes running, which may be up
+            # to max_staleness seconds old.
+            active_sessions, version = session_inventory.get_versioned()
+            log.debug("Session inventory reads: {}".format(session_inventory.stats()))
+            resp = active_sessions_response(active_sessions, version, msg_fields.get("version"))
+
+        elif msg_fields["msg_type"] == "start_active_session" and "username" not in msg_fields:
+            msg = ("Invalid message from {0}:{1}."
+                   " Missing username value."
+                   " Discarding".format(remote_addr[0],
+                                        remote_addr[1]))
+            log.warning(msg)
+            resp = MortProtocol.error_response("missing username")
 
         elif msg_fields["msg_type"] == "start_active_session":
-            # Pull out the params to call vncserver with
-
-            # Confirm there are no vncservers running with the requested display
-            active_sessions = get_xvnc_process_info()
-            for session in active_sessions:
-                if session["display_number"] == msg_fields["display_number"]:
-                    log.debug("Found session already running on display {}".format(msg_fields["display_number"]))
-                    resp = ("msg_type:start_active_session_response\n"
-                            "outcome:display in use\n")
-                    break
+            # Pick the display and reserve it for the start. The display is
+            # the one asked for, if any, otherwise the one leased, if any,
+            # otherwise the lowest free one.
+            # :NOTE: The display allocator checks the displays in use and
+            #        reserves the display under one lock, so concurrent starts
+            #        can't pick the same display.
+            display_number = msg_fields.get("display_number") or None
+            entry = None
+            if display_number is None:
+                # Hand over an idle server of the warm pool if one fits,
+                # which is near instant.
+                entry = warm_pool.claim(msg_fields["username"],
+                                        msg_fields.get("display_name", ""),
+                                        msg_fields.get("geometry", ""),
+                                        msg_fields.get("pixelformat", ""))
+            if entry is not None:
+                display_allocator.release(msg_fields.get("lease_id"))
+                resp = {"msg_type": "start_active_session_response",
+                        "outcome": "success",
+                        "display_number": entry.display_number,
+                        "pid": entry.pid,
+                        "state": StartJobTracker.READY}
+            else:
+                job = display_allocator.claim(lambda chosen: start_jobs.reserve(dict(msg_fields, display_number=chosen)),
+                                              display_number,
+                                              msg_fields.get("lease_id"))
+                if job is None:
+                    if display_number is None:
+                        log.warning("No free display to start a session on.")
+                        resp = {"msg_type": "start_active_session_response",
+                                "outcome": "no free display"}
+                    else:
+                        log.debug("Display {} is in use or already starting".format(display_number))
+                        resp = {"msg_type": "start_active_session_response",
+                                "outcome": "display in use"}
+                else:
+                    msg_fields = dict(msg_fields, display_number=job.display_number)
+                    # :NOTE: Until it is launched, the job holds its display
+                    #        reserved, so a failure before then must fail the
+                    #        job, or the display would never be used again.
+                    try:
+                        if display_number is not None:
+                            # A display asked for by number may have a leftover lock
+                            # or pipe file. (Displays picked by the server never do.)
+                            x_display_lock_file_path = "/tmp/.X{}-lock".format(job.display_number)
+                            if os.path.exists(x_display_lock_file_path):
+                                log.debug("Found X11 lock file @ {}".format(x_display_lock_file_path))
+                                os.remove(x_display_lock_file_path)
+                            x_display_pipe_file_path = "/tmp/.X11-unix/X{}".format(job.display_number)
+                            if os.path.exists(x_display_pipe_file_path):
+                                log.debug("Found X11 pipe file @ {}".format(x_display_pipe_file_path))
+                                os.remove(x_display_pipe_file_path)
+                        # Start a new VNC server in the background.
+                        # :NOTE: The response is sent straight away. Clients follow
+                        #        the start with get_start_job requests.
+                        start_jobs.launch(job, msg_fields)
+                    except Exception as ex:
+                        log.exception("Could not launch start job {}".format(job.job_id))
+                        start_jobs.set_state(job, StartJobTracker.FAILED, error="Could not launch: {}".format(ex))
+                        resp = {"msg_type": "start_active_session_response",
+                                "outcome": "failed",
+                                "display_number": job.display_number,
+                                "job_id": job.job_id,
+                                "state": job.state,
+                                "error": job.error}
+                    else:
+                        resp = {"msg_type": "start_active_session_response",
+                                "outcome": "success",
+                                "display_number": job.display_number,
+                                "job_id": job.job_id,
+                                "state": job.state}
+
+        elif msg_fields["msg_type"] == "lease_display":
+            # Hold the next free display for the client while its user fills
+            # in the details of a new session.
+            lease = display_allocator.lease()
+            if lease is None:
+                resp = {"msg_type": "lease_display_response",
+                        "outcome": "no free display"}
+            else:
+                resp = {"msg_type": "lease_display_response",
+                        "outcome": "success",
+                        "lease_id": lease[0],
+                        "display_number": lease[1],
+                        "lease_time": str(display_allocator.lease_time)}
+
+        elif msg_fields["msg_type"] == "release_display":
+            # The client no longer needs the display it leased.
+            if "lease_id" in msg_fields:
+                display_allocator.release(msg_fields["lease_id"])
+            resp = {"msg_type": "release_display_response"}
+
+        elif msg_fields["msg_type"] == "get_start_job":
+            # Report the progress of a session start, waiting up to the
+            # requested number of seconds for it to finish.
+            try:
+                job_fields = start_jobs.get(msg_fields["job_id"], float(msg_fields.get("wait", 0)))
+            except (KeyError, ValueError):
+                msg = ("Invalid get_start_job message from {0}:{1}."
+                       " Missing job_id or invalid wait value."
+                       " Discarding".format(remote_addr[0],
+                                            remote_addr[1]))
+                log.warning(msg)
+                resp = MortProtocol.error_response("missing job_id or invalid wait")
             else:
-                # No VNC process is running using the display we want to use.
-                # However, check there is no leftover lock or pipe file.
-                x_display_lock_file_path = "/tmp/.X{}-lock".format(msg_fields["display_number"])
-                if os.path.exists(x_display_lock_file_path):
-                    log.debug("Found X11 lock file @ {}".format(x_display_lock_file_path))
-                    os.remove(x_display_lock_file_path)
-                x_display_pipe_file_path = "/tmp/.X11-unix/X{}".format(msg_fields["display_number"])
-                if os.path.exists(x_display_pipe_file_path):
-                    log.debug("Found X11 pipe file @ {}".format(x_display_pipe_file_path))
-                    os.remove(x_display_pipe_file_path)
-                # Start a new VNC server
-                log.debug("Creating VNC server for user: {}, disp: {}, name: {}, geo: {}, pf: {}".format(msg_fields["username"],
-                                                                                                         msg_fields["display_number"],
-                                                                                                         msg_fields["display_name"],
-                                                                                                         msg_fields["geometry"],
-                                                                                                         msg_fields["pixelformat"]))
-                new_server = CreateNewVNCServer.CreateNewVNCServer("create_new_vnc_server",
-                                                                   msg_fields["username"],
-                                                                   msg_fields["display_number"],
-                                                                   msg_fields["display_name"],
-                                                                   msg_fields["geometry"],
-                                                                   msg_fields["pixelformat"])
-                new_server.start()
-                resp = ("msg_type:start_active_session_response\n"
-                        "outcome:success\n")
+                if job_fields is None:
+                    job_fields = {"job_id": msg_fields["job_id"],
+                                  "state": "unknown"}
+                resp = dict(job_fields, msg_type="start_job_status")
 
         elif msg_fields["msg_type"] == "kill_active_session":
             # Get the PID of the Xvnc process to kill from the message
             if "pid" in msg_fields:
                 # Get a list of all the Xvnc processes running
-                active_sessions = get_xvnc_process_info()
+                # :NOTE: A fresh list is used here, so a PID that has since been
+                #        reused by another process isn't killed.
+                active_sessions = session_inventory.get(max_age=0)
                 # Confirm it is an Xvnc process that is active
                 pid = msg_fields["pid"]
                 for active_session in active_sessions:
                     if active_session["pid"] == pid:
                         # Kill it
-                        os.kill(int(pid), signal.SIGKILL)
+                        try:
+                            os.kill(int(pid), signal.SIGKILL)
+                        except ProcessLookupError:
+                            # It exited since the list was made.
+                            continue
+                        session_inventory.killed(pid)
                         # Prepare response message to confirm the process was killed.
-                        resp = ("msg_type:kill_active_session_response\n"
-                                "outcome:killed\n")
+                        resp = {"msg_type": "kill_active_session_response",
+                                "outcome": "killed"}
                         break
                 else:
                     # An Xvnc process with the requested PID was not found so
                     # nothing to kill (no work to do).
                     # Prepare response message for the client to explain this.
-                    resp = ("msg_type:kill_active_session_response\n"
-                            "outcome:process not found\n")
+                    resp = {"msg_type": "kill_active_session_response",
+                            "outcome": "process not found"}
 
             else:
                 msg = ("Invalid message from {0}:{1}."
@@ -348,6 +800,7 @@ def handle_socket_task(sock, remote_addr):
                        " Discarding".format(remote_addr[0],
                                             remote_addr[1]))
                 log.warning(msg)
+                resp = MortProtocol.error_response("missing pid")
 
 
         else:
@@ -357,6 +810,7 @@ def handle_socket_task(sock, remote_addr):
                    " Discarding".format(remote_addr[0],
                                         remote_addr[1]))
             log.warning(msg)
+            resp = MortProtocol.error_response("unknown msg_type")
     else:
         # Discard message; no msg_type field found.
         msg = ("Invalid message from {0}:{1}."
@@ -364,28 +818,8 @@ def handle_socket_task(sock, remote_addr):
                " Discarding".format(remote_addr[0],
                                     remote_addr[1]))
         log.warning(msg)
-
-    # If a response was generated, attempt to send it
-    try:
-        if resp is not None:
-            log.debug("Sending response message...")
-            sock.sendall(resp.encode('utf8'))
-    except OSError as ex:
-        msg = ("Could not send response message back to client."
-               " IP Address: {0}"
-               " Port: {1}"
-               " Error No: {2}"
-               " Error Msg: {3}".format(remote_addr[0],
-                                        remote_addr[1],
-                                        ex.errno,
-                                        ex.strerror))
-        log.critical(msg)
-        return
-
-    # Close the socket as we are done with it.
-    log.debug("Closing socket...")
-    sock.close()
-    log.debug("Done.")
+        resp = MortProtocol.error_response("missing msg_type")
+    return resp
 
 
 if __name__ == "__main__":